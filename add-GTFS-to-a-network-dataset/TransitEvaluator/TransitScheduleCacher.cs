@@ -54,6 +54,7 @@ namespace TransitEvaluator
 
                     bool hasCalendar = false;
                     bool hasCalendarDates = false;
+                    bool hasFrequencySchedules = false;
 
                     // Check that the SQL database contains the necessary tables
                     using (SQLiteCommand cmd = new SQLiteCommand(conn))
@@ -69,6 +70,7 @@ namespace TransitEvaluator
                             Existing_tbls.Add(tblname);
                             if (tblname == "calendar") {hasCalendar = true;}
                             else if (tblname == "calendar_dates") {hasCalendarDates = true;}                           
+                            else if (tblname == "frequency_schedules") {hasFrequencySchedules = true;}
                         }
 
                         if (!hasCalendar && !hasCalendarDates)
@@ -111,7 +113,14 @@ namespace TransitEvaluator
                         cmd.CommandText = "SELECT COUNT(*) from linefeatures";
                         linefeatures_count = Convert.ToInt32(cmd.ExecuteScalar()); // Cannot be 0
                         cmd.CommandText = "SELECT COUNT(*) from schedules";
-                        int schedules_count = Convert.ToInt32(cmd.ExecuteScalar()); // Cannot be 0
+                        int schedules_count = Convert.ToInt32(cmd.ExecuteScalar());
+                        int frequency_schedules_count = 0;
+                        if (hasFrequencySchedules)
+                        {
+                            // Networks created before this table was added have all the frequencies.txt trips in schedules
+                            cmd.CommandText = "SELECT COUNT(*) from frequency_schedules";
+                            frequency_schedules_count = Convert.ToInt32(cmd.ExecuteScalar());
+                        } // schedules and frequency_schedules cannot both be 0
 
                         if (trip_count == 0 || linefeatures_count == 0)
                         {
@@ -123,13 +132,13 @@ namespace TransitEvaluator
                             // If both calendar and calendar_dates are empty, something went horrendously wrong.
                             throw new Exception("Transit schedules cannot be cached because your SQL database is missing calendar information.  Please check that your GTFS data contains either a calendar or a calendar_dates file (or both) and re-create your network using the Add GTFS to a Network Dataset toolbox.");
                         }
-                        if (schedules_count == 0)
+                        if (schedules_count == 0 && frequency_schedules_count == 0)
                         {
                             // If the schedules table is empty, something got messed up in Step 1, or they're using an old network or something
                             throw new Exception("Transit schedules cannot be cached because your SQL database is missing schedule information. Please re-create your network using the Add GTFS to a Network Dataset toolbox.");
                         }
 
-                        total_row_count = trip_count + calendar_count + calendar_dates_count + linefeatures_count + schedules_count;
+                        total_row_count = trip_count + calendar_count + calendar_dates_count + linefeatures_count + schedules_count + frequency_schedules_count;
                         // Update the progress form with the total number of rows
                         if (setTotalRowCount != null)
                             setTotalRowCount();
@@ -208,6 +217,21 @@ namespace TransitEvaluator
                         CacheTripInstances(ref reader, ref processedRowCount, timeSoFar,
                             ref current_table_name, displayTableName, updateTimeUI, ref eids, ref linefeatures);
                     }
+
+                    /////////////////////////////////////////////////
+                    //  Process the frequency_schedules table (trip instances of frequencies.txt trips, one row per time window)
+                    if (hasFrequencySchedules)
+                    {
+                        using (SQLiteCommand cmd = new SQLiteCommand(conn))
+                        {
+                            SQLiteDataReader reader;
+                            current_table_name = "frequency_schedules";
+                            cmd.CommandText = String.Format("SELECT * from {0}", current_table_name);
+                            reader = cmd.ExecuteReader();
+                            CacheFrequencyTripInstances(ref reader, ref processedRowCount, timeSoFar,
+                                ref current_table_name, displayTableName, updateTimeUI, ref eids, ref linefeatures);
+                        }
+                    }
                 }
 
                 caching_complete = true;
@@ -488,6 +512,66 @@ namespace TransitEvaluator
             }
         }
 
+        private static void CacheFrequencyTripInstances(ref SQLiteDataReader reader,
+            ref int processedRowCount, Stopwatch timeSoFar,
+            ref string current_table_name, Action displayTableName, Action<int, Stopwatch> updateTimeUI,
+            ref Dictionary<long, List<trip_instance>> eids,
+            ref Dictionary<long, long> linefeatures)
+        {
+            // Update the table name shown on the progress form
+            if (displayTableName != null)
+                displayTableName();
+
+            // Loop through the time windows and add a trip instance for every departure in the window
+            // to the same dictionary keyed by EID as the schedules table.
+            try
+            {
+                while (reader.Read())
+                {
+                    ++processedRowCount;
+                    if (updateTimeUI != null)
+                        updateTimeUI(processedRowCount, timeSoFar);
+
+                    long SourceOID = Convert.ToInt64(reader["SourceOID"].ToString());
+                    long EID;
+                    try{EID = linefeatures[SourceOID];}
+                    catch
+                    {
+                        // Same as for the schedules table. Skip line features with no EID.
+                        continue;
+                    }
+
+                    string trip_id = reader["trip_id"].ToString();
+                    int window_start = Convert.ToInt32(reader["window_start"].ToString());
+                    int window_end = Convert.ToInt32(reader["window_end"].ToString());
+                    int headway_secs = Convert.ToInt32(reader["headway_secs"].ToString());
+                    int start_offset = Convert.ToInt32(reader["start_offset"].ToString());
+                    int end_offset = Convert.ToInt32(reader["end_offset"].ToString());
+                    if (headway_secs <= 0)
+                        continue;
+
+                    if (!eids.ContainsKey(EID))
+                    {
+                        eids.Add(EID, new List<trip_instance>());
+                    }
+                    // The trip departs at window_start, window_start + headway_secs, ... up to (not including) window_end
+                    for (int departure = window_start; departure < window_end; departure += headway_secs)
+                    {
+                        trip_instance TI = new trip_instance();
+                        TI.trip_id = trip_id;
+                        TI.start_time = departure + start_offset;
+                        TI.end_time = departure + end_offset;
+                        eids[EID].Add(TI);
+                    }
+                }
+
+            }
+            catch (Exception e)
+            {
+                throw new Exception("Error caching frequency trip instances table. Error: " + e.Message, e);
+            }
+        }
+
         #endregion
 
         #endregion
@@ -0,0 +1,82 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+''' Accessibility Counts
+
+Counts how many times each destination is reached from each origin over the
+OD Cost Matrix solves of Calculate Accessibility Matrix, and calculates the
+tool's statistics for all origins at once.
+
+The counts are a sparse matrix of origins by destinations, stored as sorted
+arrays of pair keys (origin index * number of destinations + destination
+index) and counts, so only the pairs that were reached take up memory. The OD
+lines of each solve are added as arrays of OriginID and DestinationID.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import numpy as np
+
+# Percentages of start times for the "reachable at least x% of the time" statistics
+Thresholds = range(10, 100, 10)
+
+
+class ODCounts(object):
+    '''The number of times each destination was reached from each origin.
+    origin_oids and destination_oids are the ObjectIDs of the Origins and
+    Destinations sublayers, which the OriginID and DestinationID of the OD
+    lines refer to. The origins and destinations are indexed in sorted ObjectID
+    order (self.origin_oids and self.destination_oids).'''
+
+    def __init__(self, origin_oids, destination_oids):
+        self.origin_oids = np.unique(np.asarray(origin_oids, dtype=np.int64))
+        self.destination_oids = np.unique(np.asarray(destination_oids, dtype=np.int64))
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def AddLines(self, origin_ids, destination_ids, weight=1):
+        '''Count weight more times for each OD line, given as arrays of OriginID
+        and DestinationID. An OD pair must only appear once per solve. The
+        weight is the number of start times the solve stands for.'''
+        origins = np.searchsorted(self.origin_oids, np.asarray(origin_ids, dtype=np.int64))
+        destinations = np.searchsorted(self.destination_oids, np.asarray(destination_ids, dtype=np.int64))
+        keys = np.concatenate((self.keys, origins * len(self.destination_oids) + destinations))
+        counts = np.concatenate((self.counts, np.empty(len(origins), dtype=np.int64)))
+        counts[len(self.counts):] = weight
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+    def Statistics(self, num_times, destination_weights=None):
+        '''Return (total, threshold_totals) for the origins, in self.origin_oids
+        order. total is the number of destinations ever reached from each
+        origin. threshold_totals has one row per origin and one column per
+        value in Thresholds: the number of destinations reached at least that
+        percentage of the num_times start times. If destination_weights (an array
+        in self.destination_oids order) is given, the weights of the
+        destinations are added up instead of counting them.'''
+        num_origins = len(self.origin_oids)
+        origins = self.keys // len(self.destination_oids)
+        weights = None
+        if destination_weights is not None:
+            weights = np.asarray(destination_weights, dtype=np.float64)[self.keys % len(self.destination_oids)]
+        total = np.bincount(origins, weights=weights, minlength=num_origins)
+
+        # The number of thresholds each OD pair meets, totaled by origin, then
+        # accumulated from the highest threshold down.
+        percent_of_times_reachable = (self.counts.astype(np.float64) / float(num_times)) * 100
+        thresholds_met = np.searchsorted(np.array(Thresholds, dtype=np.float64), percent_of_times_reachable, "right")
+        num_columns = len(Thresholds) + 1
+        by_thresholds_met = np.bincount(origins * num_columns + thresholds_met, weights=weights,
+                                        minlength=num_origins * num_columns).reshape(num_origins, num_columns)
+        threshold_totals = np.cumsum(by_thresholds_met[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        return total, threshold_totals
@@ -17,8 +17,23 @@
    limitations under the License.'''
 ################################################################################
 
+import bisect
 import datetime
+import math
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
 import arcpy
+import FrequencySchedules
+import TimeOfDaySolving
+
+# Adaptive times of day assume nobody walks faster than this, so the departures
+# that can change the results are at stops within cutoff * speed of the study area
+ADAPTIVE_WALK_METERS_PER_MINUTE = 100.0
+METERS_PER_DEGREE_LAT = 111320.0
 
 def make_analysis_time_of_day_list(start_day_input, end_day_input, start_time_input, end_time_input, increment_input):
     '''Make a list of datetimes to use as input for a network analysis time of day run in a loop'''
@@ -96,4 +111,314 @@ Please use either a specific date or a generic weekday for both Start Date and E
         raise
 
     return start_time, end_time
- 
\ No newline at end of file
+ 
+
+
+def get_num_workers():
+    '''Return the number of worker processes to solve with, from the Parallel Processing Factor
+    environment setting: a number of processes, a percentage of the computer's cores, or empty for 1.'''
+    factor = arcpy.env.parallelProcessingFactor
+    if not factor:
+        return 1
+    factor = str(factor).strip()
+    if factor.endswith("%"):
+        num_workers = int(multiprocessing.cpu_count() * float(factor[:-1]) / 100)
+    else:
+        num_workers = int(float(factor))
+    return max(num_workers, 1)
+
+
+def prepare_worker_layer(input_network_analyst_layer, num_workers):
+    '''Return the network analysis layer for a TimeOfDaySolver. If solving in parallel, the layer, with
+    all its loaded locations, is saved to a layer file in a new scratch folder so each worker process can
+    load its own copy, and the path to the layer file is returned instead.'''
+    if num_workers <= 1:
+        return input_network_analyst_layer
+    if sys.platform == "win32":
+        # The worker processes must be started with python, not the ArcGIS application.
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+    scratch_folder = tempfile.mkdtemp(prefix="TimeOfDay_", dir=arcpy.env.scratchFolder)
+    layer_file = os.path.join(scratch_folder, "NALayer.lyr")
+    arcpy.management.SaveToLayerFile(input_network_analyst_layer, layer_file, "ABSOLUTE")
+    return layer_file
+
+
+def clean_up_worker_layer(layer):
+    '''Delete the scratch folder created by prepare_worker_layer, if any.'''
+    if isinstance(layer, basestring):
+        shutil.rmtree(os.path.dirname(layer), ignore_errors=True)
+
+
+class ArcpyTimeOfDaySolver(TimeOfDaySolving.TimeOfDaySolver):
+    '''Solve a network analysis layer at a time of day. layer is the layer object, or the path to a
+    layer file from prepare_worker_layer when solving in worker processes, which load their own copy.'''
+
+    def __init__(self, layer):
+        self.layer = layer
+
+    def setup(self):
+        if isinstance(self.layer, basestring):
+            # Worker processes don't inherit the environment settings or license checkouts.
+            arcpy.env.overwriteOutput = True
+            arcpy.CheckOutExtension("Network")
+            self.layer = arcpy.mapping.Layer(self.layer)
+        self.solver_props = arcpy.na.GetSolverProperties(self.layer)
+
+    def sublayer(self, name):
+        return arcpy.mapping.ListLayers(self.layer, name)[0]
+
+    def solve_layer(self, time_of_day):
+        self.solver_props.timeOfDay = time_of_day
+        arcpy.na.Solve(self.layer)
+
+
+class ODCostMatrixTimeSolver(ArcpyTimeOfDaySolver):
+    '''Solve an OD Cost Matrix layer and return the OriginID and DestinationID of its lines as a NumPy
+    array, or None if no destinations were reachable.'''
+
+    def __init__(self, layer, lines_sublayer_name):
+        ArcpyTimeOfDaySolver.__init__(self, layer)
+        self.lines_sublayer_name = lines_sublayer_name
+
+    def setup(self):
+        ArcpyTimeOfDaySolver.setup(self)
+        self.lines_subLayer = self.sublayer(self.lines_sublayer_name)
+
+    def solve(self, time_of_day):
+        try:
+            self.solve_layer(time_of_day)
+        except:
+            # Solve failed.  It could be that no destinations were reachable within the time limit,
+            # or it could be another error.  Running out of memory is a distinct possibility.
+            errs = arcpy.GetMessages(2)
+            if "No solution found" not in errs:
+                # Only alert them if it's some weird error.
+                raise TimeOfDaySolving.SolveError(errs)
+            return None
+        return arcpy.da.TableToNumPyArray(self.lines_subLayer, ["OriginID", "DestinationID"])
+
+
+class ServiceAreaTimeSolver(ArcpyTimeOfDaySolver):
+    '''Solve a Service Area layer and stamp its polygons with the time of day in time_field. Returns
+    the polygons sublayer, or, in a worker process, a copy of the polygons in the worker's own scratch
+    geodatabase.'''
+
+    def __init__(self, layer, polygons_sublayer_name, time_field):
+        ArcpyTimeOfDaySolver.__init__(self, layer)
+        self.polygons_sublayer_name = polygons_sublayer_name
+        self.time_field = time_field
+        self.scratch_gdb = None
+
+    def setup(self):
+        if isinstance(self.layer, basestring):
+            scratch_folder = tempfile.mkdtemp(prefix="Worker_", dir=os.path.dirname(self.layer))
+            self.scratch_gdb = arcpy.management.CreateFileGDB(scratch_folder, "Polygons.gdb").getOutput(0)
+        ArcpyTimeOfDaySolver.setup(self)
+        self.polygons_subLayer = self.sublayer(self.polygons_sublayer_name)
+
+    def solve(self, time_of_day):
+        self.solve_layer(time_of_day)
+        expression = '"' + str(time_of_day) + '"' # Unclear why a DATE field requires a string expression, but it does.
+        arcpy.management.CalculateField(self.polygons_subLayer, self.time_field, expression, "PYTHON_9.3")
+        if not self.scratch_gdb:
+            return self.polygons_subLayer
+        polygons = os.path.join(self.scratch_gdb, "Polygons_" + time_of_day.strftime("%Y%m%d_%H%M%S"))
+        arcpy.management.CopyFeatures(self.polygons_subLayer, polygons)
+        return polygons
+
+
+def get_adaptive_max_gap(parameter_index):
+    '''Return the tool's optional Maximum Time Between Solves (minutes) parameter at parameter_index as a
+    timedelta, or None if it is empty, meaning every time of day is solved. Solving at fewer times of day is
+    turned on by giving this value (see make_adaptive_time_of_day_list).'''
+    if arcpy.GetArgumentCount() <= parameter_index:
+        return None
+    max_gap = arcpy.GetParameterAsText(parameter_index)
+    if not max_gap:
+        return None
+    return datetime.timedelta(minutes=float(max_gap))
+
+
+def get_layer_cutoff(input_network_analyst_layer):
+    '''Return the largest default cutoff (OD Cost Matrix) or break (Service Area) of the network analysis
+    layer as a timedelta, or None if it has none. The cutoff is assumed to be in minutes, as the User's
+    Guide asks for.'''
+    solverProps = arcpy.na.GetSolverProperties(input_network_analyst_layer)
+    if hasattr(solverProps, "defaultBreaks"):
+        cutoffs = solverProps.defaultBreaks
+        if isinstance(cutoffs, basestring):
+            cutoffs = cutoffs.split()
+    else:
+        cutoffs = [solverProps.defaultCutoff]
+    cutoffs = [float(cutoff) for cutoff in cutoffs if cutoff is not None and float(cutoff) > 0]
+    if not cutoffs:
+        return None
+    return datetime.timedelta(minutes=max(cutoffs))
+
+
+def get_study_area(points, distance_meters):
+    '''Return the (min lon, min lat, max lon, max lat) of the points in a feature class or layer, expanded by
+    distance_meters, or None if there are no points.'''
+    lons = []
+    lats = []
+    with arcpy.da.SearchCursor(points, ["SHAPE@XY"], spatial_reference=arcpy.SpatialReference(4326)) as cur:
+        for row in cur:
+            if row[0][0] is not None:
+                lons.append(row[0][0])
+                lats.append(row[0][1])
+    if not lons:
+        return None
+    dlat = distance_meters / METERS_PER_DEGREE_LAT
+    max_abs_lat = min(max(abs(min(lats) - dlat), abs(max(lats) + dlat)), 89.0)
+    dlon = dlat / math.cos(math.radians(max_abs_lat))
+    return min(lons) - dlon, min(lats) - dlat, max(lons) + dlon, max(lats) + dlat
+
+
+def read_departure_times(SQLDbase, study_area):
+    '''Return a sorted list of the distinct departure times (seconds since midnight, possibly past 24:00) of
+    all trips from the stops in the study area (see get_study_area) in the GTFS SQL database, or None if they
+    can't be read. The departures are read from the schedules table, and from the frequency_schedules table
+    for trips using frequencies.txt, as the start_time of each trip on the transit lines leaving the stops.
+    Trips of every service_id are included, which can only add departures.'''
+    xmin, ymin, xmax, ymax = study_area
+    conn = sqlite3.connect(SQLDbase)
+    try:
+        c = conn.cursor()
+        c.execute('''CREATE TEMP TABLE StudyAreaStops AS SELECT stop_id FROM stops
+                     WHERE stop_lon BETWEEN ? AND ? AND stop_lat BETWEEN ? AND ?;''', (xmin, xmax, ymin, ymax))
+        c.execute('''CREATE TEMP TABLE StudyAreaLines AS SELECT SourceOID FROM linefeatures
+                     WHERE from_stop IN (SELECT stop_id FROM temp.StudyAreaStops);''')
+
+        # Trips with regular schedules
+        c.execute('''SELECT DISTINCT start_time FROM schedules
+                     WHERE SourceOID IN (SELECT SourceOID FROM temp.StudyAreaLines);''')
+        departure_times = set(row[0] for row in c)
+
+        # Trips using frequencies.txt
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (FrequencySchedules.TableName,))
+        if c.fetchone():
+            c.execute('''SELECT trip_id, window_start, window_end, headway_secs, start_offset, end_offset
+                         FROM frequency_schedules
+                         WHERE SourceOID IN (SELECT SourceOID FROM temp.StudyAreaLines);''')
+            for window in c.fetchall():
+                departure_times.update(start_time for trip_id, start_time, end_time in
+                                       FrequencySchedules.ExpandDepartures(window))
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return sorted(departure_times)
+
+
+def read_arrival_times(SQLDbase):
+    '''Return a sorted list of the distinct arrival times (seconds since midnight, possibly past 24:00) of all
+    trips at all stops in the GTFS SQL database, or None if they can't be read. The arrivals are the end_time
+    of each trip on each transit line, from the schedules and frequency_schedules tables. There are at most
+    as many distinct times as seconds in the service day, however many trips there are.'''
+    conn = sqlite3.connect(SQLDbase)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT end_time FROM schedules;")
+        arrival_times = set(row[0] for row in c)
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (FrequencySchedules.TableName,))
+        if c.fetchone():
+            c.execute('''SELECT trip_id, window_start, window_end, headway_secs, start_offset, end_offset
+                         FROM frequency_schedules;''')
+            for window in c.fetchall():
+                arrival_times.update(end_time for trip_id, start_time, end_time in
+                                     FrequencySchedules.ExpandDepartures(window))
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return sorted(arrival_times)
+
+
+def make_adaptive_time_of_day_list(timelist, departure_times, arrival_times, max_walk_time, cutoff,
+                                   max_gap=None):
+    '''Choose the times of day in timelist (from make_analysis_time_of_day_list) to solve at, based on the
+    departure times from read_departure_times and the arrival times from read_arrival_times.
+
+    With a start time of t, a traveler who walks w (at most max_walk_time, a timedelta) to a stop catches a
+    departure at d if t + w <= d, so the departure can change the results only for start times in
+    [d - max_walk_time, d]. A stop reached at a (by any trip, after any transfers) that is w from a
+    destination is within the cutoff (a timedelta) if a + w <= t + cutoff, so the arrival can change the
+    results only for start times in [a - cutoff, a - cutoff + max_walk_time]. A time in timelist is
+    skipped, and the last solve stands for it, if none of these windows overlaps the time from the last
+    solve to it. The results of the skipped times are then the same as the results of the solve, as long as
+    max_walk_time and cutoff bound the walking and travel times of the analysis, and the departures include
+    every stop the travelers can walk to. If max_gap (a timedelta) is given, the time between solves is also
+    kept within max_gap. That limits how long one solve can stand for, but it is not a bound on the error.
+
+    Returns a list of (time of day, weight), where weight is the number of times in timelist the solve at
+    that time of day stands for: itself and the skipped times after it.'''
+    if not timelist:
+        return []
+
+    # Seconds since midnight of the first day of the analysis
+    first_day = datetime.datetime(timelist[0].year, timelist[0].month, timelist[0].day)
+
+    def seconds(t):
+        return (t - first_day).total_seconds()
+
+    walk = max_walk_time.total_seconds()
+    cut = cutoff.total_seconds()
+
+    # The windows of start times the results can change in, on each day of the analysis, including trips from
+    # the previous day that run past midnight
+    windows = []
+    for day in range(-1, (timelist[-1] - first_day).days + 1):
+        for departure in departure_times:
+            d = day * 86400 + departure
+            windows.append((d - walk, d))
+        for arrival in arrival_times:
+            a = day * 86400 + arrival - cut
+            windows.append((a, a + walk))
+    windows.sort()
+    starts = []
+    ends = []
+    for start, end in windows:
+        if ends and start <= ends[-1]:
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+
+    def may_change(start, end):
+        '''True if a window overlaps the time from start to end (in seconds), inclusive.'''
+        i = bisect.bisect_left(ends, start)
+        return i < len(ends) and starts[i] <= end
+
+    chosen = [0]
+    for i in range(1, len(timelist)):
+        if may_change(seconds(timelist[chosen[-1]]), seconds(timelist[i])):
+            chosen.append(i)
+        elif max_gap is not None and i + 1 < len(timelist) and timelist[i + 1] - timelist[chosen[-1]] > max_gap:
+            # The next time would be too far from the last solve.
+            chosen.append(i)
+    return [(timelist[i], end - i) for i, end in zip(chosen, chosen[1:] + [len(timelist)])]
+
+
+def make_adaptive_time_of_day_list_for_layer(timelist, input_network_analyst_layer, study_points, max_gap):
+    '''Return make_adaptive_time_of_day_list for the departures near the study points (a feature class or
+    layer) and the arrivals at all stops, read from the GTFS.sql database of the network analysis layer's
+    transit network. The layer's cutoff bounds the walking times too. If the layer has no cutoff or the
+    schedules can't be read, every time of day in timelist is solved, with weight 1.'''
+    cutoff = get_layer_cutoff(input_network_analyst_layer)
+    if not cutoff:
+        arcpy.AddWarning("Adaptive times of day need a default cutoff or break value on your network analysis \
+layer. Solving at every time of day.")
+        return [(t, 1) for t in timelist]
+    network = arcpy.Describe(input_network_analyst_layer).network.catalogPath
+    SQLDbase = os.path.join(os.path.dirname(os.path.dirname(network)), "GTFS.sql")
+    study_area = get_study_area(study_points, cutoff.total_seconds() / 60 * ADAPTIVE_WALK_METERS_PER_MINUTE)
+    departure_times = None
+    arrival_times = None
+    if os.path.exists(SQLDbase) and study_area:
+        departure_times = read_departure_times(SQLDbase, study_area)
+        arrival_times = read_arrival_times(SQLDbase)
+    if departure_times is None or arrival_times is None:
+        arcpy.AddWarning("Unable to read the transit schedules for adaptive times of day from %s. \
+Solving at every time of day." % SQLDbase)
+        return [(t, 1) for t in timelist]
+    return make_adaptive_time_of_day_list(timelist, departure_times, arrival_times, cutoff, cutoff, max_gap)
@@ -26,8 +26,12 @@ calculates the percentage of total destinations reachable.'''
    limitations under the License.'''
 ################################################################################
 
+import multiprocessing
 import arcpy
 import AnalysisHelpers
+import AccessibilityCounts
+import Instrumentation
+import TimeOfDaySolving
 arcpy.env.overwriteOutput = True
 
 class CustomError(Exception):
@@ -35,6 +39,12 @@ class CustomError(Exception):
 
 try:
 
+    # Worker processes started by TimeOfDaySolving may import this script. Only run the tool in the main process.
+    if multiprocessing.current_process().name != "MainProcess":
+        raise CustomError
+
+    Instrumentation.StartRun("Calculate Accessibility Matrix")
+
     #Check out the Network Analyst extension license
     if arcpy.CheckExtension("Network") == "Available":
         arcpy.CheckOutExtension("Network")
@@ -66,6 +76,9 @@ try:
     end_time_input = arcpy.GetParameterAsText(7)
     increment_input = arcpy.GetParameter(8)
 
+    # Optional longest time between solves, which turns on solving at fewer times of day
+    max_gap = AnalysisHelpers.get_adaptive_max_gap(9)
+
     # Make sure origins and destinations aren't empty
     empty_error = u"Your %s feature class is empty.  Please choose a feature class containing points you wish to analyze."
     if int(arcpy.management.GetCount(origins_feature_class).getOutput(0)) == 0:
@@ -81,9 +94,20 @@ try:
     except:
         raise CustomError
 
+    # Solve at fewer times of day, skipping the times the transit schedules can't change the results at, if
+    # adaptive times of day are turned on. Each solve stands for one or more of the times in timelist.
+    if max_gap:
+        solve_timelist = AnalysisHelpers.make_adaptive_time_of_day_list_for_layer(
+            timelist, input_network_analyst_layer, origins_feature_class, max_gap)
+        arcpy.AddMessage("Solving at %i of the %i times of day, based on the transit schedules." %
+                         (len(solve_timelist), len(timelist)))
+    else:
+        solve_timelist = [(t, 1) for t in timelist]
+
     
     # ----- Add Origins and Destinations to the OD layer -----
 
+    Instrumentation.StartPhase("Load origins and destinations")
     arcpy.AddMessage("Adding Origins and Destinations to OD Cost Matrix Layer...")
 
     # Get Origins and Destionations Describe objects for later use
@@ -97,7 +121,6 @@ try:
     lines_sublayer_name = sublayer_names["ODLines"]
     origins_subLayer = arcpy.mapping.ListLayers(input_network_analyst_layer, origins_sublayer_name)[0]
     destinations_subLayer = arcpy.mapping.ListLayers(input_network_analyst_layer, destinations_sublayer_name)[0]
-    lines_subLayer = arcpy.mapping.ListLayers(input_network_analyst_layer, lines_sublayer_name)[0]
 
     # Keep track of the ObjectID field of the input
     origins_objectID = origins_desc.OIDFieldName
@@ -139,46 +162,40 @@ try:
 
     # ----- Solve NA layer in a loop for each time of day -----
 
-    # Initialize a dictionary for counting the number of times each destination is reached by each origin
-    OD_count_dict = {} # {Origin OID: {Destination OID: Number of times reached}}
-
-    # Grab the solver properties object from the NA layer so we can set the time of day
-    solverProps = arcpy.na.GetSolverProperties(input_network_analyst_layer)
+    Instrumentation.StartPhase("OD")
+    # Initialize a sparse matrix for counting the number of times each destination is reached by each origin
+    OD_counts = AccessibilityCounts.ODCounts(origin_ids, destinations_oid_dict.keys())
+
+    # Solve in parallel if the Parallel Processing Factor environment is set.
+    # Each worker process solves its own copy of the OD layer.
+    num_workers = AnalysisHelpers.get_num_workers()
+    if num_workers > 1:
+        arcpy.AddMessage("Solving using %i parallel processes..." % min(num_workers, len(solve_timelist)))
+    solver_layer = AnalysisHelpers.prepare_worker_layer(input_network_analyst_layer, num_workers)
+    solver = AnalysisHelpers.ODCostMatrixTimeSolver(solver_layer, lines_sublayer_name)
+
+    def add_lines(time_result):
+        arcpy.AddMessage(str(time_result.time_of_day))
+        if time_result.error:
+            arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % time_result.error)
+            return
+        if time_result.result is None:
+            # No destinations were reachable
+            return
+        # Increment the counts with the OD matrix output
+        # There is one entry in Lines for each OD pair that was reached within the cutoff time
+        OD_counts.AddLines(time_result.result["OriginID"], time_result.result["DestinationID"],
+                           solve_timelist[time_result.index][1])
 
     # Solve for each time of day and save output
     arcpy.AddMessage("Solving OD Cost matrix at time...")
-    for t in timelist:
-        arcpy.AddMessage(str(t))
-        
-        # Switch the time of day
-        solverProps.timeOfDay = t
-        
-        # Solve the OD Cost Matrix
-        try:
-            arcpy.na.Solve(input_network_analyst_layer)
-        except:
-            # Solve failed.  It could be that no destinations were reachable within the time limit,
-            # or it could be another error.  Running out of memory is a distinct possibility.
-            errs = arcpy.GetMessages(2)
-            if "No solution found" not in errs:
-                # Only alert them if it's some weird error.
-                arcpy.AddMessage("Solve failed.  Errors: %s. Continuing to next time of day." % errs)
-            continue
-
-        # Read the OD matrix output and increment the dictionary
-        # There is one entry in Lines for each OD pair that was reached within the cutoff time
-        with arcpy.da.SearchCursor(lines_subLayer, ["OriginID", "DestinationID"]) as cur:
-            for line in cur:
-                if line[0] not in OD_count_dict:
-                    OD_count_dict[line[0]] = {}
-                if line[1] not in OD_count_dict[line[0]]:
-                    OD_count_dict[line[0]][line[1]] = 1
-                else:
-                    OD_count_dict[line[0]][line[1]] += 1
+    TimeOfDaySolving.solve_times(solver, [t for t, weight in solve_timelist], num_workers, add_lines)
+    AnalysisHelpers.clean_up_worker_layer(solver_layer)
 
 
     # ----- Calculate statistics and generate output -----
 
+    Instrumentation.StartPhase("Output")
     arcpy.AddMessage("Calculating statistics and writing results...")
 
     # If the destinations are weighted (eg, number of jobs at each destination), track them here
@@ -204,42 +221,26 @@ try:
         arcpy.management.AddField(origins_feature_class, dest_field, "LONG")
         arcpy.management.AddField(origins_feature_class, perc_field, "DOUBLE")
     
-    # For each origin, calculate statistics
+    # Calculate statistics for all origins at once
+    destination_weights = None
+    if destination_weight_dict:
+        # Weight of each destination, in the order of the Destinations sublayer OIDs in OD_counts
+        destination_weights = [destination_weight_dict[destinations_oid_dict[dest]] for dest in OD_counts.destination_oids]
+    reachable_dests, reachable_dests_perc = OD_counts.Statistics(len(timelist), destination_weights)
+    origin_index_dict = dict((oid, i) for i, oid in enumerate(OD_counts.origin_oids.tolist()))
+
+    # Write the statistics to each origin
     with arcpy.da.UpdateCursor(origins_feature_class, ["OID@"] + stats_fields) as cur:
         for row in cur:
-            origin_OID = origins_oid_dict[row[0]]
-            reachable_dests = 0
-            # Dictionary to track not just whether a destination was ever reachable, but how frequently it was reachable
-            # Keys are percentage of times reachable, 10% of times, 20% of times, etc.
-            reachable_dests_perc = {i:0 for i in range(10, 100, 10)}
-            # Loop through all destinations
-            if origin_OID in OD_count_dict: # If it's not present, that means no destinations were ever found for this origin
-                for dest in OD_count_dict[origin_OID]:
-                    if OD_count_dict[origin_OID][dest] > 0: # If this destination was ever reachable by this origin
-                        # Calculate the percentage of start times when this destination was reachable
-                        percent_of_times_reachable = (float(OD_count_dict[origin_OID][dest]) / float(len(timelist))) * 100
-                        if destination_weight_dict:
-                            # If using a weight field, determine how much weight reaching this destination contributes to the total
-                            dests_to_add = destination_weight_dict[destinations_oid_dict[dest]]
-                        else:
-                            # Otherwise, just count it as 1
-                            dests_to_add = 1
-                        # Increment the total number of destinations that were ever reached by this origin
-                        reachable_dests += dests_to_add
-                        # Also increment the percentage counters
-                        for perc in reachable_dests_perc:
-                            # If the actual percent of times reached is greater than the counter threshold, increment the counter
-                            if percent_of_times_reachable >= perc:
-                                reachable_dests_perc[perc] += dests_to_add
+            i = origin_index_dict[origins_oid_dict[row[0]]]
+            row[1] = reachable_dests[i].item()
             # Calculate the percentage of all destinations that were ever reached
-            percent_dests = (float(reachable_dests) / float(num_dests)) * 100
-            row[1] = reachable_dests
-            row[2] = percent_dests
+            row[2] = (float(reachable_dests[i]) / float(num_dests)) * 100
             # Populate the percent of times fields
             for r in range(0, 9):
-                row[3 + 2*r] = reachable_dests_perc[10 + 10*r]
+                row[3 + 2*r] = reachable_dests_perc[i, r].item()
                 # Calculate the percentage of all destinations that were reached at least this percent of times
-                row[3 + 2*r + 1] = (float(reachable_dests_perc[10 + 10*r]) / float(num_dests)) * 100
+                row[3 + 2*r + 1] = (float(reachable_dests_perc[i, r]) / float(num_dests)) * 100
             cur.updateRow(row)
 
     arcpy.AddMessage("Done!  Statistics fields have been added to your input Origins layer.")
@@ -248,3 +249,5 @@ except CustomError:
     pass
 except:
     raise
+finally:
+    Instrumentation.EndRun()
@@ -32,8 +32,25 @@ produced containing only the transit edges.
    limitations under the License.'''
 ################################################################################
 
-import arcpy, os, sqlite3, datetime
-import hms
+import arcpy, os, datetime
+import hms, FrequencySchedules, ScheduleCache, Instrumentation
+
+# Lookups run for each date and each traversed transit line, and the indices they
+# use. QueryPlans.py checks that SQLite uses the indices for the lookups.
+CalendarDatesFetch = '''
+    SELECT service_id, exception_type FROM calendar_dates
+    WHERE date == ?;'''
+# %s is start_time when solving backwards in time and end_time otherwise
+ScheduleFetch = "SELECT trip_id, start_time, end_time FROM schedules WHERE SourceOID=? AND %s=?"
+CalendarDatesIndexName = "calendardates_index_date"
+CalendarDatesIndexStmt = "CREATE INDEX calendardates_index_date ON calendar_dates (date);"
+SchedulesEndTimeIndexName = "schedules_index_SourceOID_endtime"
+SchedulesEndTimeIndexStmt = "CREATE INDEX schedules_index_SourceOID_endtime ON schedules (SourceOID, end_time);"
+SchedulesStartTimeIndexName = "schedules_index_SourceOID_starttime"
+SchedulesStartTimeIndexStmt = "CREATE INDEX schedules_index_SourceOID_starttime ON schedules (SourceOID, start_time);"
+# Generate Transit Lines and Stops clusters the schedules table on (SourceOID, end_time, trip_id)
+# and creates the start_time index. Only older networks need the indices created here.
+SchedulesClusteredIndexName = "sqlite_autoindex_schedules_1"
 
 
 class CustomError(Exception):
@@ -62,10 +79,7 @@ def EditServiceIDList_CalendarDates(date, SIDList):
     '''Modify the service_id list using info from the calendar_dates.txt file.'''
     datestring = date.strftime("%Y%m%d")
     cs = conn.cursor()
-    GetServiceIDstmt = '''
-        SELECT service_id, exception_type FROM calendar_dates
-        WHERE date == "%s";''' % datestring
-    cs.execute(GetServiceIDstmt)
+    cs.execute(CalendarDatesFetch, (datestring,))
     for SID in cs:
         if SID[1] == 2:
             SIDList = [p for p in SIDList if p != SID[0]]
@@ -74,9 +88,28 @@ def EditServiceIDList_CalendarDates(date, SIDList):
     return list(set(SIDList))
 
 
-def GetTransitTrips(row, end_time_sec_clean_1, end_time_sec_clean_2, SIDList):
-    rows_to_insert = []
-    row = list(row)
+def GetFrequencyTrips(SourceOID, time_of_day):
+    '''Generate the departures of trips using frequencies.txt that cross the
+    transit line at time_of_day (start_time when solving backwards in time and
+    end_time otherwise) from their time windows in frequency_schedules.'''
+    if not hasFrequencySchedules:
+        return []
+    cs = conn.cursor()
+    cs.execute(FrequencySchedules.FrequencyScheduleFetch, (SourceOID,))
+    trips = []
+    for window in cs:
+        trips += FrequencySchedules.DeparturesAtTime(window, time_of_day, BackInTime)
+    return trips
+
+
+def FindTrips(SourceOID, time_of_day):
+    '''Return a list of (trip_id, start_time, end_time, route_id, service_id)
+    for the trips crossing the transit line at time_of_day (start_time when
+    solving backwards in time and end_time otherwise). The schedule cache is
+    used if it could be opened. Otherwise, the schedules are read from the SQL
+    database.'''
+    if scheduleCache:
+        return scheduleCache.TripsAtTime(SourceOID, time_of_day, BackInTime)
 
     # Time direction determines which time we should use
     if BackInTime:
@@ -86,22 +119,27 @@ def GetTransitTrips(row, end_time_sec_clean_1, end_time_sec_clean_2, SIDList):
 
     # Pull out the trip info from the TransitScheduleTable
     cs = conn.cursor()
-    scheduleFetch = "SELECT trip_id, start_time, end_time FROM schedules WHERE SOURCEOID=%s AND %s=%s" % (row[0], time_to_use, end_time_sec_clean_1)
-    cs.execute(scheduleFetch)
-    EvalTableList = [sched for sched in cs]
+    cs.execute(ScheduleFetch % time_to_use, (SourceOID, time_of_day))
+    trips = cs.fetchall() + GetFrequencyTrips(SourceOID, time_of_day)
+    return [tuple(trip) + tuple(trip_info_dict[trip[0]]) for trip in trips]
+
+
+def GetTransitTrips(row, end_time_sec_clean_1, end_time_sec_clean_2, SIDList):
+    rows_to_insert = []
+    row = list(row)
+
+    EvalTableList = FindTrips(row[0], end_time_sec_clean_1)
 
     if not EvalTableList:
         # Try to find trips after rounding in the other direction
-        scheduleFetch = "SELECT trip_id, start_time, end_time FROM schedules WHERE SOURCEOID=%s AND %s=%s" % (row[0], time_to_use, end_time_sec_clean_2)
-        cs.execute(scheduleFetch)
-        EvalTableList = [sched for sched in cs]
+        EvalTableList = FindTrips(row[0], end_time_sec_clean_2)
 
     if not EvalTableList:
         return rows_to_insert
 
     for trip in EvalTableList:
         trip_id = trip[0]
-        service_id = trip_info_dict[trip_id][1]
+        service_id = trip[4]
         if service_id in SIDList:
             trip_start_time = trip[1]
             if trip_start_time > SecsInDay:
@@ -111,7 +149,7 @@ def GetTransitTrips(row, end_time_sec_clean_1, end_time_sec_clean_2, SIDList):
                 trip_end_time = trip_end_time - SecsInDay
 
             row[3] = trip_id #trip_id
-            route_id = trip_info_dict[trip_id][0]
+            route_id = trip[3]
             row[4] = RouteDict[route_id][0] #agency_id
             row[5] = route_id #route_id
             row[6] = RouteDict[route_id][4] #route_type
@@ -150,6 +188,8 @@ def GetTransitTrips(row, end_time_sec_clean_1, end_time_sec_clean_2, SIDList):
 
 try:
 
+    Instrumentation.StartRun("Copy Traversed Source Features (with Transit)")
+
     try:
 
         # ----- Collect and validate user inputs -----
@@ -332,7 +372,7 @@ repair your transit network or choose a different layer." % naGDB)
                 junction_source_dict[junc.name] = junc.sourceID
 
         # Connect to the SQL database
-        conn = sqlite3.connect(SQLDbase)
+        conn = Instrumentation.connect(SQLDbase)
         c = conn.cursor()
 
         # Determine if we have the correct tables
@@ -357,54 +397,67 @@ Transit Network Dataset tool, or re-create your network dataset from scratch."
             if not table in tblnamelist:
                 arcpy.AddError(message)
                 raise CustomError
+        # Networks created before frequency_schedules was added have every
+        # frequencies.txt departure in the schedules table instead.
+        hasFrequencySchedules = FrequencySchedules.TableName in tblnamelist
 
         # ----- Create helpful indices on the SQL database if they don't already exist -----
 
         # Create a date index on the calendar_dates table for fast lookups
         if "calendar_dates" in tblnamelist:
             hasIndex = False
-            idxName = "calendardates_index_date"
             c.execute("PRAGMA index_list(calendar_dates)")
             for index in c:
-                if index[1] == idxName:
+                if index[1] == CalendarDatesIndexName:
                     hasIndex = True
             if not hasIndex:
                 arcpy.AddMessage("Adding a date index to the calendar_dates table in your GTFS SQL database \
 for fast schedule lookups.  This will only be done once for this dataset.")
                 arcpy.AddMessage("Indexing calendar_dates table...")
-                c.execute("CREATE INDEX %s ON calendar_dates (date);" % idxName)
+                c.execute(CalendarDatesIndexStmt)
                 conn.commit()
 
         if not BackInTime: # We need fast lookups for SourceOID and end_time
             hasIndex = False
-            idxName = "schedules_index_SourceOID_endtime"
             c.execute("PRAGMA index_list(schedules)")
             for index in c:
-                if index[1] == idxName:
+                if index[1] in [SchedulesEndTimeIndexName, SchedulesClusteredIndexName]:
                     hasIndex = True
             if not hasIndex:
                 arcpy.AddMessage("Adding a SourceOID/end_time index to the schedules table in your GTFS SQL database \
 for fast schedule lookups.  The indexing process may take a few minutes, \
 but the table need only be indexed once, and future runs of this tool will be fast.")
                 arcpy.AddMessage("Indexing schedules table...")
-                c.execute("CREATE INDEX %s ON schedules (SourceOID, end_time);" % idxName)
+                c.execute(SchedulesEndTimeIndexStmt)
                 conn.commit()
 
         else: # We need fast lookups for SourceOID and start_time
             hasIndex = False
-            idxName = "schedules_index_SourceOID_starttime"
             c.execute("PRAGMA index_list(schedules)")
             for index in c:
-                if index[1] == idxName:
+                if index[1] == SchedulesStartTimeIndexName:
                     hasIndex = True
             if not hasIndex:
                 arcpy.AddMessage("Adding a SourceOID/start_time index to the schedules table in your GTFS SQL database \
 for fast schedule lookups.  The indexing process may take a few minutes, \
 but the table need only be indexed once, and future runs of this tool will be fast.")
                 arcpy.AddMessage("Indexing schedules table...")
-                c.execute("CREATE INDEX %s ON schedules (SourceOID, start_time);" % idxName)
+                c.execute(SchedulesStartTimeIndexStmt)
                 conn.commit()
 
+        # ----- Open the schedule cache, or build it if it's missing or out of date -----
+
+        scheduleCache = ScheduleCache.LoadCache(SQLDbase)
+        if not scheduleCache:
+            arcpy.AddMessage("Caching the transit schedules from your GTFS SQL database for fast lookups.  \
+This will only be done once for this dataset, unless the SQL database changes.")
+            try:
+                ScheduleCache.BuildCache(conn, SQLDbase)
+                scheduleCache = ScheduleCache.LoadCache(SQLDbase)
+            except (IOError, OSError):
+                arcpy.AddWarning("Unable to write the schedule cache in the folder containing your GTFS SQL \
+database.  Schedules will be read from the SQL database instead, which is slower.")
+
     except Exception as e:
         arcpy.AddError("Error collecting and validating user inputs.")
         raise
@@ -413,6 +466,7 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     # ---- Run Copy Traversed Source Features -----
 
+        Instrumentation.StartPhase("Copy traversed")
         arcpy.AddMessage("Calculating traversal result...")
 
         TraversalResult = arcpy.na.CopyTraversedSourceFeatures(inNALayerPath, outGDB, tempedgesName,
@@ -425,6 +479,7 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     try:
 
+        Instrumentation.StartPhase("GTFS info")
         arcpy.AddMessage("Collecting GTFS information...")
 
 
@@ -464,21 +519,31 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
         # We need to know the largest stop time so we can determine whether or
         # not we need to consider trips still running from the previous day.
-        MaxTimeFetch = '''SELECT MAX(%s) FROM schedules;''' % time_to_use
-        c.execute(MaxTimeFetch)
-        MaxTime = c.fetchone()[0]
+        if scheduleCache:
+            MaxTime = scheduleCache.MaxTime(BackInTime)
+        else:
+            MaxTimeFetch = '''SELECT MAX(%s) FROM schedules;''' % time_to_use
+            c.execute(MaxTimeFetch)
+            MaxTime = c.fetchone()[0]
+        if hasFrequencySchedules and not scheduleCache:
+            offset_to_use = "start_offset" if BackInTime else "end_offset"
+            MaxFrequencyTime = FrequencySchedules.GetMaxTime(c, offset_to_use)
+            if MaxTime is None or MaxFrequencyTime > MaxTime:
+                MaxTime = MaxFrequencyTime
 
 
     # ----- Match trip_ids with route_id and service_id -----
 
+        # The schedule cache already has the trip info.
         trip_info_dict = {}
-        tripsfetch = '''
-            SELECT trip_id, route_id, service_id
-            FROM trips
-            ;'''
-        c.execute(tripsfetch)
-        for trip in c:
-            trip_info_dict[trip[0]] = [trip[1], trip[2]]
+        if not scheduleCache:
+            tripsfetch = '''
+                SELECT trip_id, route_id, service_id
+                FROM trips
+                ;'''
+            c.execute(tripsfetch)
+            for trip in c:
+                trip_info_dict[trip[0]] = [trip[1], trip[2]]
 
 
     # ----- Make dictionary of route info -----
@@ -566,6 +631,7 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     # ----- Update Junctions with GTFS stop info -----
 
+        Instrumentation.StartPhase("Junctions")
         arcpy.AddMessage("Adding GTFS stop information to output Junctions...")
 
         arcpy.management.AddField(Junctions, "stop_id", "TEXT")
@@ -612,6 +678,7 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     # ----- Update Edges with GTFS route info -----
 
+        Instrumentation.StartPhase("Edges")
         arcpy.AddMessage("Adding GTFS route and trip information to output Edges...")
 
         if outGDB == "in_memory":
@@ -746,6 +813,7 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     # ----- Produce the transit-only output table -----
 
+        Instrumentation.StartPhase("Transit edges")
         arcpy.AddMessage("Generating Transit Edges feature class...")
 
         # Copy out only the transit lines
@@ -775,4 +843,5 @@ except Exception as e:
     raise
 
 finally:
-    arcpy.env.overwriteOutput = orig_overwrite
\ No newline at end of file
+    arcpy.env.overwriteOutput = orig_overwrite
+    Instrumentation.EndRun()
\ No newline at end of file
@@ -20,8 +20,11 @@ to a feature class that can be used to generate a time lapse video.'''
 ################################################################################
 
 import datetime
+import multiprocessing
 import arcpy
 import AnalysisHelpers
+import Instrumentation
+import TimeOfDaySolving
 arcpy.env.overwriteOutput = True
 
 class CustomError(Exception):
@@ -29,6 +32,12 @@ class CustomError(Exception):
 
 try:
 
+    # Worker processes started by TimeOfDaySolving may import this script. Only run the tool in the main process.
+    if multiprocessing.current_process().name != "MainProcess":
+        raise CustomError
+
+    Instrumentation.StartRun("Create Time Lapse Polygons")
+
     #Check out the Network Analyst extension license
     if arcpy.CheckExtension("Network") == "Available":
         arcpy.CheckOutExtension("Network")
@@ -58,6 +67,9 @@ try:
     end_time_input = arcpy.GetParameterAsText(5)
     increment_input = arcpy.GetParameter(6)
 
+    # Optional longest time between solves, which turns on solving at fewer times of day
+    max_gap = AnalysisHelpers.get_adaptive_max_gap(7)
+
     # Make list of times of day to run the analysis
     try:
         timelist = AnalysisHelpers.make_analysis_time_of_day_list(start_day_input, end_day_input, start_time_input, end_time_input, increment_input)
@@ -67,6 +79,7 @@ try:
     
     # ----- Add a TimeOfDay field to SA Polygons -----
 
+    Instrumentation.StartPhase("Prepare layer")
     # Grab the polygons sublayer, which we will export after each solve.
     sublayer_names = arcpy.na.GetNAClassNames(input_network_analyst_layer) # To ensure compatibility with localized software
     polygons_subLayer = arcpy.mapping.ListLayers(input_network_analyst_layer, sublayer_names["SAPolygons"])[0]
@@ -89,32 +102,58 @@ of this tool.")
 
     # ----- Solve NA layer in a loop for each time of day -----
 
-    # Grab the solver properties object from the NA layer so we can set the time of day
-    solverProps = arcpy.na.GetSolverProperties(input_network_analyst_layer)
-
-    # Solve for each time of day and save output
-    arcpy.AddMessage("Solving Service Area at time...")
-    for t in timelist:
-        arcpy.AddMessage(str(t))
-        
-        # Switch the time of day
-        solverProps.timeOfDay = t
-        
-        # Solve the Service Area
-        arcpy.na.Solve(input_network_analyst_layer)
-        
-        # Calculate the TimeOfDay field
-        expression = '"' + str(t) + '"' # Unclear why a DATE field requires a string expression, but it does.
-        arcpy.management.CalculateField(polygons_subLayer, time_field, expression, "PYTHON_9.3")
-        
+    Instrumentation.StartPhase("Service areas")
+    # Solve at fewer times of day, skipping the times the transit schedules can't change the results at, if
+    # adaptive times of day are turned on. Each solve stands for one or more of the times in timelist.
+    if max_gap:
+        facilities_subLayer = arcpy.mapping.ListLayers(input_network_analyst_layer, sublayer_names["Facilities"])[0]
+        solve_timelist = AnalysisHelpers.make_adaptive_time_of_day_list_for_layer(
+            timelist, input_network_analyst_layer, facilities_subLayer, max_gap)
+        arcpy.AddMessage("Solving at %i of the %i times of day, based on the transit schedules." %
+                         (len(solve_timelist), len(timelist)))
+    else:
+        solve_timelist = [(t, 1) for t in timelist]
+    # The skipped times of day after each solve, which get the polygons of the solve
+    skipped_times = []
+    i = 0
+    for t, weight in solve_timelist:
+        skipped_times.append(timelist[i + 1:i + weight])
+        i += weight
+
+    # Solve in parallel if the Parallel Processing Factor environment is set.
+    # Each worker process solves its own copy of the Service Area layer.
+    num_workers = AnalysisHelpers.get_num_workers()
+    if num_workers > 1:
+        arcpy.AddMessage("Solving using %i parallel processes..." % min(num_workers, len(solve_timelist)))
+
+    solver_layer = AnalysisHelpers.prepare_worker_layer(input_network_analyst_layer, num_workers)
+    solver = AnalysisHelpers.ServiceAreaTimeSolver(solver_layer, sublayer_names["SAPolygons"], time_field)
+
+    def append_polygons(time_result):
+        arcpy.AddMessage(str(time_result.time_of_day))
         #Append the polygons to the output feature class. If this was the first
         #solve, create the feature class.
         if not arcpy.Exists(output_feature_class):
-            arcpy.management.CopyFeatures(polygons_subLayer, output_feature_class)
+            arcpy.management.CopyFeatures(time_result.result, output_feature_class)
         else:
-            arcpy.management.Append(polygons_subLayer, output_feature_class)
+            arcpy.management.Append(time_result.result, output_feature_class)
+        # The skipped times of day have the same polygons as this solve.
+        for t in skipped_times[time_result.index]:
+            expression = '"' + str(t) + '"'
+            arcpy.management.CalculateField(time_result.result, time_field, expression, "PYTHON_9.3")
+            arcpy.management.Append(time_result.result, output_feature_class)
+        if num_workers > 1:
+            # Clean up the worker's copy of the polygons.
+            arcpy.management.Delete(time_result.result)
+
+    # Solve for each time of day and save output.  The polygons are appended in time of day order.
+    arcpy.AddMessage("Solving Service Area at time...")
+    TimeOfDaySolving.solve_times(solver, [t for t, weight in solve_timelist], num_workers, append_polygons)
+    AnalysisHelpers.clean_up_worker_layer(solver_layer)
 
 except CustomError:
     pass
 except:
     raise
+finally:
+    Instrumentation.EndRun()
@@ -0,0 +1,82 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Frequency Schedules
+
+Helpers for the frequency_schedules table, which holds the schedules of trips
+that use frequencies.txt.
+
+Rather than one schedules row for every departure of the trip, the table has
+one row for each transit line the trip crosses in each frequencies.txt time
+window:
+    (SourceOID, trip_id, window_start, window_end, headway_secs, start_offset,
+     end_offset)
+The trip departs its first stop at window_start, window_start + headway_secs,
+... up to but not including window_end, and crosses the transit line from
+start_offset to end_offset seconds after each of those departures. The size of
+the table depends on the number of time windows, not the number of departures.
+The departures are generated from the rows when a tool needs them.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+TableName = "frequency_schedules"
+
+# The time windows of the trips crossing a transit line
+FrequencyScheduleFetch = '''SELECT trip_id, window_start, window_end, headway_secs, start_offset, end_offset
+    FROM frequency_schedules WHERE SourceOID=?'''
+
+# Created by Generate Transit Lines and Stops when the table is filled
+FrequencySchedulesIndexStmt = "CREATE INDEX frequencyschedules_index_SourceOID ON frequency_schedules (SourceOID);"
+
+# Latest start_time or end_time (%s = start_offset or end_offset) of any departure
+MaxTimeFetch = '''SELECT MAX(window_start + ((window_end - 1 - window_start) / headway_secs) * headway_secs + %s)
+    FROM frequency_schedules WHERE window_end > window_start'''
+
+
+def ExpandDepartures(window):
+    '''Return a list of (trip_id, start_time, end_time) for every departure in a
+    row of the frequency_schedules table, in the column order of
+    FrequencyScheduleFetch.'''
+    trip_id, window_start, window_end, headway_secs, start_offset, end_offset = window
+    return [(trip_id, i + start_offset, i + end_offset) for i in range(window_start, window_end, headway_secs)]
+
+
+def NumDepartures(window):
+    '''Return the number of departures ExpandDepartures returns for a row of
+    the frequency_schedules table, without expanding them.'''
+    trip_id, window_start, window_end, headway_secs, start_offset, end_offset = window
+    if window_end <= window_start:
+        return 0
+    return (window_end - window_start - 1) // headway_secs + 1
+
+
+def DeparturesAtTime(window, time_of_day, use_start_time=False):
+    '''Return a list of (trip_id, start_time, end_time) for the departures in a
+    row of the frequency_schedules table that cross the transit line with an
+    end_time (or start_time, if use_start_time) of exactly time_of_day. This
+    matches the schedules rows a "WHERE end_time=?" query would have found if
+    every departure had been written out.'''
+    trip_id, window_start, window_end, headway_secs, start_offset, end_offset = window
+    departure = time_of_day - (start_offset if use_start_time else end_offset)
+    if window_start <= departure < window_end and (departure - window_start) % headway_secs == 0:
+        return [(trip_id, departure + start_offset, departure + end_offset)]
+    return []
+
+
+def GetMaxTime(cursor, offset_field):
+    '''Return the latest start_time (offset_field="start_offset") or end_time
+    (offset_field="end_offset") of any departure in the frequency_schedules
+    table, or None if the table has no departures.'''
+    cursor.execute(MaxTimeFetch % offset_field)
+    return cursor.fetchone()[0]
@@ -24,28 +24,23 @@ locations or station interior geometry.'''
    limitations under the License.'''
 ################################################################################
 
-import os, sqlite3
+import os
+import numpy as np
 import arcpy
+import StopGeometry, StreetSnapping, Instrumentation
 
 class CustomError(Exception):
     pass
 
 try:
 
+    Instrumentation.StartRun("Generate Stop-Street Connectors")
+
     # Get the original overwrite output setting so we can reset it at the end.
     OverwriteOutput = arcpy.env.overwriteOutput
     # It's okay to overwrite stuff in this tool
     arcpy.env.overwriteOutput = True
 
-    # Check if they have the necessary license.
-    # The snap_edit tool requires at least Standard (ArcEditor)
-    ArcLicense = arcpy.ProductInfo()
-    if ArcLicense != "ArcEditor" and ArcLicense != "ArcInfo":
-        message = "To run this tool, you must have the Desktop Standard (ArcEditor) \
-    or Advanced (ArcInfo) license.  Your license type is: %s." % ArcLicense
-        arcpy.AddError(message)
-        raise CustomError
-
 
 # ----- Collect user inputs -----
 
@@ -70,12 +65,11 @@ try:
     outStopsSnapped = os.path.join(outFD, "Stops_Snapped2Streets")
     outConnectors = os.path.join(outFD, "Connectors_Stops2Streets")
     outStreetsSplit = os.path.join(outFD, "Streets_UseThisOne")
-    outTempSelection = os.path.join(outFD, "Temp_SelectedStreets")
-    TempSnappedStops = os.path.join(outGDB, "TempStopsSnapped4Integrate")
     
 
 # ----- Collect parent_station info -----
 
+    Instrumentation.StartPhase("Parent stations")
     parent_stations = {}
     where = "location_type = '1'"
     with arcpy.da.SearchCursor(outStops, ["Shape@", "stop_id"], where) as cur:
@@ -143,41 +137,95 @@ try:
     
     
 # ----- Snap stops to streets -----
-    
-    # Select only those streets where pedestrians are allowed,
+
+    Instrumentation.StartPhase("Snap stops")
+    # Copy the streets to a new FC because we're going to add vertices to them.
+    # The copy is in the feature dataset's coordinate system, like the stops.
+    arcpy.management.CopyFeatures(Streets, outStreetsSplit)
+
+    # Read only those streets where pedestrians are allowed,
     # as specified by the user's SQL expression
     if SelectExpression:
         SelectionMessage = "Stops will snap only to street features where the \
 following is true: " + SelectExpression
         arcpy.AddMessage(SelectionMessage)
-    arcpy.analysis.Select(Streets, outTempSelection, SelectExpression)
+    # Stops are snapped to the straight segments between the streets' vertices,
+    # and the streets are rebuilt from their vertices when vertices are added,
+    # so true curves (circular arcs and Bezier curves) would be lost. Curved
+    # streets are replaced by straight segments that follow the curves within
+    # 100 times the XY tolerance before snapping.
+    curve_deviation = SR.XYTolerance * 100
+    num_curved = 0
+    street_parts = []
+    with arcpy.da.UpdateCursor(outStreetsSplit, ["OID@", "SHAPE@"], SelectExpression) as cur:
+        for row in cur:
+            if not row[1]:
+                continue
+            if getattr(row[1], "hasCurves", False):
+                row[1] = row[1].densify("DISTANCE", row[1].length, curve_deviation)
+                cur.updateRow(row)
+                num_curved += 1
+            for part_index, part in enumerate(row[1]):
+                street_parts.append((row[0], part_index, [(pt.X, pt.Y) for pt in part]))
+    segments = StreetSnapping.StreetSegments(street_parts)
+    del street_parts
+    if num_curved:
+        arcpy.AddWarning("%i street features have true curves. In %s, their curves were replaced by straight \
+segments so that stops can be snapped to them." % (num_curved, outStreetsSplit))
+
+    # Read the stops to snap
+    stop_oids = []
+    stop_ids = []
+    location_types = []
+    stop_xy = []
+    with arcpy.da.SearchCursor(outStopsSnapped, ["OID@", "stop_id", "location_type", "SHAPE@XY"]) as cur:
+        for row in cur:
+            stop_oids.append(row[0])
+            stop_ids.append(row[1])
+            location_types.append(row[2])
+            stop_xy.append(row[3])
+    stop_xy = np.array(stop_xy, dtype=np.float64).reshape(-1, 2)
+
+    # Convert the snapping tolerance specified in the user's input to the
+    # units of the coordinate system.  Geographic coordinates are snapped with
+    # the longitudes scaled to the length of a degree of latitude.
+    snapdist_meters = float(snapdist) * StreetSnapping.MetersPerUnit[snapunits.lower()]
+    x_scale = 1.0
+    if SR.type == "Geographic":
+        tolerance = snapdist_meters / (SR.radiansPerUnit * StopGeometry.WGS84_A)
+        if len(stop_xy):
+            x_scale = float(np.cos(np.radians(stop_xy[:, 1].mean())))
+    else:
+        tolerance = snapdist_meters / SR.metersPerUnit
+
+    # Snap each stop to the closest point on the closest street within the tolerance.
+    snapped_segment, snapped_t, snapped_xy, snapped_distance = StreetSnapping.SnapPoints(
+        stop_xy, segments, tolerance, x_scale=x_scale)
+    with arcpy.da.UpdateCursor(outStopsSnapped, ["OID@", "SHAPE@XY"]) as cur:
+        stop_index_dict = dict((oid, i) for i, oid in enumerate(stop_oids))
+        for row in cur:
+            i = stop_index_dict[row[0]]
+            if snapped_segment[i] >= 0:
+                row[1] = (float(snapped_xy[i, 0]), float(snapped_xy[i, 1]))
+                cur.updateRow(row)
 
-    # Snap the stops to the streets network, using the snapping tolerance
-    # specified in the user's input.
-    snapdisttext = str(snapdist) + " " + snapunits # Eg, "40 meters"
-    snapenv = [outTempSelection, "EDGE", snapdisttext]
-    arcpy.edit.Snap(outStopsSnapped, [snapenv])
-
-    # Clean up.
-    arcpy.management.Delete(outTempSelection)
-        
 
 # ----- Generate lines connecting streets with stops -----
 
+    Instrumentation.StartPhase("Connectors")
     arcpy.AddMessage("Creating connector lines between stops and streets...")
 
-    # Put Stops and Snapped stops into same scratch FC for input to PointsToLine
-    outStopsCombined = os.path.join(outGDB, "TempStopswSnapped")
-    arcpy.management.CopyFeatures(outStops, outStopsCombined)
-    arcpy.management.Append(outStopsSnapped, outStopsCombined)
-
-    # Create Connector lines
-    arcpy.management.PointsToLine(outStopsCombined, outConnectors, "stop_id")
+    # Create Connector lines from each stop's original location to its snapped
+    # location.  Station entrances are connected to their parent station below instead.
+    arcpy.management.CreateFeatureclass(outFD, os.path.basename(outConnectors), "POLYLINE", spatial_reference=SR)
+    arcpy.management.AddField(outConnectors, "stop_id", "TEXT")
     arcpy.management.AddField(outConnectors, "connector_type", "TEXT")
-    arcpy.management.CalculateField(outConnectors, "connector_type", '"Direct stop to street connection"', "PYTHON_9.3")
-
-    # Clean up.
-    arcpy.management.Delete(outStopsCombined)
+    with arcpy.da.InsertCursor(outConnectors, ["stop_id", "SHAPE@", "connector_type"]) as cur:
+        for i, stop_id in enumerate(stop_ids):
+            if location_types[i] == u'2':
+                continue
+            polyline = StopGeometry.SegmentPolyline(stop_xy[i], snapped_xy[i], SR)
+            cur.insertRow([stop_id, polyline, "Direct stop to street connection"])
 
 
 # ----- Generate lines connecting parent stations with their child stops -----
@@ -229,8 +277,10 @@ following is true: " + SelectExpression
 
 # ----- Create and populate the wheelchair_boarding field -----
 
+    Instrumentation.StartPhase("Wheelchair boarding")
+
     # Connect to the SQL database
-    conn = sqlite3.connect(SQLDbase)
+    conn = Instrumentation.connect(SQLDbase)
     c = conn.cursor()
 
     # Determine if wheelchair_boarding is present
@@ -272,29 +322,35 @@ following is true: " + SelectExpression
 
 # ----- Create vertices in steets at locations of snapped stops
 
+    Instrumentation.StartPhase("Street vertices")
     arcpy.AddMessage("Creating vertices in streets at location of stops...")
-    arcpy.AddMessage("(This step might take a while.)")
 
-    # Copy snapped stops before running integrate because we don't want to make
-    # permanent changes to it.
-    arcpy.management.CopyFeatures(outStopsSnapped, TempSnappedStops)
-    # Copy the streets to a new FC because we're going to modify them.
-    arcpy.management.CopyFeatures(Streets, outStreetsSplit)
+    # Add a vertex to the streets wherever a stop snapped between two existing
+    # vertices.  Z and M values of the new vertices are interpolated.
+    vertex_inserts = StreetSnapping.VertexInserts(segments, snapped_segment, snapped_t, snapped_xy)
+    desc = arcpy.Describe(outStreetsSplit)
+
+    def interpolate(start, end, t):
+        if start is None or end is None:
+            return None
+        return start + t * (end - start)
 
-    # Integrate adds vertices in outStreetsSplit at the locations where
-    # TempSnappedStops fall within the default XY Tolerance.  Because the
-    # snapped stops are directly on top of the streets, neither streets nor
-    # stops should move at all (though Integrate sometimes causes this to
-    # happen).
-    arcpy.management.Integrate([[outStreetsSplit, 1], [TempSnappedStops, 2]])
+    def new_vertex(start, end, t, x, y):
+        return arcpy.Point(x, y, interpolate(start.Z, end.Z, t), interpolate(start.M, end.M, t))
+
+    if vertex_inserts:
+        with arcpy.da.UpdateCursor(outStreetsSplit, ["OID@", "SHAPE@"]) as cur:
+            for row in cur:
+                if row[0] not in vertex_inserts:
+                    continue
+                parts = StreetSnapping.InsertVertices([list(part) for part in row[1]], vertex_inserts[row[0]], new_vertex)
+                row[1] = arcpy.Polyline(arcpy.Array([arcpy.Array(part) for part in parts]), SR, desc.hasZ, desc.hasM)
+                cur.updateRow(row)
 
     # Add a pedestrians_allowed field that the user can calculate. It will be automatically used in the pedestrian
     # restriction attribute if the user creates their network using the provided template.
     arcpy.management.AddField(outStreetsSplit, "pedestrians_allowed", "SHORT")
 
-    # Clean up.
-    arcpy.management.Delete(TempSnappedStops)
-
     arcpy.AddMessage("Finished!")
     arcpy.AddMessage("Your stop-street connector feature class is:")
     arcpy.AddMessage("- " + outConnectors)
@@ -313,4 +369,5 @@ except:
 
 finally:
     # Reset the overwrite output to the user's original setting..
-    arcpy.env.overwriteOutput = OverwriteOutput
\ No newline at end of file
+    arcpy.env.overwriteOutput = OverwriteOutput
+    Instrumentation.EndRun()
\ No newline at end of file
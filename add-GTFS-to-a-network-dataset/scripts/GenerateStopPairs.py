@@ -28,7 +28,7 @@ dataset for schedule lookups.'''
 
 import sqlite3, os, operator, itertools, csv, re
 import arcpy
-import sqlize_csv, hms
+import sqlize_csv, hms, StopGeometry, Instrumentation, FrequencySchedules
 
 class CustomError(Exception):
     pass
@@ -44,9 +44,8 @@ outFD = arcpy.GetParameterAsText(1)
 outGDB = os.path.dirname(outFD)
 SQLDbaseName = "GTFS.sql"
 SQLDbase = os.path.join(outGDB, SQLDbaseName)
-outStopPairsFCName = "StopPairs"
-outStopPairsFC = os.path.join(outGDB, outStopPairsFCName)
-outLinesFC = os.path.join(outFD, "TransitLines")
+outLinesFCName = "TransitLines"
+outLinesFC = os.path.join(outFD, outLinesFCName)
 outStopsFCName = "Stops"
 outStopsFC = os.path.join(outFD, outStopsFCName)
 
@@ -86,6 +85,7 @@ try:
 
 # ----- SQLize the GTFS data -----
 
+    Instrumentation.StartRun("Generate Transit Lines and Stops", first_phase="SQLize")
     arcpy.AddMessage("SQLizing the GTFS data...")
     arcpy.AddMessage("(This will take a few minutes for large datasets.)")
 
@@ -130,6 +130,7 @@ try:
 
 # ----- Make dictionary of route types -----
 
+    Instrumentation.StartPhase("Route info")
     # Find all routes and associated info.
     RouteDict = {}
     routesfetch = '''
@@ -191,21 +192,41 @@ This is invalid, so trips with this id will not be included in your network." %
 
 # ----- Generate transit stops feature class (for the final ND) -----
 
+    Instrumentation.StartPhase("Stops feature class")
     arcpy.AddMessage("Generating transit stops feature class.")
 
     # Find parent stations that are actually used
     selectparentstationsstmt = "SELECT parent_station FROM stops WHERE location_type='0' AND parent_station <> ''"
     c.execute(selectparentstationsstmt)
-    used_parent_stations = list(set([station[0] for station in c]))
+    used_parent_stations = set([station[0] for station in c])
 
     # Get the combined stops table.
-    selectstoptablestmt = "SELECT stop_id, stop_lat, stop_lon, stop_code, \
-                        stop_name, stop_desc, zone_id, stop_url, location_type, \
-                        parent_station, wheelchair_boarding FROM stops;"
-    c.execute(selectstoptablestmt)
+    StopTable = StopGeometry.ReadStops(c, ["stop_id", "stop_lat", "stop_lon", "stop_code",
+                        "stop_name", "stop_desc", "zone_id", "stop_url", "location_type",
+                        "parent_station", "wheelchair_boarding"])
+    KeepStops = []
+    for stop in StopTable:
+        stop_id = stop[0]
+        location_type = stop[8]
+        parent_station = stop[9]
+        if location_type == 1 and stop_id not in used_parent_stations:
+            # Skip this stop because it's an unused parent station
+            # since these will just make useless standalone junctions.
+            continue
+        if location_type == 2 and parent_station not in used_parent_stations:
+            # Remove station entrances that don't have a valid parent_station
+            # since these serve no purpose
+            continue
+        KeepStops.append(stop)
 
-    # Initialize a dictionary of stop lat/lon (filled below)
-    # {stop_id: <stop geometry object>} in the output coordinate system
+    # GTFS stop lat/lon is written in WGS1984, but the stops fc must be in the
+    # user's FD coordinate system. Project all the stops at once.
+    StopXs, StopYs = StopGeometry.ProjectLatLonsToSpatialReference([float(stop[1]) for stop in KeepStops],
+                                                                   [float(stop[2]) for stop in KeepStops],
+                                                                   outFD_SR)
+
+    # Initialize a dictionary of stop locations (filled below)
+    # {stop_id: (x, y)} in the output coordinate system
     stoplatlon_dict = {}
 
     # Create a points feature class for the point pairs.
@@ -221,14 +242,12 @@ This is invalid, so trips with this id will not be included in your network." %
     arcpy.management.AddField(outStopsFC, "wheelchair_boarding", "TEXT")
 
     # Add the stops table to a feature class.
-    with arcpy.da.InsertCursor(outStopsFC, ["SHAPE@", "stop_id",
+    with arcpy.da.InsertCursor(outStopsFC, ["SHAPE@XY", "stop_id",
                                                  "stop_code", "stop_name", "stop_desc",
                                                  "zone_id", "stop_url", "location_type",
                                                  "parent_station", "wheelchair_boarding"]) as cur3:
-        for stop in c:
+        for stop, x, y in zip(KeepStops, StopXs, StopYs):
             stop_id = stop[0]
-            stop_lat = stop[1]
-            stop_lon = stop[2]
             stop_code = stop[3]
             stop_name = stop[4]
             stop_desc = stop[5]
@@ -237,42 +256,41 @@ This is invalid, so trips with this id will not be included in your network." %
             location_type = stop[8]
             parent_station = stop[9]
             wheelchair_boarding = unicode(stop[10])
-            if location_type == 1 and stop_id not in used_parent_stations:
-                # Skip this stop because it's an unused parent station
-                # since these will just make useless standalone junctions.
-                continue
-            if location_type == 2 and parent_station not in used_parent_stations:
-                # Remove station entrances that don't have a valid parent_station
-                # since these serve no purpose
-                continue
-            pt = arcpy.Point()
-            pt.X = float(stop_lon)
-            pt.Y = float(stop_lat)
-            # GTFS stop lat/lon is written in WGS1984
-            ptGeometry = arcpy.PointGeometry(pt, WGSCoords)
-            # But the stops fc must be in the user's FD coordinate system
-            ptGeometry_projected = ptGeometry.projectAs(outFD_SR)
-            stoplatlon_dict[stop_id] = ptGeometry_projected
-            cur3.insertRow((ptGeometry_projected, stop_id, stop_code, stop_name,
+            stoplatlon_dict[stop_id] = (x, y)
+            cur3.insertRow(((x, y), stop_id, stop_code, stop_name,
                             stop_desc, zone_id, stop_url, location_type,
                             parent_station, wheelchair_boarding))
 
 
 # ----- Obtain schedule info from the stop_times.txt file and convert it to a line-based model -----
 
+    Instrumentation.StartPhase("Schedule query")
     arcpy.AddMessage("Obtaining and processing transit schedule and line information...")
     arcpy.AddMessage("(This will take a few minutes for large datasets.)")
 
+    def Get_Segment_ID(start_stop, end_stop, route_type):
+        '''Return the integer id of the line segment between two directly-
+        connected stops for a route_type, assigning the next id if this is the
+        first time the segment has been seen.'''
+        key = (start_stop, end_stop, route_type)
+        segment_id = linefeature_dict.get(key)
+        if segment_id is None:
+            segment_id = len(linefeature_dict) + 1
+            linefeature_dict[key] = segment_id
+        return segment_id
+
     def Make_Frequency_Rows(trip_id, stop_times):
-        '''If the trip uses the frequencies.txt file, extrapolate the stop_times
-        throughout the day using the relative time between the stops given in
-        stop_times and the headways listed in frequencies. Construct rows of 
-        (SourceOIDkey, start_time, end_time, trip_id) to insert into schedule table'''
+        '''If the trip uses the frequencies.txt file, construct rows of
+        (segment_id, trip_id, window_start, window_end, headway_secs,
+        start_offset, end_offset) to insert into the frequency_schedules table,
+        one for each time window in frequencies. The offsets are the relative
+        time between the stops given in stop_times. The individual departures
+        are extrapolated from these rows when they are needed (see
+        FrequencySchedules.py).'''
 
         if len(stop_times) < 2: # No complete stop-stop segments for this trip
             return []
 
-        global linefeature_dict
         route_type = trip_routetype_dict[trip_id]
 
         stop_times_current_trip = []
@@ -288,18 +306,14 @@ This is invalid, so trips with this id will not be included in your network." %
             end_stop = stop_id
             start_time_along_trip = start_time - first_trip_initial_start_time # Start time of line segment is departure time of first stop
             end_time_along_trip = arrival_time - first_trip_initial_start_time # End time of line segment is arrival time at second stop
-            SourceOIDkey = "%s , %s , %s" % (start_stop, end_stop, route_type)
-            linefeature_dict[SourceOIDkey] = True
+            segment_id = Get_Segment_ID(start_stop, end_stop, route_type)
             # Loop over all time windows in frequencies.txt for this trip
             for window in frequencies_dict[trip_id]: # {trip_id: [start_time, end_time, headway_secs]}
-                start_timeofday = window[0]
-                end_timeofday = window[1]
+                start_timeofday = int(round(window[0], 0))
+                end_timeofday = int(round(window[1], 0))
                 headway = window[2]
-                # Loop over the range of times based on headway
-                for i in range(int(round(start_timeofday, 0)), int(round(end_timeofday, 0)), headway):
-                    start_time_extrapolated = i + start_time_along_trip # current trip initial start time + time along trip
-                    end_time_extrapolated = i + end_time_along_trip # current trip initial start time + time along trip
-                    stop_times_current_trip.append((SourceOIDkey, start_time_extrapolated, end_time_extrapolated, trip_id))
+                stop_times_current_trip.append((segment_id, trip_id, start_timeofday, end_timeofday, headway,
+                                                start_time_along_trip, end_time_along_trip))
             previous_stop = stop_id # Increment previous_stop
             start_time = departure_time # Reset start_time to current stop's departure_time
 
@@ -307,12 +321,11 @@ This is invalid, so trips with this id will not be included in your network." %
 
     def Make_StopsTimes_Rows(trip_id, stop_times):
         '''Using values from stop_times for a particular trip, construct rows of 
-        (SourceOIDkey, start_time, end_time, trip_id) to insert into schedule table'''
+        (segment_id, start_time, end_time, trip_id) to insert into schedule table'''
         
         if len(stop_times) < 2: # No complete stop-stop segments for this trip
             return []
 
-        global linefeature_dict
         route_type = trip_routetype_dict[trip_id]
 
         stop_times_current_trip = []
@@ -327,45 +340,73 @@ This is invalid, so trips with this id will not be included in your network." %
             start_stop = previous_stop
             end_stop = stop_id
             end_time = arrival_time # End time of line segment is arrival time at second stop
-            SourceOIDkey = "%s , %s , %s" % (start_stop, end_stop, route_type)
-            linefeature_dict[SourceOIDkey] = True
-            stop_times_current_trip.append((SourceOIDkey, start_time, end_time, trip_id))
+            segment_id = Get_Segment_ID(start_stop, end_stop, route_type)
+            stop_times_current_trip.append((segment_id, start_time, end_time, trip_id))
             previous_stop = stop_id # Increment previous_stop
             start_time = departure_time # Reset start_time to current stop's departure_time
 
         return stop_times_current_trip
 
+    # Until the transit lines feature class is created, the SourceOID column of
+    # the schedules and frequency_schedules tables holds the segment_id.
     def Insert_Schedules(rows):
-        '''Insert into schedules table'''
+        '''Insert into schedules table in batches'''
         c2 = conn.cursor()
-        columns = ["SourceOIDKey", "start_time", "end_time", "trip_id"]
+        columns = ["SourceOID", "start_time", "end_time", "trip_id"]
         values_placeholders = ["?"] * len(columns)
-        c2.executemany("INSERT INTO schedules (%s) VALUES (%s);" %
-                        (",".join(columns), ",".join(values_placeholders)), rows)
+        insertstmt = "INSERT INTO schedules (%s) VALUES (%s);" % (",".join(columns), ",".join(values_placeholders))
+        while True:
+            batch = list(itertools.islice(rows, 100000))
+            if not batch:
+                break
+            c2.executemany(insertstmt, batch)
+
+    def Insert_Frequency_Schedules(rows):
+        '''Insert into frequency_schedules table'''
+        c2 = conn.cursor()
+        columns = ["SourceOID", "trip_id", "window_start", "window_end", "headway_secs", "start_offset", "end_offset"]
+        values_placeholders = ["?"] * len(columns)
+        insertstmt = "INSERT INTO frequency_schedules (%s) VALUES (%s);" % (",".join(columns), ",".join(values_placeholders))
+        c2.executemany(insertstmt, rows)
 
-    def Make_Rows_For_Trip(trip_id):
-        '''Find pairs of directly-connected stops for this trip and prepare to insert in schedule table'''
+    def Make_Rows_For_All_Trips():
+        '''Find pairs of directly-connected stops for every trip and prepare to
+        insert in schedule table. stop_times is read in a single pass in trip and
+        stop_sequence order (using the stopTimes_index_tripIdsSeq index) and
+        grouped by trip. Rows for trips using frequencies.txt are collected in
+        frequency_rows instead, since they go in the frequency_schedules table.'''
 
         stoptimefetch = '''
-        SELECT stop_id, arrival_time, departure_time
+        SELECT trip_id, stop_id, arrival_time, departure_time
         FROM stop_times
-        WHERE trip_id = '%s'
-        ORDER BY stop_sequence
-        ;''' % trip_id
+        ORDER BY trip_id, stop_sequence
+        ;'''
         c.execute(stoptimefetch)
-        stop_time_data = c.fetchall()
-        if trip_id in frequencies_dict:
-            stop_times_current_trip = Make_Frequency_Rows(trip_id, stop_time_data)
-        else:
-            stop_times_current_trip = Make_StopsTimes_Rows(trip_id, stop_time_data)
-        return stop_times_current_trip
+        for trip_id, stop_times in itertools.groupby(c, key=operator.itemgetter(0)):
+            if trip_id not in trip_routetype_dict:
+                # stop_times entry for a trip that isn't in trips.txt
+                continue
+            stop_time_data = [st[1:] for st in stop_times]
+            if trip_id in frequencies_dict:
+                frequency_rows.extend(Make_Frequency_Rows(trip_id, stop_time_data))
+                continue
+            for row in Make_StopsTimes_Rows(trip_id, stop_time_data):
+                yield row
 
 
-    global linefeature_dict
-    linefeature_dict = {}
-    # Insert the trip schedules into the table
-    rows = itertools.chain.from_iterable(itertools.imap(Make_Rows_For_Trip, trip_routetype_dict.keys()))
-    Insert_Schedules(rows)
+    linefeature_dict = {} # {(start_stop, end_stop, route_type): segment_id}
+    frequency_rows = []
+    # Insert the trip schedules into the tables
+    Insert_Schedules(Make_Rows_For_All_Trips())
+    Insert_Frequency_Schedules(frequency_rows)
+    conn.commit()
+
+    # Write the line segments to the linefeatures table. Their SourceOID values
+    # are filled in once the transit lines have been created.
+    c.executemany("INSERT INTO linefeatures (segment_id, from_stop, to_stop, route_type) VALUES (?, ?, ?, ?);",
+                  ((segment_id, key[0], key[1], key[2] if isinstance(key[2], int) else None)
+                   for key, segment_id in linefeature_dict.iteritems()))
+    c.execute("CREATE INDEX linefeatures_index_segmentID ON linefeatures (segment_id);")
     conn.commit()
 
     # Delete stop_times table because it's huge and we're done with it.
@@ -374,119 +415,55 @@ This is invalid, so trips with this id will not be included in your network." %
     conn.commit()
 
 
-# ----- Write pairs to a points feature class (this is intermediate and will NOT go into the final ND) -----
+# ----- Generate lines between all stops (for the final ND) -----
 
-    # Create a points feature class for the point pairs.
-    arcpy.management.CreateFeatureclass(outGDB, outStopPairsFCName, "POINT", "", "", "", outFD_SR)
-    arcpy.management.AddField(outStopPairsFC, "stop_id", "TEXT")
-    arcpy.management.AddField(outStopPairsFC, "pair_id", "TEXT")
-    arcpy.management.AddField(outStopPairsFC, "sequence", "SHORT")
-
-    # Add pairs of stops to the feature class in preparation for generating line features
-    badStops = []
-    badkeys = []
-    with arcpy.da.InsertCursor(outStopPairsFC, ["SHAPE@", "stop_id", "pair_id", "sequence"]) as cur:
-        # linefeature_dict = {"start_stop , end_stop , route_type": True}
-        for SourceOIDkey in linefeature_dict:
-            stopPair = SourceOIDkey.split(" , ")
-            # {stop_id: [stop_lat, stop_lon]}
-            try:
-                stop1 = stopPair[0]
-                stop1_geom = stoplatlon_dict[stop1]
-            except KeyError:
-                badStops.append(stop1)
-                badkeys.append(SourceOIDkey)
-                continue
-            try:
-                stop2 = stopPair[1]
-                stop2_geom = stoplatlon_dict[stop2]
-            except KeyError:
-                badStops.append(stop2)
-                badkeys.append(SourceOIDkey)
-                continue
-            cur.insertRow((stop1_geom, stop1, SourceOIDkey, 1))
-            cur.insertRow((stop2_geom, stop2, SourceOIDkey, 2))
+    Instrumentation.StartPhase("Output lines")
+    # Resolve the end points of all the segments at once
+    # linefeature_dict = {(start_stop, end_stop, route_type): segment_id}
+    segments = list(linefeature_dict.items())
+    from_xy, to_xy, badStops = StopGeometry.SegmentCoordinates([key[:2] for key, segment_id in segments], stoplatlon_dict)
 
     if badStops:
-        badStops = list(set(badStops))
         arcpy.AddWarning("Your stop_times.txt lists times for the following \
 stops which are not included in your stops.txt file. Schedule information for \
-these stops will be ignored. " + unicode(badStops))
-
-    # Remove these entries from the linefeatures dictionary so it doesn't cause false records later
-    if badkeys:
-        badkeys = list(set(badkeys))
-        for key in badkeys:
-            del linefeature_dict[key]
-
+these stops will be ignored. " + unicode(list(badStops)))
 
-# ----- Generate lines between all stops (for the final ND) -----
+    # Skip segments with a stop that has no geometry and lines with 0 length.
+    # Zero-length lines will just produce build errors and are not valuable for
+    # the network dataset in any other way. These segments get no line feature,
+    # so they are removed from linefeatures when the SourceOID values are added.
+    # Lines shorter than the XY tolerance collapse to zero length when stored.
+    valid = StopGeometry.ValidSegments(from_xy, to_xy, outFD_SR.XYTolerance)
 
-    arcpy.management.PointsToLine(outStopPairsFC, outLinesFC, "pair_id", "sequence")
+    arcpy.management.CreateFeatureclass(outFD, outLinesFCName, "POLYLINE", "", "", "", outFD_SR)
     arcpy.management.AddField(outLinesFC, "route_type", "SHORT")
     arcpy.management.AddField(outLinesFC, "route_type_text", "TEXT")
 
-    # We don't need the points for anything anymore, so delete them.
-    arcpy.Delete_management(outStopPairsFC)
-
-    # Clean up lines with 0 length.  They will just produce build errors and
-    # are not valuable for the network dataset in any other way.
-    expression = """"Shape_Length" = 0"""
-    with arcpy.da.UpdateCursor(outLinesFC, ["pair_id"], expression) as cur2:
-        for row in cur2:
-            del linefeature_dict[row[0]]
-            cur2.deleteRow()
-
-    # Insert the route type into the output lines
-    with arcpy.da.UpdateCursor(outLinesFC, ["pair_id", "route_type", "route_type_text", "OID@"]) as cur4:
-        # StopPairs: {pairID: [firstStop_id, secondStop_id, route_type]}
-        for row in cur4:
-            pair_id_list = row[0].split(" , ")
-            try:
-                route_type = int(pair_id_list[2])
-            except ValueError:
-                # The route_type has an invalid non-integer value.  If that's the case, just leave it as a string for now.
-                route_type = pair_id_list[2]
-            # While we're at it, add the line's ObjectID value to the linefeature_dict dictionary
-            linefeature_dict[row[0]] = long(row[3])
+    # Insert the lines with their route type, and keep the line's ObjectID value
+    # for the linefeatures table
+    SourceOID_rows = []
+    with arcpy.da.InsertCursor(outLinesFC, ["SHAPE@", "route_type", "route_type_text"]) as cur4:
+        for i in valid.nonzero()[0]:
+            (start_stop, end_stop, route_type), segment_id = segments[i]
+            # The route_type might have an invalid non-integer value.
             try:
                 route_type_text = route_type_dict[route_type]
             except KeyError: # The user's data isn't a standard type from the GTFS spec
                 route_type_text = "Other / Type not specified (%s)" % unicode(route_type)
             if not isinstance(route_type, int):
-                row[1] = None
-            else:
-                row[1] = route_type
-            row[2] = route_type_text
-            cur4.updateRow(row)
+                route_type = None
+            line = StopGeometry.SegmentPolyline(from_xy[i], to_xy[i], outFD_SR)
+            SourceOID = cur4.insertRow((line, route_type, route_type_text))
+            SourceOID_rows.append((long(SourceOID), segment_id))
 
 
 # ----- Add transit line feature information to the SQL database -----
 
-    def retrieve_linefeatures_info(in_key):
-        '''Creates the correct rows for insertion into the linefeatures table.'''
-        SourceOID = linefeature_dict[in_key]
-        pair_id_list = in_key.split(" , ")
-        from_stop = pair_id_list[0]
-        to_stop = pair_id_list[1]
-        try:
-            route_type = int(pair_id_list[2])
-        except ValueError:
-            # The route_type field has an invalid non-integer value, so just set it to a dummy value
-            route_type = "NULL"
-        out_row = (SourceOID, from_stop, to_stop, route_type)
-        return out_row
-
-    # Convert the dictionary into rows appropriately formatted for insertion into the SQL table
-    rows = itertools.imap(retrieve_linefeatures_info, linefeature_dict.keys())
-
-    # Add the rows to the SQL table
-    columns = ["SourceOID", "from_stop", "to_stop", "route_type"]
-    values_placeholders = ["?"] * len(columns)
-    c.executemany("INSERT INTO linefeatures (%s) VALUES (%s);" %
-                        (",".join(columns),
-                        ",".join(values_placeholders))
-                        , rows)
+    Instrumentation.StartPhase("Line feature info")
+    # Add the line ObjectIDs to the segments. Segments with no line feature (bad
+    # stops or zero length) are removed.
+    c.executemany("UPDATE linefeatures SET SourceOID = ? WHERE segment_id = ?;", SourceOID_rows)
+    c.execute("DELETE FROM linefeatures WHERE SourceOID IS NULL;")
     conn.commit()
 
     # Index the new table for fast lookups later (particularly in GetEIDs)
@@ -496,8 +473,16 @@ these stops will be ignored. " + unicode(badStops))
 
 # ----- Add the TransitLines feature class OID values to the schedules table for future reference -----
 
-    conn.create_function("getSourceOID", 1, lambda v: linefeature_dict[v] if v in linefeature_dict else -1)
-    c.execute("UPDATE schedules SET SourceOID = getSourceOID(SourceOIDKey)")
+    Instrumentation.StartPhase("Schedules table")
+    # Replace the segment_id with the SourceOID. The schedules table is rewritten
+    # sorted and clustered for fast lookups by SourceOID and time at the same
+    # time. Rows for segments with no line feature are left out.
+    sqlize_csv.create_clustered_schedules('''SELECT linefeatures.SourceOID, trip_id, start_time, end_time
+        FROM schedules_unsorted JOIN linefeatures ON linefeatures.segment_id = schedules_unsorted.SourceOID''')
+    # frequency_schedules is small, so it's updated in place. Segments with no line feature get -1.
+    c.execute('''UPDATE frequency_schedules SET SourceOID = IFNULL((SELECT linefeatures.SourceOID FROM linefeatures
+                 WHERE linefeatures.segment_id = frequency_schedules.SourceOID), -1);''')
+    c.execute(FrequencySchedules.FrequencySchedulesIndexStmt)
     conn.commit()
 
 
@@ -505,9 +490,6 @@ these stops will be ignored. " + unicode(badStops))
 
     # Clean up
     conn.close()
-    # We don't need the points for anything anymore, so delete them.
-    # Delete the pair_id column from TransitLines since it's no longer needed
-    arcpy.management.DeleteField(outLinesFC, "pair_id")
 
     arcpy.AddMessage("Finished!")
     arcpy.AddMessage("Your SQL table of GTFS data is:")
@@ -527,4 +509,5 @@ except:
 
 finally:
     # Reset the overwrite output to the user's original setting..
-    arcpy.env.overwriteOutput = OverwriteOutput
\ No newline at end of file
+    arcpy.env.overwriteOutput = OverwriteOutput
+    Instrumentation.EndRun()
\ No newline at end of file
@@ -0,0 +1,405 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Instrumentation
+
+Opt-in profiling of tool runs. Set the TRANSIT_TOOLS_PROFILE environment
+variable to a file path (or an existing folder) before running a tool, and a
+JSON trace of the run is written there when the tool finishes. If
+TRANSIT_TOOLS_PROFILE_CHROME is also set, a copy of the trace in Chrome's trace
+event format is written next to it. It can be opened in chrome://tracing or
+https://ui.perfetto.dev.
+
+The trace breaks the run into the phases marked with StartPhase and records
+for each phase:
+- wall clock and CPU time
+- peak Python memory use (via tracemalloc)
+- the number of SQLite statements executed, the number of rows fetched, and
+  the time spent executing and fetching them, for connections made with
+  connect()
+- the number of calls to, and time spent in, each arcpy geoprocessing tool
+
+When the environment variable is not set, all of this is a no-op and
+connect() returns a plain sqlite3 connection.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import datetime
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+ENV_VAR = "TRANSIT_TOOLS_PROFILE"
+CHROME_ENV_VAR = "TRANSIT_TOOLS_PROFILE_CHROME"
+
+# arcpy toolsets whose functions are timed
+ARCPY_TOOLSETS = ["management", "analysis", "conversion", "cartography", "edit", "na"]
+
+try:
+    _cpu_clock = time.process_time
+    _wall_clock = time.perf_counter
+except AttributeError:
+    # Python 2
+    _cpu_clock = time.clock
+    _wall_clock = time.time
+
+# The run being profiled, if any
+_run = None
+# Guards the phase counters, which cursors used from worker threads update
+_counter_lock = threading.Lock()
+
+
+def Enabled():
+    '''Return True if profiling has been turned on with the environment variable.'''
+    return bool(os.environ.get(ENV_VAR))
+
+
+def _Message(msg):
+    try:
+        import arcpy
+        arcpy.AddMessage(msg)
+    except ImportError:
+        logging.getLogger("AddGTFS").info(msg)
+
+
+class _Phase(object):
+    '''Timings and counters for one phase of a run.'''
+
+    def __init__(self, name, run_start):
+        self.name = name
+        self.start = _wall_clock() - run_start
+        self._wall_start = _wall_clock()
+        self._cpu_start = _cpu_clock()
+        self.wall = None
+        self.cpu = None
+        self.peak_memory = None
+        self.sql_statements = 0
+        self.sql_rows = 0
+        self.sql_execute_time = 0.0
+        self.sql_fetch_time = 0.0
+        self.arcpy_calls = {} # {tool name: [number of calls, seconds]}
+        if tracemalloc and tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def end(self):
+        self.wall = _wall_clock() - self._wall_start
+        self.cpu = _cpu_clock() - self._cpu_start
+        if tracemalloc and tracemalloc.is_tracing():
+            # Before Python 3.9, the peak can't be reset, so this is the peak since the run started.
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+
+    def as_dict(self):
+        return {"name": self.name,
+                "start_s": round(self.start, 6),
+                "wall_s": round(self.wall, 6),
+                "cpu_s": round(self.cpu, 6),
+                "peak_memory_bytes": self.peak_memory,
+                "sql": {"statements": self.sql_statements,
+                        "rows_fetched": self.sql_rows,
+                        "execute_s": round(self.sql_execute_time, 6),
+                        "fetch_s": round(self.sql_fetch_time, 6)},
+                "arcpy": dict((tool, {"calls": calls, "seconds": round(seconds, 6)})
+                              for tool, (calls, seconds) in self.arcpy_calls.items())}
+
+
+class _Run(object):
+    '''A profiled tool run, made up of consecutive phases.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.datetime.now()
+        self.start = _wall_clock()
+        self.epoch_start = time.time()
+        self.phases = []
+        self.phase = None
+        self.arcpy_events = [] # [(tool name, start, duration)] relative to the run start
+        self.arcpy_depth = 0
+        self.arcpy_originals = [] # [(toolset module, function name, original function)]
+        self.started_tracemalloc = False
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self._wrap_arcpy()
+
+    def start_phase(self, name):
+        self.end_phase()
+        with _counter_lock:
+            self.phase = _Phase(name, self.start)
+
+    def end_phase(self):
+        with _counter_lock:
+            if self.phase:
+                self.phase.end()
+                self.phases.append(self.phase)
+                self.phase = None
+
+    def end(self):
+        self.end_phase()
+        self.wall = _wall_clock() - self.start
+        self._unwrap_arcpy()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+    def _wrap_arcpy(self):
+        '''Time calls to the arcpy geoprocessing tools for the duration of the run.'''
+        try:
+            import arcpy
+        except ImportError:
+            return
+        for toolset_name in ARCPY_TOOLSETS:
+            toolset = getattr(arcpy, toolset_name, None)
+            if toolset is None:
+                continue
+            for func_name in dir(toolset):
+                if func_name.startswith("_"):
+                    continue
+                func = getattr(toolset, func_name)
+                # Only wrap functions, not the classes and constants in the toolsets
+                if not callable(func) or isinstance(func, type):
+                    continue
+                self.arcpy_originals.append((toolset, func_name, func))
+                setattr(toolset, func_name, self._timed(toolset_name + "." + func_name, func))
+
+    def _unwrap_arcpy(self):
+        for toolset, func_name, func in self.arcpy_originals:
+            setattr(toolset, func_name, func)
+        self.arcpy_originals = []
+
+    def _timed(self, tool_name, func):
+        run = self
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Only time the outermost call if tools call other tools.
+            if run.arcpy_depth:
+                return func(*args, **kwargs)
+            run.arcpy_depth += 1
+            start = _wall_clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = _wall_clock() - start
+                run.arcpy_depth -= 1
+                run.arcpy_events.append((tool_name, start - run.start, duration))
+                if run.phase:
+                    stats = run.phase.arcpy_calls.setdefault(tool_name, [0, 0.0])
+                    stats[0] += 1
+                    stats[1] += duration
+        return wrapper
+
+    def as_dict(self):
+        return {"tool": self.name,
+                "started": self.started.isoformat(),
+                "wall_s": round(self.wall, 6),
+                "python": sys.version.split()[0],
+                "phases": [phase.as_dict() for phase in self.phases]}
+
+    def as_chrome_trace(self):
+        '''Return the run in Chrome's trace event format. Times are in microseconds.'''
+        pid = os.getpid()
+        events = [{"name": self.name, "cat": "run", "ph": "X", "pid": pid, "tid": 0,
+                   "ts": 0, "dur": int(self.wall * 1e6)}]
+        for phase in self.phases:
+            args = phase.as_dict()
+            del args["name"]
+            events.append({"name": phase.name, "cat": "phase", "ph": "X", "pid": pid, "tid": 0,
+                           "ts": int(phase.start * 1e6), "dur": int(phase.wall * 1e6), "args": args})
+        for tool_name, start, duration in self.arcpy_events:
+            events.append({"name": tool_name, "cat": "arcpy", "ph": "X", "pid": pid, "tid": 0,
+                           "ts": int(start * 1e6), "dur": int(duration * 1e6)})
+        return {"traceEvents": events, "displayTimeUnit": "ms",
+                "otherData": {"tool": self.name, "started": self.started.isoformat()}}
+
+
+def StartRun(name, first_phase="Set up"):
+    '''Start profiling a tool run, if profiling is enabled. The first phase of
+    the run is started automatically.'''
+    global _run
+    if not Enabled():
+        return
+    if _run:
+        # A run is already being profiled (for example, a tool calling another tool).
+        # Treat this as a phase of the outer run.
+        StartPhase(name)
+        return
+    _run = _Run(name)
+    _run.start_phase(first_phase)
+
+
+def StartPhase(name):
+    '''End the current phase of the run being profiled, if any, and start a new one.'''
+    if _run:
+        _run.start_phase(name)
+
+
+def EndRun():
+    '''Stop profiling and write the trace files. Returns the path to the JSON
+    trace, or None if profiling was not enabled.'''
+    global _run
+    if not _run:
+        return None
+    run = _run
+    _run = None
+    run.end()
+
+    trace_path = os.environ.get(ENV_VAR)
+    if os.path.isdir(trace_path):
+        filename = "%s_%s.json" % (re.sub(r"\W+", "_", run.name).strip("_"),
+                                   run.started.strftime("%Y%m%d_%H%M%S"))
+        trace_path = os.path.join(trace_path, filename)
+    with open(trace_path, "w") as f:
+        json.dump(run.as_dict(), f, indent=2)
+    _Message("Profiling trace written to " + trace_path)
+    if os.environ.get(CHROME_ENV_VAR):
+        chrome_path = os.path.splitext(trace_path)[0] + ".chrome.json"
+        with open(chrome_path, "w") as f:
+            json.dump(run.as_chrome_trace(), f)
+        _Message("Chrome trace written to " + chrome_path)
+    return trace_path
+
+
+def Profiled(name):
+    '''Decorator for a tool's runTool function that profiles each call as one run.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not Enabled():
+                return func(*args, **kwargs)
+            is_outer_run = _run is None
+            StartRun(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if is_outer_run:
+                    EndRun()
+        return wrapper
+    return decorator
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    '''sqlite3 cursor that counts statements and fetched rows and times them
+    in the current phase of the run. Cursors may be used from several threads at
+    once, so the counters are updated under a lock.'''
+
+    def _record(self, start, is_fetch, num_rows=0):
+        elapsed = _wall_clock() - start
+        with _counter_lock:
+            phase = _run.phase if _run else None
+            if not phase:
+                return
+            if is_fetch:
+                phase.sql_fetch_time += elapsed
+                phase.sql_rows += num_rows
+            else:
+                phase.sql_execute_time += elapsed
+                phase.sql_statements += 1
+
+    def execute(self, *args, **kwargs):
+        start = _wall_clock()
+        try:
+            return sqlite3.Cursor.execute(self, *args, **kwargs)
+        finally:
+            self._record(start, False)
+
+    def executemany(self, *args, **kwargs):
+        start = _wall_clock()
+        try:
+            return sqlite3.Cursor.executemany(self, *args, **kwargs)
+        finally:
+            self._record(start, False)
+
+    def executescript(self, *args, **kwargs):
+        start = _wall_clock()
+        try:
+            return sqlite3.Cursor.executescript(self, *args, **kwargs)
+        finally:
+            self._record(start, False)
+
+    def fetchone(self):
+        start = _wall_clock()
+        row = sqlite3.Cursor.fetchone(self)
+        self._record(start, True, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = _wall_clock()
+        rows = sqlite3.Cursor.fetchmany(self, *args, **kwargs)
+        self._record(start, True, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = _wall_clock()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._record(start, True, len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = _wall_clock()
+        try:
+            row = sqlite3.Cursor.__next__(self)
+        except StopIteration:
+            self._record(start, True)
+            raise
+        self._record(start, True, 1)
+        return row
+
+    def next(self):
+        # Python 2
+        start = _wall_clock()
+        try:
+            row = sqlite3.Cursor.next(self)
+        except StopIteration:
+            self._record(start, True)
+            raise
+        self._record(start, True, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''sqlite3 connection whose cursors are InstrumentedCursors.'''
+
+    def cursor(self, factory=InstrumentedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    # The execute shortcuts on sqlite3.Connection don't always go through cursor().
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
+
+    def executescript(self, *args, **kwargs):
+        return self.cursor().executescript(*args, **kwargs)
+
+
+def connect(database, **kwargs):
+    '''Connect to a SQLite database. If profiling is enabled, the connection is
+    instrumented to record query statistics.'''
+    if Enabled():
+        kwargs["factory"] = InstrumentedConnection
+    return sqlite3.connect(database, **kwargs)
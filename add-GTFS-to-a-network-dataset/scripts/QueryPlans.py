@@ -0,0 +1,205 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Query Plans
+
+Checks the query plans SQLite uses for the schedule lookups that Copy Traversed
+Source Features (with Transit) and Transit Identify run for every date and
+every transit line. These lookups are run many thousands of times, so if
+SQLite stops using an index for one of them, because an index or a query was
+changed, the tools slow down dramatically without giving wrong answers. A
+query fails the check if its plan scans a whole table or sorts with a
+temporary B-tree. Queries that run once per tool run and have to read a whole
+table, such as FrequencySchedules.MaxTimeFetch, are checked only for sorts.
+
+The queries and the indices the tools create the first time they are run on a
+GTFS SQL database are read from the module-level constants in the tool
+scripts, without running the scripts. By default, the check is run on a small
+synthetic database built with the tables and indices of sqlize_csv, including
+the clustered schedules table, plus those indices for the other tables. An
+existing GTFS SQL database can be checked instead (the tools' indices are not
+added to it).
+
+Usage:
+    python QueryPlans.py [GTFS SQL database]
+The plan of each query is printed. The exit status is 1 if any query fails.
+The same checks run on the synthetic database in tests/test_QueryPlans.py.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import argparse
+import ast
+import os
+import re
+import sqlite3
+import sys
+import sqlize_csv
+import FrequencySchedules
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Plan details that mean SQLite reads every row of a table or sorts the results
+ScanDetail = re.compile(r"^SCAN (TABLE )?(?P<table>\w+)")
+TempBTreeDetail = re.compile(r"USE TEMP B-TREE")
+
+
+def ReadConstants(script):
+    '''Return a dictionary of the module-level constants assigned in a tool
+    script. The script is parsed, not imported, since the tool scripts run when
+    they are imported.'''
+    with open(os.path.join(scripts_dir, script)) as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                constants[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return constants
+
+
+def HotQueries():
+    '''Return a list of (name, sql, params) for the queries to check, with
+    sample parameters.'''
+    copytraversed = ReadConstants("CopyTraversedSourceFeatures_wTransit.py")
+    transitidentify = ReadConstants("TransitIdentify.py")
+    return [("CopyTraversedSourceFeatures_wTransit.CalendarDatesFetch", copytraversed["CalendarDatesFetch"], ("20180102",)),
+            ("CopyTraversedSourceFeatures_wTransit.ScheduleFetch (end_time)", copytraversed["ScheduleFetch"] % "end_time", (1, 30000)),
+            ("CopyTraversedSourceFeatures_wTransit.ScheduleFetch (start_time)", copytraversed["ScheduleFetch"] % "start_time", (1, 30000)),
+            ("TransitIdentify.ScheduleFetch", transitidentify["ScheduleFetch"], (1,)),
+            ("FrequencySchedules.FrequencyScheduleFetch", FrequencySchedules.FrequencyScheduleFetch, (1,))]
+
+
+def FullScanQueries():
+    '''Return a list of (name, sql, params) for the queries that run once per
+    tool run and read a whole table.'''
+    return [("FrequencySchedules.MaxTimeFetch (%s)" % field, FrequencySchedules.MaxTimeFetch % field, ())
+            for field in ["start_offset", "end_offset"]]
+
+
+def ToolIndexStmts():
+    '''Return the CREATE INDEX statements the tools run the first time they are
+    used with a GTFS SQL database.'''
+    stmts = []
+    for script in ["CopyTraversedSourceFeatures_wTransit.py", "TransitIdentify.py"]:
+        for name, value in sorted(ReadConstants(script).items()):
+            if name.endswith("IndexStmt") and value not in stmts:
+                stmts.append(value)
+    return stmts
+
+
+def BuildTestDatabase(SQLDbase=":memory:", num_lines=100, num_trips=100):
+    '''Create a synthetic GTFS SQL database with the tables and indices created
+    by Generate Transit Lines and Stops (including frequency_schedules) and the
+    tools. Returns the connection.'''
+    # Start a new database even if an earlier one is still open or was closed.
+    sqlize_csv.db = None
+    sqlize_csv.connect(SQLDbase)
+    conn = sqlize_csv.db
+    for tblname in sqlize_csv.sql_schema:
+        sqlize_csv.create_table(tblname)
+
+    conn.executemany('''INSERT INTO calendar (service_id, monday, tuesday, wednesday, thursday, friday,
+                        saturday, sunday, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                     [("s0", 1, 1, 1, 1, 1, 0, 0, "20180101", "20181231"),
+                      ("s1", 0, 0, 0, 0, 0, 1, 1, "20180101", "20181231")])
+    conn.executemany("INSERT INTO calendar_dates (service_id, date, exception_type) VALUES (?, ?, ?);",
+                     [("s0", "20180101", 2), ("s1", "20180101", 1)])
+    conn.executemany("INSERT INTO trips (route_id, service_id, trip_id) VALUES (?, ?, ?);",
+                     [("r0", "s%d" % (trip % 2), "t%d" % trip) for trip in range(num_trips)])
+    schedules = []
+    for trip in range(num_trips):
+        for line in range(num_lines):
+            start_time = 5 * 3600 + trip * 300 + line * 60
+            schedules.append((line + 1, "t%d" % trip, start_time, start_time + 60))
+    conn.executemany('''INSERT INTO schedules (SourceOID, trip_id, start_time, end_time)
+                        VALUES (?, ?, ?, ?);''', schedules)
+    conn.executemany('''INSERT INTO frequency_schedules (SourceOID, trip_id, window_start,
+                        window_end, headway_secs, start_offset, end_offset) VALUES (?, ?, ?, ?, ?, ?, ?);''',
+                     [(line + 1, "f0", 6 * 3600, 9 * 3600, 600, line * 60, line * 60 + 60)
+                      for line in range(num_lines)])
+    conn.commit()
+    sqlize_csv.create_indices()
+    sqlize_csv.create_clustered_schedules()
+    conn.execute(FrequencySchedules.FrequencySchedulesIndexStmt)
+    # The tools don't index a schedules table made by create_clustered_schedules.
+    for stmt in ToolIndexStmts():
+        if " ON schedules " not in stmt:
+            conn.execute(stmt)
+    conn.commit()
+    return conn
+
+
+def GetQueryPlan(conn, sql, params=()):
+    '''Return the list of detail strings from EXPLAIN QUERY PLAN for the query.'''
+    return [str(row[-1]) for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def FindPlanProblems(plan, allow_scan=False):
+    '''Return a list of the steps in the query plan that scan a whole table
+    (unless allow_scan is True) or sort with a temporary B-tree.'''
+    problems = []
+    for detail in plan:
+        scan = ScanDetail.match(detail)
+        if scan:
+            if not allow_scan:
+                problems.append("Full scan of table %s: %s" % (scan.group("table"), detail))
+        elif TempBTreeDetail.search(detail):
+            problems.append("Temporary B-tree: %s" % detail)
+    return problems
+
+
+def CheckQueryPlans(conn):
+    '''Return a list of (name, plan, problems) for each of the HotQueries and
+    FullScanQueries.'''
+    results = []
+    for queries, allow_scan in [(HotQueries(), False), (FullScanQueries(), True)]:
+        for name, sql, params in queries:
+            plan = GetQueryPlan(conn, sql, params)
+            results.append((name, plan, FindPlanProblems(plan, allow_scan)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the transit schedule lookups use indices.")
+    parser.add_argument("database", nargs="?",
+                        help="GTFS SQL database to check (default: a synthetic database with the standard indices)")
+    args = parser.parse_args(argv)
+
+    if args.database:
+        conn = sqlite3.connect(args.database)
+    else:
+        conn = BuildTestDatabase()
+
+    num_failed = 0
+    for name, plan, problems in CheckQueryPlans(conn):
+        print("%-4s  %s" % ("FAIL" if problems else "ok", name))
+        for detail in plan:
+            print("        " + detail)
+        for problem in problems:
+            print("        " + problem)
+        if problems:
+            num_failed += 1
+    conn.close()
+
+    if num_failed:
+        print("%d queries do not use an index." % num_failed)
+        return 1
+    print("All queries use an index.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Schedule Cache
+
+A binary cache of the transit schedules in a GTFS SQL database, for the Python
+tools that look up the trips crossing a transit line many thousands of times
+(Copy Traversed Source Features (with Transit) and Transit Identify).
+
+The cache is a single file stored next to the database and named after it
+(the cache of GTFS.sql is GTFS_schedules.cache). It holds NumPy arrays that are
+memory-mapped when the cache is opened, so opening it takes milliseconds no
+matter how large the schedules are:
+- For each transit line (SourceOID), the trips crossing it, sorted by end_time,
+  as int32 arrays of start_time, end_time, and trip index, plus a second copy
+  of the start times sorted by start_time. The trips at a time of day are
+  found with a binary search of the line's slice of the arrays.
+- For each trip index, the trip_id and the index of its route_id and
+  service_id.
+The departures of trips using frequencies.txt (the frequency_schedules table)
+are expanded into the arrays when the cache is built.
+
+The size and modification time of the database are stored in the cache. If
+they don't match the database, the cache is stale and must be rebuilt.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import json
+import os
+import struct
+import tempfile
+import numpy as np
+import FrequencySchedules
+
+# Added to the name of the database, without its extension, to name its cache
+CacheSuffix = "_schedules.cache"
+CacheVersion = 1
+
+# File layout: magic bytes, header length, JSON header, then the arrays, each
+# starting at a multiple of Alignment bytes. The header gives the offset of
+# each array from the start of the arrays.
+Magic = b"GTFSSCHD"
+Alignment = 8
+FetchSize = 100000
+
+
+def CachePath(SQLDbase):
+    '''Return the path of the schedule cache for a GTFS SQL database.'''
+    return os.path.splitext(SQLDbase)[0] + CacheSuffix
+
+
+def DatabaseStamp(SQLDbase):
+    '''Return the size and modification time of the GTFS SQL database, which
+    change whenever the database is written.'''
+    stat = os.stat(SQLDbase)
+    return [stat.st_size, stat.st_mtime]
+
+
+def ReadSchedules(conn, trip_index_dict):
+    '''Return arrays of SourceOID, trip index, start_time, and end_time for every
+    row of the schedules table and every departure in frequency_schedules. Trips
+    missing from the trips table get trip index -1. The arrays are allocated
+    once from the row counts and filled FetchSize rows at a time, so no Python
+    object is kept for each row.'''
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM schedules;")
+    num_rows = c.fetchone()[0]
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (FrequencySchedules.TableName,))
+    if c.fetchall():
+        c.execute('''SELECT SourceOID, trip_id, window_start, window_end, headway_secs, start_offset, end_offset
+                     FROM frequency_schedules;''')
+        windows = c.fetchall()
+    else:
+        windows = []
+    num_rows += sum(FrequencySchedules.NumDepartures(window[1:]) for window in windows)
+
+    sourceoids = np.empty(num_rows, dtype=np.int64)
+    trips = np.empty(num_rows, dtype=np.int32)
+    start_times = np.empty(num_rows, dtype=np.int32)
+    end_times = np.empty(num_rows, dtype=np.int32)
+    filled = [0]
+
+    def add_rows(rows):
+        first = filled[0]
+        last = first + len(rows)
+        if last > num_rows:
+            raise ValueError("The schedules table changed while the schedule cache was being built.")
+        SourceOIDs, trip_ids, row_start_times, row_end_times = zip(*rows)
+        sourceoids[first:last] = SourceOIDs
+        trips[first:last] = [trip_index_dict.get(trip_id, -1) for trip_id in trip_ids]
+        # Round half up, like round() in Python 2, since the times are not negative
+        start_times[first:last] = np.floor(np.array(row_start_times, dtype=np.float64) + 0.5)
+        end_times[first:last] = np.floor(np.array(row_end_times, dtype=np.float64) + 0.5)
+        filled[0] = last
+
+    c.execute("SELECT SourceOID, trip_id, start_time, end_time FROM schedules;")
+    while True:
+        rows = c.fetchmany(FetchSize)
+        if not rows:
+            break
+        add_rows(rows)
+
+    for window in windows:
+        departures = FrequencySchedules.ExpandDepartures(window[1:])
+        if departures:
+            add_rows([(window[0],) + departure for departure in departures])
+
+    num_rows = filled[0]
+    return sourceoids[:num_rows], trips[:num_rows], start_times[:num_rows], end_times[:num_rows]
+
+
+def Align(num_bytes):
+    '''Round num_bytes up to a multiple of Alignment.'''
+    return -(-num_bytes // Alignment) * Alignment
+
+
+def StringArray(values):
+    '''Return a fixed-width unicode array of the values, with None as "".'''
+    values = [u"" if value is None else value for value in values]
+    if not values:
+        return np.zeros(0, dtype="U1")
+    return np.array(values, dtype="U")
+
+
+def BuildCache(conn, SQLDbase):
+    '''Build the schedule cache for the GTFS SQL database from the open
+    connection conn. The file is written under a unique temporary name in the
+    same folder and then moved into place, so tools building the cache at the
+    same time don't write over each other's files. Raises IOError or OSError if
+    it can't be written.'''
+    c = conn.cursor()
+    c.execute("SELECT trip_id, route_id, service_id FROM trips;")
+    tripinfo = c.fetchall()
+    route_ids = sorted(set(trip[1] for trip in tripinfo))
+    service_ids = sorted(set(trip[2] for trip in tripinfo))
+    route_index_dict = dict((route_id, i) for i, route_id in enumerate(route_ids))
+    service_index_dict = dict((service_id, i) for i, service_id in enumerate(service_ids))
+    trip_index_dict = dict((trip[0], i) for i, trip in enumerate(tripinfo))
+
+    sourceoids, trips, start_times, end_times = ReadSchedules(conn, trip_index_dict)
+
+    # Sort by SourceOID and end_time, and find where each SourceOID starts
+    order = np.lexsort((trips, end_times, sourceoids))
+    sourceoids = sourceoids[order]
+    trips = trips[order]
+    start_times = start_times[order]
+    end_times = end_times[order]
+    lines, first_rows = np.unique(sourceoids, return_index=True)
+    offsets = np.append(first_rows, len(sourceoids)).astype(np.int64)
+    # Rows sorted by start_time within each SourceOID, for solves backwards in time
+    start_rows = np.lexsort((start_times, sourceoids)).astype(np.int32)
+
+    arrays = [("lines", lines),
+              ("offsets", offsets),
+              ("trips", trips),
+              ("start_times", start_times),
+              ("end_times", end_times),
+              ("start_rows", start_rows),
+              ("start_times_sorted", start_times[start_rows]),
+              ("trip_ids", StringArray([trip[0] for trip in tripinfo])),
+              ("trip_routes", np.array([route_index_dict[trip[1]] for trip in tripinfo], dtype=np.int32)),
+              ("trip_services", np.array([service_index_dict[trip[2]] for trip in tripinfo], dtype=np.int32)),
+              ("route_ids", StringArray(route_ids)),
+              ("service_ids", StringArray(service_ids))]
+
+    header = {"version": CacheVersion,
+              "database": DatabaseStamp(SQLDbase),
+              "max_start_time": int(start_times.max()) if len(start_times) else None,
+              "max_end_time": int(end_times.max()) if len(end_times) else None,
+              "arrays": {}}
+    offset = 0
+    for name, array in arrays:
+        header["arrays"][name] = [array.dtype.str, len(array), offset]
+        offset += Align(array.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = Align(len(Magic) + 8 + len(header_bytes))
+
+    path = CachePath(SQLDbase)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", prefix=os.path.basename(path) + ".",
+                                     dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(Magic)
+            f.write(struct.pack("<Q", len(header_bytes)))
+            f.write(header_bytes)
+            for name, array in arrays:
+                f.seek(data_start + header["arrays"][name][2])
+                f.write(array.tobytes() if hasattr(array, "tobytes") else array.tostring())
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def LoadCache(SQLDbase):
+    '''Return a ScheduleCache for the GTFS SQL database, or None if the cache
+    doesn't exist, was written by a different version of this module, or is
+    stale.'''
+    path = CachePath(SQLDbase)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(Magic)) != Magic:
+            return None
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    if header["version"] != CacheVersion or header["database"] != DatabaseStamp(SQLDbase):
+        return None
+    return ScheduleCache(path, header, Align(len(Magic) + 8 + header_length))
+
+
+class ScheduleCache(object):
+    '''The memory-mapped arrays of a schedule cache file. Use LoadCache to
+    open one.'''
+
+    def __init__(self, path, header, data_start):
+        self.max_start_time = header["max_start_time"]
+        self.max_end_time = header["max_end_time"]
+        for name, (dtype, length, offset) in header["arrays"].items():
+            if length:
+                array = np.memmap(path, dtype=np.dtype(dtype), mode="r", offset=data_start + offset, shape=(length,))
+            else:
+                array = np.zeros(0, dtype=np.dtype(dtype))
+            setattr(self, name, array)
+
+    def MaxTime(self, use_start_time=False):
+        '''Return the largest start_time (if use_start_time) or end_time of any
+        trip, or None if there are no schedules.'''
+        return self.max_start_time if use_start_time else self.max_end_time
+
+    def LineRows(self, SourceOID):
+        '''Return the first and last + 1 rows of the arrays for the transit line.'''
+        i = np.searchsorted(self.lines, SourceOID)
+        if i == len(self.lines) or self.lines[i] != SourceOID:
+            return 0, 0
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def Trip(self, row):
+        '''Return (trip_id, start_time, end_time, route_id, service_id) for a row
+        of the arrays, or None if the trip isn't in the trips table.'''
+        trip = self.trips[row]
+        if trip < 0:
+            return None
+        return (self.trip_ids[trip].item(), int(self.start_times[row]), int(self.end_times[row]),
+                self.route_ids[self.trip_routes[trip]].item(), self.service_ids[self.trip_services[trip]].item())
+
+    def TripsAtTime(self, SourceOID, time_of_day, use_start_time=False):
+        '''Return a list of (trip_id, start_time, end_time, route_id, service_id)
+        for the trips crossing the transit line with an end_time (or start_time,
+        if use_start_time) of exactly time_of_day (seconds since midnight).'''
+        first, last = self.LineRows(SourceOID)
+        if use_start_time:
+            times = self.start_times_sorted[first:last]
+            rows = self.start_rows[first + np.searchsorted(times, time_of_day, "left"):
+                                   first + np.searchsorted(times, time_of_day, "right")]
+        else:
+            times = self.end_times[first:last]
+            rows = range(first + int(np.searchsorted(times, time_of_day, "left")),
+                         first + int(np.searchsorted(times, time_of_day, "right")))
+        return [trip for trip in (self.Trip(row) for row in rows) if trip]
+
+    def AllTrips(self, SourceOID):
+        '''Return a list of (trip_id, start_time, end_time, route_id, service_id)
+        for all the trips crossing the transit line.'''
+        first, last = self.LineRows(SourceOID)
+        return [trip for trip in (self.Trip(row) for row in range(first, last)) if trip]
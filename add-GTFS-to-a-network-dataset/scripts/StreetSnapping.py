@@ -0,0 +1,228 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Street Snapping
+
+Snaps points (transit stops) to the nearest street segment within a tolerance,
+for Generate Stop-Street Connectors. This replaces Snap and Integrate, which
+copy and rewrite the whole street feature class. Only NumPy is needed, so the
+snapping can be checked without arcpy.
+
+- StreetSegments flattens the street polylines into a structured array with
+  one row per two-vertex segment, remembering which feature, part, and vertex
+  it came from.
+- SnapPoints looks up the candidate segments for each point in a uniform grid
+  over the segments, projects the points onto all their candidates at once,
+  and keeps the nearest one within the tolerance.
+- VertexInserts turns the snapped positions into instructions for adding a
+  vertex to each street feature where a point snapped to the middle of a
+  segment, and InsertVertices applies them to the vertices of a feature.
+The connector lines run from each point to its snapped location.
+
+Each point is snapped independently, so a large area can be split into tiles:
+snapping the points in a tile to SegmentsInExtent of the tile's extent gives
+the same answer as snapping them to all the segments.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import numpy as np
+
+SegmentDtype = [("feature", np.int64), ("part", np.int32), ("vertex", np.int32),
+                ("x0", np.float64), ("y0", np.float64), ("x1", np.float64), ("y1", np.float64)]
+
+# Conversion of the snap distance units offered by the tool
+MetersPerUnit = {"meters": 1.0, "feet": 0.3048}
+
+
+def StreetSegments(parts):
+    '''Return a structured array of the segments of the street features. parts
+    is an iterable of (feature_id, part_index, vertices), where vertices is a
+    list of (x, y). Segment i of a part runs from vertex i to vertex i + 1.'''
+    rows = []
+    for feature_id, part_index, vertices in parts:
+        for i in range(len(vertices) - 1):
+            rows.append((feature_id, part_index, i) + tuple(vertices[i][:2]) + tuple(vertices[i + 1][:2]))
+    return np.array(rows, dtype=SegmentDtype)
+
+
+def SegmentsInExtent(segments, xmin, ymin, xmax, ymax, tolerance):
+    '''Return a boolean array that is True for the segments whose bounding box
+    is within tolerance of the extent.'''
+    return ((np.maximum(segments["x0"], segments["x1"]) >= xmin - tolerance) &
+            (np.minimum(segments["x0"], segments["x1"]) <= xmax + tolerance) &
+            (np.maximum(segments["y0"], segments["y1"]) >= ymin - tolerance) &
+            (np.minimum(segments["y0"], segments["y1"]) <= ymax + tolerance))
+
+
+def ProjectToSegments(px, py, x0, y0, x1, y1):
+    '''Project points onto segments, element by element. Returns (t, x, y,
+    distance), where t is the position of the nearest point of the segment
+    (0 at the start, 1 at the end), x and y are its coordinates, and distance
+    is the distance to it.'''
+    dx = x1 - x0
+    dy = y1 - y0
+    length2 = dx * dx + dy * dy
+    t = ((px - x0) * dx + (py - y0) * dy) / np.where(length2 > 0, length2, 1.0)
+    t = np.clip(np.where(length2 > 0, t, 0.0), 0.0, 1.0)
+    x = x0 + t * dx
+    y = y0 + t * dy
+    return t, x, y, np.hypot(px - x, py - y)
+
+
+def BuildGrid(segments, tolerance, cell_size):
+    '''Index the segments in a grid of square cells. A segment is listed in
+    every cell its bounding box, grown by tolerance, touches, so every segment
+    within tolerance of a point is listed in the point's cell. Segments longer
+    than cell_size are split into pieces no longer than cell_size first, and
+    each piece is listed under its segment's index, so a long diagonal segment
+    is listed in the cells along it instead of every cell of its bounding box.
+    Returns (origin, cell keys, segment indices), sorted by cell key and
+    segment index, with each segment listed at most once per cell.'''
+    x0 = segments["x0"]
+    y0 = segments["y0"]
+    dx = segments["x1"] - x0
+    dy = segments["y1"] - y0
+    num_pieces = np.maximum(np.ceil(np.hypot(dx, dy) / cell_size), 1).astype(np.int64)
+    seg = np.repeat(np.arange(len(segments)), num_pieces)
+    piece = np.arange(num_pieces.sum()) - np.repeat(np.cumsum(num_pieces) - num_pieces, num_pieces)
+    t0 = piece / num_pieces[seg].astype(np.float64)
+    t1 = (piece + 1) / num_pieces[seg].astype(np.float64)
+    px0 = x0[seg] + t0 * dx[seg]
+    px1 = x0[seg] + t1 * dx[seg]
+    py0 = y0[seg] + t0 * dy[seg]
+    py1 = y0[seg] + t1 * dy[seg]
+
+    xmin = np.minimum(px0, px1) - tolerance
+    xmax = np.maximum(px0, px1) + tolerance
+    ymin = np.minimum(py0, py1) - tolerance
+    ymax = np.maximum(py0, py1) + tolerance
+    origin = (xmin.min(), ymin.min())
+    ix0 = ((xmin - origin[0]) // cell_size).astype(np.int64)
+    ix1 = ((xmax - origin[0]) // cell_size).astype(np.int64)
+    iy0 = ((ymin - origin[1]) // cell_size).astype(np.int64)
+    iy1 = ((ymax - origin[1]) // cell_size).astype(np.int64)
+    ny = iy1 - iy0 + 1
+    counts = (ix1 - ix0 + 1) * ny
+    cell_piece = np.repeat(np.arange(len(seg)), counts)
+    cell = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = _CellKey(ix0[cell_piece] + cell // ny[cell_piece], iy0[cell_piece] + cell % ny[cell_piece])
+    cell_seg = seg[cell_piece]
+    # Neighboring pieces of a segment touch some of the same cells
+    order = np.lexsort((cell_seg, keys))
+    keys = keys[order]
+    cell_seg = cell_seg[order]
+    unique = np.ones(len(keys), dtype=bool)
+    unique[1:] = (keys[1:] != keys[:-1]) | (cell_seg[1:] != cell_seg[:-1])
+    return origin, keys[unique], cell_seg[unique]
+
+
+def _CellKey(ix, iy):
+    '''Combine grid column and row numbers into one sortable key.'''
+    return ix * (1 << 32) + iy
+
+
+def SnapPoints(xy, segments, tolerance, cell_size=None, x_scale=1.0):
+    '''Snap points to the nearest segment within tolerance. xy is an array of
+    shape (number of points, 2). Distances are measured after multiplying the
+    x coordinates by x_scale, which lets geographic coordinates be snapped with
+    a tolerance in degrees of latitude. The grid cell size defaults to the
+    larger of the tolerance and the median segment length.
+
+    Returns (segment, t, snapped_xy, distance). segment is the index of the
+    nearest segment, or -1 if there is none within tolerance. t is the
+    position along it (see ProjectToSegments). snapped_xy is the snapped
+    location, or the original location of points that didn't snap. distance is
+    NaN for points that didn't snap. Ties go to the lowest segment index.'''
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    num_points = len(xy)
+    segment = np.empty(num_points, dtype=np.int64)
+    segment.fill(-1)
+    t = np.zeros(num_points)
+    snapped_xy = xy.copy()
+    distance = np.empty(num_points)
+    distance.fill(np.nan)
+    if not num_points or not len(segments):
+        return segment, t, snapped_xy, distance
+
+    # Snap in the scaled coordinates
+    scaled = segments.copy()
+    scaled["x0"] *= x_scale
+    scaled["x1"] *= x_scale
+    px = xy[:, 0] * x_scale
+    py = xy[:, 1]
+    if cell_size is None:
+        lengths = np.hypot(scaled["x1"] - scaled["x0"], scaled["y1"] - scaled["y0"])
+        cell_size = max(tolerance, float(np.median(lengths)))
+    if cell_size <= 0:
+        cell_size = 1.0
+    origin, keys, cell_segments = BuildGrid(scaled, tolerance, cell_size)
+
+    # Candidate (point, segment) pairs from each point's cell
+    point_keys = _CellKey(((px - origin[0]) // cell_size).astype(np.int64),
+                          ((py - origin[1]) // cell_size).astype(np.int64))
+    first = np.searchsorted(keys, point_keys, "left")
+    counts = np.searchsorted(keys, point_keys, "right") - first
+    pair_point = np.repeat(np.arange(num_points), counts)
+    pair_segment = cell_segments[np.repeat(first, counts) + np.arange(counts.sum()) -
+                                 np.repeat(np.cumsum(counts) - counts, counts)]
+    pair_t, pair_x, pair_y, pair_distance = ProjectToSegments(
+        px[pair_point], py[pair_point], scaled["x0"][pair_segment], scaled["y0"][pair_segment],
+        scaled["x1"][pair_segment], scaled["y1"][pair_segment])
+
+    # Keep the nearest candidate within tolerance for each point
+    within = pair_distance <= tolerance
+    pair_point = pair_point[within]
+    pair_segment = pair_segment[within]
+    pair_distance = pair_distance[within]
+    pair_t = pair_t[within]
+    order = np.lexsort((pair_segment, pair_distance, pair_point))
+    nearest = order[np.r_[True, pair_point[order][1:] != pair_point[order][:-1]]] if len(order) else order
+    points = pair_point[nearest]
+    segment[points] = pair_segment[nearest]
+    t[points] = pair_t[nearest]
+    distance[points] = pair_distance[nearest]
+
+    # Calculate the snapped locations from the original coordinates so they
+    # are exactly on the segment
+    snapped = segments[segment[points]]
+    snapped_xy[points, 0] = snapped["x0"] + t[points] * (snapped["x1"] - snapped["x0"])
+    snapped_xy[points, 1] = snapped["y0"] + t[points] * (snapped["y1"] - snapped["y0"])
+    return segment, t, snapped_xy, distance
+
+
+def VertexInserts(segments, segment, t, snapped_xy):
+    '''Return the vertices to add to the street features so they have a vertex
+    at every snapped point, from the results of SnapPoints. The result is
+    {feature_id: [(part, vertex, t, x, y), ...]}, meaning a vertex at (x, y)
+    goes between vertex and vertex + 1 of the part. Points that snapped to an
+    existing vertex need no new vertex. Each feature's list is sorted in
+    reverse, so inserting the vertices in list order doesn't change the
+    position of the ones still to be inserted.'''
+    inserts = {}
+    for i in np.nonzero((segment >= 0) & (t > 0) & (t < 1))[0]:
+        seg = segments[segment[i]]
+        insert = (int(seg["part"]), int(seg["vertex"]), float(t[i]), float(snapped_xy[i, 0]), float(snapped_xy[i, 1]))
+        inserts.setdefault(int(seg["feature"]), set()).add(insert)
+    return dict((feature_id, sorted(feature_inserts, reverse=True)) for feature_id, feature_inserts in inserts.items())
+
+
+def InsertVertices(parts, inserts, new_vertex):
+    '''Apply a feature's list from VertexInserts to its parts, a list of lists
+    of vertices of any type. new_vertex(start, end, t, x, y) returns the vertex
+    to add between the vertices start and end. Returns the new list of parts.'''
+    original = [list(part) for part in parts]
+    parts = [list(part) for part in parts]
+    for part, vertex, t, x, y in inserts:
+        parts[part].insert(vertex + 1, new_vertex(original[part][vertex], original[part][vertex + 1], t, x, y))
+    return parts
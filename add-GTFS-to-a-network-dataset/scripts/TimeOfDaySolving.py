@@ -0,0 +1,124 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+''' Time of Day Solving
+
+Solves a network analysis at each time of day in a list, optionally in
+parallel worker processes, for the analysis tools that loop over a time
+window (Calculate Accessibility Matrix and Prepare Time Lapse Polygons).
+
+Each worker process sets up its own copy of the network analysis layer once
+and then solves the times of day it is handed. The result of each solve is
+sent back to the parent process as soon as it is ready and handed to the
+tool's on_result callback in time of day order, so the tool can merge the
+results (OD counts, polygons, etc.) as they arrive without holding on to all
+of them.
+
+The scheduling and merging logic does not depend on arcpy. The network
+analysis work is done through a small solver interface (see TimeOfDaySolver).
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import multiprocessing
+
+
+class SolveError(Exception):
+    '''Raised by TimeOfDaySolver.solve when the solve at one time of day failed
+    and the tool should report the error and continue with the next time.'''
+    pass
+
+
+class TimeResult(object):
+    '''The result of solving at one time of day.
+
+    index is the position of the time of day in the list of times. result is
+    whatever the solver returned, or None if the solve failed, in which case
+    error is the message of the SolveError.'''
+
+    def __init__(self, index, time_of_day, result, error=None):
+        self.index = index
+        self.time_of_day = time_of_day
+        self.result = result
+        self.error = error
+
+
+class TimeOfDaySolver(object):
+    '''Interface for the network analysis done at each time of day.
+
+    setup() is called once in each process before it solves anything, for
+    example to load its own copy of the network analysis layer.
+    solve(time_of_day) solves the analysis at the time of day and returns the
+    result to hand to on_result, or raises SolveError.
+
+    When times are solved in parallel, the solver is sent to the worker
+    processes before setup() is called, so it must be picklable, and the
+    results of solve must be picklable too.'''
+
+    def setup(self):
+        pass
+
+    def solve(self, time_of_day):
+        raise NotImplementedError
+
+
+# The solver of this worker process
+_worker_solver = None
+
+
+def _init_worker(solver):
+    '''Set up the solver of a worker process. Module-level so it can be sent to
+    worker processes.'''
+    global _worker_solver
+    _worker_solver = solver
+    _worker_solver.setup()
+
+
+def _solve(solver, index, time_of_day):
+    '''Solve at one time of day and wrap the outcome in a TimeResult.'''
+    try:
+        return TimeResult(index, time_of_day, solver.solve(time_of_day))
+    except SolveError as e:
+        return TimeResult(index, time_of_day, None, str(e))
+
+
+def _solve_time(args):
+    '''Solve at one time of day in a worker process. Module-level so it can be
+    sent to worker processes.'''
+    index, time_of_day = args
+    return _solve(_worker_solver, index, time_of_day)
+
+
+def solve_times(solver, timelist, num_workers=1, on_result=None):
+    '''Solve at each time of day in timelist with the solver, using up to
+    num_workers worker processes. on_result(time_result) is called with a
+    TimeResult for each time of day, in timelist order, as the results become
+    available. The results are not kept.'''
+    if num_workers > 1 and len(timelist) > 1:
+        pool = multiprocessing.Pool(min(num_workers, len(timelist)), _init_worker, (solver,))
+        try:
+            for time_result in pool.imap(_solve_time, list(enumerate(timelist))):
+                if on_result:
+                    on_result(time_result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        solver.setup()
+        for index, time_of_day in enumerate(timelist):
+            time_result = _solve(solver, index, time_of_day)
+            if on_result:
+                on_result(time_result)
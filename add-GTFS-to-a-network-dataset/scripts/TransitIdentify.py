@@ -20,13 +20,24 @@ schedule information to a text file for easier reading.'''
    limitations under the License.'''
 ################################################################################
 
-import arcpy, sqlite3, os, operator, codecs
-import hms
+import arcpy, os, operator, codecs
+import hms, FrequencySchedules, ScheduleCache, Instrumentation
+
+# Schedule lookup run for each selected transit line, and the index it uses.
+# QueryPlans.py checks that SQLite uses the index for the lookup.
+ScheduleFetch = "SELECT trip_id, start_time, end_time from schedules WHERE SourceOID=?"
+SchedulesIndexName = "schedules_index_SourceOID_endtime"
+SchedulesIndexStmt = "CREATE INDEX schedules_index_SourceOID_endtime ON schedules (SourceOID, end_time);"
+# Generate Transit Lines and Stops clusters the schedules table on (SourceOID, end_time, trip_id),
+# so only older networks need the index created here.
+SchedulesClusteredIndexName = "sqlite_autoindex_schedules_1"
 
 class CustomError(Exception):
     pass
 
 try:
+    Instrumentation.StartRun("Transit Identify")
+
     # User inputs
     TransitLines = arcpy.GetParameter(0)
     outFile = arcpy.GetParameterAsText(1)
@@ -44,16 +55,17 @@ user's guide.")
     SQLDbase = os.path.join(os.path.dirname(os.path.dirname(TransitLines.dataSource)), "GTFS.sql")
 
     # Connect to the SQL database
-    conn = sqlite3.connect(SQLDbase)
+    conn = Instrumentation.connect(SQLDbase)
     c = conn.cursor()
 
     # ----- Check if the schedules table is indexed and index it if not -----
 
+    Instrumentation.StartPhase("Schedules index")
+
     hasIndex = False
-    idxName = "schedules_index_SourceOID_endtime"
     c.execute("PRAGMA index_list(schedules)")
     for index in c:
-        if index[1] == idxName:
+        if index[1] in [SchedulesIndexName, SchedulesClusteredIndexName]:
             hasIndex = True
 
     if not hasIndex:
@@ -61,22 +73,48 @@ user's guide.")
 the schedules table for faster schedule lookups.  The indexing process may take a few minutes, \
 but the table need only be indexed once, and future runs of this tool will be fast.")
         arcpy.AddMessage("Indexing schedules table...")
-        c.execute("CREATE INDEX %s ON schedules (SourceOID, end_time);" % idxName)
+        c.execute(SchedulesIndexStmt)
         conn.commit()
     # Note: We don't need the extra index on end_time here, but Copy Traversed Source Features (with Transit)
     # uses it, so no need for that tool to create yet another large index.
 
 
+    # Networks created before frequency_schedules was added have every
+    # frequencies.txt departure in the schedules table instead.
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?;", (FrequencySchedules.TableName,))
+    hasFrequencySchedules = bool(c.fetchall())
+
+
+    # ----- Open the schedule cache, or build it if it's missing or out of date -----
+
+    Instrumentation.StartPhase("Schedule cache")
+
+    scheduleCache = ScheduleCache.LoadCache(SQLDbase)
+    if not scheduleCache:
+        arcpy.AddMessage("Caching the transit schedules from your GTFS SQL database for fast lookups.  \
+This will only be done once for this dataset, unless the SQL database changes.")
+        try:
+            ScheduleCache.BuildCache(conn, SQLDbase)
+            scheduleCache = ScheduleCache.LoadCache(SQLDbase)
+        except (IOError, OSError):
+            arcpy.AddWarning("Unable to write the schedule cache in the folder containing your GTFS SQL \
+database.  Schedules will be read from the SQL database instead, which is slower.")
+
+
     # ----- Collect some GTFS information for reference -----
 
+    Instrumentation.StartPhase("GTFS info")
+
+    # The schedule cache already has the trip info.
     trip_info_dict = {}
-    tripsfetch = '''
-        SELECT trip_id, route_id, service_id
-        FROM trips
-        ;'''
-    c.execute(tripsfetch)
-    for trip in c:
-        trip_info_dict[trip[0]] = [trip[1], trip[2]]
+    if not scheduleCache:
+        tripsfetch = '''
+            SELECT trip_id, route_id, service_id
+            FROM trips
+            ;'''
+        c.execute(tripsfetch)
+        for trip in c:
+            trip_info_dict[trip[0]] = [trip[1], trip[2]]
 
     cal_info_dict = {}
     calfetch = '''
@@ -105,6 +143,8 @@ but the table need only be indexed once, and future runs of this tool will be fa
 
     # ----- For each selected transit line, pull the schedules and print them nicely -----
 
+    Instrumentation.StartPhase("Print schedules")
+
     if outFile:
         arcpy.AddMessage("Writing the schedule information to a text file: %s" % outFile)
         f = codecs.open(outFile, 'w', "utf-8-sig")
@@ -116,15 +156,25 @@ but the table need only be indexed once, and future runs of this tool will be fa
             prettyPrint = u"\n\n-- Schedule for TransitLine with ObjectID %s --\nRoute type: %s" % (SourceOID, route_type)
             prettyPrint += "\nstart_time  end_time  weekdays  trip_id  route_id  service_id"
 
-            scheduleFetch = "SELECT trip_id, start_time, end_time from schedules WHERE SourceOID=%s" % SourceOID
-            c.execute(scheduleFetch)
+            if scheduleCache:
+                # [(trip_id, start_time, end_time, route_id, service_id)]
+                schedules = scheduleCache.AllTrips(SourceOID)
+            else:
+                c.execute(ScheduleFetch, (SourceOID,))
+                schedules = c.fetchall()
+                if hasFrequencySchedules:
+                    # Generate the individual departures of trips using frequencies.txt
+                    c.execute(FrequencySchedules.FrequencyScheduleFetch, (SourceOID,))
+                    for window in c.fetchall():
+                        schedules += FrequencySchedules.ExpandDepartures(window)
+                schedules = [tuple(sched) + tuple(trip_info_dict[sched[0]]) for sched in schedules]
             alltrips = [] # {route_id: {service_id: [trip, trip, trip]}}
-            for sched in c:
+            for sched in schedules:
                 trip_id = sched[0]
                 start_time = hms.sec2str(float(sched[1]))
                 end_time = hms.sec2str(float(sched[2]))
-                route_id = trip_info_dict[trip_id][0]
-                service_id = trip_info_dict[trip_id][1]
+                route_id = sched[3]
+                service_id = sched[4]
                 try:
                     weekdays = cal_info_dict[service_id]
                 except KeyError:
@@ -150,4 +200,5 @@ except:
 
 finally:
     if outFile:
-        f.close()
\ No newline at end of file
+        f.close()
+    Instrumentation.EndRun()
\ No newline at end of file
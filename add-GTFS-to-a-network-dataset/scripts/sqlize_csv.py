@@ -39,6 +39,7 @@ import sqlite3
 import sys
 
 import hms
+import Instrumentation
 
 
 class CustomError(Exception):
@@ -127,14 +128,23 @@ sql_schema = {
                 "from_stop" :  (str, True),
                 "to_stop" :    (str, True),
                 "route_type" :  (int, True),
-                "eid" :    (int, True)
+                "eid" :    (int, True),
+                "segment_id" :    (int, True)
             },
         "schedules" : { # Non-GTFS table for each instance of a transit trip crossing a line
-                "SourceOIDKey" :     (str, True),
                 "SourceOID" :     (int, True),
                 "trip_id" :     (str, True),
                 "start_time" :  (float, True),
                 "end_time" :    (float, True)
+            },
+        "frequency_schedules" : { # Non-GTFS table for each frequencies.txt time window of a transit trip crossing a line
+                "SourceOID" :     (int, True),
+                "trip_id" :     (str, True),
+                "window_start" :  (int, True),
+                "window_end" :    (int, True),
+                "headway_secs" :    (int, True),
+                "start_offset" :  (float, True),
+                "end_offset" :    (float, True)
             }
     }
 
@@ -144,7 +154,7 @@ db = None
 def connect(dbname):
     global db
     if db == None:
-        db = sqlite3.connect(dbname)
+        db = Instrumentation.connect(dbname)
         # Turn off journaling and synchronous mode to make things run faster.
         # We don't care about data corruption and backups because if sqlite crashes, 
         # the user will have to re-run this tool anyway.
@@ -452,6 +462,38 @@ def create_indices():
     cur.close()
 
 
+def create_clustered_schedules(select_stmt="SELECT SourceOID, trip_id, start_time, end_time FROM schedules_unsorted"):
+    '''Rebuild the schedules table sorted for the schedule lookups.
+
+    The schedules table as it was written is renamed to schedules_unsorted,
+    and select_stmt, which must select (SourceOID, trip_id, start_time,
+    end_time) from it, fills a new schedules table in SourceOID and end_time
+    order. The new table is a WITHOUT ROWID table clustered on (SourceOID,
+    end_time, trip_id), so the trips crossing a transit line at a time are one
+    range read, and it gets a (SourceOID, start_time) index for solving
+    backwards in time. SQLite versions older than 3.8.2 don't support
+    WITHOUT ROWID, so they get an ordinary table with indices on both. Either
+    way, Copy Traversed Source Features (with Transit) and Transit Identify
+    have the indices they need from their first run.'''
+    cur = db.cursor()
+    cur.execute("ALTER TABLE schedules RENAME TO schedules_unsorted;")
+    columns = "SourceOID INTEGER, trip_id TEXT, start_time REAL, end_time REAL"
+    clustered = sqlite3.sqlite_version_info >= (3, 8, 2)
+    if clustered:
+        # A trip crossing a line twice at the same time would be a duplicate row, so it's ignored.
+        cur.execute("CREATE TABLE schedules (%s, PRIMARY KEY (SourceOID, end_time, trip_id)) WITHOUT ROWID;" % columns)
+    else:
+        cur.execute("CREATE TABLE schedules (%s);" % columns)
+    cur.execute('''INSERT OR IGNORE INTO schedules (SourceOID, trip_id, start_time, end_time)
+                   SELECT * FROM (%s) ORDER BY 1, 4, 2;''' % select_stmt)
+    cur.execute("DROP TABLE schedules_unsorted;")
+    if not clustered:
+        cur.execute("CREATE INDEX schedules_index_SourceOID_endtime ON schedules (SourceOID, end_time);")
+    cur.execute("CREATE INDEX schedules_index_SourceOID_starttime ON schedules (SourceOID, start_time);")
+    db.commit()
+    cur.close()
+
+
 def check_nonoverlapping_dateranges():
     '''Check for non-overlapping date ranges in calendar.txt to prevent
     double-counting in analyses that use generic weekdays.'''
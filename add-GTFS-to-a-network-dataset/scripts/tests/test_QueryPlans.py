@@ -0,0 +1,72 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Tests for QueryPlans, run against its synthetic GTFS SQL database.
+
+Run with python -m unittest discover from the tests folder, using the Python 2
+that runs the tools.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FrequencySchedules
+import QueryPlans
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = QueryPlans.BuildTestDatabase()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.close()
+
+    def test_queries_use_indices(self):
+        failures = [(name, problems) for name, plan, problems in QueryPlans.CheckQueryPlans(self.conn) if problems]
+        self.assertEqual(failures, [])
+
+    def test_every_statement_registered(self):
+        names = set(name.split(" (")[0] for name, sql, params in QueryPlans.HotQueries() + QueryPlans.FullScanQueries())
+        constants = [("FrequencySchedules", name) for name in dir(FrequencySchedules)]
+        for script in ["CopyTraversedSourceFeatures_wTransit.py", "TransitIdentify.py"]:
+            constants += [(os.path.splitext(script)[0], name) for name in QueryPlans.ReadConstants(script)]
+        fetches = set("%s.%s" % (module, name) for module, name in constants if name.endswith("Fetch"))
+        self.assertTrue(fetches)
+        self.assertEqual(sorted(fetches - names), [])
+
+    def test_scan_is_a_problem(self):
+        plan = QueryPlans.GetQueryPlan(self.conn, "SELECT * FROM trips WHERE route_id=?", ("r0",))
+        self.assertTrue(QueryPlans.FindPlanProblems(plan))
+        self.assertFalse(QueryPlans.FindPlanProblems(plan, allow_scan=True))
+
+    def test_sort_is_a_problem(self):
+        plan = QueryPlans.GetQueryPlan(self.conn, "SELECT * FROM schedules WHERE SourceOID=? ORDER BY trip_id", (1,))
+        self.assertTrue(QueryPlans.FindPlanProblems(plan, allow_scan=True))
+
+
+class TestMain(unittest.TestCase):
+
+    def test_main(self):
+        # main builds and closes its own database.
+        self.assertEqual(QueryPlans.main([]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Tests for reading the schedules into the arrays of ScheduleCache.
+
+Run with python -m unittest discover from the tests folder, using the Python 2
+that runs the tools.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import FrequencySchedules
+import ScheduleCache
+
+
+class TestReadSchedules(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute("CREATE TABLE schedules (SourceOID INTEGER, trip_id CHAR, start_time REAL, end_time REAL);")
+        self.schedules = [(line, "t%d" % trip, 18000 + trip * 300 + line * 60.4, 18060 + trip * 300 + line * 60.3)
+                          for trip in range(7) for line in range(1, 4)]
+        self.conn.executemany("INSERT INTO schedules VALUES (?, ?, ?, ?);", self.schedules + [(1, "unknown", 1, 2)])
+        self.trip_index_dict = dict(("t%d" % trip, trip) for trip in range(7))
+        self.trip_index_dict["f0"] = 7
+        self.fetch_size = ScheduleCache.FetchSize
+        # Smaller than the number of rows, so the arrays are filled in several chunks
+        ScheduleCache.FetchSize = 4
+
+    def tearDown(self):
+        ScheduleCache.FetchSize = self.fetch_size
+        self.conn.close()
+
+    def read(self):
+        arrays = ScheduleCache.ReadSchedules(self.conn, self.trip_index_dict)
+        return [tuple(int(value) for value in row) for row in zip(*arrays)]
+
+    def test_schedules(self):
+        expected = [(line, self.trip_index_dict[trip_id], int(round(start_time)), int(round(end_time)))
+                    for line, trip_id, start_time, end_time in self.schedules] + [(1, -1, 1, 2)]
+        self.assertEqual(self.read(), expected)
+
+    def test_frequency_schedules(self):
+        self.conn.execute('''CREATE TABLE frequency_schedules (SourceOID INTEGER, trip_id CHAR, window_start INTEGER,
+                             window_end INTEGER, headway_secs INTEGER, start_offset INTEGER, end_offset INTEGER);''')
+        windows = [(2, "f0", 21600, 25200, 600, 60, 120), (3, "f0", 21600, 21601, 600, 0, 60),
+                   (3, "f0", 25200, 25200, 600, 0, 60)]
+        self.conn.executemany("INSERT INTO frequency_schedules VALUES (?, ?, ?, ?, ?, ?, ?);", windows)
+        expected = [(window[0], 7, start_time, end_time) for window in windows
+                    for trip_id, start_time, end_time in FrequencySchedules.ExpandDepartures(window[1:])]
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(self.read()[len(self.schedules) + 1:], expected)
+
+    def test_no_schedules(self):
+        self.conn.execute("DELETE FROM schedules;")
+        self.assertEqual(self.read(), [])
+
+
+class TestNumDepartures(unittest.TestCase):
+
+    def test_matches_expanded_departures(self):
+        for window_start in range(0, 20):
+            for window_end in range(-5, 40):
+                for headway_secs in range(1, 12):
+                    window = ("t", window_start, window_end, headway_secs, 0, 60)
+                    self.assertEqual(FrequencySchedules.NumDepartures(window),
+                                     len(FrequencySchedules.ExpandDepartures(window)))
+
+
+if __name__ == "__main__":
+    unittest.main()
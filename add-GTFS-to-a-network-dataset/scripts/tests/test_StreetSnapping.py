@@ -0,0 +1,107 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset
+################################################################################
+''' Tests for StreetSnapping, compared with snapping every point to every
+segment.
+
+Run with python -m unittest discover from the tests folder, using the Python 2
+that runs the tools.
+'''
+################################################################################
+'''Copyright 2018 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import StreetSnapping
+
+
+def BruteForceSnap(xy, segments, tolerance, x_scale=1.0):
+    '''Return the index of the nearest segment within tolerance of each point,
+    or -1, and the distances.'''
+    nearest = []
+    distances = []
+    for px, py in xy:
+        t, x, y, distance = StreetSnapping.ProjectToSegments(
+            px * x_scale, py, segments["x0"] * x_scale, segments["y0"], segments["x1"] * x_scale, segments["y1"])
+        within = np.nonzero(distance <= tolerance)[0]
+        if len(within):
+            nearest.append(within[np.argmin(distance[within])])
+            distances.append(distance[nearest[-1]])
+        else:
+            nearest.append(-1)
+            distances.append(np.nan)
+    return np.array(nearest), np.array(distances)
+
+
+class TestSnapPoints(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        parts = []
+        for feature_id in range(200):
+            vertices = rng.uniform(0, 5000, 2) + np.cumsum(rng.uniform(-150, 150, (rng.randint(2, 6), 2)), axis=0)
+            parts.append((feature_id, 0, [tuple(vertex) for vertex in vertices]))
+        # A few streets much longer than the others, crossing the whole area
+        parts.append((200, 0, [(0.0, 0.0), (5000.0, 5000.0)]))
+        parts.append((201, 0, [(0.0, 5000.0), (5000.0, 0.0), (5000.0, 5000.0)]))
+        self.segments = StreetSnapping.StreetSegments(parts)
+        self.xy = rng.uniform(-100, 5100, (1000, 2))
+
+    def check(self, tolerance, cell_size=None, x_scale=1.0):
+        segment, t, snapped_xy, distance = StreetSnapping.SnapPoints(self.xy, self.segments, tolerance, cell_size,
+                                                                     x_scale)
+        expected, expected_distance = BruteForceSnap(self.xy, self.segments, tolerance, x_scale)
+        self.assertTrue((segment >= 0).any())
+        self.assertTrue(np.array_equal(segment >= 0, expected >= 0))
+        snapped = segment >= 0
+        self.assertTrue(np.allclose(distance[snapped], expected_distance[snapped]))
+
+    def test_default_cell_size(self):
+        self.check(40.0)
+
+    def test_small_cells(self):
+        self.check(40.0, cell_size=7.0)
+
+    def test_x_scale(self):
+        self.check(40.0, x_scale=0.7)
+
+
+class TestBuildGrid(unittest.TestCase):
+
+    def test_long_diagonal_segment(self):
+        # The bounding box of the segment covers 10^10 cells, but only the
+        # cells along it are listed.
+        segments = StreetSnapping.StreetSegments([(1, 0, [(0.0, 0.0), (1e6, 1e6)])])
+        origin, keys, cell_segments = StreetSnapping.BuildGrid(segments, 10.0, 10.0)
+        self.assertLess(len(keys), 1e6)
+        self.assertEqual(len(set(keys.tolist())), len(keys))
+        segment, t, snapped_xy, distance = StreetSnapping.SnapPoints([(5e5 + 3, 5e5 - 3), (9e5, 0.0)], segments,
+                                                                     10.0, cell_size=10.0)
+        self.assertEqual(segment.tolist(), [0, -1])
+        self.assertTrue(np.allclose(snapped_xy[0], (5e5, 5e5)))
+
+    def test_sorted_by_cell(self):
+        segments = StreetSnapping.StreetSegments([(1, 0, [(0.0, 0.0), (100.0, 30.0), (100.0, 0.0)]),
+                                                  (2, 0, [(50.0, -10.0), (50.0, 60.0)])])
+        origin, keys, cell_segments = StreetSnapping.BuildGrid(segments, 2.0, 10.0)
+        order = np.lexsort((cell_segments, keys))
+        self.assertTrue(np.array_equal(order, np.arange(len(keys))))
+        self.assertEqual(sorted(set(cell_segments.tolist())), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
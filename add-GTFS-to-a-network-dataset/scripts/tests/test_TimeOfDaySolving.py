@@ -0,0 +1,132 @@
+################################################################################
+## Toolbox: Add GTFS to a Network Dataset / Transit Analysis Tools
+################################################################################
+''' Tests for TimeOfDaySolving, run with a fake solver instead of a network
+analysis layer.
+
+Run with python -m unittest discover from the tests folder, using the Python 2
+that runs the tools.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import multiprocessing
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import TimeOfDaySolving
+
+
+class FakeSolver(TimeOfDaySolving.TimeOfDaySolver):
+    '''Returns (time_of_day squared, process id, number of setup calls in the
+    process). Times in fail_times raise SolveError, and times in crash_times
+    raise RuntimeError. Earlier times take longer to solve, so parallel workers
+    finish them out of order.'''
+
+    def __init__(self, num_times, fail_times=(), crash_times=()):
+        self.num_times = num_times
+        self.fail_times = fail_times
+        self.crash_times = crash_times
+        self.num_setups = 0
+
+    def setup(self):
+        self.num_setups += 1
+
+    def solve(self, time_of_day):
+        time.sleep(0.002 * (self.num_times - time_of_day))
+        if time_of_day in self.fail_times:
+            raise TimeOfDaySolving.SolveError("No solution at %d" % time_of_day)
+        if time_of_day in self.crash_times:
+            raise RuntimeError("Crashed at %d" % time_of_day)
+        return (time_of_day * time_of_day, os.getpid(), self.num_setups)
+
+
+class TestSolveTimes(unittest.TestCase):
+
+    num_times = 20
+
+    def tearDown(self):
+        # No worker processes are left behind, whether the solve finished or failed
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def solve(self, num_workers, on_result=None, **kwargs):
+        results = []
+        if on_result is None:
+            on_result = results.append
+        TimeOfDaySolving.solve_times(FakeSolver(self.num_times, **kwargs), list(range(self.num_times)),
+                                     num_workers, on_result)
+        return results
+
+    def check_order(self, num_workers):
+        results = self.solve(num_workers)
+        self.assertEqual([result.index for result in results], list(range(self.num_times)))
+        self.assertEqual([result.time_of_day for result in results], list(range(self.num_times)))
+        self.assertEqual([result.result[0] for result in results], [t * t for t in range(self.num_times)])
+        # Each process sets up its solver once
+        self.assertEqual(set(result.result[2] for result in results), set([1]))
+        return results
+
+    def test_order(self):
+        results = self.check_order(1)
+        self.assertEqual(set(result.result[1] for result in results), set([os.getpid()]))
+
+    def test_order_parallel(self):
+        results = self.check_order(4)
+        processes = set(result.result[1] for result in results)
+        self.assertNotIn(os.getpid(), processes)
+        self.assertLessEqual(len(processes), 4)
+
+    def test_weights(self):
+        # The tools look up the weight of each solve by the index of its result.
+        weights = [(t % 3) + 1 for t in range(self.num_times)]
+        expected = sum(weight * t * t for t, weight in enumerate(weights))
+        for num_workers in [1, 4]:
+            totals = []
+            self.solve(num_workers, lambda result: totals.append(weights[result.index] * result.result[0]))
+            self.assertEqual(sum(totals), expected)
+
+    def test_solve_error(self):
+        for num_workers in [1, 4]:
+            results = self.solve(num_workers, fail_times=(3, 11))
+            self.assertEqual(len(results), self.num_times)
+            failed = [result for result in results if result.error]
+            self.assertEqual([result.time_of_day for result in failed], [3, 11])
+            self.assertEqual([result.result for result in failed], [None, None])
+            self.assertEqual(failed[0].error, "No solution at 3")
+
+    def test_other_errors_propagate(self):
+        for num_workers in [1, 4]:
+            results = []
+            with self.assertRaises(RuntimeError):
+                self.solve(num_workers, results.append, crash_times=(5,))
+            self.assertEqual([result.index for result in results], list(range(5)))
+            self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_on_result_error_stops_pool(self):
+        def on_result(result):
+            if result.index == 2:
+                raise ValueError("Can't merge")
+        with self.assertRaises(ValueError):
+            self.solve(4, on_result)
+
+    def test_one_time_solved_in_process(self):
+        results = []
+        TimeOfDaySolving.solve_times(FakeSolver(1), [0], 4, results.append)
+        self.assertEqual([result.result[1] for result in results], [os.getpid()])
+
+
+if __name__ == "__main__":
+    unittest.main()
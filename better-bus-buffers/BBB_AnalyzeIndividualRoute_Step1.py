@@ -32,15 +32,20 @@ The trip count information is filled in Step 2.
 ################################################################################
 
 
-import os, sqlite3
+import os
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import sqlize_csv
 
 OverwriteOutput = None
 conn = None
 
 
+@BBB_Instrumentation.Profiled("Count Trips for Individual Route Step 1")
 def runTool(outGDB, SQLDbase, RouteText, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings):
+    # Connect to or create the SQL file.
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
     try:
         OverwriteOutput = arcpy.env.overwriteOutput # Get the orignal value so we can reset it.
         arcpy.env.overwriteOutput = True
@@ -59,18 +64,30 @@ def runTool(outGDB, SQLDbase, RouteText, inNetworkDataset, imp, BufferSize, rest
 
             arcpy.AddMessage("Gathering route, trip, and stop information...")
 
-            # Connect to or create the SQL file.
-            conn = sqlite3.connect(SQLDbase)
-            c = BBB_SharedFunctions.c = conn.cursor()
-
-            # Get list of routes in the GTFS data
-            routefetch = "SELECT route_short_name, route_long_name, route_id FROM routes;"
-            c.execute(routefetch)
-            # Extract the route_id based on what the user picked from the GUI list
-            # It's better to do it by searching the database instead of trying to extract
-            # the route_id from the text they chose because we don't know what kind of
-            # characters will be in the route names and id, so parsing could be unreliable
+            conn = gtfs.conn
+            c = conn.cursor()
+
+            # The unique stop sequences used by each route and direction are calculated
+            # when the GTFS data is preprocessed. SQL databases created with an older
+            # version of the tool won't have them yet, so add them before anything else.
+            c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='patterns';")
+            if not c.fetchall():
+                arcpy.AddMessage("Your GTFS SQL database does not contain route patterns. \
+Adding them now. This will only happen once for this dataset.")
+                sqlize_csv.db = conn
+                sqlize_csv.create_patterns()
+
+            # Extract the route_id based on what the user picked from the GUI list.
+            # The text is formatted as "route_short_name: route_long_name [route_id]",
+            # so look up the text inside the last set of brackets as the route_id and
+            # confirm the match against the database. If the text isn't in that format,
+            # search all the routes.
             route_id = ""
+            routefetch = "SELECT route_short_name, route_long_name, route_id FROM routes"
+            if RouteText.endswith("]") and " [" in RouteText:
+                c.execute(routefetch + " WHERE route_id=?;", (RouteText[RouteText.rfind(" [") + 2:-1],))
+            else:
+                c.execute(routefetch + ";")
             for route in c:
                 routecheck = route[0] + ": " + route[1] + " [" + route[2] + "]"
                 if routecheck == RouteText:
@@ -91,51 +108,30 @@ def runTool(outGDB, SQLDbase, RouteText, inNetworkDataset, imp, BufferSize, rest
             raise
 
 
-        # ----- Get trips associated with route and split into directions -----
+        # ----- Get list of stops associated with the route and split into directions -----
+        BBB_Instrumentation.StartPhase("Route stops")
         try:
             # Some GTFS datasets use the same route_id to identify trips traveling in
             # either direction along a route. Others identify it as a different route.
             # We will consider each direction separately if there is more than one.
+            # If a stop is used for trips going in both directions, count them separately.
 
-            # Get list of trips
-            trip_route_dict = {}
-            triproutefetch = '''
-                SELECT trip_id, direction_id FROM trips
-                WHERE route_id='%s'
-                ;''' % route_id
-            c.execute(triproutefetch)
-
-            # Fill some dictionaries for use later.
-            trip_dir_dict = {} # {Direction: [trip_id, trip_id, ...]}
-            for triproute in c:
-                trip_dir_dict.setdefault(triproute[1], []).append(triproute[0])
-            if not trip_dir_dict:
+            # Select unique set of stops used by trips in each direction
+            stoplist = {} # {Direction: [stop_id, stop_id, ...]}
+            stopsfetch = '''
+                SELECT DISTINCT patterns.direction_id, pattern_stops.stop_id
+                FROM patterns JOIN pattern_stops ON patterns.pattern_id = pattern_stops.pattern_id
+                WHERE patterns.route_id=?
+                ;'''
+            c.execute(stopsfetch, (route_id,))
+            for stop in c:
+                stoplist.setdefault(stop[0], []).append(stop[1])
+            if not stoplist:
                 arcpy.AddError("There are no trips in the GTFS data for the route \
 you have selected (%s).  Please select a different route or fix your GTFS \
 dataset." % RouteText)
                 raise BBB_SharedFunctions.CustomError
 
-        except:
-            arcpy.AddError("Error getting trips associated with route.")
-            raise
-
-
-        # ----- Get list of stops associated with trips and split into directions -----
-        try:
-            # If a stop is used for trips going in both directions, count them separately.
-
-            # Select unique set of stops used by trips in each direction
-            stoplist = {} # {Direction: [stop_id, stop_id, ...]}
-            for direction in trip_dir_dict:
-                stops = []
-                for trip in trip_dir_dict[direction]:
-                    stopsfetch = '''SELECT stop_id FROM stop_times
-                                WHERE trip_id == ?'''
-                    c.execute(stopsfetch, (trip,))
-                    for stop in c:
-                        stops.append(stop[0])
-                stoplist[direction] = list(set(stops))
-
             # If there is more than one direction, we will append the direction number
             # to the output fc names, so add an _ here for prettiness.
             if len(stoplist) > 1:
@@ -153,6 +149,7 @@ GTFS direction_id will be appended to the feature class name." % route_short_nam
         # ===== Create output =====
 
         # ----- Create a feature class of stops ------
+        BBB_Instrumentation.StartPhase("Stops feature class")
         try:
 
             arcpy.AddMessage("Creating feature class of GTFS stops...")
@@ -164,7 +161,7 @@ GTFS direction_id will be appended to the feature class name." % route_short_nam
                     outputname += str(direction)
                 outStops = os.path.join(outGDB, outputname)
 
-                outStops, outStopList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops, stops)
+                outStops, outStopList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, outStops, stops)
 
                 # Add a route_id and direction_id field and populate it
                 arcpy.management.AddField(outStops, "route_id", "TEXT")
@@ -182,6 +179,7 @@ GTFS direction_id will be appended to the feature class name." % route_short_nam
 
 
         #----- Create Service Areas around stops -----
+        BBB_Instrumentation.StartPhase("Service areas")
         try:
 
             arcpy.AddMessage("Creating buffers around stops...")
@@ -244,5 +242,6 @@ GTFS direction_id will be appended to the feature class name." % route_short_nam
         raise
 
     finally:
+        gtfs.close()
         if OverwriteOutput:
             arcpy.env.overwriteOutput = OverwriteOutput
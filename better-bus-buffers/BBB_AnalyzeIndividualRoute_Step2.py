@@ -31,12 +31,14 @@ Step 2: Count Trips for Route uses the template feature class created in Step
    limitations under the License.'''
 ################################################################################
 
-import os, sqlite3
+import os
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
 
 
 #===== Main code =====
+@BBB_Instrumentation.Profiled("Count Trips for Individual Route Step 2")
 def runTool(FCs, SQLDbase, dayString, start_time, end_time, DepOrArrChoice):
 
     def RetrieveStatsForStop(stop_id, rtdirtuple):
@@ -70,6 +72,7 @@ def runTool(FCs, SQLDbase, dayString, start_time, end_time, DepOrArrChoice):
 
         return NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway
 
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
     try:
         # ------ Get input parameters and set things up. -----
         try:
@@ -99,8 +102,7 @@ fields %s. Please choose a valid feature class." % (FC, str(RequiredFields)))
                         raise BBB_SharedFunctions.CustomError
 
             # SQL database of preprocessed GTFS from Step 1
-            conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
-            c = BBB_SharedFunctions.c = conn.cursor()
+            c = gtfs.cursor()
 
             Specific, day = BBB_SharedFunctions.CheckSpecificDate(dayString)
             # For field names in the output file
@@ -127,6 +129,7 @@ fields %s. Please choose a valid feature class." % (FC, str(RequiredFields)))
 
 
         # ----- Get list of route_ids and direction_ids to analyze from input files -----
+        BBB_Instrumentation.StartPhase("Read inputs")
         try:
             # We just check the first line in each file for this information.
             FC_route_dir_dict = {} # {FC: [route_id, direction_id]}
@@ -146,12 +149,13 @@ fields %s. Please choose a valid feature class." % (FC, str(RequiredFields)))
 
         # ----- Get trips associated with route and direction -----
 
+        BBB_Instrumentation.StartPhase("Trips")
         try:
             arcpy.AddMessage("Getting list of trips...")
 
             # Get the service_ids serving the correct days
             serviceidlist, serviceidlist_yest, serviceidlist_tom = \
-                BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific)
+                BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
 
             trip_route_dict = {} #{(route_id, direction_id): [trip_id, trip_id,..]}
             trip_route_dict_yest = {}
@@ -204,42 +208,17 @@ the values will be 0 or <Null>." % (route_id, str(direction_id), str(day)))
 
 
         #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
-            frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict()
-
-            stoptimedict_rtdirpair = {}
-            for rtdirpair in list(set([rt for rt in list(trip_route_dict.keys()) + list(trip_route_dict_yest.keys()) + list(trip_route_dict_tom.keys())])):
-
-                # Get the stop_times that occur during this time window
-                stoptimedict = {}
-                stoptimedict_yest = {}
-                stoptimedict_tom = {}
-                try:
-                    triplist = trip_route_dict[rtdirpair]
-                    stoptimedict = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist, "today", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-                try:
-                    triplist_yest = trip_route_dict_yest[rtdirpair]
-                    stoptimedict_yest = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_yest, "yesterday", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-                try:
-                    triplist_tom = trip_route_dict_tom[rtdirpair]
-                    stoptimedict_tom = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_tom, "tomorrow", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-
-                # Combine the three dictionaries into one master
-                for stop in stoptimedict_yest:
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_yest[stop]
-                for stop in stoptimedict_tom:
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_tom[stop]
-
-                stoptimedict_rtdirpair[rtdirpair] = stoptimedict
+            frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict(gtfs)
 
+            # Get the stop_times that occur during this time window for each route and direction
+            stoptimedict_rtdirpair = BBB_SharedFunctions.CountTripsForRouteDirections(
+                gtfs, start_sec, end_sec, DepOrArr, trip_route_dict, trip_route_dict_yest, trip_route_dict_tom, frequencies_dict)
+
+            for rtdirpair, stoptimedict in stoptimedict_rtdirpair.items():
                 # Add a warning if there is no service.
                 if not stoptimedict:
                     arcpy.AddWarning("There is no service for route %s in direction %s \
@@ -255,6 +234,7 @@ the values will be 0 or <Null>." % (rtdirpair[0], str(rtdirpair[1]), dayString))
 
         arcpy.AddMessage("Writing output...")
 
+        BBB_Instrumentation.StartPhase("Output")
         try:
             # Prepare the fields we're going to add to the feature classes
             ending = "_" + dayshort + "_" + start_time_pretty + "_" + end_time_pretty
@@ -301,4 +281,5 @@ headway were written to the following fields in your input feature class(es):")
         raise
 
     finally:
+        gtfs.close()
         arcpy.env.overwriteOutput = OverwriteOutput
@@ -0,0 +1,350 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Batch Scenarios
+
+Command-line runner for the GTFS schedule analysis in BetterBusBuffers. It
+runs many scenarios (combinations of tool, day, and time window) against the
+same preprocessed GTFS SQL database without ArcGIS, spreading them over a pool
+of worker processes.
+
+Supported tools:
+- stops: the statistics calculated by Count Trips at Stops (NumTrips,
+  NumTripsPerHr, and MaxWaitTime for every stop)
+- lines: the statistics calculated by Count Trips on Lines Step 2 (NumTrips,
+  NumTripsPerHr, MaxWaitTime, and AvgHeadway for every stop pair served during
+  the time window). pair_id matches the lines template created by Count Trips
+  on Lines Step 1.
+
+Each worker process opens its own read-only connection to the GTFS database.
+The results of all the scenarios are written to a single SQLite database,
+along with a summary of each scenario's status and run time.
+
+Usage:
+    python BBB_BatchScenarios.py scenarios.json [--database GTFS.sql]
+        [--output Results.sql] [--workers 4]
+
+The scenario file is JSON (or YAML, if PyYAML is installed):
+    {
+        "database": "C:/Data/GTFS.sql",
+        "output": "C:/Data/Results.sql",
+        "workers": 4,
+        "scenarios": [
+            {"name": "Weekday AM", "tool": "stops", "day": "Monday",
+             "start_time": "07:00", "end_time": "09:00"}
+        ],
+        "matrix": {
+            "tool": ["stops", "lines"],
+            "day": ["Monday", "Saturday", "20171225"],
+            "window": [["07:00", "09:00"], ["16:00", "18:00"]],
+            "dep_or_arr": "Departures"
+        }
+    }
+Scenarios listed in "scenarios" are run as given. Every combination of the
+values in "matrix" is run as well. Optional scenario settings are dep_or_arr
+("Departures" or "Arrivals", for stops; default Departures), low_memory (for
+stops; default false; see Count Trips at Stops), and combine_corridors (for
+lines; default true).
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+try:
+    import yaml
+except ImportError:
+    yaml = None
+import BBB_SharedFunctions
+
+try:
+    _cpu_clock = time.process_time
+    _wall_clock = time.perf_counter
+except AttributeError:
+    # Python 2
+    _cpu_clock = time.clock
+    _wall_clock = time.time
+
+TOOLS = ["stops", "lines"]
+
+
+def LoadScenarioFile(path):
+    '''Read the scenario file. Returns the dictionary of settings.'''
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in [".yml", ".yaml"]:
+            if not yaml:
+                raise BBB_SharedFunctions.CustomError("Reading YAML scenario files requires the PyYAML package.")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def ExpandScenarios(config):
+    '''Return the list of scenarios in the scenario file settings, with the
+    combinations in the matrix expanded and default settings filled in.'''
+    scenarios = [dict(scenario) for scenario in config.get("scenarios", [])]
+
+    matrix = config.get("matrix")
+    if matrix:
+        def as_list(value):
+            return value if isinstance(value, list) else [value]
+        windows = [tuple(window) for window in as_list(matrix.get("window", [["", ""]]))]
+        for tool, day, window, dep_or_arr in itertools.product(as_list(matrix["tool"]), as_list(matrix["day"]), windows,
+                                                               as_list(matrix.get("dep_or_arr", "Departures"))):
+            scenarios.append({"tool": tool, "day": str(day), "start_time": window[0], "end_time": window[1],
+                              "dep_or_arr": dep_or_arr})
+
+    for idx, scenario in enumerate(scenarios):
+        scenario["id"] = idx + 1
+        scenario.setdefault("start_time", "")
+        scenario.setdefault("end_time", "")
+        scenario.setdefault("dep_or_arr", "Departures")
+        scenario.setdefault("combine_corridors", True)
+        scenario.setdefault("low_memory", False)
+        scenario["day"] = str(scenario.get("day", ""))
+        if not scenario.get("name"):
+            scenario["name"] = "%s %s %s-%s" % (scenario.get("tool"), scenario["day"],
+                                               scenario["start_time"], scenario["end_time"])
+    return scenarios
+
+
+def CountTripsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific, LowMemory=False):
+    '''Return a list of (stop_id, NumTrips, NumTripsPerHr, MaxWaitTime) for all stops.'''
+    if LowMemory:
+        # Calculate the statistics one stop at a time as the stop visits are streamed.
+        stopstats = BBB_SharedFunctions.CountTripStatsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
+        stoptimedict = None
+    else:
+        stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
+    rows = []
+    c = gtfs.cursor()
+    c.execute("SELECT stop_id FROM stops;")
+    for stop in c.fetchall():
+        stop_id = stop[0]
+        if stoptimedict is None:
+            NumTrips, NumTripsPerHr, MaxWaitTime = stopstats.get(str(stop_id), (0, 0.0, None))
+        else:
+            NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                        BBB_SharedFunctions.RetrieveStatsForSetOfStops(
+                            [str(stop_id)], stoptimedict, True, start_sec, end_sec)
+        rows.append((stop_id, NumTrips, NumTripsPerHr, MaxWaitTime))
+    return rows
+
+
+def CountTripsOnLines(gtfs, day, start_sec, end_sec, Specific, combine_corridors):
+    '''Return a list of (pair_id, NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway)
+    for the stop pairs served during the time window.'''
+    linetimedict = BBB_SharedFunctions.CountTripsOnLines(gtfs, day, start_sec, end_sec, "departure_time", Specific)
+    triproute_dict = None
+    if combine_corridors:
+        pair_ids = sorted(linetimedict)
+    else:
+        # Count each route separately. The pair_id includes the route_id, as in the Step 1 lines.
+        triproute_dict = BBB_SharedFunctions.MakeTripRouteDict(gtfs)
+        pair_ids = set()
+        for line_key in linetimedict:
+            for linetime in linetimedict[line_key]:
+                pair_ids.add(line_key + " , " + triproute_dict[linetime[0]])
+        pair_ids = sorted(pair_ids)
+    rows = []
+    for pair_id in pair_ids:
+        NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway = \
+                    BBB_SharedFunctions.RetrieveStatsForLines(
+                        pair_id, linetimedict, start_sec, end_sec, combine_corridors, triproute_dict)
+        rows.append((pair_id, NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway))
+    return rows
+
+
+# Read-only connection to the GTFS database for the current process, opened by _InitWorker
+_gtfs = None
+
+
+def _InitWorker(SQLDbase, num_threads):
+    '''Open the worker process's read-only connection to the GTFS database.'''
+    global _gtfs
+    _gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True, num_threads=num_threads)
+
+
+def RunScenario(scenario):
+    '''Run one scenario using the current process's GTFS database connection.
+    Returns a dictionary with the scenario, its status, the timings, and the
+    result rows.'''
+    result = {"scenario": scenario, "status": "Succeeded", "error": None, "rows": []}
+    wall_start = _wall_clock()
+    cpu_start = _cpu_clock()
+    try:
+        if scenario.get("tool") not in TOOLS:
+            raise BBB_SharedFunctions.CustomError("Unknown tool %s. Choose from %s." % (scenario.get("tool"), ", ".join(TOOLS)))
+        Specific, day = BBB_SharedFunctions.CheckSpecificDate(scenario["day"])
+        start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(scenario["start_time"], scenario["end_time"])
+        if end_sec <= start_sec:
+            raise BBB_SharedFunctions.CustomError("The time window end must be later than the start.")
+        if scenario["tool"] == "stops":
+            DepOrArr = BBB_SharedFunctions.CleanUpDepOrArr(scenario["dep_or_arr"])
+            result["rows"] = CountTripsAtStops(_gtfs, day, start_sec, end_sec, DepOrArr, Specific,
+                                               bool(scenario["low_memory"]))
+        else:
+            result["rows"] = CountTripsOnLines(_gtfs, day, start_sec, end_sec, Specific, bool(scenario["combine_corridors"]))
+    except Exception as e:
+        result["status"] = "Failed"
+        result["error"] = str(e) or traceback.format_exc()
+    result["wall_s"] = _wall_clock() - wall_start
+    result["cpu_s"] = _cpu_clock() - cpu_start
+    result["pid"] = os.getpid()
+    return result
+
+
+class ResultsStore(object):
+    '''SQLite database holding the results of all the scenarios.
+
+    Tables:
+    - scenarios: one row per scenario with its settings, status, and timings
+    - stop_results: (scenario_id, stop_id, NumTrips, NumTripsPerHr, MaxWaitTime)
+    - line_results: (scenario_id, pair_id, NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway)
+    Existing results in the database are replaced.'''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        for table in ["scenarios", "stop_results", "line_results"]:
+            self.conn.execute("DROP TABLE IF EXISTS %s;" % table)
+        self.conn.execute('''CREATE TABLE scenarios (scenario_id INTEGER PRIMARY KEY, name TEXT, tool TEXT,
+                             day TEXT, start_time TEXT, end_time TEXT, dep_or_arr TEXT, combine_corridors INTEGER,
+                             status TEXT, error TEXT, num_rows INTEGER, wall_s REAL, cpu_s REAL, pid INTEGER);''')
+        self.conn.execute('''CREATE TABLE stop_results (scenario_id INTEGER, stop_id TEXT, NumTrips INTEGER,
+                             NumTripsPerHr REAL, MaxWaitTime INTEGER);''')
+        self.conn.execute('''CREATE TABLE line_results (scenario_id INTEGER, pair_id TEXT, NumTrips INTEGER,
+                             NumTripsPerHr REAL, MaxWaitTime INTEGER, AvgHeadway INTEGER);''')
+        self.conn.commit()
+
+    def add(self, result):
+        scenario = result["scenario"]
+        self.conn.execute('''INSERT INTO scenarios VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                          (scenario["id"], scenario["name"], scenario.get("tool"), scenario["day"],
+                           scenario["start_time"], scenario["end_time"], scenario["dep_or_arr"],
+                           int(bool(scenario["combine_corridors"])), result["status"], result["error"],
+                           len(result["rows"]), result["wall_s"], result["cpu_s"], result["pid"]))
+        if scenario.get("tool") == "stops":
+            self.conn.executemany("INSERT INTO stop_results VALUES (?, ?, ?, ?, ?);",
+                                  ((scenario["id"],) + tuple(row) for row in result["rows"]))
+        elif scenario.get("tool") == "lines":
+            self.conn.executemany("INSERT INTO line_results VALUES (?, ?, ?, ?, ?, ?);",
+                                  ((scenario["id"],) + tuple(row) for row in result["rows"]))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.execute("CREATE INDEX IF NOT EXISTS stop_results_index ON stop_results (scenario_id, stop_id);")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS line_results_index ON line_results (scenario_id, pair_id);")
+        self.conn.commit()
+        self.conn.close()
+
+
+def RunScenarios(SQLDbase, scenarios, outResults, num_workers=1):
+    '''Run the scenarios against the GTFS database using up to num_workers worker
+    processes and write the results to outResults. Returns the list of
+    results, without the result rows, in scenario order.'''
+    store = ResultsStore(outResults)
+    summaries = []
+
+    def collect(result):
+        store.add(result)
+        result["num_rows"] = len(result["rows"])
+        del result["rows"]
+        summaries.append(result)
+        scenario = result["scenario"]
+        BBB_SharedFunctions.AddMessage("[%d/%d] %s: %s in %.2f s" % (len(summaries), len(scenarios), scenario["name"],
+                                                                     result["status"], result["wall_s"]))
+        if result["error"]:
+            BBB_SharedFunctions.AddWarning(result["error"])
+
+    try:
+        if num_workers > 1 and len(scenarios) > 1:
+            # Each worker process runs its schedule queries in a single thread.
+            pool = multiprocessing.Pool(min(num_workers, len(scenarios)), _InitWorker, (SQLDbase, 1))
+            try:
+                for result in pool.imap_unordered(RunScenario, scenarios):
+                    collect(result)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            _InitWorker(SQLDbase, BBB_SharedFunctions.ScheduleQueryThreads)
+            try:
+                for scenario in scenarios:
+                    collect(RunScenario(scenario))
+            finally:
+                _gtfs.close()
+    finally:
+        store.close()
+
+    summaries.sort(key=lambda result: result["scenario"]["id"])
+    return summaries
+
+
+def FormatSummary(summaries, wall_time):
+    '''Return a text table of the scenario run times.'''
+    lines = ["%4s  %-40s  %-9s  %8s  %9s  %9s" % ("ID", "Scenario", "Status", "Rows", "Wall (s)", "CPU (s)")]
+    for result in summaries:
+        scenario = result["scenario"]
+        lines.append("%4d  %-40s  %-9s  %8d  %9.2f  %9.2f" % (scenario["id"], scenario["name"][:40], result["status"],
+                                                              result["num_rows"], result["wall_s"], result["cpu_s"]))
+    scenario_time = sum(result["wall_s"] for result in summaries)
+    lines.append("%d scenarios in %.2f s (%.2f s of scenario run time)" % (len(summaries), wall_time, scenario_time))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run BetterBusBuffers GTFS schedule analysis for many scenarios.")
+    parser.add_argument("scenario_file", help="JSON or YAML file listing the scenarios to run")
+    parser.add_argument("--database", help="GTFS SQL database created by Preprocess GTFS (overrides the scenario file)")
+    parser.add_argument("--output", help="SQLite database to write the results to (overrides the scenario file)")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (overrides the scenario file)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    try:
+        config = LoadScenarioFile(args.scenario_file)
+        SQLDbase = args.database or config.get("database")
+        outResults = args.output or config.get("output")
+        num_workers = args.workers or config.get("workers") or multiprocessing.cpu_count()
+        if not SQLDbase or not os.path.exists(SQLDbase):
+            raise BBB_SharedFunctions.CustomError("GTFS SQL database %s does not exist." % SQLDbase)
+        if not outResults:
+            raise BBB_SharedFunctions.CustomError("No output results database was given.")
+        scenarios = ExpandScenarios(config)
+        if not scenarios:
+            raise BBB_SharedFunctions.CustomError("The scenario file does not contain any scenarios.")
+    except BBB_SharedFunctions.CustomError as e:
+        BBB_SharedFunctions.AddError(str(e))
+        return 1
+
+    BBB_SharedFunctions.AddMessage("Running %d scenarios with %d worker processes..." % (len(scenarios), num_workers))
+    start = _wall_clock()
+    summaries = RunScenarios(SQLDbase, scenarios, outResults, num_workers)
+    BBB_SharedFunctions.AddMessage(FormatSummary(summaries, _wall_clock() - start))
+    BBB_SharedFunctions.AddMessage("Results written to " + outResults)
+    return 0 if all(result["status"] == "Succeeded" for result in summaries) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Chunk Scheduler
+
+Helpers for splitting a large origin-destination problem into chunks that fit
+within the limits of a remote service and solving those chunks concurrently.
+
+The scheduler does not depend on arcpy. It talks to the solver through a small
+service interface (see ODService), so it can be run against the ArcGIS Online
+OD Cost Matrix service in the Count Trips at Points (Online) tool or against a
+local fake service.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import time
+
+# Job status codes. These match the status property of an arcpy Result object.
+# Anything less than SUCCEEDED means the job is still running.
+SUCCEEDED = 4
+
+
+def make_chunks(ids, chunk_size):
+    '''Sort the ids once and split them into consecutive lists of at most
+    chunk_size ids each.'''
+    ids = sorted(ids)
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+class ODService(object):
+    '''Interface for an asynchronous OD solver used by ChunkScheduler.
+
+    submit(origins, destinations) starts solving one chunk and returns a job
+    object. status(job) returns the job's status code (less than SUCCEEDED while
+    it is running). collect(job) is called once the job has finished and returns
+    the results for the chunk; it should raise an exception if the job failed.
+    cancel(job) is called for jobs that are still running if the scheduler stops
+    early because of an error.'''
+
+    def submit(self, origins, destinations):
+        raise NotImplementedError
+
+    def status(self, job):
+        raise NotImplementedError
+
+    def collect(self, job):
+        raise NotImplementedError
+
+    def cancel(self, job):
+        pass
+
+
+class ChunkScheduler(object):
+    '''Keeps up to max_in_flight jobs running on an ODService at once.
+
+    Running jobs are polled together. The polling interval starts at
+    poll_interval seconds and doubles each time no job has finished, up to
+    max_poll_interval seconds, and goes back to poll_interval as soon as a job
+    finishes.'''
+
+    def __init__(self, service, max_in_flight=4, poll_interval=0.5, max_poll_interval=8, sleep=time.sleep):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1.")
+        self.service = service
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.sleep = sleep
+
+    def run(self, chunks, on_result):
+        '''Solve each (origins, destinations) chunk and pass its results to
+        on_result(chunk_index, results) as soon as the chunk finishes. Chunks are
+        submitted in order, but results are handed back in the order the jobs
+        finish.'''
+        pending = iter(enumerate(chunks))
+        in_flight = [] # [(chunk_index, job)]
+        interval = self.poll_interval
+        try:
+            while True:
+                # Top up the running jobs
+                while len(in_flight) < self.max_in_flight:
+                    try:
+                        idx, chunk = next(pending)
+                    except StopIteration:
+                        break
+                    in_flight.append((idx, self.service.submit(chunk[0], chunk[1])))
+                if not in_flight:
+                    break
+
+                # Poll all running jobs and hand back the results of finished ones
+                finished = False
+                for idx, job in list(in_flight):
+                    if self.service.status(job) < SUCCEEDED:
+                        continue
+                    finished = True
+                    in_flight.remove((idx, job))
+                    on_result(idx, self.service.collect(job))
+
+                if finished:
+                    interval = self.poll_interval
+                elif in_flight:
+                    self.sleep(interval)
+                    interval = min(interval * 2, self.max_poll_interval)
+        except:
+            for idx, job in in_flight:
+                self.service.cancel(job)
+            raise
@@ -42,11 +42,11 @@ during that time window, and the average, minimum, and maximum headways of all r
 # --------------------------------
 ################################################################################
 
-import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
 import numpy as np
 import collections
-import sqlite3, os, datetime
+import os, datetime
 
 
 def post_process_headways(avg_headway,number_of_trips_per_hour,trip_per_hr_threshold=.5,reset_headway_if_low_trip_count=180):
@@ -58,6 +58,7 @@ def post_process_headways(avg_headway,number_of_trips_per_hour,trip_per_hr_thres
     return avg_headway
 
 
+@BBB_Instrumentation.Profiled("Count High Frequency Routes at Stops")
 def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, FrequencyThreshold, SnapToNearest5MinuteBool):
 
     def RetrieveFrequencyStatsForStop(stop_id, rtdirtuple, snap_to_nearest_5_minutes=False):
@@ -95,10 +96,13 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
                 AvgHeadway = round(AvgHeadway / 5.0) * 5
         return NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway
 
+    # GTFS SQL dbase - must be created ahead of time.
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
     try:
         # ------ Get input parameters and set things up. -----
         try:
-            arcpy.env.overwriteOutput = True
+            if BBB_SharedFunctions.arcpy:
+                BBB_SharedFunctions.arcpy.env.overwriteOutput = True
 
             BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2", min_version_10x="10.4")
 
@@ -106,12 +110,10 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
                 import pandas as pd
             except:
                 # Pandas is shipped with ArcGIS Pro and ArcGIS 10.4 and higher.  The previous logic should hopefully prevent users from ever hitting this error.
-                arcpy.AddError("This BetterBusBuffers tool requires the python library pandas, but the tool was unable to import the library.")
+                BBB_SharedFunctions.AddError("This BetterBusBuffers tool requires the python library pandas, but the tool was unable to import the library.")
                 raise BBB_SharedFunctions.CustomError
 
-            # GTFS SQL dbase - must be created ahead of time.
-            conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
-            c = BBB_SharedFunctions.c = conn.cursor()
+            c = gtfs.cursor()
 
             Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
             start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
@@ -127,25 +129,17 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
             time_period = start_time + ":" + end_time
 
         except:
-            arcpy.AddError("Error getting user inputs.")
+            BBB_SharedFunctions.AddError("Error getting user inputs.")
             raise
 
-        # ----- Create a feature class of stops and add fields for transit trip counts ------
-        try:
-            arcpy.AddMessage("Creating feature class of GTFS stops...")
-            # Create a feature class of transit stops
-            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
-        except:
-            arcpy.AddError("Error creating feature class of GTFS stops.")
-            raise
-        
         # ----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Trips")
         try:
-            arcpy.AddMessage("Calculating the determining trips for route-direction pairs...")
+            BBB_SharedFunctions.AddMessage("Calculating the determining trips for route-direction pairs...")
             
             # Get the service_ids serving the correct days
             serviceidlist, serviceidlist_yest, serviceidlist_tom = \
-                BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific)
+                BBB_SharedFunctions.GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
 
             # Assemble Route and Direction IDS
             triproutefetch = '''SELECT DISTINCT route_id,direction_id FROM trips;'''
@@ -160,7 +154,7 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
             trip_route_dict_yest = {}
             trip_route_dict_tom = {}
             triproutelist = []
-            c2 = conn.cursor()
+            c2 = gtfs.cursor()
             for rtpair in c:
                 key = tuple(rtpair)
                 route_id = rtpair[0]
@@ -181,7 +175,7 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, Frequ
                 c2.execute(triproutefetch)
                 triproutelist = c2.fetchall()
                 if not triproutelist:
-                    arcpy.AddWarning("Your GTFS dataset does not contain any trips \
+                    BBB_SharedFunctions.AddWarning("Your GTFS dataset does not contain any trips \
 corresponding to Route %s and Direction %s. Please ensure that \
 you have selected the correct GTFS SQL file for this input file or that your \
 GTFS data is good. Output fields will be generated, but \
@@ -197,69 +191,45 @@ the values will be 0 or <Null>." % (route_id, str(direction_id)))
                         trip_route_dict_yest.setdefault(key, []).append(triproute[0])
 
                 if not trip_route_dict and not trip_route_dict_tom and not trip_route_dict_yest:
-                    arcpy.AddWarning("There is no service for route %s in direction %s \
+                    BBB_SharedFunctions.AddWarning("There is no service for route %s in direction %s \
 on %s during the time window you selected. Output fields will be generated, but \
 the values will be 0 or <Null>." % (route_id, str(direction_id), str(day)))
 
         except:
-            arcpy.AddError("Error getting trips associated with route.")
+            BBB_SharedFunctions.AddError("Error getting trips associated with route.")
             raise
 
 
         # ----- Query the GTFS data to count the trips at each stop for this time period -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
-            arcpy.AddMessage("Calculating the number of transit trips available during the time window of time period ID {0}...".format(str(time_period)))
+            BBB_SharedFunctions.AddMessage("Calculating the number of transit trips available during the time window of time period ID {0}...".format(str(time_period)))
             
-            frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict()
+            frequencies_dict = BBB_SharedFunctions.MakeFrequenciesDict(gtfs)
             
-            stoptimedict_rtedirpair = {}  # #{rtdir tuple:stoptimedict}}
+            # Get the stop_times that occur during this time window for each route and direction
+            stoptimedict_rtedirpair = BBB_SharedFunctions.CountTripsForRouteDirections(
+                gtfs, start_sec, end_sec, DepOrArr, trip_route_dict, trip_route_dict_yest, trip_route_dict_tom, frequencies_dict)  # {rtdir tuple:{stoptimedict}}
             stoptimedict_service_check_counter=0
-            for rtdirpair in list(set([rt for rt in list(trip_route_dict.keys()) + list(trip_route_dict_yest.keys()) + list(trip_route_dict_tom.keys())])):
-                
-                # Get the stop_times that occur during this time window
-                stoptimedict = {}
-                stoptimedict_yest = {}
-                stoptimedict_tom = {}
-                try:
-                    triplist = trip_route_dict[rtdirpair]
-                    stoptimedict = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist, "today", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-                try:
-                    triplist_yest = trip_route_dict_yest[rtdirpair]
-                    stoptimedict_yest = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_yest, "yesterday", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-                try:
-                    triplist_tom = trip_route_dict_tom[rtdirpair]
-                    stoptimedict_tom = BBB_SharedFunctions.GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_tom, "tomorrow", frequencies_dict)
-                except KeyError: # No trips
-                    pass
-
-                # Combine the three dictionaries into one master
-                for stop in stoptimedict_yest:  # Update Dictionaries based on setdefault returns values.
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_yest[stop]
-                for stop in stoptimedict_tom:
-                    stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_tom[stop]
-                # PD here
-                stoptimedict_rtedirpair[rtdirpair] = stoptimedict  # {rtdir tuple:{stoptimedict}}
+            for stoptimedict in stoptimedict_rtedirpair.values():
                 # Add a minor warning if there is no service for at least one route-direction combination.
                 if not stoptimedict:
                     stoptimedict_service_check_counter+=1
             if stoptimedict_service_check_counter>0:
-                arcpy.AddWarning("There is no service for %s route-direction pair(s) \
+                BBB_SharedFunctions.AddWarning("There is no service for %s route-direction pair(s) \
 on %s during the time window you selected. Output fields will be generated, but \
 the values will be 0 or <Null>." % (str(stoptimedict_service_check_counter),str(day)))
 
 
         except:
-            arcpy.AddError("Error counting arrivals or departures at stop during time window.")
+            BBB_SharedFunctions.AddError("Error counting arrivals or departures at stop during time window.")
             raise
 
         # ----- Write to output -----
 
+        BBB_Instrumentation.StartPhase("Statistics")
         try:
-            arcpy.AddMessage("Calculating frequency statistics from route direction pairs...")
+            BBB_SharedFunctions.AddMessage("Calculating frequency statistics from route direction pairs...")
             frequency_record_table=[] #[(rtedirpair_id,route_id,direction_id,stop_id,NumTripsPerHr,MaxWaitTime,AvgHeadway)]
             labels=["rtedir_id","rte_count","stop_id","NumTrips","NumTripsPerHr","MaxWaitTime","AvgHeadway"]
             for rtedirpair in stoptimedict_rtedirpair:
@@ -289,25 +259,49 @@ the values will be 0 or <Null>." % (str(stoptimedict_service_check_counter),str(
                 stop_frequency_statistics=stop_frequency_statistics.fillna(value=-1)
 
         except:
-            arcpy.AddError("Error calculating frequency statistics...")
+            BBB_SharedFunctions.AddError("Error calculating frequency statistics...")
             raise
+        BBB_Instrumentation.StartPhase("Output")
         try:
-            arcpy.AddMessage("Writing output data...")
-            # Create an update cursor to add numtrips, trips/hr, maxwaittime, and headway stats to stops
-            frequency_records=stop_frequency_statistics.to_records()
-            arcpy.da.ExtendTable(outStops,"stop_id", frequency_records, "stop_id", append_only=False)
-            arcpy.AddMessage("Script complete!")
+            BBB_SharedFunctions.AddMessage("Writing output data...")
+            # Convert the statistics to plain python values keyed by stop_id so they can be
+            # written along with the stops in one pass.
+            stat_columns = list(stop_frequency_statistics.columns)
+            stats_dict = {}  # {stop_id: (NumTrips, NumTripsPerHr, MaxWaitTime, rte_count, AvgHeadway, ...)}
+            for stop_id, values in zip(stop_frequency_statistics.index, stop_frequency_statistics.itertuples(index=False)):
+                stats = []
+                for value in values:
+                    if hasattr(value, "item"):
+                        value = value.item()
+                    if isinstance(value, float) and np.isnan(value):
+                        value = None
+                    stats.append(value)
+                stats_dict[stop_id] = tuple(stats)
+            empty_stats = (None,) * len(stat_columns)
+            stat_types = {"NumTrips": "LONG", "rte_count": "LONG"}
+            stat_fields = [(column, stat_types.get(column, "DOUBLE")) for column in stat_columns]
+
+            def GetStats(stop_id):
+                return stats_dict.get(stop_id, empty_stats)
+
+            # Create a feature class of transit stops with the frequency statistics
+            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, outStops, stat_fields=stat_fields,
+                                                                             GetStats=GetStats)
+            BBB_SharedFunctions.AddMessage("Script complete!")
         except:
-            arcpy.AddError("Error writing to output.")
+            BBB_SharedFunctions.AddError("Error writing to output.")
             raise
 
-        arcpy.AddMessage("Finished!")
-        arcpy.AddMessage("Your output is located at " + outStops)
+        BBB_SharedFunctions.AddMessage("Finished!")
+        BBB_SharedFunctions.AddMessage("Your output is located at " + outStops)
 
     except BBB_SharedFunctions.CustomError:
-        arcpy.AddError("Failed to count high frequency routes at stops.")
+        BBB_SharedFunctions.AddError("Failed to count high frequency routes at stops.")
         pass
 
     except:
-        arcpy.AddError("Failed to count high frequency routes at stops.")
+        BBB_SharedFunctions.AddError("Failed to count high frequency routes at stops.")
         raise
+
+    finally:
+        gtfs.close()
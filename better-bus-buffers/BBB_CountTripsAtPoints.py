@@ -30,10 +30,15 @@ subsequent trips, and the number of stops within range of the input point.
 import os
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_SpatialIndex
+import BBB_PointsAndStopsStore
 
 
+@BBB_Instrumentation.Profiled("Count Trips at Points")
 def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, end_time,
-            inNetworkDataset, imp, BufferSize, restrictions, DepOrArrChoice):
+            inNetworkDataset, imp, BufferSize, restrictions, DepOrArrChoice, LowMemory=False):
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
     try:
         # Source FC names are not prepended to field names.
         arcpy.env.qualifiedFieldNames = False
@@ -46,8 +51,6 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         BBB_SharedFunctions.CheckWorkspace()
         BBB_SharedFunctions.CheckOutNALicense()
 
-        BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
-
         Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
         start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
 
@@ -58,6 +61,8 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
         # Hard-wired OD variables
         ExcludeRestricted = "EXCLUDE"
+        SearchToleranceMeters = 500
+        SearchTolerance = "%i meters" % SearchToleranceMeters
         PathShape = "NO_LINES"
         accumulate = ""
         uturns = "ALLOW_UTURNS"
@@ -72,19 +77,57 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
         arcpy.AddMessage("Run set up successfully.")
 
+        # ----- Find the points and stops that could be within range of each other -----
+        BBB_Instrumentation.StartPhase("Points near stops")
+        try:
+            # If the impedance is a distance, a stop can only be reached from a point if the
+            # straight-line distance between them is less than the buffer distance plus the
+            # search tolerance used to locate each of them on the network. Leave everything
+            # else out of the OD problem. There's nothing we can do for time impedances.
+            impunits = imp.split(" (Units: ")[1].split(")")[0]
+            radius = BBB_SpatialIndex.ConvertToMeters(BufferSize, impunits)
+            PointsLayer = inPointsLayer
+            NearbyStopList = None
+            if radius is not None:
+                arcpy.AddMessage("Finding transit stops near input points...")
+                radius += 2 * SearchToleranceMeters
+                PointsWithStops, NearbyStopList = BBB_SharedFunctions.FindStopsNearPoints(gtfs, inPointsLayer, radius)
+                if not NearbyStopList:
+                    arcpy.AddError("No transit stops were found within a %s %s walk of any of your input points.  \
+Consequently, there is no transit service available to your input points, so no output will be generated." % (str(BufferSize), impunits))
+                    raise BBB_SharedFunctions.CustomError
+                # Skip points with no stops nearby
+                num_points = int(arcpy.management.GetCount(inPointsLayer).getOutput(0))
+                if len(PointsWithStops) < num_points:
+                    if len(PointsWithStops) < num_points / 2:
+                        where = BBB_SharedFunctions.MakeOIDWhereClause(inPointsLayer, PointsWithStops)
+                    else:
+                        PointsWithStops = set(PointsWithStops)
+                        with arcpy.da.SearchCursor(inPointsLayer, ["OID@"]) as cur:
+                            PointsWithoutStops = [row[0] for row in cur if row[0] not in PointsWithStops]
+                        where = BBB_SharedFunctions.MakeOIDWhereClause(inPointsLayer, PointsWithoutStops, exclude=True)
+                    PointsLayer = "PointsNearStops"
+                    arcpy.management.MakeFeatureLayer(inPointsLayer, PointsLayer, where)
+                arcpy.AddMessage("%i of %i input points have transit stops nearby." % (len(PointsWithStops), num_points))
+        except:
+            arcpy.AddError("Error finding transit stops near input points.")
+            raise
+
         # ----- Create a feature class of stops ------
+        BBB_Instrumentation.StartPhase("Stops feature class")
         try:
             arcpy.AddMessage("Getting GTFS stops...")
             tempstopsname = "Temp_Stops"
             if ".shp" in outFilename:
                 tempstopsname += ".shp"
-            StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(outDir, tempstopsname))
+            StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, os.path.join(outDir, tempstopsname), NearbyStopList)
         except:
             arcpy.AddError("Error creating feature class of GTFS stops.")
             raise
 
 
         #----- Create OD Matrix between stops and user's points -----
+        BBB_Instrumentation.StartPhase("OD")
         try:
             arcpy.AddMessage("Creating OD matrix between points and stops...")
             arcpy.AddMessage("(This step could take a while for large datasets or buffer sizes.)")
@@ -112,7 +155,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
             fieldMappingStops["stop_id"].mappedFieldName = "stop_id"
             # Add the GTFS stops as locations for the analysis.
             arcpy.na.AddLocations(outNALayer_OD, stops, StopsLayer,
-                                    fieldMappingStops, "500 meters", "", "", "", "", "", "",
+                                    fieldMappingStops, SearchTolerance, "", "", "", "", "", "",
                                     ExcludeRestricted)
             # Clear out the memory because we don't need this anymore.
             arcpy.management.Delete(StopsLayer)
@@ -125,9 +168,11 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
             fieldMappingPoints["Name"].mappedFieldName = inLocUniqueID
             fieldMappingPoints[inLocUniqueID_qualified].mappedFieldName = inLocUniqueID
             # Add the input points as locations for the analysis.
-            arcpy.na.AddLocations(outNALayer_OD, points, inPointsLayer,
-                                    fieldMappingPoints, "500 meters", "", "", "", "", "", "",
+            arcpy.na.AddLocations(outNALayer_OD, points, PointsLayer,
+                                    fieldMappingPoints, SearchTolerance, "", "", "", "", "", "",
                                     ExcludeRestricted)
+            if PointsLayer != inPointsLayer:
+                arcpy.management.Delete(PointsLayer)
 
             # Solve the OD matrix.
             try:
@@ -169,13 +214,15 @@ Consequently, there is no transit service available to your input points, so no
                                         stops_OID, ["stop_id"])
 
             # Use searchcursor on lines to find the stops that are reachable from points.
+            # The point-stop pairs are streamed to disk so memory use doesn't grow with
+            # the number of points.
             global PointsAndStops
-            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}
-            PointsAndStops = {}
-            ODCursor = arcpy.da.SearchCursor(linesSubLayer, [inLocUniqueID_qualified, "stop_id"])
-            for row in ODCursor:
-                PointsAndStops.setdefault(str(row[0]), []).append(str(row[1]))
-            del ODCursor
+            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}, stored on disk
+            PointsAndStops = BBB_PointsAndStopsStore.PointsAndStopsStore(
+                point_key=BBB_SharedFunctions.GetUniqueIDKey(inPointsLayer, inLocUniqueID))
+            with arcpy.da.SearchCursor(linesSubLayer, [inLocUniqueID_qualified, "stop_id"]) as ODCursor:
+                PointsAndStops.add_pairs(ODCursor)
+            PointsAndStops.finish()
 
         except:
             arcpy.AddError("Error creating OD matrix between stops and input points.")
@@ -183,11 +230,12 @@ Consequently, there is no transit service available to your input points, so no
 
 
         #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
             # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific, LowMemory)
 
         except:
             arcpy.AddError("Error calculating the number of transit trips available during the time window.")
@@ -195,6 +243,7 @@ Consequently, there is no transit service available to your input points, so no
 
 
         # ----- Generate output data -----
+        BBB_Instrumentation.StartPhase("Output")
         try:
             arcpy.AddMessage("Writing output data...")
 
@@ -212,21 +261,24 @@ Consequently, there is no transit service available to your input points, so no
                 arcpy.management.AddField(outFile, "MaxWaitTime", "SHORT")
 
             if ".shp" in outFilename:
+                # Shapefiles don't support ORDER BY, so look up each point's reachable
+                # stops on its own with the store's index.
+                GetStops = PointsAndStops.lookup
                 ucursor = arcpy.da.UpdateCursor(outFile,
                                                 [inLocUniqueID[0:10], "NumTrips",
                                                 "TripsPerHr", "NumStops",
                                                 "MaxWaitTm"])
             else:
+                # Read the points in order of unique ID so the reachable stops are read
+                # from disk in consecutive chunks.
+                GetStops = PointsAndStops.get
                 ucursor = arcpy.da.UpdateCursor(outFile,
                                             [inLocUniqueID, "NumTrips",
                                             "NumTripsPerHr", "NumStopsInRange",
-                                            "MaxWaitTime"])
+                                            "MaxWaitTime"], sql_clause=(None, "ORDER BY " + inLocUniqueID))
             for row in ucursor:
-                try:
-                    ImportantStops = PointsAndStops[str(row[0])]
-                except KeyError:
-                    # This point had no stops in range
-                    ImportantStops = []
+                # An empty list means this point had no stops in range
+                ImportantStops = GetStops(row[0])
                 NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime =\
                                 BBB_SharedFunctions.RetrieveStatsForSetOfStops(
                                     ImportantStops, stoptimedict, CalcWaitTime,
@@ -239,6 +291,8 @@ Consequently, there is no transit service available to your input points, so no
                 else:
                     row[4] = MaxWaitTime
                 ucursor.updateRow(row)
+            del ucursor
+            PointsAndStops.close()
 
         except:
             arcpy.AddError("Error writing output.")
@@ -257,5 +311,6 @@ Consequently, there is no transit service available to your input points, so no
         raise
 
     finally:
+        gtfs.close()
         # Reset overwriteOutput to what it was originally.
         arcpy.env.overwriteOutput = OverwriteOutput
\ No newline at end of file
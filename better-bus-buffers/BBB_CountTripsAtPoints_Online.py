@@ -30,31 +30,66 @@ service.
    limitations under the License.'''
 ################################################################################
 
-import os, time, math, json, math
+import os, json
+import numpy as np
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_ChunkScheduler
+import BBB_SpatialIndex
+import BBB_PointsAndStopsStore
+
+# Maximum number of OD Cost Matrix jobs to have running on the service at once
+max_concurrent_OD_jobs = 4
+
+
+class AGOLODService(BBB_ChunkScheduler.ODService):
+    '''Solves chunks of the points-to-stops problem with the ArcGIS Online
+    OD Cost Matrix service. Origins and destinations are lists of ObjectIDs in
+    the points and stops feature classes.'''
+
+    def __init__(self, ODservice, points_fc, points_where, stops_fc, stops_where,
+                 TravelMode, BufferUnits, BufferSize, PathShape):
+        self.ODservice = ODservice
+        self.points_fc = points_fc
+        self.points_where = points_where
+        self.stops_fc = stops_fc
+        self.stops_where = stops_where
+        self.TravelMode = TravelMode
+        self.BufferUnits = BufferUnits
+        self.BufferSize = BufferSize
+        self.PathShape = PathShape
+        self.job_count = 0
+
+    def submit(self, origins, destinations):
+        # Each job gets its own layers because several jobs are running at once.
+        self.job_count += 1
+        PointsLayer = "PointsLayer_%i" % self.job_count
+        StopsLayer = "StopsLayer_%i" % self.job_count
+        arcpy.management.MakeFeatureLayer(self.points_fc, PointsLayer, self.points_where(origins))
+        arcpy.management.MakeFeatureLayer(self.stops_fc, StopsLayer, self.stops_where(destinations))
+        # Call the OD Cost Matrix service for this chunk. The service runs asynchronously.
+        result = self.ODservice.GenerateOriginDestinationCostMatrix(PointsLayer, StopsLayer, self.TravelMode,
+                                                    Distance_Units=self.BufferUnits, Cutoff=self.BufferSize,
+                                                    Origin_Destination_Line_Shape=self.PathShape)
+        return (result, PointsLayer, StopsLayer)
+
+    def status(self, job):
+        return job[0].status
+
+    def collect(self, job):
+        '''Return a list of (points OID, stops OID) pairs reachable from each other.'''
+        result, PointsLayer, StopsLayer = job
+        arcpy.management.Delete(PointsLayer)
+        arcpy.management.Delete(StopsLayer)
 
-
-def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, end_time, 
-            BufferSize, BufferUnits, DepOrArrChoice, username, password):
-
-    def runOD(Points, Stops):
-        # Call the OD Cost Matrix service for this set of chunks
-        result = ODservice.GenerateOriginDestinationCostMatrix(Points, Stops, TravelMode, Distance_Units=BufferUnits, Cutoff=BufferSize,
-                                                        Origin_Destination_Line_Shape=PathShape)
-
-        # Check the status of the result object every 0.5 seconds 
-        # until it has a value of 4(succeeded) or greater 
-        while result.status < 4:
-            time.sleep(0.5)
-        
         # Print any warning or error messages returned from the tool
         result_severity = result.maxSeverity
         if result_severity == 2:
             errors = result.getMessages(2)
             if "No solution found." in errors:
                 # No destinations were found for the origins, which probably just means they were too far away.
-                pass
+                return []
             else:
                 arcpy.AddError("An error occured when running the tool")
                 arcpy.AddError(result.getMessages(2))
@@ -62,15 +97,26 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         elif result_severity == 1:
             arcpy.AddWarning("Warnings were returned when running the tool")
             arcpy.AddWarning(result.getMessages(1))
-            
-        # Get the resulting OD Lines and store the stops that are reachable from points.
-        if result_severity != 2:
-            linesSubLayer = result.getOutput(1)
-            with arcpy.da.SearchCursor(linesSubLayer, ["OriginOID", "DestinationOID"]) as ODCursor:
-                for row in ODCursor:
-                    UID = pointsOIDdict[row[0]]
-                    SID = stopOIDdict[row[1]]
-                    PointsAndStops.setdefault(str(UID), []).append(str(SID))
+
+        # Get the resulting OD Lines
+        linesSubLayer = result.getOutput(1)
+        with arcpy.da.SearchCursor(linesSubLayer, ["OriginOID", "DestinationOID"]) as ODCursor:
+            return [(row[0], row[1]) for row in ODCursor]
+
+    def cancel(self, job):
+        result, PointsLayer, StopsLayer = job
+        try:
+            result.cancel()
+        except:
+            pass
+        arcpy.management.Delete(PointsLayer)
+        arcpy.management.Delete(StopsLayer)
+
+
+@BBB_Instrumentation.Profiled("Count Trips at Points Online")
+def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, end_time, 
+            BufferSize, BufferUnits, DepOrArrChoice, username, password, LowMemory=False):
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
 
     try:
         # Source FC names are not prepended to field names.
@@ -80,14 +126,12 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         arcpy.env.overwriteOutput = True
         
         BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
-        BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
 
         Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
         start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
 
         # Distance between stops and points
         BufferSize_padded = BufferSize + (.2 * BufferSize)
-        BufferLinearUnit = str(BufferSize_padded) + " " + BufferUnits
 
         # Will we calculate the max wait time?
         CalcWaitTime = True
@@ -100,6 +144,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         inLocUniqueID = BBB_SharedFunctions.HandleOIDUniqueID(inPointsLayer, inLocUniqueID)
 
         # ----- Prepare OD service -----
+        BBB_Instrumentation.StartPhase("OD service")
         try:
             arcpy.AddMessage("Obtaining credentials for and information about OD Cost Matrix service...")
         
@@ -135,21 +180,31 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
             raise
 
 
+        # ----- Find the points and stops that could be within range of each other -----
+        BBB_Instrumentation.StartPhase("Points near stops")
+        try:
+            arcpy.AddMessage("Finding transit stops near input points...")
+            # Only stops within a reasonable distance of points and points within a
+            # reasonable distance of stops are included to reduce problem size.
+            BufferRadius = BBB_SpatialIndex.ConvertToMeters(BufferSize_padded, BufferUnits)
+            PointsWithStops, NearbyStopList = BBB_SharedFunctions.FindStopsNearPoints(gtfs, inPointsLayer, BufferRadius)
+            if not NearbyStopList:
+                arcpy.AddError("No transit stops were found within %s %s of any of your input points.  \
+Consequently, there is no transit service available to your input points, so no output will be generated." % (str(BufferSize), BufferUnits))
+                raise BBB_SharedFunctions.CustomError
+
+        except:
+            arcpy.AddError("Error finding transit stops near input points.")
+            raise
+
+
         # ----- Create a feature class of stops ------
+        BBB_Instrumentation.StartPhase("Stops feature class")
         try:
             arcpy.AddMessage("Getting GTFS stops...")
             tempstopsname = "Temp_Stops"
-            StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(outDir, tempstopsname))
-            
-            # Select only the stops within a reasonable distance of points to reduce problem size
-            arcpy.management.MakeFeatureLayer(StopsLayer, "StopsToRemove")
-            arcpy.management.SelectLayerByLocation("StopsToRemove", "WITHIN_A_DISTANCE_GEODESIC", inPointsLayer, BufferLinearUnit, invert_spatial_relationship="INVERT")
-            arcpy.management.DeleteRows("StopsToRemove")
-            arcpy.management.Delete("StopsToRemove")
-            
-            # Make Feature Layer of stops to use later
-            arcpy.management.MakeFeatureLayer(StopsLayer, "StopsLayer")
-            stopsOID = arcpy.Describe("StopsLayer").OIDFieldName
+            StopsLayer, StopList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, os.path.join(outDir, tempstopsname), NearbyStopList)
+            stopsOID = arcpy.Describe(StopsLayer).OIDFieldName
 
         except:
             arcpy.AddError("Error creating feature class of GTFS stops.")
@@ -157,15 +212,16 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
 
         # ----- Prepare input data -----
+        BBB_Instrumentation.StartPhase("Prepare inputs")
         try:
             arcpy.AddMessage("Preparing input points...")
             
             # Select only the points within a reasonable distance of stops to reduce problem size
             temppointsname = outFilename + "_Temp"
             relevantPoints = os.path.join(outDir, temppointsname)
-            arcpy.management.MakeFeatureLayer(inPointsLayer, "PointsToKeep")
-            arcpy.management.SelectLayerByLocation("PointsToKeep", "WITHIN_A_DISTANCE_GEODESIC", StopsLayer, BufferLinearUnit)
-            num_points = int(arcpy.management.GetCount("PointsToKeep").getOutput(0))
+            arcpy.management.MakeFeatureLayer(inPointsLayer, "PointsToKeep",
+                                              BBB_SharedFunctions.MakeOIDWhereClause(inPointsLayer, PointsWithStops))
+            num_points = len(PointsWithStops)
             
             # If the number of points is large, sort them spatially for smart chunking
             if num_points > origin_limit:
@@ -189,64 +245,66 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
 
         #----- Create OD Matrix between stops and user's points -----
+        BBB_Instrumentation.StartPhase("OD")
         try:
             arcpy.AddMessage("Creating OD matrix between points and stops...")
             arcpy.AddMessage("(This step could take a while for large datasets or buffer sizes.)")
 
             global PointsAndStops
-            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}
-            PointsAndStops = {}
-
-            # Chunk the points to fit the service limits and loop through chunks
-            points_numchunks = int(math.ceil(float(num_points)/origin_limit))
-            points_chunkstart = 0
-            points_chunkend = origin_limit
-            current_chunk = 0
-            for x in range(0, points_numchunks):
-                current_chunk += 1
-                arcpy.AddMessage("Handling input points chunk %i of %i" % (current_chunk, points_numchunks))
-            
-                # Select only the points belonging to this chunk
-                points_chunk = sorted(pointsOIDdict.keys())[points_chunkstart:points_chunkend]
-                points_chunkstart = points_chunkend
-                points_chunkend = points_chunkstart + origin_limit
+            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}, stored on disk
+            PointsAndStops = BBB_PointsAndStopsStore.PointsAndStopsStore(
+                point_key=BBB_SharedFunctions.GetUniqueIDKey(relevantPoints, inLocUniqueID))
+
+            # Store stop OIDs in a dictionary for later joining
+            stopOIDdict = {} # {OID: stop_id}
+            stopIDdict = {} # {stop_id: OID}
+            with arcpy.da.SearchCursor(StopsLayer, ["OID@", "stop_id"]) as cur:
+                for row in cur:
+                    stopOIDdict[row[0]] = row[1]
+                    stopIDdict[row[1]] = row[0]
+
+            def make_where_clause(OIDfield):
                 if ispgdb:
-                    points_selection_query = '[{0}] IN ({1})'.format(relevantpointsOID, ','.join(map(str, points_chunk)))
+                    return lambda OIDs: '[{0}] IN ({1})'.format(OIDfield, ','.join(map(str, OIDs)))
                 else:
-                    points_selection_query = '"{0}" IN ({1})'.format(relevantpointsOID, ','.join(map(str, points_chunk)))
-                arcpy.MakeFeatureLayer_management(relevantPoints, "PointsLayer", points_selection_query)
-                
+                    return lambda OIDs: '"{0}" IN ({1})'.format(OIDfield, ','.join(map(str, OIDs)))
+            points_where = make_where_clause(relevantpointsOID)
+            stops_where = make_where_clause(stopsOID)
+
+            # Chunk the points to fit the service limits. For each chunk of points, find
+            # the stops within the safe buffer and chunk those as well if the number of
+            # stops in range exceeds the destination limit. All the chunks are worked
+            # out up front so the OD jobs can be run concurrently.
+            StopGrid, StopIDList = BBB_SharedFunctions.MakeStopGrid(gtfs, BufferRadius)
+            pointValues, pointLats, pointLons = BBB_SharedFunctions.ReadPointLatLons(relevantPoints, ["OID@"])
+            pointIdxDict = dict((val[0], idx) for idx, val in enumerate(pointValues)) # {OID: index in pointLats}
+            pointLats = np.array(pointLats)
+            pointLons = np.array(pointLons)
+            chunks = [] # [(points OIDs, stops OIDs)]
+            for points_chunk in BBB_ChunkScheduler.make_chunks(pointsOIDdict.keys(), origin_limit):
                 # Select only the stops within the safe buffer of these points
-                arcpy.management.SelectLayerByLocation("StopsLayer", "WITHIN_A_DISTANCE_GEODESIC", "PointsLayer", BufferLinearUnit)
-                num_stops = int(arcpy.GetCount_management("StopsLayer").getOutput(0))
-                stopOIDdict = {} # {OID: stop_id}
-                with arcpy.da.SearchCursor("StopsLayer", ["OID@", "stop_id"]) as cur:
-                    for row in cur:
-                        stopOIDdict[row[0]] = row[1]
-
-                # If the number of stops in range exceeds the destination limit, we have to chunk these as well.
-                if num_stops > destination_limit:
-                    stops_numchunks = int(math.ceil(float(num_stops)/destination_limit))
-                    stops_chunkstart = 0
-                    stops_chunkend = destination_limit
-                    for x in range(0, stops_numchunks):
-                        stops_chunk = sorted(stopOIDdict.keys())[stops_chunkstart:stops_chunkend]
-                        stops_chunkstart = stops_chunkend
-                        stops_chunkend = stops_chunkstart + destination_limit
-                        if ispgdb:
-                            stops_selection_query = '[{0}] IN ({1})'.format(stopsOID, ','.join(map(str, stops_chunk)))
-                        else:
-                            stops_selection_query = '"{0}" IN ({1})'.format(stopsOID, ','.join(map(str, stops_chunk)))
-                        arcpy.MakeFeatureLayer_management("StopsLayer", "StopsLayer_Chunk", stops_selection_query)
-                        runOD("PointsLayer", "StopsLayer_Chunk")
-                    arcpy.management.Delete("StopsLayer_Chunk")
-                # Otherwise, just run them all.
-                else:
-                    runOD("PointsLayer", "StopsLayer")
+                chunk_idx = np.array([pointIdxDict[OID] for OID in points_chunk if OID in pointIdxDict], dtype=int)
+                stops_in_range = set()
+                for point_idx, stop_idx, dist in StopGrid.query(pointLats[chunk_idx], pointLons[chunk_idx], BufferRadius):
+                    stops_in_range.update(stopIDdict[StopIDList[idx]] for idx in stop_idx.tolist())
+                for stops_chunk in BBB_ChunkScheduler.make_chunks(stops_in_range, destination_limit):
+                    chunks.append((points_chunk, stops_chunk))
+
+            def store_result(chunk_index, OD_pairs):
+                # Store the stops that are reachable from points.
+                PointsAndStops.add_pairs((pointsOIDdict[pointOID], stopOIDdict[stopOID]) for pointOID, stopOID in OD_pairs)
+                store_result.num_finished += 1
+                arcpy.AddMessage("Finished OD chunk %i of %i" % (store_result.num_finished, len(chunks)))
+            store_result.num_finished = 0
+
+            # Run the OD chunks, keeping several jobs running on the service at once.
+            ODsolver = AGOLODService(ODservice, relevantPoints, points_where, StopsLayer, stops_where,
+                                     TravelMode, BufferUnits, BufferSize, PathShape)
+            scheduler = BBB_ChunkScheduler.ChunkScheduler(ODsolver, max_concurrent_OD_jobs)
+            scheduler.run(chunks, store_result)
+            PointsAndStops.finish()
 
             # Clean up
-            arcpy.management.Delete("StopsLayer")
-            arcpy.management.Delete("PointsLayer")
             arcpy.management.Delete(StopsLayer)
             arcpy.management.Delete(relevantPoints)
 
@@ -256,11 +314,12 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
 
         #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
             arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
 
             # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific, LowMemory)
 
         except:
             arcpy.AddError("Error calculating the number of transit trips available during the time window.")
@@ -268,6 +327,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
 
 
         # ----- Generate output data -----
+        BBB_Instrumentation.StartPhase("Output")
         try:
             arcpy.AddMessage("Writing output data...")
 
@@ -278,16 +338,15 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
             arcpy.management.AddField(outFile, "NumStopsInRange", "SHORT")
             arcpy.management.AddField(outFile, "MaxWaitTime", "SHORT")
 
+            # Read the points in order of unique ID so the reachable stops are read
+            # from disk in consecutive chunks.
             with arcpy.da.UpdateCursor(outFile,
                                             [inLocUniqueID, "NumTrips",
                                             "NumTripsPerHr", "NumStopsInRange",
-                                            "MaxWaitTime"]) as ucursor:
+                                            "MaxWaitTime"], sql_clause=(None, "ORDER BY " + inLocUniqueID)) as ucursor:
                 for row in ucursor:
-                    try:
-                        ImportantStops = PointsAndStops[str(row[0])]
-                    except KeyError:
-                        # This point had no stops in range
-                        ImportantStops = []
+                    # An empty list means this point had no stops in range
+                    ImportantStops = PointsAndStops.get(row[0])
                     NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime =\
                                     BBB_SharedFunctions.RetrieveStatsForSetOfStops(
                                         ImportantStops, stoptimedict, CalcWaitTime,
@@ -297,6 +356,7 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
                     row[3] = NumStopsInRange
                     row[4] = MaxWaitTime
                     ucursor.updateRow(row)
+            PointsAndStops.close()
                     
         except:
             arcpy.AddError("Error writing output.")
@@ -315,5 +375,6 @@ def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, en
         raise
 
     finally:
+        gtfs.close()
         # Reset overwriteOutput to what it was originally.
         arcpy.env.overwriteOutput = OverwriteOutput
\ No newline at end of file
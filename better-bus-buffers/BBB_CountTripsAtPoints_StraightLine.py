@@ -0,0 +1,177 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Count Trips at Points (Straight Line)
+
+BetterBusBuffers provides a quantitative measure of access to public transit
+in your city by counting the transit trip frequency at various locations.
+
+The Count Trips at Points tool takes a set of input points, finds the transit stops
+reachable within a user-selected buffer distance, and counts the number of
+transit trips that pass those stops during the time window selected. The tool
+also calculates the number of trips per hour, the maximum time between
+subsequent trips, and the number of stops within range of the input point.
+
+This version of the tool does not use a network dataset. The walking distance
+between points and stops is estimated as the straight-line distance multiplied
+by a detour factor, so it is suitable for quickly screening very large sets of
+points and does not require a Network Analyst license.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import arcpy
+import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_SpatialIndex
+import BBB_PointsAndStopsStore
+
+
+@BBB_Instrumentation.Profiled("Count Trips at Points Straight Line")
+def runTool(outFile, SQLDbase, inPointsLayer, inLocUniqueID, day, start_time, end_time,
+            BufferSize, BufferUnits, DetourFactor, DepOrArrChoice, LowMemory=False):
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
+    try:
+        # It's okay to overwrite in-memory stuff.
+        OverwriteOutput = arcpy.env.overwriteOutput # Get the orignal value so we can reset it.
+        arcpy.env.overwriteOutput = True
+
+        BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
+
+        Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
+        start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
+
+        # Will we calculate the max wait time?
+        CalcWaitTime = True
+
+        # Walking distance between points and stops
+        BufferMeters = BBB_SpatialIndex.ConvertToMeters(BufferSize, BufferUnits)
+        if not DetourFactor:
+            DetourFactor = 1.0
+
+        # Output file designated by user
+        outFilename = os.path.basename(outFile)
+
+        inLocUniqueID = BBB_SharedFunctions.HandleOIDUniqueID(inPointsLayer, inLocUniqueID)
+
+        arcpy.AddMessage("Run set up successfully.")
+
+        #----- Find the stops within walking distance of each point -----
+        BBB_Instrumentation.StartPhase("Points near stops")
+        try:
+            arcpy.AddMessage("Finding transit stops within range of input points...")
+
+            StopGrid, StopIDList = BBB_SharedFunctions.MakeStopGrid(gtfs, BufferMeters / DetourFactor)
+            PointIDs, PointLats, PointLons = BBB_SharedFunctions.ReadPointLatLons(inPointsLayer, [inLocUniqueID])
+            PointIDs = [UID[0] for UID in PointIDs]
+
+            global PointsAndStops
+            # PointsAndStops = {LocID: [stop_1, stop_2, ...]}, stored on disk
+            PointsAndStops = BBB_PointsAndStopsStore.PointsAndStopsStore(
+                point_key=BBB_SharedFunctions.GetUniqueIDKey(inPointsLayer, inLocUniqueID))
+            PointsAndStops.add_pairs(BBB_SpatialIndex.IterPointStopPairs(PointIDs, PointLats, PointLons, StopIDList,
+                                                                         StopGrid, BufferMeters, DetourFactor))
+            PointsAndStops.finish()
+            del PointIDs, PointLats, PointLons
+
+        except:
+            arcpy.AddError("Error finding transit stops within range of input points.")
+            raise
+
+
+        #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
+        try:
+            arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
+
+            # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific, LowMemory)
+
+        except:
+            arcpy.AddError("Error calculating the number of transit trips available during the time window.")
+            raise
+
+
+        # ----- Generate output data -----
+        BBB_Instrumentation.StartPhase("Output")
+        try:
+            arcpy.AddMessage("Writing output data...")
+
+            arcpy.management.CopyFeatures(inPointsLayer, outFile)
+            # Add a field to the output file for number of trips and num trips / hour.
+            if ".shp" in outFilename:
+                arcpy.management.AddField(outFile, "NumTrips", "SHORT")
+                arcpy.management.AddField(outFile, "TripsPerHr", "DOUBLE")
+                arcpy.management.AddField(outFile, "NumStops", "SHORT")
+                arcpy.management.AddField(outFile, "MaxWaitTm", "SHORT")
+            else:
+                arcpy.management.AddField(outFile, "NumTrips", "SHORT")
+                arcpy.management.AddField(outFile, "NumTripsPerHr", "DOUBLE")
+                arcpy.management.AddField(outFile, "NumStopsInRange", "SHORT")
+                arcpy.management.AddField(outFile, "MaxWaitTime", "SHORT")
+
+            if ".shp" in outFilename:
+                # Shapefiles don't support ORDER BY, so look up each point's reachable
+                # stops on its own with the store's index.
+                GetStops = PointsAndStops.lookup
+                ucursor = arcpy.da.UpdateCursor(outFile,
+                                                [inLocUniqueID[0:10], "NumTrips",
+                                                "TripsPerHr", "NumStops",
+                                                "MaxWaitTm"])
+            else:
+                # Read the points in order of unique ID so the reachable stops are read
+                # from disk in consecutive chunks.
+                GetStops = PointsAndStops.get
+                ucursor = arcpy.da.UpdateCursor(outFile,
+                                            [inLocUniqueID, "NumTrips",
+                                            "NumTripsPerHr", "NumStopsInRange",
+                                            "MaxWaitTime"], sql_clause=(None, "ORDER BY " + inLocUniqueID))
+            for row in ucursor:
+                # An empty list means this point had no stops in range
+                ImportantStops = GetStops(row[0])
+                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime =\
+                                BBB_SharedFunctions.RetrieveStatsForSetOfStops(
+                                    ImportantStops, stoptimedict, CalcWaitTime,
+                                    start_sec, end_sec)
+                row[1] = NumTrips
+                row[2] = NumTripsPerHr
+                row[3] = NumStopsInRange
+                if ".shp" in outFilename and MaxWaitTime == None:
+                    row[4] = -1
+                else:
+                    row[4] = MaxWaitTime
+                ucursor.updateRow(row)
+            del ucursor
+            PointsAndStops.close()
+
+        except:
+            arcpy.AddError("Error writing output.")
+            raise
+
+        arcpy.AddMessage("Done!")
+        arcpy.AddMessage("Output files written:")
+        arcpy.AddMessage("- " + outFile)
+
+    except BBB_SharedFunctions.CustomError:
+        arcpy.AddError("Error counting transit trips at input locations.")
+        pass
+
+    except:
+        arcpy.AddError("Error counting transit trips at input locations.")
+        raise
+
+    finally:
+        gtfs.close()
+        # Reset overwriteOutput to what it was originally.
+        arcpy.env.overwriteOutput = OverwriteOutput
@@ -26,15 +26,18 @@ during that time window.
    limitations under the License.'''
 ################################################################################
 
-import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
 
 
-def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
+# If outStops is a table in a GeoPackage, this tool does not use arcpy and can be
+# run on machines without ArcGIS.
+@BBB_Instrumentation.Profiled("Count Trips at Stops")
+def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice, LowMemory=False):
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
     try:
             
         BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
-        BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
 
         Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
         start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
@@ -42,80 +45,68 @@ def runTool(outStops, SQLDbase, day, start_time, end_time, DepOrArrChoice):
         # Will we calculate the max wait time?
         CalcWaitTime = True
 
-        # ----- Create a feature class of stops and add fields for transit trip counts ------
-        try:
-            arcpy.AddMessage("Creating feature class of GTFS stops...")
-
-            # Create a feature class of transit stops
-            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(outStops)
-
-            # Add a field to the output file for number of trips, num trips / hour, and max wait time
-            if ".shp" in outStops:
-                # Shapefiles can't have long field names
-                arcpy.management.AddField(outStops, "NumTrips", "SHORT")
-                arcpy.management.AddField(outStops, "TripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outStops, "MaxWaitTm", "SHORT")
-            else:
-                arcpy.management.AddField(outStops, "NumTrips", "SHORT")
-                arcpy.management.AddField(outStops, "NumTripsPerHr", "DOUBLE")
-                arcpy.management.AddField(outStops, "MaxWaitTime", "SHORT")
-
-        except:
-            arcpy.AddError("Error creating feature class of GTFS stops.")
-            raise
-
 
         #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
-            arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
-
-            # Get a dictionary of {stop_id: [[trip_id, stop_time]]} for our time window
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            BBB_SharedFunctions.AddMessage("Calculating the number of transit trips available during the time window...")
+
+            DepOrArr = BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice)
+            if LowMemory:
+                # For a very large feed, calculate the statistics one stop at a time
+                # as the stop visits are streamed. {stop_id: (NumTrips, NumTripsPerHr, MaxWaitTime)}
+                stopstats = BBB_SharedFunctions.CountTripStatsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific, CalcWaitTime)
+                stoptimedict = None
+            else:
+                # Get a dictionary of {stop_id: [[trip_id, stop_time]]} for our time window
+                stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
 
         except:
-            arcpy.AddError("Error counting arrivals or departures at stop during time window.")
+            BBB_SharedFunctions.AddError("Error counting arrivals or departures at stop during time window.")
             raise
 
 
-        # ----- Write to output -----
+        # ----- Create a feature class of stops with fields for transit trip counts ------
+        BBB_Instrumentation.StartPhase("Output")
         try:
-            arcpy.AddMessage("Writing output data...")
+            BBB_SharedFunctions.AddMessage("Writing output data...")
 
-            # Create an update cursor to add numtrips, trips/hr, and maxwaittime to stops
+            # Fields for number of trips, num trips / hour, and max wait time
             if ".shp" in outStops:
-                ucursor = arcpy.da.UpdateCursor(outStops,
-                                            ["stop_id", "NumTrips",
-                                            "TripsPerHr",
-                                            "MaxWaitTm"])
+                # Shapefiles can't have long field names
+                stat_fields = [("NumTrips", "SHORT"), ("TripsPerHr", "DOUBLE"), ("MaxWaitTm", "SHORT")]
             else:
-                ucursor = arcpy.da.UpdateCursor(outStops,
-                                            ["stop_id", "NumTrips",
-                                            "NumTripsPerHr",
-                                            "MaxWaitTime"])
-            for row in ucursor:
-                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
-                            BBB_SharedFunctions.RetrieveStatsForSetOfStops(
-                                [str(row[0])], stoptimedict, CalcWaitTime,
-                                start_sec, end_sec)
-                row[1] = NumTrips
-                row[2] = NumTripsPerHr
-                if ".shp" in outStops and MaxWaitTime == None:
-                    row[3] = -1
+                stat_fields = [("NumTrips", "SHORT"), ("NumTripsPerHr", "DOUBLE"), ("MaxWaitTime", "SHORT")]
+
+            def GetStats(stop_id):
+                if stoptimedict is None:
+                    NumTrips, NumTripsPerHr, MaxWaitTime = stopstats.get(str(stop_id), (0, 0.0, None))
                 else:
-                    row[3] = MaxWaitTime
-                ucursor.updateRow(row)
+                    NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                                BBB_SharedFunctions.RetrieveStatsForSetOfStops(
+                                    [str(stop_id)], stoptimedict, CalcWaitTime,
+                                    start_sec, end_sec)
+                if ".shp" in outStops and MaxWaitTime == None:
+                    MaxWaitTime = -1
+                return NumTrips, NumTripsPerHr, MaxWaitTime
+
+            # Create a feature class of transit stops and write the counts in the same pass
+            outStops, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, outStops, stat_fields=stat_fields, GetStats=GetStats)
 
         except:
-            arcpy.AddError("Error writing to output.")
+            BBB_SharedFunctions.AddError("Error writing to output.")
             raise
 
-        arcpy.AddMessage("Finished!")
-        arcpy.AddMessage("Your output is located at " + outStops)
+        BBB_SharedFunctions.AddMessage("Finished!")
+        BBB_SharedFunctions.AddMessage("Your output is located at " + outStops)
 
     except BBB_SharedFunctions.CustomError:
-        arcpy.AddError("Failed to count trips at stops.")
+        BBB_SharedFunctions.AddError("Failed to count trips at stops.")
         pass
 
     except:
-        arcpy.AddError("Failed to count trips at stops.")
-        raise
\ No newline at end of file
+        BBB_SharedFunctions.AddError("Failed to count trips at stops.")
+        raise
+
+    finally:
+        gtfs.close()
@@ -29,16 +29,17 @@ Step 1 need only be run once for a given transit system.
    limitations under the License.'''
 ################################################################################
 
-import sqlite3
 import os
 import sys
-import uuid
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_StopGeometry
 
 
 # ----- Collect user inputs -----
 
+@BBB_Instrumentation.Profiled("Count Trips on Lines Step 1")
 def runTool(outLinesFC, SQLDbase, combine_corridors):
     try:
 
@@ -48,33 +49,28 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
 
         # Derived inputs
         outGDB = os.path.dirname(outLinesFC) # Must be in fgdb. Validated in tool validation.
-        # Create a guid to make sure temporary outputs have unique names. They should be deleted
-        # when the tool completes, but this ensures they don't conflict with any existing feature
-        # classes in the gdb and makes it easier to know what they are and delete them if they
-        # don't automatically get deleted.
-        guid = uuid.uuid4().hex
-        outStopPairsFCName = "StopPairs_" + guid
-        outStopPairsFC = os.path.join(outGDB, outStopPairsFCName)
 
         # Get the original overwrite output setting so we can reset it at the end.
         OverwriteOutput = arcpy.env.overwriteOutput
         # It's okay to overwrite stuff in this tool
         arcpy.env.overwriteOutput = True
 
-        conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
+        gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
+        conn = gtfs.conn
 
-        triproute_dict = BBB_SharedFunctions.MakeTripRouteDict()
+        triproute_dict = BBB_SharedFunctions.MakeTripRouteDict(gtfs)
 
 
     # ----- Initialize a dictionary of stop geometry -----
 
+        BBB_Instrumentation.StartPhase("Stop geometry")
         # Get the stops table (exclude parent stations and station entrances)
         c = conn.cursor()
         selectstoptablestmt = "SELECT stop_id, stop_lat, stop_lon, location_type FROM stops;"
         c.execute(selectstoptablestmt)
 
         # Initialize a dictionary of stop lat/lon
-        # {stop_id: <stop geometry object>} in the output coordinate system
+        # {stop_id: (stop_lon, stop_lat)} in WGS84, the output coordinate system
         stoplatlon_dict = {}
         for stop in c:
             stop_id = stop[0]
@@ -84,25 +80,22 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
             if location_type not in [0, '0', None, ""]:
                 # Skip parent stations and station entrances
                 continue
-            pt = arcpy.Point()
-            pt.X = float(stop_lon)
-            pt.Y = float(stop_lat)
-            # GTFS stop lat/lon is written in WGS1984
-            ptGeometry = arcpy.PointGeometry(pt, BBB_SharedFunctions.WGSCoords)
-            stoplatlon_dict[stop_id] = ptGeometry
+            stoplatlon_dict[stop_id] = (float(stop_lon), float(stop_lat))
 
 
     # ----- Obtain schedule info from the stop_times.txt file and convert it to a line-based model -----
 
+        BBB_Instrumentation.StartPhase("Schedule query")
         arcpy.AddMessage("Obtaining and processing transit schedule and line information...")
         arcpy.AddMessage("(This will take a few minutes for large datasets.)")
 
         # Create a line-based schedule table
         c2 = conn.cursor()
         c2.execute("DROP TABLE IF EXISTS schedules;")
-        c2.execute("CREATE TABLE schedules (key TEXT, start_time REAL, end_time REAL, trip_id TEXT);")
+        c2.execute(BBB_SharedFunctions.SchedulesTableStmt)
 
         # Find pairs of directly-connected stops
+        # {pair_id: (start_stop, end_stop, route_id)}, with route_id None when combining corridors
         linefeature_dict = {}
         stoptimefetch = '''
         SELECT trip_id, stop_id, arrival_time, departure_time
@@ -130,54 +123,30 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
             SourceOIDkey = "%s , %s" % (start_stop, end_stop)
             if combine_corridors:
                 # All trips between each pair of stops will be combined, regardless of route_id
-                linefeature_dict[SourceOIDkey] = True
+                linefeature_dict[SourceOIDkey] = (start_stop, end_stop, None)
             else:
                 # A separate line will be created for each separate route between the same two stops
-                linefeature_dict[SourceOIDkey + " , " + triproute_dict[trip_id]] = True
+                route_id = triproute_dict[trip_id]
+                linefeature_dict[SourceOIDkey + " , " + route_id] = (start_stop, end_stop, route_id)
             stmt = """INSERT INTO schedules (key, start_time, end_time, trip_id) VALUES ('%s', %s, %s, '%s');""" % (SourceOIDkey, start_time, end_time, trip_id)
             c2.execute(stmt)
             previous_stop = stop_id
             start_time = departure_time
         conn.commit()
-        c2.execute("CREATE INDEX schedules_index_tripsstend ON schedules (trip_id, start_time, end_time);")
+        c2.execute(BBB_SharedFunctions.SchedulesIndexStmt)
         conn.commit()
 
 
-        # ----- Write pairs to a points feature class (this is intermediate and will NOT go into the final output) -----
-
-        # Create a points feature class for the point pairs.
-        arcpy.management.CreateFeatureclass(outGDB, outStopPairsFCName, "POINT", "", "", "", BBB_SharedFunctions.WGSCoords)
-        arcpy.management.AddField(outStopPairsFC, "stop_id", "TEXT")
-        arcpy.management.AddField(outStopPairsFC, "pair_id", "TEXT")
-        arcpy.management.AddField(outStopPairsFC, "sequence", "SHORT")
-
-        # Add pairs of stops to the feature class in preparation for generating line features
-        badStops = []
-        badkeys = []
-        with arcpy.da.InsertCursor(outStopPairsFC, ["SHAPE@", "stop_id", "pair_id", "sequence"]) as cur:
-            # linefeature_dict = {"start_stop , end_stop , route_type": True}
-            for SourceOIDkey in linefeature_dict:
-                stopPair = SourceOIDkey.split(" , ")
-                # {stop_id: [stop_lat, stop_lon]}
-                try:
-                    stop1 = stopPair[0]
-                    stop1_geom = stoplatlon_dict[stop1]
-                except KeyError:
-                    badStops.append(stop1)
-                    badkeys.append(SourceOIDkey)
-                    continue
-                try:
-                    stop2 = stopPair[1]
-                    stop2_geom = stoplatlon_dict[stop2]
-                except KeyError:
-                    badStops.append(stop2)
-                    badkeys.append(SourceOIDkey)
-                    continue
-                cur.insertRow((stop1_geom, stop1, SourceOIDkey, 1))
-                cur.insertRow((stop2_geom, stop2, SourceOIDkey, 2))
+    # ----- Generate lines between all stops (for the final output) -----
+
+        BBB_Instrumentation.StartPhase("Output")
+        # Resolve the end points of all the lines at once
+        pair_ids = list(linefeature_dict.keys())
+        from_xy, to_xy, badStops = BBB_StopGeometry.SegmentCoordinates(
+            [linefeature_dict[pair_id][:2] for pair_id in pair_ids], stoplatlon_dict)
 
         if badStops:
-            badStops = list(set(badStops))
+            badStops = list(badStops)
             if ispy3:
                 badStops_str = str(badStops)
             else:
@@ -186,39 +155,36 @@ def runTool(outLinesFC, SQLDbase, combine_corridors):
 stops which are not included in your stops.txt file. Schedule information for \
 these stops will be ignored. " + badStops_str)
 
-        # Remove these entries from the linefeatures dictionary so it doesn't cause false records later
-        if badkeys:
-            badkeys = list(set(badkeys))
-            for key in badkeys:
-                del linefeature_dict[key]
+        arcpy.management.CreateFeatureclass(outGDB, os.path.basename(outLinesFC), "POLYLINE", "", "", "",
+                                            BBB_SharedFunctions.WGSCoords)
 
-    # ----- Generate lines between all stops (for the final output) -----
+        # Skip lines with a stop that has no geometry and lines with 0 length.
+        # Zero-length lines will just produce build errors and are not valuable
+        # for visualization anyway. Lines shorter than the XY tolerance of the
+        # output collapse to zero length when stored.
+        valid = BBB_StopGeometry.ValidSegments(from_xy, to_xy,
+                                               arcpy.Describe(outLinesFC).spatialReference.XYTolerance)
 
-        arcpy.management.PointsToLine(outStopPairsFC, outLinesFC, "pair_id", "sequence")
+        arcpy.management.AddField(outLinesFC, "pair_id", "TEXT")
+        fields = ["SHAPE@", "pair_id"]
         if not combine_corridors:
             arcpy.management.AddField(outLinesFC, "route_id", "TEXT")
+            fields.append("route_id")
 
-        # We don't need the points for anything anymore, so delete them.
-        arcpy.management.Delete(outStopPairsFC)
-
-        # Clean up lines with 0 length.  They will just produce build errors and
-        # are not valuable for visualization anyway.
-        expression = """"Shape_Length" = 0"""
-        with arcpy.da.UpdateCursor(outLinesFC, ["pair_id"], expression) as cur2:
-            for row in cur2:
-                del linefeature_dict[row[0]]
-                cur2.deleteRow()
-
-        if not combine_corridors:
-            with arcpy.da.UpdateCursor(outLinesFC, ["pair_id", "route_id"]) as cur4:
-                for row in cur4:
-                    row[1] = row[0].split(" , ")[2]
-                    cur4.updateRow(row)
+        WGS_SR = arcpy.SpatialReference(4326)
+        with arcpy.da.InsertCursor(outLinesFC, fields) as cur:
+            for i in valid.nonzero()[0]:
+                pair_id = pair_ids[i]
+                line = BBB_StopGeometry.SegmentPolyline(from_xy[i], to_xy[i], WGS_SR)
+                if combine_corridors:
+                    cur.insertRow((line, pair_id))
+                else:
+                    cur.insertRow((line, pair_id, linefeature_dict[pair_id][2]))
 
 
     # ----- Finish up. -----
 
-        conn.close()
+        gtfs.close()
 
         arcpy.AddMessage("Finished!")
         arcpy.AddMessage("Your transit lines template feature class is:")
@@ -26,11 +26,17 @@ of Step 1 and counts the frequency of service during specific time windows.
    limitations under the License.'''
 ################################################################################
 
-import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_OutputWriters
 
 
+# If the template lines and the output are both tables in GeoPackages, this tool
+# does not use arcpy and can be run on machines without ArcGIS.
+@BBB_Instrumentation.Profiled("Count Trips on Lines Step 2")
 def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
+    # GTFS SQL dbase - must be created ahead of time.
+    gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
     try:
         # ------ Get input parameters and set things up. -----
 
@@ -43,9 +49,6 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
             # Otherwise, assume it was a catalog path and use as is
             pass
 
-        # GTFS SQL dbase - must be created ahead of time.
-        BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
-
         Specific, day = BBB_SharedFunctions.CheckSpecificDate(day)
         start_sec, end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(start_time, end_time)
 
@@ -53,67 +56,77 @@ def runTool(step1LinesFC, SQLDbase, linesFC, day, start_time, end_time):
         DepOrArr = "departure_time"
 
 
-        # ----- Prepare output file -----
+        # ----- Read the template lines -----
 
+        BBB_Instrumentation.StartPhase("Read template")
         try:
-            arcpy.management.Copy(step1LinesFC, linesFC)
+            combine_corridors = "route_id" not in BBB_OutputWriters.GetFieldNames(step1LinesFC)
+            template_fields = ["pair_id"] if combine_corridors else ["pair_id", "route_id"]
+            # GeoPackage output is always in WGS84. Otherwise, keep the template's coordinate system.
+            if BBB_OutputWriters.IsGeoPackage(linesFC):
+                output_coords = None
+                read_coords = None if BBB_OutputWriters.IsGeoPackage(step1LinesFC) else BBB_SharedFunctions.WGSCoords
+            else:
+                output_coords = read_coords = BBB_SharedFunctions.arcpy.Describe(step1LinesFC).spatialReference
+            TemplateLines = BBB_OutputWriters.ReadFeatures(step1LinesFC, template_fields, read_coords)
         except:
-            arcpy.AddError("Error copying template lines feature class to output %s," % linesFC)
+            BBB_SharedFunctions.AddError("Error reading template lines feature class %s," % step1LinesFC)
             raise
 
 
         # ----- Query the GTFS data to count the trips on each line segment -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
-            arcpy.AddMessage("Calculating the number of transit trips available during the time window...")
+            BBB_SharedFunctions.AddMessage("Calculating the number of transit trips available during the time window...")
 
             # Get a dictionary of {line_key: [[trip_id, start_time, end_time]]} for our time window
-            linetimedict = BBB_SharedFunctions.CountTripsOnLines(day, start_sec, end_sec, DepOrArr, Specific)
+            linetimedict = BBB_SharedFunctions.CountTripsOnLines(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
 
         except:
-            arcpy.AddError("Error counting arrivals or departures at during time window.")
+            BBB_SharedFunctions.AddError("Error counting arrivals or departures at during time window.")
             raise
 
 
         # ----- Write to output -----
+        BBB_Instrumentation.StartPhase("Output")
         try:
-            arcpy.AddMessage("Writing output data...")
-
-            combine_corridors = "route_id" not in [f.name for f in arcpy.ListFields(linesFC)]
+            BBB_SharedFunctions.AddMessage("Writing output data...")
 
             triproute_dict = None
             if not combine_corridors:
-                triproute_dict = BBB_SharedFunctions.MakeTripRouteDict()
+                triproute_dict = BBB_SharedFunctions.MakeTripRouteDict(gtfs)
 
-            arcpy.management.AddField(linesFC, "NumTrips", "SHORT")
-            arcpy.management.AddField(linesFC, "NumTripsPerHr", "DOUBLE")
-            arcpy.management.AddField(linesFC, "MaxWaitTime", "SHORT")
-            arcpy.management.AddField(linesFC, "AvgHeadway", "SHORT")
+            fields = [("pair_id", "TEXT")]
+            if not combine_corridors:
+                fields.append(("route_id", "TEXT"))
+            fields += [("NumTrips", "SHORT"), ("NumTripsPerHr", "DOUBLE"),
+                       ("MaxWaitTime", "SHORT"), ("AvgHeadway", "SHORT")]
 
-            with arcpy.da.UpdateCursor(linesFC, ["pair_id", "NumTrips",
-                                                "NumTripsPerHr",
-                                                "MaxWaitTime", "AvgHeadway"]) as ucursor:
-                for row in ucursor:
+            def LineRows():
+                for row in TemplateLines:
                     NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway = \
                                 BBB_SharedFunctions.RetrieveStatsForLines(
-                                    str(row[0]), linetimedict,
+                                    str(row[1]), linetimedict,
                                     start_sec, end_sec, combine_corridors, triproute_dict)
-                    row[1] = NumTrips
-                    row[2] = NumTripsPerHr
-                    row[3] = MaxWaitTime
-                    row[4] = AvgHeadway
-                    ucursor.updateRow(row)
+                    yield tuple(row) + (NumTrips, NumTripsPerHr, MaxWaitTime, AvgHeadway)
+
+            with BBB_OutputWriters.MakeOutputWriter(linesFC, "POLYLINE", fields, output_coords) as writer:
+                writer.insert_rows(LineRows())
 
         except:
-            arcpy.AddError("Error writing to output.")
+            BBB_SharedFunctions.AddError("Error writing to output.")
             raise
 
-        arcpy.AddMessage("Finished!")
-        arcpy.AddMessage("Your output is located at " + linesFC)
+        BBB_SharedFunctions.AddMessage("Finished!")
+        BBB_SharedFunctions.AddMessage("Your output is located at " + linesFC)
 
     except BBB_SharedFunctions.CustomError:
-        arcpy.AddError("Failed to count trips on lines.")
+        BBB_SharedFunctions.AddError("Failed to count trips on lines.")
         pass
 
     except:
-        arcpy.AddError("Failed to count trips on lines.")
-        raise
\ No newline at end of file
+        BBB_SharedFunctions.AddError("Failed to count trips on lines.")
+        raise
+
+    finally:
+        gtfs.close()
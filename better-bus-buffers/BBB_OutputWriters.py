@@ -0,0 +1,297 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Output Writers
+
+Writers for the feature classes produced by the BetterBusBuffers tools.
+
+Tools describe their output as a geometry type and a list of fields and pass
+all the rows to insert_rows in bulk, so the same tool code can write to either
+of these:
+- ArcpyWriter: any feature class arcpy can create (file geodatabase, shapefile,
+  etc.)
+- GeoPackageWriter: a table in an OGC GeoPackage, written directly with the
+  sqlite3 module. It does not need ArcGIS, so tools writing GeoPackage output
+  can run on machines without arcpy. GeoPackage output is always in WGS84.
+
+A path is treated as a GeoPackage if it contains ".gpkg". The table name follows
+the .gpkg file name (for example, C:/Data/Results.gpkg/StopCounts), or, if it is
+left off, is the name of the .gpkg file.
+
+ReadFeatures reads the geometry and attributes of an existing feature class or
+GeoPackage table in the same format used by the writers.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sqlite3
+import struct
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+# GeoPackage 1.2 file identifiers
+GPKG_APPLICATION_ID = 0x47504B47 # "GPKG"
+GPKG_USER_VERSION = 10200
+
+WGS84_SRS_ID = 4326
+WGS84_DEFINITION = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,\
+AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],\
+UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+
+# Field and geometry types used by the tools, and their GeoPackage equivalents
+GPKG_FIELD_TYPES = {"TEXT": "TEXT", "SHORT": "SMALLINT", "LONG": "MEDIUMINT", "DOUBLE": "DOUBLE"}
+GPKG_GEOMETRY_TYPES = {"POINT": "POINT", "POLYLINE": "LINESTRING"}
+
+# WKB geometry type codes
+WKB_POINT = 1
+WKB_LINESTRING = 2
+
+
+def IsGeoPackage(path):
+    '''Return True if the output path points to a GeoPackage.'''
+    return ".gpkg" in path.lower()
+
+
+def SplitGeoPackagePath(path):
+    '''Split a GeoPackage output path into the .gpkg file and the table name.'''
+    idx = path.lower().index(".gpkg") + len(".gpkg")
+    gpkg = path[:idx]
+    table = path[idx:].lstrip("/\\")
+    if table.lower().startswith("main."):
+        table = table[len("main."):]
+    if not table:
+        table = os.path.splitext(os.path.basename(gpkg))[0]
+    return gpkg, table
+
+
+class OutputWriter(object):
+    '''Writes the rows of a new feature class, replacing any existing one.
+
+    geometry_type is POINT or POLYLINE. fields is a list of (field_name,
+    field_type) where field_type is TEXT, SHORT, LONG, or DOUBLE. Each row passed
+    to insert_rows is (geometry, value, value, ...), with a value for each field.
+    The geometry is an (x, y) tuple for points and a list of (x, y) tuples for
+    polylines. Use the writer as a context manager or call close() when done.'''
+
+    def __init__(self, path, geometry_type, fields):
+        self.path = path
+        self.geometry_type = geometry_type
+        self.fields = fields
+
+    def insert_rows(self, rows):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ArcpyWriter(OutputWriter):
+    '''Write a feature class with arcpy. spatial_reference is the coordinate system
+    of the geometry passed to insert_rows (WGS84 if not given).'''
+
+    def __init__(self, path, geometry_type, fields, spatial_reference=None):
+        OutputWriter.__init__(self, path, geometry_type, fields)
+        if spatial_reference is None:
+            spatial_reference = arcpy.SpatialReference(WGS84_SRS_ID)
+        self.spatial_reference = spatial_reference
+        arcpy.management.CreateFeatureclass(os.path.dirname(path), os.path.basename(path), geometry_type,
+                                            spatial_reference=spatial_reference)
+        for field_name, field_type in fields:
+            arcpy.management.AddField(path, field_name, field_type)
+        shape_token = "SHAPE@XY" if geometry_type == "POINT" else "SHAPE@"
+        self.cursor = arcpy.da.InsertCursor(path, [shape_token] + [field[0] for field in fields])
+
+    def insert_rows(self, rows):
+        for row in rows:
+            if self.geometry_type == "POLYLINE":
+                row = list(row)
+                row[0] = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in row[0]]), self.spatial_reference)
+            self.cursor.insertRow(row)
+
+    def close(self):
+        if self.cursor is not None:
+            del self.cursor
+            self.cursor = None
+
+
+class GeoPackageWriter(OutputWriter):
+    '''Write a feature table to a GeoPackage with sqlite3. The geometry passed to
+    insert_rows must be WGS84 longitude and latitude.'''
+
+    def __init__(self, path, geometry_type, fields):
+        OutputWriter.__init__(self, path, geometry_type, fields)
+        self.gpkg, self.table = SplitGeoPackagePath(path)
+        self.conn = sqlite3.connect(self.gpkg)
+        self.extent = None # [min_x, min_y, max_x, max_y]
+        self._create_core_tables()
+        self._create_table()
+
+    def _create_core_tables(self):
+        c = self.conn.cursor()
+        c.execute("PRAGMA application_id = %i;" % GPKG_APPLICATION_ID)
+        c.execute("PRAGMA user_version = %i;" % GPKG_USER_VERSION)
+        c.execute('''CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+                        srs_name TEXT NOT NULL, srs_id INTEGER NOT NULL PRIMARY KEY,
+                        organization TEXT NOT NULL, organization_coordsys_id INTEGER NOT NULL,
+                        definition TEXT NOT NULL, description TEXT);''')
+        c.execute('''CREATE TABLE IF NOT EXISTS gpkg_contents (
+                        table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL,
+                        identifier TEXT UNIQUE, description TEXT DEFAULT '',
+                        last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                        min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                        srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id));''')
+        c.execute('''CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+                        table_name TEXT NOT NULL UNIQUE REFERENCES gpkg_contents(table_name),
+                        column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+                        srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys(srs_id),
+                        z TINYINT NOT NULL, m TINYINT NOT NULL,
+                        PRIMARY KEY (table_name, column_name));''')
+        c.executemany('''INSERT OR IGNORE INTO gpkg_spatial_ref_sys
+                        (srs_name, srs_id, organization, organization_coordsys_id, definition, description)
+                        VALUES (?, ?, ?, ?, ?, ?);''',
+                      [("Undefined cartesian SRS", -1, "NONE", -1, "undefined", "undefined cartesian coordinate reference system"),
+                       ("Undefined geographic SRS", 0, "NONE", 0, "undefined", "undefined geographic coordinate reference system"),
+                       ("WGS 84 geodetic", WGS84_SRS_ID, "EPSG", WGS84_SRS_ID, WGS84_DEFINITION, "longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid")])
+        self.conn.commit()
+
+    def _create_table(self):
+        c = self.conn.cursor()
+        # Overwrite any existing table with the same name
+        c.execute("DELETE FROM gpkg_geometry_columns WHERE table_name = ?;", (self.table,))
+        c.execute("DELETE FROM gpkg_contents WHERE table_name = ?;", (self.table,))
+        c.execute('DROP TABLE IF EXISTS "%s";' % self.table)
+        columns = ['fid INTEGER PRIMARY KEY AUTOINCREMENT', 'geom %s' % GPKG_GEOMETRY_TYPES[self.geometry_type]]
+        columns += ['"%s" %s' % (field_name, GPKG_FIELD_TYPES[field_type]) for field_name, field_type in self.fields]
+        c.execute('CREATE TABLE "%s" (%s);' % (self.table, ", ".join(columns)))
+        c.execute('''INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id)
+                     VALUES (?, 'features', ?, ?);''', (self.table, self.table, WGS84_SRS_ID))
+        c.execute('''INSERT INTO gpkg_geometry_columns (table_name, column_name, geometry_type_name, srs_id, z, m)
+                     VALUES (?, 'geom', ?, ?, 0, 0);''', (self.table, GPKG_GEOMETRY_TYPES[self.geometry_type], WGS84_SRS_ID))
+        self.conn.commit()
+        self.insert_stmt = 'INSERT INTO "%s" (geom, %s) VALUES (?%s);' % (
+            self.table, ", ".join(['"%s"' % field[0] for field in self.fields]), ", ?" * len(self.fields))
+
+    def _update_extent(self, min_x, min_y, max_x, max_y):
+        if self.extent is None:
+            self.extent = [min_x, min_y, max_x, max_y]
+        else:
+            self.extent = [min(self.extent[0], min_x), min(self.extent[1], min_y),
+                           max(self.extent[2], max_x), max(self.extent[3], max_y)]
+
+    def _geometry_blob(self, geometry):
+        '''Encode a geometry as a GeoPackage binary blob (little endian).'''
+        if self.geometry_type == "POINT":
+            x, y = geometry
+            self._update_extent(x, y, x, y)
+            # Points don't need an envelope.
+            header = struct.pack("<2sBBi", b"GP", 0, 1, WGS84_SRS_ID)
+            wkb = struct.pack("<BIdd", 1, WKB_POINT, x, y)
+        else:
+            xs = [pt[0] for pt in geometry]
+            ys = [pt[1] for pt in geometry]
+            min_x, min_y, max_x, max_y = min(xs), min(ys), max(xs), max(ys)
+            self._update_extent(min_x, min_y, max_x, max_y)
+            # Flags: little endian with a [min_x, max_x, min_y, max_y] envelope
+            header = struct.pack("<2sBBi4d", b"GP", 0, 3, WGS84_SRS_ID, min_x, max_x, min_y, max_y)
+            wkb = struct.pack("<BII", 1, WKB_LINESTRING, len(geometry)) + \
+                  b"".join([struct.pack("<dd", x, y) for x, y in geometry])
+        return sqlite3.Binary(header + wkb)
+
+    def insert_rows(self, rows):
+        self.conn.executemany(self.insert_stmt,
+                              ((self._geometry_blob(row[0]),) + tuple(row[1:]) for row in rows))
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.extent:
+            self.conn.execute('''UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ?,
+                                 last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now')
+                                 WHERE table_name = ?;''', tuple(self.extent) + (self.table,))
+        self.conn.commit()
+        self.conn.close()
+        self.conn = None
+
+
+def MakeOutputWriter(path, geometry_type, fields, spatial_reference=None):
+    '''Return a GeoPackageWriter if the path is in a GeoPackage and an ArcpyWriter
+    otherwise. spatial_reference is only used by the ArcpyWriter.'''
+    if IsGeoPackage(path):
+        return GeoPackageWriter(path, geometry_type, fields)
+    return ArcpyWriter(path, geometry_type, fields, spatial_reference)
+
+
+def _parse_geometry_blob(blob):
+    '''Decode a GeoPackage binary point or linestring into the writers' geometry format.'''
+    blob = bytes(blob)
+    flags = struct.unpack("<B", blob[3:4])[0]
+    envelope_size = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}[(flags >> 1) & 7]
+    wkb = blob[8 + envelope_size:]
+    endian = "<" if struct.unpack("<B", wkb[0:1])[0] == 1 else ">"
+    geometry_type = struct.unpack(endian + "I", wkb[1:5])[0] % 1000
+    if geometry_type == WKB_POINT:
+        return struct.unpack(endian + "dd", wkb[5:21])
+    num_points = struct.unpack(endian + "I", wkb[5:9])[0]
+    coords = struct.unpack(endian + "%id" % (2 * num_points), wkb[9:9 + 16 * num_points])
+    return list(zip(coords[0::2], coords[1::2]))
+
+
+def ReadFeatures(path, fields, spatial_reference=None):
+    '''Read the rows of a point or polyline feature class or GeoPackage table as
+    (geometry, value, value, ...) tuples, in the format used by the writers.
+    Polylines are assumed to be single part. spatial_reference is the coordinate
+    system to read feature class geometry in (ignored for GeoPackages, which are
+    read as stored).'''
+    if IsGeoPackage(path):
+        gpkg, table = SplitGeoPackagePath(path)
+        conn = sqlite3.connect(gpkg)
+        try:
+            geom_column = conn.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?;",
+                                       (table,)).fetchone()[0]
+            cur = conn.execute('SELECT "%s", %s FROM "%s";' % (geom_column, ", ".join(['"%s"' % field for field in fields]), table))
+            return [(_parse_geometry_blob(row[0]),) + tuple(row[1:]) for row in cur]
+        finally:
+            conn.close()
+
+    rows = []
+    with arcpy.da.SearchCursor(path, ["SHAPE@"] + list(fields), spatial_reference=spatial_reference) as cur:
+        for row in cur:
+            geom = row[0]
+            if geom.type == "point":
+                geometry = (geom.firstPoint.X, geom.firstPoint.Y)
+            else:
+                geometry = [(pt.X, pt.Y) for pt in geom.getPart(0)]
+            rows.append((geometry,) + tuple(row[1:]))
+    return rows
+
+
+def GetFieldNames(path):
+    '''Return the names of the attribute fields of a feature class or GeoPackage table.'''
+    if IsGeoPackage(path):
+        gpkg, table = SplitGeoPackagePath(path)
+        conn = sqlite3.connect(gpkg)
+        try:
+            return [row[1] for row in conn.execute('PRAGMA table_info("%s");' % table)]
+        finally:
+            conn.close()
+    return [f.name for f in arcpy.ListFields(path)]
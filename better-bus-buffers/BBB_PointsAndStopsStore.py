@@ -0,0 +1,154 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Points and Stops Store
+
+An on-disk store of the transit stops reachable from each input point, used by
+the Count Trips at Points tools in place of a dictionary of
+{point_id: [stop_id, stop_id, ...]} so that memory use stays flat no matter how
+many points are analyzed.
+
+Point-stop pairs are streamed into a temporary SQLite table in which stops are
+stored as small integers. Once the table is indexed, the stops for a point are
+looked up in chunks of consecutive points (in point order), so only one chunk is
+held in memory at a time. get() should be called for the points in sorted order.
+A point that comes before the current chunk is looked up on its own with the
+index. When the points can't be read in sorted order, use lookup(), which
+always looks up the point on its own.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import itertools
+import os
+import sqlite3
+import tempfile
+
+
+class PointsAndStopsStore(object):
+    '''On-disk store of the stops reachable from each point.
+
+    point_key is applied to every point id before it is stored or looked up. It
+    should convert the ids to the type of the points' unique ID field (for example,
+    int) so the stored order matches the order the points are read in.
+    chunk_size is the maximum number of point-stop pairs held in memory when
+    reading the stops back.'''
+
+    def __init__(self, path=None, point_key=str, chunk_size=200000):
+        if path:
+            self.path = path
+            self.is_temp = False
+        else:
+            fd, self.path = tempfile.mkstemp(suffix=".sql", prefix="BBB_PointsAndStops_")
+            os.close(fd)
+            self.is_temp = True
+        self.point_key = point_key
+        self.chunk_size = chunk_size
+        self.conn = sqlite3.connect(self.path)
+        # This is a scratch database, so don't bother protecting it against crashes.
+        self.conn.execute("PRAGMA journal_mode = OFF;")
+        self.conn.execute("PRAGMA synchronous = OFF;")
+        self.conn.execute("DROP TABLE IF EXISTS point_stops;")
+        self.conn.execute("CREATE TABLE point_stops (point, stop INTEGER);")
+        self.stop_idx = {} # {stop_id: integer stop index}
+        self.stop_ids = [] # [stop_id], by integer stop index
+        self.is_indexed = False
+        # Chunk of points currently in memory
+        self._chunk = {}
+        self._chunk_lo = None
+        self._chunk_hi = None
+
+    def _stop_index(self, stop_id):
+        try:
+            return self.stop_idx[stop_id]
+        except KeyError:
+            idx = self.stop_idx[stop_id] = len(self.stop_ids)
+            self.stop_ids.append(stop_id)
+            return idx
+
+    def add_pairs(self, pairs):
+        '''Stream an iterable of (point_id, stop_id) pairs into the store. Pairs
+        with no point_id are skipped.'''
+        rows = ((self.point_key(point), self._stop_index(stop)) for point, stop in pairs if point is not None)
+        self.conn.executemany("INSERT INTO point_stops (point, stop) VALUES (?, ?);", rows)
+        self.conn.commit()
+        self.is_indexed = False
+
+    def finish(self):
+        '''Index the stored pairs. Called automatically before the first lookup.'''
+        if not self.is_indexed:
+            self.conn.execute("DROP INDEX IF EXISTS point_stops_index_points;")
+            self.conn.execute("CREATE INDEX point_stops_index_points ON point_stops (point, stop);")
+            self.conn.commit()
+            self.is_indexed = True
+            self._chunk = {}
+            self._chunk_lo = self._chunk_hi = None
+
+    def _load_chunk(self, point):
+        '''Read the pairs for the next chunk of points, starting with point.'''
+        rows = self.conn.execute('''SELECT point, stop FROM point_stops
+                                    WHERE point >= ? ORDER BY point LIMIT ?;''',
+                                 (point, self.chunk_size)).fetchall()
+        chunk = {}
+        for pt, stops in itertools.groupby(rows, key=lambda row: row[0]):
+            chunk[pt] = [row[1] for row in stops]
+        if len(rows) < self.chunk_size:
+            # Reached the end of the table
+            hi = None
+        else:
+            # The last point may have been cut off by the limit, so don't keep it.
+            hi = rows[-1][0]
+            del chunk[hi]
+            if not chunk:
+                # A single point has more pairs than the chunk size. Read all of them.
+                chunk[hi] = [row[0] for row in self.conn.execute(
+                    "SELECT stop FROM point_stops WHERE point = ?;", (hi,))]
+            else:
+                hi = max(chunk)
+        self._chunk = chunk
+        self._chunk_lo = point
+        self._chunk_hi = hi
+
+    def get(self, point_id):
+        '''Return the list of stop_ids reachable from the point.'''
+        if point_id is None:
+            return []
+        self.finish()
+        point = self.point_key(point_id)
+        in_chunk = self._chunk_lo is not None and self._chunk_lo <= point and \
+            (self._chunk_hi is None or point <= self._chunk_hi)
+        if not in_chunk:
+            if self._chunk_lo is not None and point < self._chunk_lo:
+                # Out of order. Look up just this point rather than reading the chunks again.
+                return self._lookup(point)
+            self._load_chunk(point)
+        return [self.stop_ids[stop] for stop in self._chunk.get(point, [])]
+
+    def _lookup(self, point):
+        return [self.stop_ids[row[0]] for row in self.conn.execute(
+            "SELECT stop FROM point_stops WHERE point = ?;", (point,))]
+
+    def lookup(self, point_id):
+        '''Return the list of stop_ids reachable from the point, looking it up
+        with the index without reading a chunk. Use this instead of get() when
+        the points are requested in no particular order.'''
+        if point_id is None:
+            return []
+        self.finish()
+        return self._lookup(self.point_key(point_id))
+
+    def close(self):
+        '''Close the store, deleting the file if it was temporary.'''
+        self.conn.close()
+        if self.is_temp and os.path.exists(self.path):
+            os.remove(self.path)
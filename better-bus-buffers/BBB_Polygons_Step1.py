@@ -22,6 +22,9 @@ Step 1 does the following:
   analysis
 You should only have to run Step 1 once for the geography and buffer size you
 are analyzing.  Step 1 will take a while to run for larger transit systems.
+
+For large transit systems, the stops can be split into square tiles that are
+solved in parallel worker processes and stitched back together. See BBB_Tiling.
 '''
 ################################################################################
 '''Copyright 2017 Esri
@@ -36,13 +39,146 @@ are analyzing.  Step 1 will take a while to run for larger transit systems.
    limitations under the License.'''
 ################################################################################
 
-import os, sqlite3
+import os, sys, math, shutil, tempfile, multiprocessing
 from shutil import copyfile
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
+import BBB_SpatialIndex
+import BBB_Tiling
+
+# Search tolerance used to locate the stops on the network when solving service areas
+SearchToleranceMeters = 500
+
+
+class ArcpyTileSolver(BBB_Tiling.TileSolver):
+    '''Solve, flatten, and merge the service area polygons for each tile with
+    ArcGIS Network Analyst. Each tile is written to its own scratch geodatabase so
+    tiles can be solved in separate processes without locking each other out. If
+    scratchDir is None, there is only one tile, and it is written straight to the
+    output geodatabase with nothing to merge.'''
+
+    def __init__(self, StopsFC, scratchDir, inNetworkDataset, impedanceAttribute, BufferSize,
+                 restrictions, TrimPolys, TrimPolysValue, FlatPolys):
+        self.StopsFC = StopsFC
+        self.scratchDir = scratchDir
+        self.inNetworkDataset = inNetworkDataset
+        self.impedanceAttribute = impedanceAttribute
+        self.BufferSize = BufferSize
+        self.restrictions = restrictions
+        self.TrimPolys = TrimPolys
+        self.TrimPolysValue = TrimPolysValue
+        self.FlatPolys = FlatPolys
+
+    def solve(self, tile):
+        # Worker processes don't inherit the environment settings or license checkouts.
+        arcpy.env.overwriteOutput = True
+        BBB_SharedFunctions.CheckOutNALicense()
+
+        # The tile is solved with its own workspace and output coordinate system. Restore the
+        # original settings afterward, since serial tiles run in the tool's own process.
+        OrigWorkspace = arcpy.env.workspace
+        OrigOutputCoordinateSystem = arcpy.env.outputCoordinateSystem
+        try:
+            if self.scratchDir:
+                tileGDBName = "Tile_%i.gdb" % tile.index
+                tileGDB = os.path.join(self.scratchDir, tileGDBName)
+                arcpy.management.CreateFileGDB(self.scratchDir, tileGDBName)
+                TileFlatPolys = os.path.join(tileGDB, "FlatPolys")
+            else:
+                tileGDB = os.path.dirname(self.FlatPolys)
+                TileFlatPolys = self.FlatPolys
+            arcpy.env.workspace = tileGDB
+
+            # ----- Create service areas around the tile's stops -----
+            StopsLayer = "StopsLayer_%i" % tile.index
+            arcpy.management.MakeFeatureLayer(self.StopsFC, StopsLayer,
+                                BBB_SharedFunctions.MakeOIDWhereClause(self.StopsFC, tile.stop_ids))
+            polygons = BBB_SharedFunctions.MakeServiceAreasAroundStops(StopsLayer,
+                                self.inNetworkDataset, self.impedanceAttribute, self.BufferSize,
+                                self.restrictions, self.TrimPolys, self.TrimPolysValue)
+
+            # Use World Cylindrical Equal Area (WKID 54034) to ensure proper use of cluster tolerance in meters
+            arcpy.env.outputCoordinateSystem = BBB_SharedFunctions.WorldCylindrical
+
+            # Keep only the part of the service areas inside the tile. The rest is covered
+            # by the neighboring tiles.
+            if tile.bounds:
+                xmin, ymin, xmax, ymax = tile.bounds
+                TileExtent = arcpy.Polygon(arcpy.Array([arcpy.Point(xmin, ymin), arcpy.Point(xmin, ymax),
+                                                        arcpy.Point(xmax, ymax), arcpy.Point(xmax, ymin)]),
+                                           arcpy.SpatialReference(54034))
+                ClippedPolys = os.path.join(tileGDB, "ServiceAreas")
+                arcpy.analysis.Clip(polygons, TileExtent, ClippedPolys)
+                polygons = ClippedPolys
+            else:
+                ClippedPolys = None
+
+            # ----- Flatten the overlapping service area polygons -----
+
+            # Dummy points to use in FeatureToPolygon to get rid of unnecessary fields.
+            dummypoints = arcpy.management.CreateFeatureclass("in_memory",
+                                                                "DummyPoints", "POINT")
+
+            # FeatureToPolygon flattens overalpping polys.
+            # Set a large cluster tolerance to eliminate small sliver polygons and to
+            # keep the output file size down.  Boundaries may move up to the distance
+            # specified in the cluster tolerance, but some amount of movement is
+            # acceptable, as service area polygons are inexact anyway.
+            # The large cluster tolerance may cause some geometry issues with the output
+            # later, but this is the best solution I've found so far that doesn't eat
+            # up too much analysis time and memory
+            clusTol = "5 meters"
+            arcpy.management.FeatureToPolygon(polygons, TileFlatPolys, clusTol, "", dummypoints)
+            arcpy.management.Delete(dummypoints)
 
+            # Record which tile polygon each polygon came from so they can be matched up after merging.
+            arcpy.management.AddField(TileFlatPolys, "TileID", "LONG")
+            arcpy.management.AddField(TileFlatPolys, "TileFID", "LONG")
+            with arcpy.da.UpdateCursor(TileFlatPolys, ["OID@", "TileID", "TileFID"]) as ucursor:
+                for row in ucursor:
+                    ucursor.updateRow([row[0], tile.index, row[0]])
 
-def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings):
+            # ----- Create stacked points, one for each original SA polygon -----
+
+            # Create points for use in the Identity tool (one point per poly)
+            FlattenedPoints = os.path.join(tileGDB, "FlattenedPoints")
+            arcpy.management.FeatureToPoint(TileFlatPolys, FlattenedPoints, "INSIDE")
+
+            # Use Identity to stack points and keep the stop_ids from the original SAs.
+            # Results in a points layer with fields ORIG_FID for the IDs of the
+            # flattened polygons and a stop_id column with the stop ids.
+            # Points are stacked, and each has only one stop_id.
+            StackedPoints = os.path.join(tileGDB, "StackedPoints")
+            arcpy.analysis.Identity(FlattenedPoints, polygons, StackedPoints)
+            with arcpy.da.SearchCursor(StackedPoints, ["ORIG_FID", "stop_id"]) as StackedPtCursor:
+                poly_stops = [(row[0], row[1]) for row in StackedPtCursor]
+            arcpy.management.Delete(FlattenedPoints)
+            arcpy.management.Delete(StackedPoints)
+            if ClippedPolys:
+                arcpy.management.Delete(ClippedPolys)
+
+            return BBB_Tiling.TileResult(tile.index, TileFlatPolys, poly_stops)
+        finally:
+            arcpy.env.workspace = OrigWorkspace
+            arcpy.env.outputCoordinateSystem = OrigOutputCoordinateSystem
+
+    def merge(self, results):
+        if self.scratchDir:
+            arcpy.management.Merge([result.polygons for result in results], self.FlatPolys)
+        polyids = {}
+        with arcpy.da.SearchCursor(self.FlatPolys, ["OID@", "TileID", "TileFID"]) as cur:
+            for row in cur:
+                polyids[(row[1], row[2])] = row[0]
+        arcpy.management.DeleteField(self.FlatPolys, ["TileID", "TileFID"])
+        return polyids
+
+
+@BBB_Instrumentation.Profiled("Count Trips in Polygon Buffers around Stops Step 1")
+def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restrictions, TrimSettings,
+            TileSize=None, TileMargin=None, NumWorkers=1):
+    scratchDir = None
+    gtfs = None
     try:
 
     # ----- Set up the run -----
@@ -69,69 +205,119 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
             SQLDbase = os.path.join(outGDBwPath, "Step1_GTFS.sql")
             copyfile(inSQLDbase, SQLDbase)
             # Connect to or create the SQL file.
-            conn = sqlite3.connect(SQLDbase)
-            c = BBB_SharedFunctions.c = conn.cursor()
+            gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase)
+            conn = gtfs.conn
+            c = conn.cursor()
 
             impedanceAttribute = BBB_SharedFunctions.CleanUpImpedance(imp)
             TrimPolys, TrimPolysValue = BBB_SharedFunctions.CleanUpTrimSettings(TrimSettings)
 
+            # Tile size and overlap margin, in meters. The overlap margin must be at least as
+            # large as the furthest a service area can reach from its stop, so it defaults
+            # to the buffer size plus the search tolerance if the impedance is a distance.
+            TileSizeMeters = None
+            TileMarginMeters = None
+            if TileSize:
+                TileSizeMeters = BBB_SpatialIndex.ConvertLinearUnitToMeters(TileSize)
+                if TileMargin:
+                    TileMarginMeters = BBB_SpatialIndex.ConvertLinearUnitToMeters(TileMargin)
+                else:
+                    impunits = imp.split(" (Units: ")[1].split(")")[0]
+                    TileMarginMeters = BBB_SpatialIndex.ConvertToMeters(BufferSize, impunits)
+                    if TileMarginMeters is None:
+                        arcpy.AddError("Your impedance attribute is not a distance, so you must specify a tile \
+overlap margin at least as large as the furthest distance a service area can reach from its stop.")
+                        raise BBB_SharedFunctions.CustomError
+                    TileMarginMeters += SearchToleranceMeters
+                if not TileSizeMeters or TileMarginMeters is None:
+                    arcpy.AddError("The tile size and tile overlap margin must be linear distances.")
+                    raise BBB_SharedFunctions.CustomError
+            NumWorkers = max(int(NumWorkers or 1), 1)
+
         except:
             arcpy.AddError("Error setting up run.")
             raise
 
 
     #----- Make a feature class of GTFS stops that we can use for buffers -----
+        BBB_Instrumentation.StartPhase("Stops feature class")
         try:
             # Create a feature class of transit stops
             arcpy.AddMessage("Creating a feature class of GTFS stops...")
-            StopsLayer, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(os.path.join(outGDBwPath, "Step1_Stops"))
+            StopsFC = os.path.join(outGDBwPath, "Step1_Stops")
+            StopsLayer, StopIDList = BBB_SharedFunctions.MakeStopsFeatureClass(gtfs, StopsFC)
         except:
             arcpy.AddError("Error creating a feature class of GTFS stops.")
             raise
 
 
     #----- Create Service Areas around all stops in the system -----
+        BBB_Instrumentation.StartPhase("Service areas")
         try:
             arcpy.AddMessage("Creating service areas around stops...")
             arcpy.AddMessage("(This step will take a while for large networks.)")
-            polygons = BBB_SharedFunctions.MakeServiceAreasAroundStops(StopsLayer,
-                                inNetworkDataset, impedanceAttribute, BufferSize,
-                                restrictions, TrimPolys, TrimPolysValue)
+
+            # Split the stops into tiles. Use the same projected coordinate system used to flatten the polygons.
+            # It stretches east-west distances by 1/cos(latitude), so the overlap margin is widened by
+            # that much in the x direction at each stop.
+            StopOIDs = []
+            StopXs = []
+            StopYs = []
+            with arcpy.da.SearchCursor(StopsFC, ["OID@", "SHAPE@XY"],
+                                       spatial_reference=arcpy.SpatialReference(54034)) as cur:
+                for row in cur:
+                    StopOIDs.append(row[0])
+                    StopXs.append(row[1][0])
+                    StopYs.append(row[1][1])
+            StopLats = {}
+            with arcpy.da.SearchCursor(StopsFC, ["OID@", "SHAPE@Y"],
+                                       spatial_reference=arcpy.SpatialReference(4326)) as cur:
+                for row in cur:
+                    StopLats[row[0]] = row[1]
+            StopXScales = [1.0 / math.cos(math.radians(min(abs(StopLats[oid]), 89.0))) for oid in StopOIDs]
+            tiles = BBB_Tiling.make_tiles(StopOIDs, StopXs, StopYs, TileSizeMeters, TileMarginMeters, StopXScales)
+            if len(tiles) > 1:
+                arcpy.AddMessage("Solving %i tiles using %i parallel processes..." % (len(tiles), min(NumWorkers, len(tiles))))
+
+            # Each tile goes in its own scratch geodatabase. A single tile is written straight
+            # to the output.
+            if len(tiles) > 1:
+                scratchDir = tempfile.mkdtemp(prefix="BBB_Tiles_", dir=arcpy.env.scratchFolder)
+            if NumWorkers > 1 and len(tiles) > 1:
+                # Worker processes can't find the network dataset by its layer name in the map.
+                inNetworkDataset = arcpy.Describe(inNetworkDataset).catalogPath
+                if sys.platform == "win32":
+                    # The worker processes must be started with python, not the ArcGIS application.
+                    multiprocessing.set_executable(os.path.join(sys.exec_prefix, "python.exe"))
+
+            FlatPolys = os.path.join(outGDBwPath, "Step1_FlatPolys")
+            solver = ArcpyTileSolver(StopsFC, scratchDir, inNetworkDataset, impedanceAttribute, BufferSize,
+                                     restrictions, TrimPolys, TrimPolysValue, FlatPolys)
+
+            def report_progress(result):
+                report_progress.num_finished += 1
+                if len(tiles) > 1:
+                    arcpy.AddMessage("Finished tile %i of %i." % (report_progress.num_finished, len(tiles)))
+            report_progress.num_finished = 0
+            results = BBB_Tiling.solve_tiles(solver, tiles, NumWorkers, report_progress)
         except:
             arcpy.AddError("Error creating service areas around stops.")
             raise
 
 
     #----- Post-process the polygons to prepare for Step 2 -----
+        BBB_Instrumentation.StartPhase("Post-process")
         try:
 
             arcpy.AddMessage("Reformatting polygons for further analysis...")
-            arcpy.AddMessage("(This step will take a while for large networks.)")
-
-            # ----- Flatten the overlapping service area polygons -----
 
-            # Use World Cylindrical Equal Area (WKID 54034) to ensure proper use of cluster tolerance in meters
-            arcpy.env.outputCoordinateSystem = BBB_SharedFunctions.WorldCylindrical
-
-            # Flatten the overlapping polygons.  This will ultimately be our output.
-            # Dummy points to use in FeatureToPolygon to get rid of unnecessary fields.
-            dummypoints = arcpy.management.CreateFeatureclass("in_memory",
-                                                                "DummyPoints", "POINT")
+            # ----- Stitch the tiles together -----
 
             # The flattened polygons will be our ultimate output in the end (final
             # output of step 2).
-            FlatPolys = os.path.join(outGDBwPath, "Step1_FlatPolys")
-            # FeatureToPolygon flattens overalpping polys.
-            # Set a large cluster tolerance to eliminate small sliver polygons and to
-            # keep the output file size down.  Boundaries may move up to the distance
-            # specified in the cluster tolerance, but some amount of movement is
-            # acceptable, as service area polygons are inexact anyway.
-            # The large cluster tolerance may cause some geometry issues with the output
-            # later, but this is the best solution I've found so far that doesn't eat
-            # up too much analysis time and memory
-            clusTol = "5 meters"
-            arcpy.management.FeatureToPolygon(polygons, FlatPolys, clusTol, "", dummypoints)
-            arcpy.management.Delete(dummypoints)
+            # Polygon-stop pairs, plus the polygons not associated with any stop_ids so we
+            # can delete them.
+            AddToStackedPts, FIDsToDelete = BBB_Tiling.stitch(solver, results)
 
             # Add a field to the output file for number of trips and num trips / hour.
             # Also create a polygon id field so we can keep track of them.
@@ -142,21 +328,6 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
             arcpy.management.AddField(FlatPolys, "MaxWaitTime", "DOUBLE")
 
 
-            # ----- Create stacked points, one for each original SA polygon -----
-
-            # Create points for use in the Identity tool (one point per poly)
-            FlattenedPoints = os.path.join(outGDBwPath, "Step1_FlattenedPoints")
-            arcpy.management.FeatureToPoint(FlatPolys, FlattenedPoints, "INSIDE")
-
-            # Use Identity to stack points and keep the stop_ids from the original SAs.
-            # Results in a points layer with fields ORIG_FID for the IDs of the
-            # flattened polygons and a stop_id column with the stop ids.
-            # Points are stacked, and each has only one stop_id.
-            StackedPoints = os.path.join(outGDBwPath, "Step1_StackedPoints")
-            arcpy.analysis.Identity(FlattenedPoints, polygons, StackedPoints)
-            arcpy.management.Delete(FlattenedPoints)
-
-
             # ----- Read the Stacked Points into an SQL table -----
 
             # Create a SQL table associating the Polygon FID with the stop_ids that serve it.
@@ -165,22 +336,11 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
             create_stmt = "CREATE TABLE StackedPoints (%s);" % schema
             c.execute(create_stmt)
 
-            # Add data to the table. Track Polygon IDs with no associated stop_ids so we can delete them.
-            FIDsToDelete = []
-            AddToStackedPts = []
-            with arcpy.da.SearchCursor(StackedPoints, ["ORIG_FID", "stop_id"]) as StackedPtCursor:
-                for row in StackedPtCursor:
-                    if not row[1]:
-                        FIDsToDelete.append(row[0])
-                    else:
-                        AddToStackedPts.append((row[0], row[1],))
             # Add the OD items to the SQL table
             c.executemany('''INSERT INTO StackedPoints \
                             (Polygon_FID, stop_id) \
                             VALUES (?, ?);''', AddToStackedPts)
             conn.commit()
-            arcpy.management.Delete(StackedPoints)
-            FIDsToDelete = set(FIDsToDelete)
 
 
             # ----- Delete polygons not associated with any stop_ids -----
@@ -221,9 +381,9 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
         arcpy.AddMessage("- Step1_GTFS.sql")
 
         # Tell the tool that this is output. This will add the output to the map.
-        arcpy.SetParameterAsText(8, os.path.join(outGDBwPath, "Step1_Stops"))
-        arcpy.SetParameterAsText(9, os.path.join(outGDBwPath, "Step1_FlatPolys"))
-        arcpy.SetParameterAsText(10, os.path.join(outGDBwPath, "Step1_GTFS.sql"))
+        arcpy.SetParameterAsText(11, os.path.join(outGDBwPath, "Step1_Stops"))
+        arcpy.SetParameterAsText(12, os.path.join(outGDBwPath, "Step1_FlatPolys"))
+        arcpy.SetParameterAsText(13, os.path.join(outGDBwPath, "Step1_GTFS.sql"))
 
 
     except BBB_SharedFunctions.CustomError:
@@ -232,3 +392,13 @@ def runTool(outDir, outGDB, inSQLDbase, inNetworkDataset, imp, BufferSize, restr
     except:
         arcpy.AddError("Failed to create BetterBusBuffers polygons.")
         raise
+
+    finally:
+        if gtfs:
+            gtfs.close()
+        # Clean up the tiles' scratch geodatabases.
+        if scratchDir:
+            shutil.rmtree(scratchDir, ignore_errors=True)
+            if os.path.exists(scratchDir):
+                arcpy.AddWarning("Unable to delete the temporary folder of tile geodatabases %s. \
+You can delete it yourself to free up disk space." % scratchDir)
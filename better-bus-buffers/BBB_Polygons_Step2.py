@@ -17,6 +17,12 @@ subsequent trips, and the number of stops within range of the area.
 
 Step 2: Count Trips in Buffers uses the template feature class created in Step
 1 and counts the trips in a specific time window.
+
+Optionally, Step 2 can also produce a time series by splitting the time window
+into a list of shorter windows (for example, one per hour). The stop visits for
+the whole time window are read from the GTFS data once, and the statistics for
+each shorter window are written to their own set of fields in the same output
+feature class.
 '''
 ################################################################################
 '''Copyright 2017 Esri
@@ -31,9 +37,10 @@ Step 2: Count Trips in Buffers uses the template feature class created in Step
    limitations under the License.'''
 ################################################################################
 
-import os, sqlite3
+import os
 import arcpy
 import BBB_SharedFunctions
+import BBB_Instrumentation
 
 class CustomError(Exception):
     pass
@@ -41,7 +48,9 @@ class CustomError(Exception):
 OverwriteOutput = None
 
 
-def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
+@BBB_Instrumentation.Profiled("Count Trips in Polygon Buffers around Stops Step 2")
+def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice, TimeWindows=None, LowMemory=False):
+    gtfs = None
     try:
 
         # ----- Set up the run -----
@@ -54,8 +63,8 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             FlatPolys = os.path.join(inStep1GDB, "Step1_FlatPolys")
             SQLDbase = os.path.join(inStep1GDB, "Step1_GTFS.sql")
             # Connect to the SQL database
-            conn = BBB_SharedFunctions.conn = sqlite3.connect(SQLDbase)
-            c = BBB_SharedFunctions.c = conn.cursor()
+            gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(SQLDbase, read_only=True)
+            c = gtfs.cursor()
 
             # Output file designated by user
             outDir = os.path.dirname(outFile)
@@ -71,17 +80,33 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             OverwriteOutput = arcpy.env.overwriteOutput # Get the orignal value so we can reset it.
             arcpy.env.overwriteOutput = True
 
+            # Time series windows [(start_sec, end_sec)], which must fall within the main time window
+            TimeWindowsSec = []
+            if TimeWindows:
+                for window in TimeWindows:
+                    window_start_sec, window_end_sec = BBB_SharedFunctions.ConvertTimeWindowToSeconds(window[0], window[1])
+                    if window_start_sec < start_sec or window_end_sec > end_sec or window_end_sec <= window_start_sec:
+                        arcpy.AddError("Time series window %s - %s is not a valid window within the time window %s - %s." % \
+                                       (window[0], window[1], start_time, end_time))
+                        raise CustomError
+                    TimeWindowsSec.append((window_start_sec, window_end_sec))
+
         except:
             arcpy.AddError("Error setting up run.")
             raise
 
 
         #----- Query the GTFS data to count the trips at each stop -----
+        BBB_Instrumentation.StartPhase("Schedule query")
         try:
             arcpy.AddMessage("Counting transit trips during the time window...")
 
             # Get a dictionary of stop times in our time window {stop_id: [[trip_id, stop_time]]}
-            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific)
+            stoptimedict = BBB_SharedFunctions.CountTripsAtStops(gtfs, day, start_sec, end_sec, BBB_SharedFunctions.CleanUpDepOrArr(DepOrArrChoice), Specific, LowMemory)
+
+            # Carve the time series windows out of the stop visits we already have
+            # rather than querying the GTFS data again for each window.
+            windowstoptimedicts = BBB_SharedFunctions.SplitStopTimesByTimeWindow(stoptimedict, TimeWindowsSec)
 
         except:
             arcpy.AddError("Failed to count transit trips during the time window.")
@@ -89,6 +114,7 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
 
 
         #----- Find which stops serve each polygon -----
+        BBB_Instrumentation.StartPhase("Polygon stops")
         try:
             arcpy.AddMessage("Retrieving list of stops associated with each polygon...")
             # Find the stop_ids associated with each flattened polygon and put them in
@@ -104,6 +130,7 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
 
 
         # ----- Generate output data -----
+        BBB_Instrumentation.StartPhase("Output")
         try:
             arcpy.AddMessage("Writing output data...")
 
@@ -113,15 +140,34 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
             badpolys = []
 
             if ".shp" in outFilename:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                                ["PolyID", "NumTrips",
-                                                "NumTripsPe", "NumStopsIn",
-                                                "MaxWaitTim"])
+                fields = ["PolyID", "NumTrips", "NumTripsPe", "NumStopsIn", "MaxWaitTim"]
             else:
-                ucursor = arcpy.da.UpdateCursor(outFile,
-                                            ["PolyID", "NumTrips",
-                                            "NumTripsPerHr", "NumStopsInRange",
-                                            "MaxWaitTime"])
+                fields = ["PolyID", "NumTrips", "NumTripsPerHr", "NumStopsInRange", "MaxWaitTime"]
+
+            # Add a set of fields for each time series window, labeled with the
+            # window's start time (HHMM). Shapefile field names are limited to 10 characters.
+            # The window fields get the same types as the main fields from the Step 1 template.
+            AddFieldTypes = {"SmallInteger": "SHORT", "Integer": "LONG", "Single": "FLOAT", "Double": "DOUBLE"}
+            outfieldtypes = dict((f.name, f.type) for f in arcpy.ListFields(outFile))
+            windowfieldtypes = [AddFieldTypes.get(outfieldtypes.get(field), "DOUBLE") for field in fields[1:]]
+            for window in TimeWindows or []:
+                label = window[0].replace(":", "")
+                if ".shp" in outFilename:
+                    windowfields = ["Trips" + label, "TPH" + label, "Stops" + label, "Wait" + label]
+                else:
+                    windowfields = ["NumTrips_" + label, "NumTripsPerHr_" + label,
+                                    "NumStopsInRange_" + label, "MaxWaitTime_" + label]
+                for field, fieldtype in zip(windowfields, windowfieldtypes):
+                    arcpy.management.AddField(outFile, field, fieldtype)
+                fields += windowfields
+
+            # The stop visits and time span for the main time window and each time series window,
+            # and whether visits at the end of the window are counted
+            windows = [(stoptimedict, start_sec, end_sec, True)] + \
+                      [(windowdict, window[0], window[1], BBB_SharedFunctions.TimeWindowIncludesEnd(idx, TimeWindowsSec))
+                       for idx, (windowdict, window) in enumerate(zip(windowstoptimedicts, TimeWindowsSec))]
+
+            ucursor = arcpy.da.UpdateCursor(outFile, fields)
             for row in ucursor:
                 try:
                     ImportantStops = stackedpointdict[int(row[0])]
@@ -133,17 +179,19 @@ def runTool(inStep1GDB, outFile, day, start_time, end_time, DepOrArrChoice):
                     # polygon and alert the user.
                     badpolys.append(row[0])
                     continue
-                NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
-                                BBB_SharedFunctions.RetrieveStatsForSetOfStops(
-                                    ImportantStops, stoptimedict, CalcWaitTime,
-                                    start_sec, end_sec)
-                row[1] = NumTrips
-                row[2] = NumTripsPerHr
-                row[3] = NumStopsInRange
-                if ".shp" in outFilename and MaxWaitTime == None:
-                    row[4] = -1
-                else:
-                    row[4] = MaxWaitTime
+                for idx, (windowdict, window_start_sec, window_end_sec, include_end) in enumerate(windows):
+                    NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                                    BBB_SharedFunctions.RetrieveStatsForSetOfStops(
+                                        ImportantStops, windowdict, CalcWaitTime,
+                                        window_start_sec, window_end_sec, include_end)
+                    col = 1 + 4 * idx
+                    row[col] = NumTrips
+                    row[col + 1] = NumTripsPerHr
+                    row[col + 2] = NumStopsInRange
+                    if ".shp" in outFilename and MaxWaitTime == None:
+                        row[col + 3] = -1
+                    else:
+                        row[col + 3] = MaxWaitTime
                 ucursor.updateRow(row)
 
             if badpolys:
@@ -168,5 +216,7 @@ PolyID values: " + str(badpolys))
         raise
 
     finally:
+        if gtfs:
+            gtfs.close()
         # Reset overwriteOutput to what it was originally.
         arcpy.env.overwriteOutput = OverwriteOutput
@@ -0,0 +1,181 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Query Plans
+
+Checks the query plans SQLite uses for the schedule queries the tools run for
+every date, service_id, and trip in an analysis (the *Fetch queries in
+BBB_SharedFunctions). These queries are run many thousands of times for a large
+GTFS dataset, so if SQLite stops using an index for one of them, because an
+index or a query was changed, the tools slow down dramatically without giving
+wrong answers. A query fails the check if its plan scans a whole table or sorts
+with a temporary B-tree.
+
+By default, the check is run on a small synthetic GTFS database built with the
+same tables and indices as Preprocess GTFS (sqlize_csv.create_indices and
+sqlize_csv.create_stop_visits) and Count Trips on Lines Step 1. An existing GTFS SQL database can be checked
+instead, for example to find out whether an old database is missing indices.
+
+Usage:
+    python BBB_QueryPlans.py [GTFS SQL database]
+The plan of each query is printed. The exit status is 1 if any query fails.
+The same checks run on the synthetic database in tests/test_BBB_QueryPlans.py.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import argparse
+import logging
+import re
+import sys
+import BBB_SharedFunctions
+import sqlize_csv
+
+# Plan details that mean SQLite reads every row of a table or sorts the results
+ScanDetail = re.compile(r"^SCAN (TABLE )?(?P<table>\w+)")
+TempBTreeDetail = re.compile(r"USE TEMP B-TREE")
+
+TimeFields = ["departure_time", "arrival_time"]
+
+
+def HotQueries(stop_visits=True):
+    '''Return a list of (name, sql, params) for the queries to check, with
+    sample parameters. The stop_visits queries are left out if stop_visits is
+    False.'''
+    queries = [("CalendarDatesFetch", BBB_SharedFunctions.CalendarDatesFetch, ("20180102",)),
+               ("TripsFetch", BBB_SharedFunctions.TripsFetch, ("s0",)),
+               ("LineTimesFetch", BBB_SharedFunctions.LineTimesFetch, ("t0",)),
+               ("LineTimesInWindowFetch", BBB_SharedFunctions.LineTimesInWindowFetch,
+                ("t0", 25200, 32400, 25200, 32400))]
+    for field in TimeFields:
+        queries.append(("StopTimesFetch (%s)" % field, BBB_SharedFunctions.StopTimesFetch % field, ("t0",)))
+        queries.append(("StopTimesInWindowFetch (%s)" % field,
+                        BBB_SharedFunctions.StopTimesInWindowFetch % (field, field), ("t0", 25200, 32400)))
+        if stop_visits:
+            queries.append(("StopVisitsInWindowFetch (%s)" % field,
+                            BBB_SharedFunctions.StopVisitsInWindowFetch % (field, field), ("s0", 25200, 32400)))
+            queries.append(("StopTimesByStopFetch (%s)" % field,
+                            BBB_SharedFunctions.StopTimesByStopFetch % (field, field), ("s0", 25200, 32400)))
+    return queries
+
+
+def BuildTestDatabase(SQLDbase=":memory:", num_stops=50, num_trips=200):
+    '''Create a synthetic GTFS SQL database with the tables and indices created
+    by Preprocess GTFS and Count Trips on Lines Step 1. Returns the connection.'''
+    sqlize_csv.connect(SQLDbase)
+    conn = sqlize_csv.db
+    for tblname in sqlize_csv.sql_schema:
+        sqlize_csv.create_table(tblname)
+
+    conn.executemany("INSERT INTO stops (stop_id, stop_name, stop_lat, stop_lon) VALUES (?, ?, ?, ?);",
+                     [("st%d" % i, "Stop %d" % i, 34.0 + i * 0.001, -117.0 - i * 0.001) for i in range(num_stops)])
+    conn.executemany('''INSERT INTO calendar (service_id, monday, tuesday, wednesday, thursday, friday,
+                        saturday, sunday, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);''',
+                     [("s0", 1, 1, 1, 1, 1, 0, 0, "20180101", "20181231"),
+                      ("s1", 0, 0, 0, 0, 0, 1, 1, "20180101", "20181231")])
+    conn.executemany("INSERT INTO calendar_dates (service_id, date, exception_type) VALUES (?, ?, ?);",
+                     [("s0", "20180101", 2), ("s1", "20180101", 1)])
+    conn.execute("INSERT INTO routes (route_id, route_type) VALUES ('r0', 3);")
+
+    trips = []
+    stop_times = []
+    schedules = []
+    for trip in range(num_trips):
+        trip_id = "t%d" % trip
+        trips.append(("r0", "s%d" % (trip % 2), trip_id, trip % 2))
+        start_time = 5 * 3600 + trip * 300
+        for seq in range(10):
+            stop_time = start_time + seq * 120
+            stop_times.append((trip_id, stop_time, stop_time, "st%d" % ((trip + seq) % num_stops), seq))
+            if seq:
+                schedules.append(("st%d , st%d" % ((trip + seq - 1) % num_stops, (trip + seq) % num_stops),
+                                  stop_time - 120, stop_time, trip_id))
+    conn.executemany("INSERT INTO trips (route_id, service_id, trip_id, direction_id) VALUES (?, ?, ?, ?);", trips)
+    conn.executemany('''INSERT INTO stop_times (trip_id, arrival_time, departure_time, stop_id, stop_sequence)
+                        VALUES (?, ?, ?, ?, ?);''', stop_times)
+    conn.execute("INSERT INTO frequencies (trip_id, start_time, end_time, headway_secs) VALUES ('t0', 25200, 32400, 600);")
+    conn.commit()
+    sqlize_csv.create_indices()
+    sqlize_csv.create_stop_visits()
+
+    conn.execute(BBB_SharedFunctions.SchedulesTableStmt)
+    conn.executemany("INSERT INTO schedules (key, start_time, end_time, trip_id) VALUES (?, ?, ?, ?);", schedules)
+    conn.execute(BBB_SharedFunctions.SchedulesIndexStmt)
+    conn.commit()
+    return conn
+
+
+def GetQueryPlan(conn, sql, params=()):
+    '''Return the list of detail strings from EXPLAIN QUERY PLAN for the query.'''
+    return [str(row[-1]) for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def FindPlanProblems(plan):
+    '''Return a list of the steps in the query plan that scan a whole table or
+    sort with a temporary B-tree.'''
+    problems = []
+    for detail in plan:
+        scan = ScanDetail.match(detail)
+        if scan:
+            problems.append("Full scan of table %s: %s" % (scan.group("table"), detail))
+        elif TempBTreeDetail.search(detail):
+            problems.append("Temporary B-tree: %s" % detail)
+    return problems
+
+
+def CheckQueryPlans(conn):
+    '''Return a list of (name, plan, problems) for each of the HotQueries. The
+    stop_visits queries are only checked if the database has the stop_visits
+    table, since it is optional.'''
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+    results = []
+    for name, sql, params in HotQueries("stop_visits" in tables):
+        plan = GetQueryPlan(conn, sql, params)
+        results.append((name, plan, FindPlanProblems(plan)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the BetterBusBuffers schedule queries use indices.")
+    parser.add_argument("database", nargs="?",
+                        help="GTFS SQL database to check (default: a synthetic database with the standard indices)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.database:
+        conn = BBB_SharedFunctions.ConnectToSQLDatabase(args.database, read_only=True).conn
+    else:
+        conn = BuildTestDatabase()
+
+    num_failed = 0
+    for name, plan, problems in CheckQueryPlans(conn):
+        status = "FAIL" if problems else "ok"
+        BBB_SharedFunctions.AddMessage("%-4s  %s" % (status, name))
+        for detail in plan:
+            BBB_SharedFunctions.AddMessage("        " + detail)
+        for problem in problems:
+            BBB_SharedFunctions.AddWarning("        " + problem)
+        if problems:
+            num_failed += 1
+    conn.close()
+
+    if num_failed:
+        BBB_SharedFunctions.AddError("%d queries do not use an index." % num_failed)
+        return 1
+    BBB_SharedFunctions.AddMessage("All queries use an index.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
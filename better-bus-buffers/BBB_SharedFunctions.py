@@ -18,13 +18,25 @@
    limitations under the License.'''
 ################################################################################
 
-import sqlite3, os, operator, datetime
-import arcpy
-
-# sqlite cursor - must be set from the script calling the functions explicitly
-# or using the ConnectToSQLDatabase() function
-c = None
-conn = None
+import os, operator, datetime, logging, bisect, threading, itertools, heapq
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import BBB_SpatialIndex
+import BBB_StopGeometry
+import BBB_OutputWriters
+import BBB_Instrumentation
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+try:
+    import arcpy
+except ImportError:
+    # The GTFS schedule and statistics functions can be used without ArcGIS.
+    # Messages are sent to the logging module instead of the geoprocessing window.
+    arcpy = None
+
+logger = logging.getLogger("BetterBusBuffers")
 
 # Version of ArcGIS they are running
 ArcVersion = None
@@ -47,12 +59,70 @@ PARAMETER['Central_Meridian',0.0],PARAMETER['Standard_Parallel_1',0.0], \
 UNIT['Meter',1.0]];-20037700 -6364000 10000;-100000 10000;-100000 10000; \
 5;0.001;0.001;IsHighPrecision"
 
+# Memory map size for read-only connections to the SQL database (1 GB)
+ReadOnlyMmapSize = 1024 * 1024 * 1024
+
+# Page cache size for each connection to the SQL database, in KiB
+ConnectionCacheSize = 64 * 1024
+
+# Number of threads used to run the schedule queries for a time window
+ScheduleQueryThreads = 3
+
+# Index on stop_visits used to read each service_id's stop visits in stop_id order
+StopVisitsByStopIndexName = "stopVisits_index_serviceIdsStopIds"
+
 # Number of seconds in a day.
 SecsInDay = 86400
 
 # Days of the week
 days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
 
+# Queries run for every date, service_id, or trip in an analysis. Their speed depends on
+# SQLite using the right index, which BBB_QueryPlans.py checks. %s is the time field.
+CalendarDatesFetch = '''
+    SELECT service_id, exception_type FROM calendar_dates
+    WHERE date == ?
+    ;'''
+TripsFetch = '''
+    SELECT trip_id FROM trips
+    WHERE service_id == ?
+    ;'''
+StopTimesFetch = '''
+    SELECT stop_id, %s FROM stop_times
+    WHERE trip_id == ?
+    ;'''
+StopTimesInWindowFetch = '''
+    SELECT stop_id, %s FROM stop_times
+    WHERE trip_id == ?
+    AND %s BETWEEN ? AND ?
+    ;'''
+StopVisitsInWindowFetch = '''
+    SELECT stop_id, trip_id, %s FROM stop_visits
+    WHERE service_id == ?
+    AND %s BETWEEN ? AND ?
+    ;'''
+StopTimesByStopFetch = '''
+    SELECT stop_id, trip_id, %s FROM stop_visits
+    INDEXED BY ''' + StopVisitsByStopIndexName + '''
+    WHERE service_id == ?
+    AND %s BETWEEN ? AND ?
+    ORDER BY stop_id
+    ;'''
+LineTimesFetch = '''
+    SELECT key, start_time, end_time FROM schedules
+    WHERE trip_id == ?
+    ;'''
+LineTimesInWindowFetch = '''
+    SELECT key, start_time, end_time FROM schedules
+    WHERE trip_id == ?
+    AND start_time BETWEEN ? AND ?
+    AND end_time BETWEEN ? AND ?
+    ;'''
+
+# The line-based schedule table created by Count Trips on Lines Step 1
+SchedulesTableStmt = "CREATE TABLE schedules (key TEXT, start_time REAL, end_time REAL, trip_id TEXT);"
+SchedulesIndexStmt = "CREATE INDEX schedules_index_tripsstend ON schedules (trip_id, start_time, end_time);"
+
 CurrentGPWorkspaceError = "This tool creates one or more Network Analysis layers. \
 In ArcGIS Pro, Network Analysis layers make use of on-disk feature classes.  These \
 feature classes are created in the Geoprocessing Current Workspace that you specify. \
@@ -61,7 +131,29 @@ Geoprocessing Current workspace.  You can do this in your python script by setti
 arcpy.env.workspace = [path to desired file geodatabase]."
 
 
-def MakeServiceIDList(day, Specific=False):
+def AddMessage(msg):
+    '''Send a message to the geoprocessing window, or to the log if arcpy is not available.'''
+    if arcpy:
+        arcpy.AddMessage(msg)
+    else:
+        logger.info(msg)
+
+def AddWarning(msg):
+    '''Send a warning to the geoprocessing window, or to the log if arcpy is not available.'''
+    if arcpy:
+        arcpy.AddWarning(msg)
+    else:
+        logger.warning(msg)
+
+def AddError(msg):
+    '''Send an error to the geoprocessing window, or to the log if arcpy is not available.'''
+    if arcpy:
+        arcpy.AddError(msg)
+    else:
+        logger.error(msg)
+
+
+def MakeServiceIDList(gtfs, day, Specific=False):
     '''Find the service ids for the specific date using both calendar and calendar_dates.'''
 
     if Specific == True:
@@ -76,16 +168,12 @@ def MakeServiceIDList(day, Specific=False):
     startdatedict = {}
     enddatedict = {}
 
-    tables = GetGTFSTableNames()
+    tables = GetGTFSTableNames(gtfs)
     
     # Find added and subtracted service_ids from calendar_dates.
-    cs = conn.cursor()
+    cs = gtfs.cursor()
     if Specific == True and "calendar_dates" in tables:
-        serviceidfetch = '''
-            SELECT service_id, exception_type FROM calendar_dates
-            WHERE date == "%s"
-            ;''' % datetime.datetime.strftime(day, '%Y%m%d')
-        cs.execute(serviceidfetch)
+        cs.execute(CalendarDatesFetch, (datetime.datetime.strftime(day, '%Y%m%d'),))
         for id in cs:
             # If service is added that day, add it to the list of valid service_ids
             if id[1] == 1:
@@ -128,14 +216,14 @@ def MakeServiceIDList(day, Specific=False):
     return serviceidlist, nonoverlappingsids
 
 
-def GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific=False, ConsiderYesterday=None, ConsiderTomorrow=None):
+def GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False, ConsiderYesterday=None, ConsiderTomorrow=None):
     ''' Get the lists of service ids for today, yesterday, and tomorrow, and
     combine non-overlapping date range list for all days'''
 
     # Determine if it's early enough in the day that we need to consider trips
     # still running from yesterday
     if ConsiderYesterday is None:
-        ConsiderYesterday = ShouldConsiderYesterday(start_sec, DepOrArr)
+        ConsiderYesterday = ShouldConsiderYesterday(gtfs, start_sec, DepOrArr)
     # If our time window spans midnight, we need to check tomorrow's trips, too.
     if ConsiderTomorrow is None:
         ConsiderTomorrow = ShouldConsiderTomorrow(end_sec)
@@ -150,26 +238,26 @@ def GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific=
     try:
         # Get the service ids applicable for the current day of the week
         # Furthermore, get list of service ids with non-overlapping date ranges.
-        serviceidlist, nonoverlappingsids = MakeServiceIDList(day, Specific)
+        serviceidlist, nonoverlappingsids = MakeServiceIDList(gtfs, day, Specific)
 
         # If we need to consider yesterday's trips, get the service ids.
         serviceidlist_yest = []
         nonoverlappingsids_yest = []
         if ConsiderYesterday:
-            serviceidlist_yest, nonoverlappingsids_yest = MakeServiceIDList(Yesterday, Specific)
+            serviceidlist_yest, nonoverlappingsids_yest = MakeServiceIDList(gtfs, Yesterday, Specific)
 
         # If we need to consider tomorrow's trips, get the service ids.
         serviceidlist_tom = []
         nonoverlappingsids_tom = []
         if ConsiderTomorrow:
-            serviceidlist_tom, nonoverlappingsids_tom = MakeServiceIDList(Tomorrow, Specific)
+            serviceidlist_tom, nonoverlappingsids_tom = MakeServiceIDList(gtfs, Tomorrow, Specific)
     except:
-        arcpy.AddError("Error getting list of service_ids for time window.")
+        AddError("Error getting list of service_ids for time window.")
         raise CustomError
 
     # Make sure there is service on the day we're analyzing.
     if not serviceidlist and not serviceidlist_yest and not serviceidlist_tom:
-        arcpy.AddWarning("There is no transit service during this time window. \
+        AddWarning("There is no transit service during this time window. \
 No service_ids cover the weekday or specific date you have selected.")
 
     # Combine lists of non-overlapping date range pairs of service ids
@@ -191,22 +279,18 @@ following pairs of service_ids: "
         if len(nonoverlappingsids) == 10:
             overlapwarning += "(Showing the first 10 non-overlaps) "
         overlapwarning += str(nonoverlappingsids)
-        arcpy.AddWarning(overlapwarning)   
+        AddWarning(overlapwarning)   
     
     return serviceidlist, serviceidlist_yest, serviceidlist_tom
 
 
-def MakeTripList(serviceidlist):
+def MakeTripList(gtfs, serviceidlist):
     '''Select the trips with the service_ids of interest'''
 
     triplist = []
-    ct = conn.cursor()
+    ct = gtfs.cursor()
     for service_id in serviceidlist:
-        tripsfetch = '''
-            SELECT DISTINCT trip_id FROM trips
-            WHERE service_id == ?
-            ;'''
-        ct.execute(tripsfetch, (service_id,))
+        ct.execute(TripsFetch, (service_id,))
         for tr in ct:
             triplist.append(tr[0])
     # There shouldn't be any duplicates, but check anyway.
@@ -215,11 +299,11 @@ def MakeTripList(serviceidlist):
     return triplist
 
 
-def MakeTripRouteDict():
+def MakeTripRouteDict(gtfs):
     '''Make global dictionary of {trip_id: route_id}'''
 
     triproute_dict = {}
-    ctr = conn.cursor()
+    ctr = gtfs.cursor()
 
     # First, make sure there are no duplicate trip_id values, as this will mess things up later.
     tripDuplicateFetch = "SELECT trip_id, count(*) from trips group by trip_id having count(*) > 1"
@@ -227,9 +311,9 @@ def MakeTripRouteDict():
     tripdups = ctr.fetchall()
     tripdupslist = [tripdup for tripdup in tripdups]
     if tripdupslist:
-        arcpy.AddError("Your GTFS trips table is invalid.  It contains multiple trips with the same trip_id.")
+        AddError("Your GTFS trips table is invalid.  It contains multiple trips with the same trip_id.")
         for tripdup in tripdupslist:
-            arcpy.AddError("There are %s instances of the trip_id value '%s'." % (str(tripdup[1]), unicode(tripdup[0])))
+            AddError("There are %s instances of the trip_id value '%s'." % (str(tripdup[1]), unicode(tripdup[0])))
         raise CustomError
  
     tripsfetch = '''
@@ -243,17 +327,17 @@ def MakeTripRouteDict():
     return triproute_dict
 
 
-def MakeFrequenciesDict():
+def MakeFrequenciesDict(gtfs):
     '''Put the frequencies.txt information into a dictionary'''
 
     # Check if the dataset uses frequency. If not, no need to do more.
-    tblnamelist = GetGTFSTableNames()
+    tblnamelist = GetGTFSTableNames(gtfs)
     if not "frequencies" in tblnamelist:
         return {}
 
     # Fill the dictionary
     frequencies_dict = {}
-    cf = conn.cursor()
+    cf = gtfs.cursor()
     freqfetch = '''
         SELECT trip_id, start_time, end_time, headway_secs
         FROM frequencies
@@ -268,7 +352,7 @@ def MakeFrequenciesDict():
     return frequencies_dict
 
 
-def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_dict):
+def GetStopTimesForStopsInTimeWindow(gtfs, start, end, DepOrArr, triplist, day, frequencies_dict):
     '''Return a dictionary of {stop_id: [[trip_id, stop_time]]} for trips and
     stop_times in the time window. Adjust the stop_time value to today's time of
     day if it is a trip from yesterday or tomorrow.'''
@@ -282,7 +366,7 @@ def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, freque
         end = end - SecsInDay
 
     stoptimedict = {} # {stop_id: [[trip_id, stop_time]]}
-    cst = conn.cursor()
+    cst = gtfs.cursor()
     for trip in triplist:
 
         # If the trip uses the frequencies.txt file, extrapolate the stop_times
@@ -291,11 +375,7 @@ def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, freque
         if trip in frequencies_dict:
 
             # Grab the stops stop_times for this trip
-            stopsfetch = '''
-                SELECT stop_id, %s FROM stop_times
-                WHERE trip_id == ?
-                ;''' % DepOrArr
-            cst.execute(stopsfetch, (trip,))
+            cst.execute(StopTimesFetch % DepOrArr, (trip,))
             StopTimes = cst.fetchall()
             # Sort by time
             StopTimes.sort(key=operator.itemgetter(1))
@@ -330,12 +410,7 @@ def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, freque
         # If the trip doesn't use frequencies, get the stop times directly
         else:
             # Grab the stop_times within the time window
-            stopsfetch = '''
-                SELECT stop_id, %s FROM stop_times
-                WHERE trip_id == ?
-                AND %s BETWEEN ? AND ?
-                ;''' % (DepOrArr, DepOrArr)
-            cst.execute(stopsfetch, (trip, start, end,))
+            cst.execute(StopTimesInWindowFetch % (DepOrArr, DepOrArr), (trip, start, end,))
             for stoptime in cst:
                 stop_id = stoptime[0]
                 stop_time = int(stoptime[1])
@@ -348,7 +423,41 @@ def GetStopTimesForStopsInTimeWindow(start, end, DepOrArr, triplist, day, freque
     return stoptimedict
 
 
-def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_dict):
+def GetStopVisitsInTimeWindow(gtfs, start, end, DepOrArr, serviceidlist, day, frequencies_dict):
+    '''Return a dictionary of {stop_id: [[trip_id, stop_time]]} for the stop
+    visits in the time window of trips with the service_ids in serviceidlist,
+    read from the stop_visits table one service_id at a time. Trips that use
+    frequencies.txt are skipped, since GetStopTimesForStopsInTimeWindow has to
+    extrapolate their stop_times. Adjust the stop_time value to today's time of
+    day if it is a trip from yesterday or tomorrow.'''
+
+    # Adjust times for trips from yesterday or tomorrow
+    if day == "yesterday":
+        start += SecsInDay
+        end += SecsInDay
+    if day == "tomorrow":
+        start = start - SecsInDay
+        end = end - SecsInDay
+
+    stoptimedict = {} # {stop_id: [[trip_id, stop_time]]}
+    cv = gtfs.cursor()
+    for service_id in serviceidlist:
+        cv.execute(StopVisitsInWindowFetch % (DepOrArr, DepOrArr), (service_id, start, end,))
+        for stopvisit in cv:
+            trip = stopvisit[1]
+            if trip in frequencies_dict:
+                continue
+            stop_time = int(stopvisit[2])
+            if day == "yesterday":
+                stop_time = stop_time - SecsInDay
+            elif day == "tomorrow":
+                stop_time += SecsInDay
+            stoptimedict.setdefault(stopvisit[0], []).append([trip, stop_time])
+
+    return stoptimedict
+
+
+def GetLineTimesInTimeWindow(gtfs, start, end, DepOrArr, triplist, day, frequencies_dict):
     '''Return a dictionary of {line_key: [[trip_id, start_time, end_time]]} for trips and
     stop_times in the time window. Adjust the stop_time value to today's time of
     day if it is a trip from yesterday or tomorrow.'''
@@ -362,6 +471,7 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
         end = end - SecsInDay
 
     linetimedict = {} # {line_key: [[trip_id, start_time, end_time]]}
+    cl = gtfs.cursor()
     for trip in triplist:
 
         # If the trip uses the frequencies.txt file, extrapolate the stop_times
@@ -370,12 +480,8 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
         if trip in frequencies_dict:
 
             # Grab the stops stop_times for this trip
-            linesfetch = '''
-                SELECT key, start_time, end_time FROM schedules
-                WHERE trip_id == ?
-                ;'''
-            c.execute(linesfetch, (trip,))
-            LineTimes = c.fetchall()
+            cl.execute(LineTimesFetch, (trip,))
+            LineTimes = cl.fetchall()
             # Sort by time
             LineTimes.sort(key=operator.itemgetter(1))
             # time 0 for this trip
@@ -414,14 +520,8 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
         # If the trip doesn't use frequencies, get the stop times directly
         else:
             # Grab the line schedules fully within the time window
-            linesfetch = '''
-                SELECT key, start_time, end_time FROM schedules
-                WHERE trip_id == ?
-                AND start_time BETWEEN ? AND ?
-                AND end_time BETWEEN ? AND ?
-                ;'''
-            c.execute(linesfetch, (trip, start, end, start, end,))
-            LineTimes = c.fetchall()
+            cl.execute(LineTimesInWindowFetch, (trip, start, end, start, end,))
+            LineTimes = cl.fetchall()
 
             for linetime in LineTimes:
                 line_id = linetime[0]
@@ -438,7 +538,7 @@ def GetLineTimesInTimeWindow(start, end, DepOrArr, triplist, day, frequencies_di
     return linetimedict
 
 
-def ShouldConsiderYesterday(start_sec, DepOrArr):
+def ShouldConsiderYesterday(gtfs, start_sec, DepOrArr):
     '''Determine if it's early enough in the day that we need to consider trips
     still running from the day before. Do this by finding the largest stop_time
     in the GTFS file and comparing it to the user's start time.'''
@@ -447,8 +547,9 @@ def ShouldConsiderYesterday(start_sec, DepOrArr):
     MaxTimeFetch = '''
         SELECT MAX(%s) FROM stop_times
         ;''' % (DepOrArr)
-    c.execute(MaxTimeFetch)
-    MaxTime = c.fetchone()[0]
+    cm = gtfs.cursor()
+    cm.execute(MaxTimeFetch)
+    MaxTime = cm.fetchone()[0]
     if start_sec < MaxTime - SecsInDay:
         ConsiderYesterday = True
     return ConsiderYesterday
@@ -461,28 +562,28 @@ def ShouldConsiderTomorrow(end_sec):
         ConsiderTomorrow = True
     return ConsiderTomorrow
 
-def GetTripLists(day, start_sec, end_sec, DepOrArr, Specific=False):
+def GetTripLists(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False):
     '''Returns separate lists of trips running today, yesterday, and tomorrow'''
 
     # Determine if it's early enough in the day that we need to consider trips
     # still running from yesterday
-    ConsiderYesterday = ShouldConsiderYesterday(start_sec, DepOrArr)
+    ConsiderYesterday = ShouldConsiderYesterday(gtfs, start_sec, DepOrArr)
     ConsiderTomorrow = ShouldConsiderTomorrow(end_sec)
 
     # Find the service_ids that serve the relevant day
     serviceidlist, serviceidlist_yest, serviceidlist_tom, = \
-        GetServiceIDListsAndNonOverlaps(day, start_sec, end_sec, DepOrArr, Specific, ConsiderYesterday, ConsiderTomorrow)
+        GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific, ConsiderYesterday, ConsiderTomorrow)
 
     try:
         # Get the list of trips with these service ids.
-        triplist = MakeTripList(serviceidlist)
+        triplist = MakeTripList(gtfs, serviceidlist)
 
         triplist_yest = []
         if ConsiderYesterday:
             # To save time, only get yesterday's trips if yesterday's service ids
             # are different than today's.
             if serviceidlist_yest != serviceidlist:
-                triplist_yest = MakeTripList(serviceidlist_yest)
+                triplist_yest = MakeTripList(gtfs, serviceidlist_yest)
             else:
                 triplist_yest = triplist
 
@@ -495,76 +596,330 @@ def GetTripLists(day, start_sec, end_sec, DepOrArr, Specific=False):
             elif serviceidlist_tom == serviceidlist_yest:
                 triplist_tom = triplist_yest
             else:
-                triplist_tom = MakeTripList(serviceidlist_tom)
+                triplist_tom = MakeTripList(gtfs, serviceidlist_tom)
     except:
-        arcpy.AddError("Error creating list of trips for time window.")
+        AddError("Error creating list of trips for time window.")
         raise CustomError
 
     # Make sure there is service on the day we're analyzing.
     if not triplist and not triplist_yest and not triplist_tom:
-        arcpy.AddWarning("There is no transit service during this time window. \
+        AddWarning("There is no transit service during this time window. \
 No trips are running.")
 
     return triplist, triplist_yest, triplist_tom
 
 
-def CountTripsAtStops(day, start_sec, end_sec, DepOrArr, Specific=False):
+def SplitTripLists(gtfs, triplist, triplist_yest, triplist_tom):
+    '''Split the trip lists for today, yesterday, and tomorrow into chunks that
+    can be queried in parallel threads. Returns a list of (triplist, day) in the
+    order the results should be combined.'''
+    chunks = []
+    for trips, day in [(triplist, "today"), (triplist_yest, "yesterday"), (triplist_tom, "tomorrow")]:
+        chunk_size = max(-(-len(trips) // gtfs.num_threads), 1)
+        for idx in range(0, len(trips), chunk_size):
+            chunks.append((trips[idx:idx + chunk_size], day))
+    return chunks
+
+
+def CombineTimeDicts(timedicts):
+    '''Combine a list of dictionaries of {key: [times]} into one master.'''
+    combined = {}
+    for timedict in timedicts:
+        for key in timedict:
+            combined.setdefault(key, []).extend(timedict[key])
+    return combined
+
+
+def HasStopVisits(gtfs):
+    '''Return True if Preprocess GTFS created the stop_visits table in the SQL
+    database.'''
+    return "stop_visits" in GetGTFSTableNames(gtfs)
+
+
+def CountStopVisits(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False):
     '''Given a time window, return a dictionary of
-    {stop_id: [[trip_id, stop_time]]}'''
+    {stop_id: [[trip_id, stop_time]]} using the stop_visits table'''
 
-    triplist, triplist_yest, triplist_tom = GetTripLists(day, start_sec, end_sec, DepOrArr, Specific)
+    ConsiderYesterday = ShouldConsiderYesterday(gtfs, start_sec, DepOrArr)
+    ConsiderTomorrow = ShouldConsiderTomorrow(end_sec)
+
+    # Find the service_ids that serve the relevant day
+    serviceidlist, serviceidlist_yest, serviceidlist_tom, = \
+        GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific, ConsiderYesterday, ConsiderTomorrow)
 
     try:
-        frequencies_dict = MakeFrequenciesDict()
+        frequencies_dict = MakeFrequenciesDict(gtfs)
+
+        # Each service_id is one range scan of stop_visits. The service_ids for
+        # today, yesterday, and tomorrow are queried in parallel threads.
+        chunks = []
+        for services, tripday in [(serviceidlist, "today"), (serviceidlist_yest, "yesterday"), (serviceidlist_tom, "tomorrow")]:
+            services = sorted(set(services))
+            chunks += [(GetStopVisitsInTimeWindow, [service_id], tripday) for service_id in services]
+            # Trips using frequencies.txt are extrapolated from their stop_times.
+            if frequencies_dict:
+                freqtrips = [trip for trip in MakeTripList(gtfs, services) if trip in frequencies_dict]
+                if freqtrips:
+                    chunks.append((GetStopTimesForStopsInTimeWindow, freqtrips, tripday))
+
+        def GetStopTimes(chunk):
+            GetTimes, idlist, tripday = chunk
+            return GetTimes(gtfs, start_sec, end_sec, DepOrArr, idlist, tripday, frequencies_dict)
+        stoptimedicts = gtfs.map(GetStopTimes, chunks)
+
+        # Combine the dictionaries into one master
+        stoptimedict = CombineTimeDicts(stoptimedicts)
 
-        # Get the stop_times that occur during this time window
-        stoptimedict = GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist, "today", frequencies_dict)
-        stoptimedict_yest = GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_yest, "yesterday", frequencies_dict)
-        stoptimedict_tom = GetStopTimesForStopsInTimeWindow(start_sec, end_sec, DepOrArr, triplist_tom, "tomorrow", frequencies_dict)
+    except:
+        AddError("Error creating dictionary of stops and trips in time window.")
+        raise CustomError
 
-        # Combine the three dictionaries into one master
-        for stop in stoptimedict_yest:
-            stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_yest[stop]
-        for stop in stoptimedict_tom:
-            stoptimedict[stop] = stoptimedict.setdefault(stop, []) + stoptimedict_tom[stop]
+    return stoptimedict
+
+
+def CountTripsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False, LowMemory=False):
+    '''Given a time window, return a dictionary of
+    {stop_id: [[trip_id, stop_time]]}. If LowMemory is True, a StopVisitArrays
+    holding the same stop visits in a fraction of the memory is returned
+    instead.'''
+
+    # For very large feeds, stream the stop visits into compact arrays.
+    if LowMemory:
+        try:
+            return StopVisitArrays(IterStopTimesByStop(gtfs, day, start_sec, end_sec, DepOrArr, Specific))
+        except CustomError:
+            raise
+        except:
+            AddError("Error creating dictionary of stops and trips in time window.")
+            raise CustomError
+
+    # The stop_visits table, if Preprocess GTFS created it, answers the same
+    # question without looking up each trip.
+    if HasStopVisits(gtfs):
+        return CountStopVisits(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
+
+    triplist, triplist_yest, triplist_tom = GetTripLists(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
+
+    try:
+        frequencies_dict = MakeFrequenciesDict(gtfs)
+
+        # Get the stop_times that occur during this time window. Today's,
+        # yesterday's, and tomorrow's trips are queried in parallel threads.
+        def GetStopTimes(chunk):
+            return GetStopTimesForStopsInTimeWindow(gtfs, start_sec, end_sec, DepOrArr, chunk[0], chunk[1], frequencies_dict)
+        stoptimedicts = gtfs.map(GetStopTimes, SplitTripLists(gtfs, triplist, triplist_yest, triplist_tom))
+
+        # Combine the dictionaries into one master
+        stoptimedict = CombineTimeDicts(stoptimedicts)
 
     except:
-        arcpy.AddError("Error creating dictionary of stops and trips in time window.")
+        AddError("Error creating dictionary of stops and trips in time window.")
         raise CustomError
 
     return stoptimedict
 
 
-def CountTripsOnLines(day, start_sec, end_sec, DepOrArr, Specific=False):
-    '''Given a time window, return a dictionary of {line_key: [[trip_id, start_time, end_time]]}'''
+def CheckLowMemoryMode(gtfs):
+    '''Raise a CustomError if the GTFS SQL database doesn't have the stop_visits
+    table and its stop_id index, which low memory mode reads the stop visits
+    from.'''
+    if HasStopVisits(gtfs):
+        cs = gtfs.cursor()
+        cs.execute("PRAGMA index_list(stop_visits);")
+        if StopVisitsByStopIndexName in [index[1] for index in cs.fetchall()]:
+            return
+    AddError("Low memory mode requires a SQL database created by this version of the Preprocess GTFS \
+tool with the option to create the stop visits table checked. Run Preprocess GTFS again, or turn \
+off low memory mode.")
+    raise CustomError
+
+
+def _StopVisitStream(cursor, shift, frequencies_dict):
+    '''Yield (stop_id, trip_id, stop_time) for the rows of a StopTimesByStopFetch
+    query, adjusting the stop times to today's time of day. Trips that use
+    frequencies.txt are skipped.'''
+    for stop_id, trip, stop_time in cursor:
+        if trip not in frequencies_dict:
+            yield stop_id, trip, int(stop_time) + shift
+
+
+def IterStopTimesByStop(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False):
+    '''Given a time window, yield (stop_id, [[trip_id, stop_time]]) for each
+    stop visited during the window, in stop_id order. The stop visits of each
+    service_id running today, yesterday, and tomorrow are read from the
+    stop_visits table with one indexed query per service_id and day, sorted by
+    stop_id, and the sorted streams are merged, so only one stop's visits are
+    held in memory at a time. Visits of trips using frequencies.txt are
+    extrapolated up front, since those trips are few. The database must pass
+    CheckLowMemoryMode.'''
+
+    CheckLowMemoryMode(gtfs)
+    ConsiderYesterday = ShouldConsiderYesterday(gtfs, start_sec, DepOrArr)
+    ConsiderTomorrow = ShouldConsiderTomorrow(end_sec)
 
-    triplist, triplist_yest, triplist_tom = GetTripLists(day, start_sec, end_sec, DepOrArr, Specific)
+    # Find the service_ids that serve the relevant day
+    serviceidlist, serviceidlist_yest, serviceidlist_tom, = \
+        GetServiceIDListsAndNonOverlaps(gtfs, day, start_sec, end_sec, DepOrArr, Specific, ConsiderYesterday, ConsiderTomorrow)
+    frequencies_dict = MakeFrequenciesDict(gtfs)
+
+    # Each service_id is queried in the time window in its trips' own time of day.
+    streams = []
+    freqdicts = []
+    for services, tripday, shift in [(serviceidlist, "today", 0), (serviceidlist_yest, "yesterday", -SecsInDay),
+                                     (serviceidlist_tom, "tomorrow", SecsInDay)]:
+        services = sorted(set(services))
+        for service_id in services:
+            cs = gtfs.cursor()
+            cs.execute(StopTimesByStopFetch % (DepOrArr, DepOrArr), (service_id, start_sec - shift, end_sec - shift,))
+            streams.append(_StopVisitStream(cs, shift, frequencies_dict))
+        if frequencies_dict:
+            freqtrips = [trip for trip in MakeTripList(gtfs, services) if trip in frequencies_dict]
+            if freqtrips:
+                freqdicts.append(GetStopTimesForStopsInTimeWindow(gtfs, start_sec, end_sec, DepOrArr, freqtrips, tripday, frequencies_dict))
+    freqdict = CombineTimeDicts(freqdicts)
+    streams.append((stop_id, stoptime[0], stoptime[1]) for stop_id in sorted(freqdict) for stoptime in freqdict[stop_id])
+
+    for stop_id, stopvisits in itertools.groupby(heapq.merge(*streams), key=operator.itemgetter(0)):
+        yield stop_id, [[stopvisit[1], stopvisit[2]] for stopvisit in stopvisits]
+
+
+def CountTripStatsAtStops(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False, CalcWaitTime=True):
+    '''Given a time window, return a dictionary of
+    {stop_id: (NumTrips, NumTripsPerHr, MaxWaitTime)} for the stops visited
+    during the window. The statistics are calculated one stop at a time from
+    IterStopTimesByStop, so the stop visits are never all held in memory.'''
 
+    stopstats = {}
     try:
-        frequencies_dict = MakeFrequenciesDict()
+        for stop_id, stoptimelist in IterStopTimesByStop(gtfs, day, start_sec, end_sec, DepOrArr, Specific):
+            NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime = \
+                        RetrieveStatsForSetOfStops([stop_id], {stop_id: stoptimelist}, CalcWaitTime, start_sec, end_sec)
+            stopstats[stop_id] = (NumTrips, NumTripsPerHr, MaxWaitTime)
+    except CustomError:
+        raise
+    except:
+        AddError("Error creating dictionary of stops and trips in time window.")
+        raise CustomError
+
+    return stopstats
+
+
+class StopVisitArrays(object):
+    '''Read-only stand-in for a {stop_id: [[trip_id, stop_time]]} dictionary for
+    very large feeds. Each stop's visits are stored as a pair of NumPy arrays,
+    the trips (as indices into tripids) and the stop times, sorted by time. This
+    takes a small fraction of the memory of the lists of lists.
+    RetrieveStatsForSetOfStops and SplitStopTimesByTimeWindow accept it in
+    place of the dictionary.'''
+
+    def __init__(self, stoptimes):
+        '''stoptimes is an iterable of (stop_id, [[trip_id, stop_time]]), such as
+        IterStopTimesByStop.'''
+        tripnums = {} # {trip_id: index in tripids}
+        self._visits = {} # {stop_id: (trip index array, stop time array)}
+        for stop_id, stoptimelist in stoptimes:
+            stoptimelist.sort(key=operator.itemgetter(1))
+            trips = np.array([tripnums.setdefault(stoptime[0], len(tripnums)) for stoptime in stoptimelist], dtype=np.int32)
+            times = np.array([stoptime[1] for stoptime in stoptimelist], dtype=np.int32)
+            self._visits[stop_id] = (trips, times)
+        self.tripids = [None] * len(tripnums)
+        for trip, tripnum in tripnums.items():
+            self.tripids[tripnum] = trip
+
+    def __contains__(self, stop_id):
+        return stop_id in self._visits
+
+    def __iter__(self):
+        return iter(self._visits)
+
+    def __len__(self):
+        return len(self._visits)
+
+    def keys(self):
+        return self._visits.keys()
+
+    def __getitem__(self, stop_id):
+        trips, times = self._visits[stop_id]
+        return [[self.tripids[tripnum], stop_time] for tripnum, stop_time in zip(trips.tolist(), times.tolist())]
+
+    def RetrieveStats(self, stoplist, CalcWaitTime, start_sec, end_sec, include_end=True):
+        '''Same as RetrieveStatsForSetOfStops, counting only the stop visits from
+        start_sec to end_sec (or to just before end_sec if not include_end).'''
+        NumStopsInRange = len(stoplist)
+        visits = [self._visits[stop] for stop in stoplist if stop in self._visits]
+        if visits:
+            trips = np.concatenate([visit[0] for visit in visits])
+            times = np.concatenate([visit[1] for visit in visits])
+            inwindow = (times >= start_sec) & ((times <= end_sec) if include_end else (times < end_sec))
+            trips = trips[inwindow]
+            times = times[inwindow]
+        else:
+            trips = times = np.zeros(0, dtype=np.int32)
+        NumTrips = len(np.unique(trips))
+        NumTripsPerHr = round(float(NumTrips) / ((end_sec - start_sec) / 3600), 2)
+
+        MaxWaitTime = None
+        if CalcWaitTime:
+            MaxWaitTime = CalculateMaxWaitTime(times.tolist(), start_sec, end_sec)
+
+        return NumTrips, NumTripsPerHr, NumStopsInRange, MaxWaitTime
 
-        # Get the stop_times that occur during this time window
-        linetimedict = GetLineTimesInTimeWindow(start_sec, end_sec, DepOrArr, triplist, "today", frequencies_dict)
-        linetimedict_yest = GetLineTimesInTimeWindow(start_sec, end_sec, DepOrArr, triplist_yest, "yesterday", frequencies_dict)
-        linetimedict_tom = GetLineTimesInTimeWindow(start_sec, end_sec, DepOrArr, triplist_tom, "tomorrow", frequencies_dict)
 
+def CountTripsForRouteDirections(gtfs, start_sec, end_sec, DepOrArr, trip_route_dict, trip_route_dict_yest,
+                                 trip_route_dict_tom, frequencies_dict):
+    '''Given dictionaries of {(route_id, direction_id): [trip_id]} for today,
+    yesterday, and tomorrow, return a dictionary of
+    {(route_id, direction_id): {stop_id: [[trip_id, stop_time]]}}. The route and
+    direction pairs are queried in parallel threads.'''
+
+    def GetStopTimesForRouteDirection(rtdirpair):
+        # Get the stop_times that occur during this time window
+        stoptimedicts = []
+        for route_dict, day in [(trip_route_dict, "today"), (trip_route_dict_yest, "yesterday"), (trip_route_dict_tom, "tomorrow")]:
+            if rtdirpair in route_dict:
+                stoptimedicts.append(GetStopTimesForStopsInTimeWindow(gtfs, start_sec, end_sec, DepOrArr,
+                                                                      route_dict[rtdirpair], day, frequencies_dict))
         # Combine the three dictionaries into one master
-        for line in linetimedict_yest:
-            linetimedict[line] = linetimedict.setdefault(line, []) + linetimedict_yest[line]
-        for line in linetimedict_tom:
-            linetimedict[line] = linetimedict.setdefault(line, []) + linetimedict_tom[line]
+        return CombineTimeDicts(stoptimedicts)
+
+    rtdirpairs = list(set(list(trip_route_dict.keys()) + list(trip_route_dict_yest.keys()) + list(trip_route_dict_tom.keys())))
+    return dict(zip(rtdirpairs, gtfs.map(GetStopTimesForRouteDirection, rtdirpairs)))
+
+
+def CountTripsOnLines(gtfs, day, start_sec, end_sec, DepOrArr, Specific=False):
+    '''Given a time window, return a dictionary of {line_key: [[trip_id, start_time, end_time]]}'''
+
+    triplist, triplist_yest, triplist_tom = GetTripLists(gtfs, day, start_sec, end_sec, DepOrArr, Specific)
+
+    try:
+        frequencies_dict = MakeFrequenciesDict(gtfs)
+
+        # Get the line schedules that occur during this time window. Today's,
+        # yesterday's, and tomorrow's trips are queried in parallel threads.
+        def GetLineTimes(chunk):
+            return GetLineTimesInTimeWindow(gtfs, start_sec, end_sec, DepOrArr, chunk[0], chunk[1], frequencies_dict)
+        linetimedicts = gtfs.map(GetLineTimes, SplitTripLists(gtfs, triplist, triplist_yest, triplist_tom))
+
+        # Combine the dictionaries into one master
+        linetimedict = CombineTimeDicts(linetimedicts)
 
     except:
-        arcpy.AddError("Error creating dictionary of lines and trips in time window.")
+        AddError("Error creating dictionary of lines and trips in time window.")
         raise CustomError
 
     return linetimedict
 
 
-def RetrieveStatsForSetOfStops(stoplist, stoptimedict, CalcWaitTime, start_sec, end_sec):
+def RetrieveStatsForSetOfStops(stoplist, stoptimedict, CalcWaitTime, start_sec, end_sec, include_end=True):
     '''For a set of stops, query the stoptimedict {stop_id: [[trip_id, stop_time]]}
     and return the NumTrips, NumTripsPerHr, NumStopsInRange, and MaxWaitTime for
-    that set of stops.'''
+    that set of stops. If include_end is False, stop visits at exactly end_sec
+    are not counted. A dictionary is expected to hold only the visits to count
+    already (see SplitStopTimesByTimeWindow), so include_end only changes the
+    results for a StopVisitArrays.'''
+
+    if isinstance(stoptimedict, StopVisitArrays):
+        return stoptimedict.RetrieveStats(stoplist, CalcWaitTime, start_sec, end_sec, include_end)
 
     # Number of stops (in range of the given point or polygon being studied)
     NumStopsInRange = len(stoplist)
@@ -659,47 +1014,92 @@ def CalculateAvgHeadway(TimeList):
         return None
 
 
-def MakeStopsFeatureClass(stopsfc, stoplist=None):
+def MakeTimeSeriesWindows(start_time, end_time, interval):
+    '''Split the time window from start_time to end_time (HH:MM) into consecutive
+    windows interval minutes long. The last window is cut short at end_time if
+    necessary. Returns a list of (start_time, end_time) tuples in HH:MM. A time
+    window that crosses midnight must be given with an end time past 24:00.'''
+    start_sec, end_sec = ConvertTimeWindowToSeconds(start_time, end_time)
+    start_min = int(start_sec // 60)
+    end_min = int(end_sec // 60)
+    if end_min <= start_min:
+        AddError("The time window %s - %s can't be split into a time series because it ends before it starts. \
+For a time window that crosses midnight, use an end time later than 24:00 (for example, 25:00 for 1:00am)." % \
+                 (start_time, end_time))
+        raise CustomError
+    windows = []
+    for window_start in range(start_min, end_min, int(interval)):
+        window_end = min(window_start + int(interval), end_min)
+        windows.append(("%02d:%02d" % divmod(window_start, 60), "%02d:%02d" % divmod(window_end, 60)))
+    return windows
+
+
+def TimeWindowIncludesEnd(idx, timewindows):
+    '''Return True if the time series window at index idx of timewindows counts
+    stop visits at exactly its end time. Only the last window does, so a visit on
+    the boundary between two windows is counted once.'''
+    return idx == len(timewindows) - 1
+
+
+def SplitStopTimesByTimeWindow(stoptimedict, timewindows):
+    '''Split a {stop_id: [[trip_id, stop_time]]} dictionary covering a long time
+    span into one dictionary of the same form for each (start_sec, end_sec) window
+    in timewindows. A stop visit at the boundary between two windows counts only
+    in the later one: every window includes visits at its start, and only the last
+    window includes visits at its end. Each stop's visits are sorted once, and the
+    visits in each window are found with a binary search, so adding windows costs
+    little. A StopVisitArrays is returned as is for every window, since its
+    statistics are calculated for a given time span (see TimeWindowIncludesEnd).'''
+    if isinstance(stoptimedict, StopVisitArrays):
+        return [stoptimedict for window in timewindows]
+    windowdicts = [{} for window in timewindows]
+    for stop, stoptimelist in stoptimedict.items():
+        stoptimelist.sort(key=operator.itemgetter(1))
+        times = [stoptime[1] for stoptime in stoptimelist]
+        for idx, (windowdict, (start_sec, end_sec)) in enumerate(zip(windowdicts, timewindows)):
+            lo = bisect.bisect_left(times, start_sec)
+            if TimeWindowIncludesEnd(idx, timewindows):
+                hi = bisect.bisect_right(times, end_sec)
+            else:
+                hi = bisect.bisect_left(times, end_sec)
+            if hi > lo:
+                windowdict[stop] = stoptimelist[lo:hi]
+    return windowdicts
+
+
+def MakeStopsFeatureClass(gtfs, stopsfc, stoplist=None, stat_fields=None, GetStats=None):
     '''Make a feature class of GTFS stops from the SQL table. Returns the path
-    to the feature class and a list of stop IDs.'''
+    to the feature class and a list of stop IDs.
+
+    stat_fields is an optional list of (field_name, field_type) for additional
+    fields, and GetStats(stop_id) returns a tuple of values for those fields for
+    each stop. All the rows are written in one pass. If stopsfc is in a
+    GeoPackage, the output is written without arcpy (see BBB_OutputWriters).'''
 
     stopsfc_path = os.path.dirname(stopsfc)
     stopsfc_name = os.path.basename(stopsfc)
+    stat_fields = stat_fields or []
 
     # If the output location is a feature dataset, we have to match the coordinate system
-    desc = arcpy.Describe(stopsfc_path)
-    if hasattr(desc, "spatialReference"):
-        output_coords = desc.spatialReference
-    else:
-        output_coords = WGSCoords
-
-    # Create a points feature class for the point pairs.
-    StopsLayer = arcpy.management.CreateFeatureclass(stopsfc_path, stopsfc_name, "POINT", spatial_reference=output_coords)
-    arcpy.management.AddField(StopsLayer, "stop_id", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_code", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_name", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_desc", "TEXT")
-    arcpy.management.AddField(StopsLayer, "zone_id", "TEXT")
-    arcpy.management.AddField(StopsLayer, "stop_url", "TEXT")
+    output_coords = None
+    if not BBB_OutputWriters.IsGeoPackage(stopsfc):
+        desc = arcpy.Describe(stopsfc_path)
+        if hasattr(desc, "spatialReference"):
+            output_coords = desc.spatialReference
+        else:
+            output_coords = WGSCoords
+
+    fields = [("stop_id", "TEXT"), ("stop_code", "TEXT"), ("stop_name", "TEXT"), ("stop_desc", "TEXT"),
+              ("zone_id", "TEXT"), ("stop_url", "TEXT")]
     if ".shp" in stopsfc_name:
-        arcpy.management.AddField(StopsLayer, "loc_type", "TEXT")
-        arcpy.management.AddField(StopsLayer, "parent_sta", "TEXT")
+        fields += [("loc_type", "TEXT"), ("parent_sta", "TEXT")]
     else:
-        arcpy.management.AddField(StopsLayer, "location_type", "TEXT")
-        arcpy.management.AddField(StopsLayer, "parent_station", "TEXT")
+        fields += [("location_type", "TEXT"), ("parent_station", "TEXT")]
 
     # Get the stop info from the GTFS SQL file
-    if stoplist:
-        StopTable = []
-        for stop_id in stoplist:
-            selectstoptablestmt = "SELECT stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, zone_id, stop_url, location_type, parent_station FROM stops WHERE stop_id='%s';" % stop_id
-            c.execute(selectstoptablestmt)
-            StopInfo = c.fetchall()
-            StopTable.append(StopInfo[0])
-    else:
-        selectstoptablestmt = "SELECT stop_id, stop_code, stop_name, stop_desc, stop_lat, stop_lon, zone_id, stop_url, location_type, parent_station FROM stops;"
-        c.execute(selectstoptablestmt)
-        StopTable = c.fetchall()
+    StopTable = BBB_StopGeometry.ReadStops(gtfs.cursor(), ["stop_id", "stop_code", "stop_name", "stop_desc", "stop_lat",
+                                                           "stop_lon", "zone_id", "stop_url", "location_type", "parent_station"],
+                                           stoplist or None)
     possiblenulls = [1, 3, 6, 7, 8, 9]
 
     # Make a list of stop_ids for use later.
@@ -707,20 +1107,18 @@ def MakeStopsFeatureClass(stopsfc, stoplist=None):
     for stop in StopTable:
         StopIDList.append(stop[0])
 
-    if not ArcVersion:
+    if arcpy and not ArcVersion:
         DetermineArcVersion()
 
-    # Add the stops table to a feature class.
-    if ".shp" in stopsfc_name:
-        cur3 = arcpy.da.InsertCursor(StopsLayer, ["SHAPE@", "stop_id",
-                                                    "stop_code", "stop_name", "stop_desc",
-                                                    "zone_id", "stop_url", "loc_type",
-                                                    "parent_sta"])
+    # GTFS stop lat/lon is written in WGS1984. Convert all the stops to the output
+    # coordinate system at once.
+    StopLats = [float(stop[4]) for stop in StopTable]
+    StopLons = [float(stop[5]) for stop in StopTable]
+    if output_coords is None:
+        StopXs, StopYs = StopLons, StopLats
     else:
-        cur3 = arcpy.da.InsertCursor(StopsLayer, ["SHAPE@", "stop_id",
-                                                    "stop_code", "stop_name", "stop_desc",
-                                                    "zone_id", "stop_url", "location_type",
-                                                    "parent_station"])
+        StopXs, StopYs = BBB_StopGeometry.ProjectLatLonsToSpatialReference(StopLats, StopLons, output_coords)
+
     # Schema of stops table
     ##   0 - stop_id
     ##   1 - stop_code
@@ -732,27 +1130,88 @@ def MakeStopsFeatureClass(stopsfc, stoplist=None):
     ##   7 - stop_url
     ##   8 - location_type
     ##   9 - parent_station
-    for stopitem in StopTable:
-        stop = list(stopitem)
-        pt = arcpy.Point()
-        pt.X = float(stop[5])
-        pt.Y = float(stop[4])
-        # GTFS stop lat/lon is written in WGS1984
-        ptGeometry = arcpy.PointGeometry(pt, WGSCoords)
-        if output_coords != WGSCoords:
-            ptGeometry = ptGeometry.projectAs(output_coords)
-        # Shapefile output can't handle null values, so make them empty strings.
-        if ".shp" in stopsfc_name:
-            for idx in possiblenulls:
-                if not stop[idx]:
-                    stop[idx] = ""
-        cur3.insertRow((ptGeometry, stop[0], stop[1],
-                            stop[2], stop[3], stop[6], stop[7], stop[8], stop[9]))
-    del cur3
+    def StopRows():
+        for stopitem, x, y in zip(StopTable, StopXs, StopYs):
+            stop = list(stopitem)
+            # Shapefile output can't handle null values, so make them empty strings.
+            if ".shp" in stopsfc_name:
+                for idx in possiblenulls:
+                    if not stop[idx]:
+                        stop[idx] = ""
+            row = ((x, y), stop[0], stop[1], stop[2], stop[3], stop[6], stop[7], stop[8], stop[9])
+            if stat_fields:
+                row += tuple(GetStats(stop[0]))
+            yield row
+
+    # Add the stops table to a feature class.
+    with BBB_OutputWriters.MakeOutputWriter(stopsfc, "POINT", fields + stat_fields, output_coords) as writer:
+        writer.insert_rows(StopRows())
 
     return stopsfc, StopIDList
 
 
+def MakeStopGrid(gtfs, cell_size):
+    '''Make a spatial grid index of the GTFS stops with cells of cell_size
+    meters. Returns the grid and a list of stop_ids in the same order as the stops
+    in the grid.'''
+    cs = gtfs.cursor()
+    cs.execute("SELECT stop_id, stop_lat, stop_lon FROM stops;")
+    StopTable = cs.fetchall()
+    StopIDList = [stop[0] for stop in StopTable]
+    grid = BBB_SpatialIndex.StopGrid([float(stop[1]) for stop in StopTable],
+                                     [float(stop[2]) for stop in StopTable], cell_size)
+    return grid, StopIDList
+
+
+def ReadPointLatLons(inPointsLayer, fields):
+    '''Read the locations of the input points in WGS84 coordinates along with
+    the values of the specified fields. Returns a list of field value tuples and
+    lists of latitudes and longitudes. Points without geometry are skipped.'''
+    values = []
+    lats = []
+    lons = []
+    with arcpy.da.SearchCursor(inPointsLayer, ["SHAPE@XY"] + fields, spatial_reference=WGSCoords) as cur:
+        for row in cur:
+            if not row[0] or row[0][0] is None:
+                continue
+            lons.append(row[0][0])
+            lats.append(row[0][1])
+            values.append(row[1:])
+    return values, lats, lons
+
+
+def FindStopsNearPoints(gtfs, inPointsLayer, radius):
+    '''Find the GTFS stops in the open GTFS SQL database gtfs within a
+    straight-line distance of radius meters of the input points. Returns a list
+    of ObjectIDs of the points that have at least one stop nearby and a list of
+    the stop_ids of the stops near any point.'''
+    grid, StopIDList = MakeStopGrid(gtfs, radius)
+    values, lats, lons = ReadPointLatLons(inPointsLayer, ["OID@"])
+    points_with_stops = set()
+    nearby_stops = set()
+    for point_idx, stop_idx, dist in grid.query(lats, lons, radius):
+        points_with_stops.update(point_idx.tolist())
+        nearby_stops.update(stop_idx.tolist())
+    return [values[idx][0] for idx in sorted(points_with_stops)], [StopIDList[idx] for idx in sorted(nearby_stops)]
+
+
+def MakeOIDWhereClause(inTable, OIDs, exclude=False):
+    '''Make a where clause selecting (or excluding) the rows with the given ObjectIDs.'''
+    OIDfield = arcpy.AddFieldDelimiters(inTable, arcpy.Describe(inTable).OIDFieldName)
+    return '{0} {1}IN ({2})'.format(OIDfield, "NOT " if exclude else "", ','.join(map(str, OIDs)))
+
+
+def GetUniqueIDKey(inTable, inLocUniqueID):
+    '''Return a function that converts unique ID values (for example, copies of
+    them stored as text in an analysis layer) to the type of the unique ID field.'''
+    fieldtype = arcpy.ListFields(inTable, inLocUniqueID)[0].type
+    if fieldtype in ["OID", "SmallInteger", "Integer"]:
+        return int
+    elif fieldtype in ["Single", "Double"]:
+        return float
+    return str
+
+
 def MakeServiceAreasAroundStops(StopsLayer, inNetworkDataset, impedanceAttribute, BufferSize, restrictions, TrimPolys, TrimPolysValue):
     '''Make Service Area polygons around transit stops and join the stop_id
     field to the output polygons. Note: Assume NA license is checked out.'''
@@ -871,16 +1330,103 @@ def import_AGOLservice(service_name, username="", password="", ags_connection_fi
     return getattr(arcpy, tbx_alias)
 
 
-def ConnectToSQLDatabase(SQLDbase):
-    '''Connect to a SQL database'''
-    global c, conn
-    conn = sqlite3.connect(SQLDbase)
-    c = conn.cursor()
-
-
-def GetGTFSTableNames():
+class GTFSConnection(object):
+    '''Connection context for a GTFS SQL database. Pass it to the schedule
+    functions in this module.
+
+    Each thread gets its own connection, made the first time the thread asks for
+    a cursor, so the context can be shared by threads. map() runs a function over
+    a list of arguments in a pool of num_threads threads, which is kept (along
+    with the threads' connections) until the context is closed.
+
+    If read_only is True, the database is opened read-only and treated as
+    immutable (so SQLite skips file locking), and it is read through a large
+    memory map. Use this when nothing is writing to the database.'''
+
+    def __init__(self, SQLDbase, read_only=False, num_threads=1):
+        self.SQLDbase = SQLDbase
+        self.read_only = read_only
+        self.num_threads = max(int(num_threads), 1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pool = None
+
+    def _connect(self):
+        '''Make a new connection with tuned pragmas.'''
+        if self.read_only:
+            uri = "file:%s?mode=ro&immutable=1" % pathname2url(os.path.abspath(self.SQLDbase))
+            try:
+                conn = BBB_Instrumentation.connect(uri, uri=True, check_same_thread=False)
+            except TypeError:
+                # Python 2's sqlite3 module doesn't support URIs.
+                conn = BBB_Instrumentation.connect(self.SQLDbase, check_same_thread=False)
+            conn.execute("PRAGMA mmap_size = %d;" % ReadOnlyMmapSize)
+        else:
+            conn = BBB_Instrumentation.connect(self.SQLDbase, check_same_thread=False)
+        # A negative cache_size is in KiB rather than pages.
+        conn.execute("PRAGMA cache_size = -%d;" % ConnectionCacheSize)
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        return conn
+
+    @property
+    def conn(self):
+        '''The current thread's connection.'''
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def cursor(self):
+        '''Return a new cursor on the current thread's connection.'''
+        return self.conn.cursor()
+
+    def commit(self):
+        '''Commit the current thread's connection.'''
+        self.conn.commit()
+
+    def map(self, func, args):
+        '''Return [func(arg) for arg in args], running the calls in up to
+        num_threads threads.'''
+        args = list(args)
+        if self.num_threads < 2 or len(args) < 2:
+            return [func(arg) for arg in args]
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+        return self._pool.map(func, args)
+
+    def close(self):
+        '''Stop the thread pool and close the connections of all threads.'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def ConnectToSQLDatabase(SQLDbase, read_only=False, num_threads=ScheduleQueryThreads):
+    '''Connect to a SQL database. Returns a GTFSConnection. If read_only is
+    True, the database is opened read-only and treated as immutable, so use it
+    when nothing is writing to the database.'''
+    return GTFSConnection(SQLDbase, read_only, num_threads)
+
+
+def GetGTFSTableNames(gtfs):
     '''Return a list of SQL database table names'''
-    ctn = conn.cursor()
+    ctn = gtfs.cursor()
     GetTblNamesStmt = "SELECT name FROM sqlite_master WHERE type='table';"
     ctn.execute(GetTblNamesStmt)
     tblnamelist = [name[0] for name in ctn]
@@ -902,6 +1448,9 @@ def DetermineArcVersion():
     ArcVersion = ArcVersionInfo['Version']
 
 def CheckArcVersion(min_version_pro=None, min_version_10x=None):
+    if not arcpy:
+        # Running without ArcGIS, so there's no software version to check.
+        return
     DetermineArcVersion()
     # Lists must stay in product release order
     # They do not need to have new product numbers added unless a tool requires a higher version
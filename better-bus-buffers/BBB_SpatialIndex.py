@@ -0,0 +1,186 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Spatial Index
+
+A grid-based spatial index of GTFS stops used to quickly find the stops within
+a straight-line distance of a set of points.
+
+Stops are hashed into square cells in latitude/longitude space, and each query
+point is compared only against the stops in the cells near its own cell. The
+distance check uses the haversine formula, vectorized with NumPy, so it works
+directly with the WGS84 coordinates in the GTFS data and does not need arcpy.
+The grid does not wrap across the 180th meridian.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import math
+import numpy as np
+
+# Mean radius of the earth, in meters
+EARTH_RADIUS = 6371008.8
+
+# Conversion factors from linear units used by network datasets and the tool
+# parameters to meters
+METERS_PER_UNIT = {
+    "Meters": 1.0,
+    "Kilometers": 1000.0,
+    "Centimeters": 0.01,
+    "Decimeters": 0.1,
+    "Millimeters": 0.001,
+    "Feet": 0.3048,
+    "Yards": 0.9144,
+    "Miles": 1609.344,
+    "Inches": 0.0254,
+    "NauticalMiles": 1852.0,
+    }
+
+# Limit on the size of the point-to-stop distance matrix calculated at once
+max_pairs_per_batch = 1000000
+
+
+def ConvertToMeters(distance, units):
+    '''Convert a distance in the given units to meters. Returns None if the
+    units are not linear units (for example, if they are time units).'''
+    try:
+        return float(distance) * METERS_PER_UNIT[units]
+    except KeyError:
+        return None
+
+
+def ConvertLinearUnitToMeters(linear_unit):
+    '''Convert a linear unit string such as "5 Kilometers" (the text value of a
+    GPLinearUnit tool parameter) to meters. Returns None if it can't be converted.'''
+    try:
+        distance, units = linear_unit.split()
+        return ConvertToMeters(distance.replace(",", "."), units)
+    except (ValueError, AttributeError):
+        return None
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''Great circle distance in meters between points given in decimal degrees.
+    Works element-wise on NumPy arrays, with broadcasting.'''
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2.0)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class StopGrid(object):
+    '''Spatial grid index of stop locations.
+
+    lats and lons are sequences of stop coordinates in decimal degrees.
+    cell_size is the height of a grid cell in meters. Queries are fastest when
+    the cell size is about the same as the search radius.'''
+
+    def __init__(self, lats, lons, cell_size):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        # Square cells, measured in degrees
+        self.cell = math.degrees(float(cell_size) / EARTH_RADIUS)
+        self.col_offset = int(math.ceil(180.0 / self.cell)) + 1
+        self.ncols = 2 * self.col_offset + 1
+        keys = self._cell_keys(*self._cells(self.lats, self.lons))
+        # Sort the stops by cell so the stops in a row of cells are contiguous
+        self.order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _cells(self, lats, lons):
+        rows = np.floor(lats / self.cell).astype(np.int64)
+        cols = np.floor(lons / self.cell).astype(np.int64) + self.col_offset
+        return rows, cols
+
+    def _cell_keys(self, rows, cols):
+        return rows * self.ncols + cols
+
+    def query(self, lats, lons, radius):
+        '''Find all pairs of query points and stops within radius meters of
+        each other. lats and lons are sequences of query point coordinates in
+        decimal degrees.
+
+        This is a generator. Each item is a tuple of three arrays of the same
+        length: indices into the query points, indices into the stops (in the
+        order they were passed to the grid), and the distances in meters.'''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        if not len(lats) or not len(self.lats):
+            return
+        radius_deg = math.degrees(float(radius) / EARTH_RADIUS)
+        row_span = int(math.ceil(radius_deg / self.cell))
+
+        # Group the query points by cell. Every point in a cell has the same candidate stops.
+        rows, cols = self._cells(lats, lons)
+        point_keys = self._cell_keys(rows, cols)
+        point_order = np.argsort(point_keys, kind="mergesort")
+        cell_keys, cell_starts = np.unique(point_keys[point_order], return_index=True)
+        cell_ends = np.append(cell_starts[1:], len(point_order))
+        cell_rows = cell_keys // self.ncols
+        cell_cols = cell_keys % self.ncols
+
+        # Degrees of longitude get shorter away from the equator, so cells nearer the
+        # poles must look further east and west to cover the radius.
+        max_lat = np.maximum(np.abs(cell_rows * self.cell), np.abs((cell_rows + 1) * self.cell)) + radius_deg
+        cos_lat = np.cos(np.radians(np.minimum(max_lat, 90.0)))
+        with np.errstate(divide="ignore"):
+            col_span = np.where(cos_lat > 1e-6, np.ceil(radius_deg / (cos_lat * self.cell)), self.ncols)
+        col_span = np.minimum(col_span, self.ncols).astype(np.int64)
+        col_min = np.maximum(cell_cols - col_span, 0)
+        col_max = np.minimum(cell_cols + col_span, self.ncols - 1)
+
+        # Find the range of sorted stops in each row of neighboring cells
+        starts = []
+        ends = []
+        for dr in range(-row_span, row_span + 1):
+            starts.append(np.searchsorted(self.keys, self._cell_keys(cell_rows + dr, col_min), "left"))
+            ends.append(np.searchsorted(self.keys, self._cell_keys(cell_rows + dr, col_max), "right"))
+        starts = np.column_stack(starts)
+        ends = np.column_stack(ends)
+
+        for u in range(len(cell_keys)):
+            candidates = [self.order[s:e] for s, e in zip(starts[u], ends[u]) if e > s]
+            if not candidates:
+                continue
+            candidates = np.concatenate(candidates)
+            stop_lats = self.lats[candidates][np.newaxis, :]
+            stop_lons = self.lons[candidates][np.newaxis, :]
+            points = point_order[cell_starts[u]:cell_ends[u]]
+            batch_size = max(1, max_pairs_per_batch // len(candidates))
+            for b in range(0, len(points), batch_size):
+                batch = points[b:b + batch_size]
+                dists = haversine(lats[batch][:, np.newaxis], lons[batch][:, np.newaxis], stop_lats, stop_lons)
+                pidx, sidx = np.nonzero(dists <= radius)
+                if len(pidx):
+                    yield batch[pidx], candidates[sidx], dists[pidx, sidx]
+
+
+def IterPointStopPairs(point_ids, lats, lons, stop_ids, grid, max_distance, detour_factor=1.0):
+    '''Generate (point_id, stop_id) pairs for the stops within walking distance
+    of each point. The walking distance is estimated as the straight-line distance
+    multiplied by the detour factor. max_distance is in meters. stop_ids are in
+    the same order as the stops in the grid.'''
+    for point_idx, stop_idx, dist in grid.query(lats, lons, float(max_distance) / detour_factor):
+        for p, s in zip(point_idx.tolist(), stop_idx.tolist()):
+            yield point_ids[p], stop_ids[s]
+
+
+def MakePointsAndStops(point_ids, lats, lons, stop_ids, grid, max_distance, detour_factor=1.0):
+    '''Make a dictionary of {point_id: [stop_id, stop_id, ...]} listing the
+    stops within walking distance of each point. See IterPointStopPairs.'''
+    PointsAndStops = {}
+    for point_id, stop_id in IterPointStopPairs(point_ids, lats, lons, stop_ids, grid, max_distance, detour_factor):
+        PointsAndStops.setdefault(str(point_id), []).append(str(stop_id))
+    return PointsAndStops
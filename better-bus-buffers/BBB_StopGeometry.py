@@ -0,0 +1,204 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Stop Geometry
+
+Helpers for turning the GTFS stops table into point features quickly.
+
+- ReadStops gets the rows for all stops, or any subset of stops, in one query.
+- ProjectLatLons converts the WGS84 stop coordinates to the output coordinate
+  system for all stops at once. Common projections (Web Mercator, World
+  Cylindrical Equal Area, and WGS84 UTM zones) are calculated directly with
+  NumPy. Anything else is projected by arcpy in a single batch.
+- The resulting plain (x, y) tuples can be written with an insert cursor using
+  the SHAPE@XY token, so no geometry objects need to be created per stop.
+- SegmentCoordinates and ValidSegments resolve the end points of stop-to-stop
+  line segments as arrays and find the ones that can't become lines, so
+  SegmentPolyline can build the lines directly without an intermediate point
+  feature class and Points To Line.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import numpy as np
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+
+# Factory codes of the coordinate systems ProjectLatLons can calculate directly
+WGS84 = 4326
+WEB_MERCATOR = (3857, 102100)
+WORLD_CYLINDRICAL_EQUAL_AREA = 54034
+UTM_NORTH = range(32601, 32661)
+UTM_SOUTH = range(32701, 32761)
+
+
+def ReadStops(cursor, fields, stoplist=None):
+    '''Return the rows of the given fields from the GTFS stops table. If
+    stoplist is given, only those stops are returned, in the order they are
+    listed. The stop_ids are loaded into a temporary table and joined to the
+    stops table, so any number of stops is retrieved in one query.'''
+    fields_str = ", ".join(["stops." + field for field in fields])
+    if stoplist is None:
+        cursor.execute("SELECT %s FROM stops;" % fields_str)
+        return cursor.fetchall()
+    cursor.execute("DROP TABLE IF EXISTS temp.StopList;")
+    cursor.execute("CREATE TEMP TABLE StopList (stop_id TEXT);")
+    cursor.executemany("INSERT INTO temp.StopList (stop_id) VALUES (?);", [(stop_id,) for stop_id in stoplist])
+    cursor.execute('''SELECT %s FROM temp.StopList JOIN stops ON stops.stop_id = StopList.stop_id
+                      ORDER BY StopList.rowid;''' % fields_str)
+    rows = cursor.fetchall()
+    cursor.execute("DROP TABLE temp.StopList;")
+    return rows
+
+
+def CanProjectWithNumPy(factory_code):
+    '''Return True if ProjectLatLons can calculate the coordinate system with
+    the given factory code (WKID) directly.'''
+    return factory_code == WGS84 or factory_code in WEB_MERCATOR or \
+        factory_code == WORLD_CYLINDRICAL_EQUAL_AREA or \
+        factory_code in UTM_NORTH or factory_code in UTM_SOUTH
+
+
+def _transverse_mercator(lat, lon, lon0, k0, false_easting, false_northing):
+    '''Transverse Mercator projection of the WGS84 ellipsoid (Snyder's series,
+    accurate to well under a meter within a UTM zone). Angles in radians.'''
+    e2 = WGS84_E2
+    ep2 = e2 / (1 - e2)
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    N = WGS84_A / np.sqrt(1 - e2 * sin_lat**2)
+    T = np.tan(lat)**2
+    C = ep2 * cos_lat**2
+    A = (lon - lon0) * cos_lat
+    M = WGS84_A * ((1 - e2 / 4 - 3 * e2**2 / 64 - 5 * e2**3 / 256) * lat
+                   - (3 * e2 / 8 + 3 * e2**2 / 32 + 45 * e2**3 / 1024) * np.sin(2 * lat)
+                   + (15 * e2**2 / 256 + 45 * e2**3 / 1024) * np.sin(4 * lat)
+                   - (35 * e2**3 / 3072) * np.sin(6 * lat))
+    x = k0 * N * (A + (1 - T + C) * A**3 / 6
+                  + (5 - 18 * T + T**2 + 72 * C - 58 * ep2) * A**5 / 120)
+    y = k0 * (M + N * np.tan(lat) * (A**2 / 2 + (5 - T + 9 * C + 4 * C**2) * A**4 / 24
+                                     + (61 - 58 * T + T**2 + 600 * C - 330 * ep2) * A**6 / 720))
+    return x + false_easting, y + false_northing
+
+
+def ProjectLatLons(lats, lons, factory_code):
+    '''Project arrays of WGS84 latitudes and longitudes (decimal degrees) to the
+    coordinate system with the given factory code (WKID). Returns arrays of x
+    and y. Raises ValueError if CanProjectWithNumPy is False for the factory code.'''
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if factory_code == WGS84:
+        return lons, lats
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    if factory_code in WEB_MERCATOR:
+        # Web Mercator uses the spherical formulas with the WGS84 semi-major axis.
+        lat = np.clip(lat, -np.radians(85.0511287798), np.radians(85.0511287798))
+        return WGS84_A * lon, WGS84_A * np.log(np.tan(np.pi / 4 + lat / 2))
+    if factory_code == WORLD_CYLINDRICAL_EQUAL_AREA:
+        # Ellipsoidal cylindrical equal area with the standard parallel at the equator
+        e = np.sqrt(WGS84_E2)
+        sin_lat = np.sin(lat)
+        q = (1 - WGS84_E2) * (sin_lat / (1 - WGS84_E2 * sin_lat**2)
+                              - np.log((1 - e * sin_lat) / (1 + e * sin_lat)) / (2 * e))
+        return WGS84_A * lon, WGS84_A * q / 2
+    if factory_code in UTM_NORTH or factory_code in UTM_SOUTH:
+        zone = factory_code % 100
+        lon0 = np.radians((zone - 1) * 6 - 180 + 3)
+        false_northing = 10000000.0 if factory_code in UTM_SOUTH else 0.0
+        return _transverse_mercator(lat, lon, lon0, 0.9996, 500000.0, false_northing)
+    raise ValueError("Projection %s can't be calculated with NumPy." % str(factory_code))
+
+
+def ProjectLatLonsToSpatialReference(lats, lons, spatial_reference):
+    '''Project arrays of WGS84 latitudes and longitudes to an arcpy spatial
+    reference (or coordinate system string). Returns lists of x and y. Uses
+    ProjectLatLons when possible. Otherwise, the points are projected by arcpy
+    in one batch by writing them to an in-memory feature class and reading them
+    back in the output coordinate system.'''
+    if not isinstance(spatial_reference, arcpy.SpatialReference):
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(spatial_reference)
+        spatial_reference = sr
+    factory_code = spatial_reference.factoryCode
+    if spatial_reference.type == "Geographic" and spatial_reference.name == "GCS_WGS_1984":
+        factory_code = WGS84
+    if CanProjectWithNumPy(factory_code):
+        xs, ys = ProjectLatLons(lats, lons, factory_code)
+        return xs.tolist(), ys.tolist()
+
+    num_points = len(lats)
+    if not num_points:
+        return [], []
+    points = np.zeros(num_points, dtype=[("idx", np.int32), ("X", np.float64), ("Y", np.float64)])
+    points["idx"] = np.arange(num_points)
+    points["X"] = lons
+    points["Y"] = lats
+    tempFC = "in_memory/StopGeometry_Project"
+    arcpy.da.NumPyArrayToFeatureClass(points, tempFC, ("X", "Y"), arcpy.SpatialReference(WGS84))
+    xs = [None] * num_points
+    ys = [None] * num_points
+    with arcpy.da.SearchCursor(tempFC, ["idx", "SHAPE@XY"], spatial_reference=spatial_reference) as cur:
+        for row in cur:
+            xs[row[0]], ys[row[0]] = row[1]
+    arcpy.management.Delete(tempFC)
+    return xs, ys
+
+
+def SegmentCoordinates(segments, stop_xy_dict):
+    '''Look up the end points of stop-to-stop segments. segments is a list of
+    (from_stop, to_stop) pairs, and stop_xy_dict is {stop_id: (x, y)}. Returns
+    (from_xy, to_xy, missing_stops), where from_xy and to_xy are arrays of
+    shape (number of segments, 2) that are NaN for stops missing from
+    stop_xy_dict, and missing_stops is the set of those stop_ids.'''
+    from_xy = np.empty((len(segments), 2), dtype=np.float64)
+    to_xy = np.empty((len(segments), 2), dtype=np.float64)
+    from_xy.fill(np.nan)
+    to_xy.fill(np.nan)
+    missing_stops = set()
+    for i, (from_stop, to_stop) in enumerate(segments):
+        try:
+            from_xy[i] = stop_xy_dict[from_stop]
+        except KeyError:
+            missing_stops.add(from_stop)
+        try:
+            to_xy[i] = stop_xy_dict[to_stop]
+        except KeyError:
+            missing_stops.add(to_stop)
+    return from_xy, to_xy, missing_stops
+
+
+def ValidSegments(from_xy, to_xy, xy_tolerance=0.0):
+    '''Return a boolean array that is True for the segments from
+    SegmentCoordinates that have both end points and a nonzero length. A
+    segment no longer than xy_tolerance, which should be the XY tolerance of
+    the output spatial reference, is treated as zero length, since its end
+    points are snapped together when the line is stored.'''
+    missing = np.isnan(from_xy).any(axis=1) | np.isnan(to_xy).any(axis=1)
+    with np.errstate(invalid="ignore"):
+        zero_length = np.hypot(to_xy[:, 0] - from_xy[:, 0], to_xy[:, 1] - from_xy[:, 1]) <= xy_tolerance
+    return ~(missing | zero_length)
+
+
+def SegmentPolyline(from_xy, to_xy, spatial_reference):
+    '''Return a two-vertex arcpy Polyline from one row of each of the
+    SegmentCoordinates arrays.'''
+    return arcpy.Polyline(arcpy.Array([arcpy.Point(float(from_xy[0]), float(from_xy[1])),
+                                       arcpy.Point(float(to_xy[0]), float(to_xy[1]))]), spatial_reference)
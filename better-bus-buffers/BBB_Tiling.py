@@ -0,0 +1,174 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' BetterBusBuffers - Tiling
+
+Helpers for splitting the Count Trips in Polygon Buffers around Stops Step 1
+analysis into square spatial tiles that can be solved independently, in
+parallel worker processes, and stitched back together.
+
+Each tile is responsible for the part of the analysis area inside its own
+bounds. It solves the service areas of every stop within an overlap margin of
+its bounds, so that every service area that reaches into the tile is present,
+and keeps only the flattened polygons inside its bounds. Polygons in the
+overlap margins are left to the neighboring tiles, so no area is output twice.
+
+The tiling, dispatch, and stitching logic does not depend on arcpy. The geometry
+work is done through a small solver interface (see TileSolver).
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import math
+import multiprocessing
+import operator
+
+
+class Tile(object):
+    '''A tile of the analysis area.
+
+    bounds is the (xmin, ymin, xmax, ymax) of the area the tile is responsible
+    for, or None if a single tile covers the whole analysis area. stop_ids are the
+    stops to solve for the tile (the stops within the overlap margin of its
+    bounds).'''
+
+    def __init__(self, index, bounds, stop_ids):
+        self.index = index
+        self.bounds = bounds
+        self.stop_ids = stop_ids
+
+
+class TileResult(object):
+    '''The flattened polygons for one tile.
+
+    polygons is whatever the solver uses to refer to the tile's polygons (for
+    example, a feature class path). poly_stops is a list of (local_poly_id, stop_id)
+    pairs listing the stops whose service areas cover each polygon, where
+    local_poly_id identifies the polygon within the tile.'''
+
+    def __init__(self, tile_index, polygons, poly_stops):
+        self.tile_index = tile_index
+        self.polygons = polygons
+        self.poly_stops = poly_stops
+
+
+class TileSolver(object):
+    '''Interface for the geometry work done on each tile.
+
+    solve(tile) creates the service areas for the tile's stops, trims them to the
+    tile's bounds (if any), flattens them, and returns a TileResult.
+    merge(results) combines the polygons of all the tiles into the final output
+    and returns a dictionary of {(tile_index, local_poly_id): poly_id} giving the id
+    of each tile polygon in the output.
+
+    solve is called in worker processes when tiles are solved in parallel, so
+    the solver must be picklable.'''
+
+    def solve(self, tile):
+        raise NotImplementedError
+
+    def merge(self, results):
+        raise NotImplementedError
+
+
+def make_tiles(stop_ids, xs, ys, tile_size, margin, x_scales=None):
+    '''Split the stops into square tiles tile_size wide. xs and ys are the stop
+    coordinates in a projected coordinate system, and tile_size and margin are in
+    the same units. x_scales optionally gives, for each stop, how much the
+    projection stretches east-west distances at the stop (1/cos(latitude) for a
+    cylindrical equal area projection), and the margin in the x direction is
+    multiplied by it. The tiles cover the area within margin of any stop. Tiles
+    with no stops within margin of their bounds are left out. If tile_size is
+    empty, a single tile without bounds is returned.'''
+    if not tile_size:
+        return [Tile(0, None, list(stop_ids))]
+    if not len(stop_ids):
+        return []
+    tile_size = float(tile_size)
+    margin = float(margin)
+    if x_scales is None:
+        x_scales = [1.0] * len(stop_ids)
+    x_margins = [margin * x_scale for x_scale in x_scales]
+    x0 = min(x - x_margin for x, x_margin in zip(xs, x_margins))
+    y0 = min(ys) - margin
+    ncols = int(math.floor((max(x + x_margin for x, x_margin in zip(xs, x_margins)) - x0) / tile_size)) + 1
+    nrows = int(math.floor((max(ys) + margin - y0) / tile_size)) + 1
+
+    # Add each stop to every tile whose bounds are within the margin of the stop.
+    buckets = {} # {(row, col): [stop_id]}
+    for stop_id, x, y, x_margin in zip(stop_ids, xs, ys, x_margins):
+        col_min = max(int(math.floor((x - x_margin - x0) / tile_size)), 0)
+        col_max = min(int(math.floor((x + x_margin - x0) / tile_size)), ncols - 1)
+        row_min = max(int(math.floor((y - margin - y0) / tile_size)), 0)
+        row_max = min(int(math.floor((y + margin - y0) / tile_size)), nrows - 1)
+        for row in range(row_min, row_max + 1):
+            for col in range(col_min, col_max + 1):
+                buckets.setdefault((row, col), []).append(stop_id)
+
+    tiles = []
+    for row, col in sorted(buckets):
+        bounds = (x0 + col * tile_size, y0 + row * tile_size,
+                  x0 + (col + 1) * tile_size, y0 + (row + 1) * tile_size)
+        tiles.append(Tile(len(tiles), bounds, buckets[(row, col)]))
+    return tiles
+
+
+def _solve_tile(args):
+    '''Solve one tile. Module-level so it can be sent to worker processes.'''
+    solver, tile = args
+    return solver.solve(tile)
+
+
+def solve_tiles(solver, tiles, num_workers=1, on_result=None):
+    '''Solve each tile with the solver, using up to num_workers worker processes.
+    on_result(result) is called as each tile finishes. Returns the TileResults in
+    tile order.'''
+    results = []
+    if num_workers > 1 and len(tiles) > 1:
+        pool = multiprocessing.Pool(min(num_workers, len(tiles)))
+        try:
+            for result in pool.imap_unordered(_solve_tile, [(solver, tile) for tile in tiles]):
+                results.append(result)
+                if on_result:
+                    on_result(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for tile in tiles:
+            result = solver.solve(tile)
+            results.append(result)
+            if on_result:
+                on_result(result)
+    results.sort(key=operator.attrgetter("tile_index"))
+    return results
+
+
+def stitch(solver, results):
+    '''Merge the tiles' polygons with the solver and translate each tile's
+    polygon-stop pairs to the ids of the merged polygons. Returns a sorted list of
+    unique (poly_id, stop_id) pairs and a sorted list of the ids of merged polygons
+    not covered by any stop's service area.'''
+    polyids = solver.merge(results)
+    pairs = set()
+    for result in results:
+        for local_poly_id, stop_id in result.poly_stops:
+            poly_id = polyids.get((result.tile_index, local_poly_id))
+            if poly_id is not None and stop_id:
+                pairs.add((poly_id, stop_id))
+    covered = set(pair[0] for pair in pairs)
+    uncovered = sorted(poly_id for poly_id in polyids.values() if poly_id not in covered)
+    return sorted(pairs), uncovered
@@ -36,14 +36,17 @@ used as input by all the BetterBusBuffers tools.
 import arcpy
 import sqlize_csv
 import BBB_SharedFunctions
+import BBB_Instrumentation
 
 
-def runTool(inGTFSdir, SQLDbase):
+@BBB_Instrumentation.Profiled("Preprocess GTFS")
+def runTool(inGTFSdir, SQLDbase, CreateStopVisits=True):
     try:
 
         BBB_SharedFunctions.CheckArcVersion(min_version_pro="1.2")
 
         #----- SQLize the GTFS data-----
+        BBB_Instrumentation.StartPhase("SQLize")
         arcpy.AddMessage("SQLizing the GTFS data...")
         arcpy.AddMessage("(This will take a while for large datasets.)")
 
@@ -72,8 +75,19 @@ def runTool(inGTFSdir, SQLDbase):
             sqlize_csv.handle_agency(gtfs_dir)
 
         # Create indices to make queries faster.
+        BBB_Instrumentation.StartPhase("Indices")
         sqlize_csv.create_indices()
 
+        # Derive route patterns so stops served by each route can be looked up directly.
+        sqlize_csv.create_patterns()
+
+        # Materialize the stop visits with their service_ids so the tools can
+        # read all the stop visits in a time window without looking up each trip.
+        if CreateStopVisits:
+            BBB_Instrumentation.StartPhase("Stop visits")
+            arcpy.AddMessage("Creating stop visits table...")
+            sqlize_csv.create_stop_visits()
+
         # Check for non-overlapping date ranges to prevent double-counting.
         overlapwarning = sqlize_csv.check_nonoverlapping_dateranges()
         if overlapwarning:
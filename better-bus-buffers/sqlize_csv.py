@@ -36,10 +36,10 @@ import os
 import re
 import sqlite3
 import sys
-import arcpy
 
 import hms
 import BBB_SharedFunctions
+import BBB_Instrumentation
 
 ispy3 = sys.version_info >= (3, 0)
 
@@ -130,7 +130,7 @@ db = None
 
 def connect(dbname):
     global db
-    db = sqlite3.connect(dbname)
+    db = BBB_Instrumentation.connect(dbname)
 
 
 def check_time_str(s):
@@ -176,7 +176,7 @@ def make_remove_extra_fields(tablename, columns):
         # Check that row was the correct length in the first place.
         if len(out_row) != orig_num_fields:
             msg = "GTFS table %s contains at least one row with the wrong number of fields. Fields: %s; Row: %s" % (tablename, columns, str(in_row))
-            arcpy.AddError(msg)
+            BBB_SharedFunctions.AddError(msg)
             raise BBB_SharedFunctions.CustomError
         # Remove the row entries for the extraneous columns
         for idx in cols:
@@ -191,7 +191,7 @@ def check_for_required_fields(tablename, columns, dataset):
         if sql_schema[tablename][col][1] == True:
             if not col in columns:
                 msg = "GTFS file " + tablename + ".txt in dataset " + dataset + " is missing required field '" + col + "'. Failed to SQLize GTFS data"
-                arcpy.AddError(msg)
+                BBB_SharedFunctions.AddError(msg)
                 raise BBB_SharedFunctions.CustomError
 
 
@@ -212,14 +212,14 @@ values for arrival_time or departure_time in stop_times.txt.  Although the \
 GTFS spec allows empty values for these fields, this toolbox \
 requires exact time values for all stops.  You will not be able to use this \
 dataset for your analysis."
-                arcpy.AddError(msg)
+                BBB_SharedFunctions.AddError(msg)
                 raise BBB_SharedFunctions.CustomError
             else:
                 try:
                     out_row[idx] = float (field)
                 except ValueError:
                     msg = 'Column "' + col_names[idx] + '" in file ' + os.path.join(GTFSdir, fname) + ' has an invalid value: ' + field + '.'
-                    arcpy.AddError(msg)
+                    BBB_SharedFunctions.AddError(msg)
                     raise BBB_SharedFunctions.CustomError
         return out_row
     if ispy3:
@@ -243,7 +243,7 @@ def check_date_fields(rows, col_names, tablename, fname):
             except ValueError:
                 msg ='Column "' + col_names[idx] + '" in file ' + fname + ' has an invalid value: ' + date + '. \
 Date fields must be in YYYYMMDD format. Please check the date field formatting in calendar.txt and calendar_dates.txt.'
-                arcpy.AddError(msg)
+                BBB_SharedFunctions.AddError(msg)
                 raise BBB_SharedFunctions.CustomError
         return row
     if ispy3:
@@ -264,7 +264,7 @@ def check_latlon_fields(rows, col_names, fname):
             msg = 'stop_id "%s" in %s contains an invalid non-numerical value \
 for the stop_lat field: "%s". Please double-check all lat/lon values in your \
 stops.txt file.' % (stop_id, fname, stop_lat)
-            arcpy.AddError(msg)
+            BBB_SharedFunctions.AddError(msg)
             raise BBB_SharedFunctions.CustomError
         try:
             stop_lon_float = float(stop_lon)
@@ -272,21 +272,21 @@ stops.txt file.' % (stop_id, fname, stop_lat)
             msg = 'stop_id "%s" in %s contains an invalid non-numerical value \
 for the stop_lon field: "%s". Please double-check all lat/lon values in your \
 stops.txt file.' % (stop_id, fname, stop_lon)
-            arcpy.AddError(msg)
+            BBB_SharedFunctions.AddError(msg)
             raise BBB_SharedFunctions.CustomError
         if not (-90.0 <= stop_lat_float <= 90.0):
             msg = 'stop_id "%s" in %s contains an invalid value outside the \
 range (-90, 90) the stop_lat field: "%s". stop_lat values must be in valid WGS 84 \
 coordinates.  Please double-check all lat/lon values in your stops.txt file.\
 ' % (stop_id, fname, stop_lat)
-            arcpy.AddError(msg)
+            BBB_SharedFunctions.AddError(msg)
             raise BBB_SharedFunctions.CustomError
         if not (-180.0 <= stop_lon_float <= 180.0):
             msg = 'stop_id "%s" in %s contains an invalid value outside the \
 range (-180, 180) the stop_lon field: "%s". stop_lon values must be in valid WGS 84 \
 coordinates.  Please double-check all lat/lon values in your stops.txt file.\
 ' % (stop_id, fname, stop_lon)
-            arcpy.AddError(msg)
+            BBB_SharedFunctions.AddError(msg)
             raise BBB_SharedFunctions.CustomError
         return row
     if ispy3:
@@ -417,7 +417,7 @@ def handle_agency(gtfs_dir):
         if not has_a_calendar:
             missing_files.append("calendar.txt or calendar_dates.txt")
         if missing_files:
-            arcpy.AddError(u"GTFS dataset %s is missing files required for \
+            BBB_SharedFunctions.AddError(u"GTFS dataset %s is missing files required for \
 this tool: %s" % (label, str(missing_files)))
             raise BBB_SharedFunctions.CustomError
 
@@ -426,7 +426,7 @@ this tool: %s" % (label, str(missing_files)))
             handle_file(fname2, label)
 
     except UnicodeDecodeError:
-        arcpy.AddError(u"Unicode decoding of GTFS dataset %s failed. Please \
+        BBB_SharedFunctions.AddError(u"Unicode decoding of GTFS dataset %s failed. Please \
 ensure that your GTFS files have the proper utf-8 encoding required by the GTFS \
 specification." % label)
         raise BBB_SharedFunctions.CustomError
@@ -444,9 +444,109 @@ def create_indices():
     cur.execute("CREATE INDEX stopTimes_index_tripIdsSeq ON stop_times (trip_id, stop_sequence);")
     cur.execute("CREATE INDEX calendar_index_serviceIds ON calendar (service_id);")
     cur.execute("CREATE INDEX calendardates_index_date ON calendar_dates (date);")
+    cur.execute("CREATE INDEX routes_index_routeIDs ON routes (route_id);")
     db.commit()
     cur.close()
 
+def create_patterns():
+    '''Derive the route patterns (unique ordered sequences of stops used by the
+    trips of each route and direction) from stop_times in a single ordered pass.
+    Writes the patterns, pattern_stops, and trip_pattern tables so that questions
+    like "which stops does route X serve in direction Y" are indexed lookups.
+    Must be run after create_indices.'''
+
+    cur = db.cursor()
+    cur.execute("DROP TABLE IF EXISTS patterns;")
+    cur.execute("DROP TABLE IF EXISTS pattern_stops;")
+    cur.execute("DROP TABLE IF EXISTS trip_pattern;")
+    cur.execute("CREATE TABLE patterns (pattern_id INTEGER PRIMARY KEY, route_id TEXT, direction_id INTEGER, num_stops INTEGER, trip_count INTEGER);")
+    cur.execute("CREATE TABLE pattern_stops (pattern_id INTEGER, stop_order INTEGER, stop_id TEXT);")
+    cur.execute("CREATE TABLE trip_pattern (trip_id TEXT, pattern_id INTEGER);")
+
+    # {trip_id: (route_id, direction_id)}
+    trip_route_dict = {}
+    cur.execute("SELECT trip_id, route_id, direction_id FROM trips;")
+    for trip in cur:
+        trip_route_dict[trip[0]] = (trip[1], trip[2])
+
+    # {(route_id, direction_id, (stop_id, stop_id, ...)): pattern_id}
+    pattern_dict = {}
+    trip_counts = {}
+    trip_pattern_rows = []
+    # Walk through stop_times once in trip and stop_sequence order. This uses the
+    # stopTimes_index_tripIdsSeq index, so no sorting is required.
+    stoptimesfetch = '''
+        SELECT trip_id, stop_id FROM stop_times
+        ORDER BY trip_id, stop_sequence
+        ;'''
+    cur.execute(stoptimesfetch)
+    for trip_id, stops in itertools.groupby(cur, key=lambda st: st[0]):
+        try:
+            route_id, direction_id = trip_route_dict[trip_id]
+        except KeyError:
+            # stop_times entry for a trip that isn't in trips.txt
+            continue
+        pattern_key = (route_id, direction_id, tuple(stop[1] for stop in stops))
+        pattern_id = pattern_dict.setdefault(pattern_key, len(pattern_dict) + 1)
+        trip_counts[pattern_id] = trip_counts.get(pattern_id, 0) + 1
+        trip_pattern_rows.append((trip_id, pattern_id))
+
+    pattern_rows = []
+    pattern_stop_rows = []
+    for pattern_key, pattern_id in pattern_dict.items():
+        route_id, direction_id, stops = pattern_key
+        pattern_rows.append((pattern_id, route_id, direction_id, len(stops), trip_counts[pattern_id]))
+        pattern_stop_rows += [(pattern_id, idx, stop_id) for idx, stop_id in enumerate(stops)]
+
+    cur.executemany("INSERT INTO patterns (pattern_id, route_id, direction_id, num_stops, trip_count) VALUES (?, ?, ?, ?, ?);", pattern_rows)
+    cur.executemany("INSERT INTO pattern_stops (pattern_id, stop_order, stop_id) VALUES (?, ?, ?);", pattern_stop_rows)
+    cur.executemany("INSERT INTO trip_pattern (trip_id, pattern_id) VALUES (?, ?);", trip_pattern_rows)
+    cur.execute("CREATE INDEX patterns_index_routeIDs ON patterns (route_id, direction_id);")
+    cur.execute("CREATE INDEX patternStops_index_patternIDs ON pattern_stops (pattern_id, stop_order);")
+    cur.execute("CREATE INDEX tripPattern_index_tripIDs ON trip_pattern (trip_id);")
+    cur.execute("CREATE INDEX tripPattern_index_patternIDs ON trip_pattern (pattern_id);")
+    db.commit()
+    cur.close()
+
+def create_stop_visits():
+    '''Materialize the stop_visits table: one row per stop_times record, with the
+    trip's service_id, route_id, and direction_id copied in from trips. The table
+    is clustered (WITHOUT ROWID) on service_id and departure_time, with a covering
+    index on service_id and arrival_time, so all the stop visits of a service_id
+    in a time window are read in one index range scan with no join. A second
+    covering index on service_id and stop_id reads a service_id's stop visits in
+    stop_id order for low memory mode. Returns
+    False, and creates nothing, if the SQLite version is too old for WITHOUT
+    ROWID tables. Must be run after create_indices.'''
+
+    if sqlite3.sqlite_version_info < (3, 8, 2):
+        BBB_SharedFunctions.AddWarning("The stop_visits table was not created because it requires \
+SQLite 3.8.2 or later, and this installation of Python uses SQLite %s. The BetterBusBuffers \
+tools will still work, but they will run slower." % sqlite3.sqlite_version)
+        return False
+
+    cur = db.cursor()
+    cur.execute("DROP TABLE IF EXISTS stop_visits;")
+    cur.execute('''CREATE TABLE stop_visits (service_id TEXT, departure_time REAL, arrival_time REAL,
+                   stop_id TEXT, trip_id TEXT, route_id TEXT, direction_id INTEGER, stop_sequence INTEGER,
+                   PRIMARY KEY (service_id, departure_time, trip_id, stop_sequence)) WITHOUT ROWID;''')
+    # A trip that repeats a stop_sequence is invalid GTFS. Only its first stop
+    # visit with that stop_sequence is kept.
+    stopvisitsinsert = '''
+        INSERT OR IGNORE INTO stop_visits (service_id, departure_time, arrival_time, stop_id, trip_id,
+                                           route_id, direction_id, stop_sequence)
+        SELECT trips.service_id, stop_times.departure_time, stop_times.arrival_time, stop_times.stop_id,
+               stop_times.trip_id, trips.route_id, trips.direction_id, stop_times.stop_sequence
+        FROM trips JOIN stop_times ON stop_times.trip_id = trips.trip_id
+        ;'''
+    cur.execute(stopvisitsinsert)
+    cur.execute("CREATE INDEX stopVisits_index_serviceIdsArr ON stop_visits (service_id, arrival_time, stop_id);")
+    cur.execute("CREATE INDEX %s ON stop_visits (service_id, stop_id, arrival_time);" %
+                BBB_SharedFunctions.StopVisitsByStopIndexName)
+    db.commit()
+    cur.close()
+    return True
+
 def metadata():
     db.execute("DROP TABLE IF EXISTS metadata;")
     db.execute("CREATE TABLE metadata (key TEXT, value TEXT);")
@@ -0,0 +1,135 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for BBB_ChunkScheduler, run against a fake OD service.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_ChunkScheduler
+
+
+class FakeJob(object):
+    def __init__(self, index, origins, destinations, polls_to_finish, fail):
+        self.index = index
+        self.origins = origins
+        self.destinations = destinations
+        self.polls_left = polls_to_finish
+        self.fail = fail
+
+
+class FakeODService(BBB_ChunkScheduler.ODService):
+    '''Finishes job i after durations[i] status polls. The results of a chunk
+    are its (origin, destination) pairs. Jobs in fail_jobs raise when
+    collected.'''
+
+    def __init__(self, durations, fail_jobs=()):
+        self.durations = durations
+        self.fail_jobs = fail_jobs
+        self.jobs = []
+        self.running = 0
+        self.max_running = 0
+        self.cancelled = []
+
+    def submit(self, origins, destinations):
+        index = len(self.jobs)
+        job = FakeJob(index, origins, destinations, self.durations[index], index in self.fail_jobs)
+        self.jobs.append(job)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        return job
+
+    def status(self, job):
+        if job.polls_left > 0:
+            job.polls_left -= 1
+            return BBB_ChunkScheduler.SUCCEEDED - 1
+        return BBB_ChunkScheduler.SUCCEEDED
+
+    def collect(self, job):
+        self.running -= 1
+        if job.fail:
+            raise RuntimeError("Job %i failed" % job.index)
+        return [(o, d) for o in job.origins for d in job.destinations]
+
+    def cancel(self, job):
+        self.running -= 1
+        self.cancelled.append(job.index)
+
+
+class TestMakeChunks(unittest.TestCase):
+
+    def test_sorted_chunks(self):
+        self.assertEqual(BBB_ChunkScheduler.make_chunks([5, 1, 4, 2, 3], 2), [[1, 2], [3, 4], [5]])
+
+    def test_empty(self):
+        self.assertEqual(BBB_ChunkScheduler.make_chunks([], 10), [])
+
+
+class TestChunkScheduler(unittest.TestCase):
+
+    def run_scheduler(self, service, chunks, max_in_flight):
+        sleeps = []
+        results = []
+        scheduler = BBB_ChunkScheduler.ChunkScheduler(service, max_in_flight, poll_interval=1,
+                                                      max_poll_interval=4, sleep=sleeps.append)
+        scheduler.run(chunks, lambda index, result: results.append((index, result)))
+        return results, sleeps
+
+    def test_every_chunk_solved_once(self):
+        chunks = [([i], ["d%i" % i]) for i in range(7)]
+        service = FakeODService([3, 0, 2, 5, 1, 0, 4])
+        results, sleeps = self.run_scheduler(service, chunks, 3)
+        self.assertEqual(sorted(index for index, result in results), list(range(7)))
+        for index, result in results:
+            self.assertEqual(result, [(index, "d%i" % index)])
+        # Chunks are submitted in order
+        self.assertEqual([job.origins for job in service.jobs], [[i] for i in range(7)])
+
+    def test_max_in_flight(self):
+        service = FakeODService([2] * 10)
+        self.run_scheduler(service, [([i], [i]) for i in range(10)], 4)
+        self.assertEqual(service.max_running, 4)
+        self.assertEqual(service.running, 0)
+
+    def test_results_in_finish_order(self):
+        service = FakeODService([5, 0, 0])
+        results, sleeps = self.run_scheduler(service, [([i], [i]) for i in range(3)], 3)
+        self.assertEqual([index for index, result in results], [1, 2, 0])
+
+    def test_poll_backoff(self):
+        # Nothing finishes for five polls: the interval doubles up to the maximum.
+        service = FakeODService([5])
+        results, sleeps = self.run_scheduler(service, [([0], [0])], 1)
+        self.assertEqual(sleeps, [1, 2, 4, 4, 4])
+
+    def test_error_cancels_running_jobs(self):
+        service = FakeODService([0, 3, 3], fail_jobs=(0,))
+        with self.assertRaises(RuntimeError):
+            self.run_scheduler(service, [([i], [i]) for i in range(3)], 3)
+        self.assertEqual(sorted(service.cancelled), [1, 2])
+        self.assertEqual(service.running, 0)
+
+    def test_max_in_flight_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            BBB_ChunkScheduler.ChunkScheduler(FakeODService([]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for BBB_Instrumentation.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_Instrumentation
+
+
+class TestInstrumentedCursor(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.orig_env = os.environ.get(BBB_Instrumentation.ENV_VAR)
+        os.environ[BBB_Instrumentation.ENV_VAR] = self.folder
+
+    def tearDown(self):
+        if self.orig_env is None:
+            del os.environ[BBB_Instrumentation.ENV_VAR]
+        else:
+            os.environ[BBB_Instrumentation.ENV_VAR] = self.orig_env
+        shutil.rmtree(self.folder)
+
+    def test_counters_from_threads(self):
+        BBB_Instrumentation.StartRun("Threads")
+        conn = BBB_Instrumentation.connect(":memory:", check_same_thread=False)
+
+        def query():
+            c = conn.cursor()
+            for i in range(500):
+                c.execute("SELECT 1;").fetchall()
+
+        threads = [threading.Thread(target=query) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        conn.close()
+        with open(BBB_Instrumentation.EndRun()) as f:
+            sql = json.load(f)["phases"][0]["sql"]
+        self.assertEqual(sql["statements"], 2000)
+        self.assertEqual(sql["rows_fetched"], 2000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for low memory mode in BBB_SharedFunctions, run against the synthetic
+GTFS database built by BBB_QueryPlans.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_QueryPlans
+import BBB_SharedFunctions
+
+# Time windows (start, end) in seconds. The trips run from 5:00 until after midnight,
+# so early windows include yesterday's trips and late windows tomorrow's.
+TimeWindows = [(25200, 32400), (1800, 7200), (82800, 90000), (0, 86400)]
+
+
+class TestLowMemoryMode(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.SQLDbase = os.path.join(cls.folder, "GTFS.sql")
+        BBB_QueryPlans.BuildTestDatabase(cls.SQLDbase, num_trips=300).close()
+        cls.gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(cls.SQLDbase)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gtfs.close()
+        shutil.rmtree(cls.folder)
+
+    def sorted_visits(self, stoptimes):
+        return dict((stop_id, sorted(stoptimelist)) for stop_id, stoptimelist in stoptimes)
+
+    def test_matches_stop_visits_dictionary(self):
+        for day in ["Monday", "Saturday"]:
+            for start_sec, end_sec in TimeWindows:
+                for DepOrArr in ["departure_time", "arrival_time"]:
+                    expected = BBB_SharedFunctions.CountStopVisits(self.gtfs, day, start_sec, end_sec, DepOrArr)
+                    streamed = list(BBB_SharedFunctions.IterStopTimesByStop(self.gtfs, day, start_sec, end_sec, DepOrArr))
+                    # Each stop is yielded once, in stop_id order.
+                    stop_ids = [stop_id for stop_id, stoptimelist in streamed]
+                    self.assertEqual(stop_ids, sorted(set(stop_ids)))
+                    self.assertEqual(self.sorted_visits(streamed), self.sorted_visits(expected.items()))
+
+    def test_windows_include_other_days(self):
+        # The frequency-based trip t0 runs from 7:00 to 9:00, and trips after 19:00
+        # run past midnight.
+        visits = dict(BBB_SharedFunctions.IterStopTimesByStop(self.gtfs, "Monday", 1800, 7200, "departure_time"))
+        self.assertTrue(visits)
+        visits = dict(BBB_SharedFunctions.IterStopTimesByStop(self.gtfs, "Monday", 25200, 32400, "departure_time"))
+        self.assertTrue(any(trip.startswith("t0_") for stoptimelist in visits.values() for trip, stop_time in stoptimelist))
+
+    def test_stop_visit_arrays(self):
+        arrays = BBB_SharedFunctions.CountTripsAtStops(self.gtfs, "Monday", 25200, 32400, "departure_time", LowMemory=True)
+        self.assertIsInstance(arrays, BBB_SharedFunctions.StopVisitArrays)
+        expected = BBB_SharedFunctions.CountTripsAtStops(self.gtfs, "Monday", 25200, 32400, "departure_time")
+        self.assertEqual(sorted(arrays.keys()), sorted(expected))
+        for stop_id in expected:
+            self.assertEqual(sorted(arrays[stop_id]), sorted(expected[stop_id]))
+
+    def test_requires_stop_visits_index(self):
+        path = os.path.join(self.folder, "NoIndex.sql")
+        shutil.copyfile(self.SQLDbase, path)
+        gtfs = BBB_SharedFunctions.ConnectToSQLDatabase(path)
+        try:
+            gtfs.conn.execute("DROP INDEX %s;" % BBB_SharedFunctions.StopVisitsByStopIndexName)
+            with self.assertRaises(BBB_SharedFunctions.CustomError):
+                BBB_SharedFunctions.CountTripsAtStops(gtfs, "Monday", 25200, 32400, "departure_time", LowMemory=True)
+        finally:
+            gtfs.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
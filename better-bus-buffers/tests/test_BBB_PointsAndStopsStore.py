@@ -0,0 +1,79 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for BBB_PointsAndStopsStore.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_PointsAndStopsStore
+
+
+class TestPointsAndStopsStore(unittest.TestCase):
+
+    def setUp(self):
+        # Point i reaches stops s0 ... s(i % 5), and point 7 reaches none.
+        self.expected = {}
+        pairs = []
+        for point in range(50):
+            if point == 7:
+                continue
+            stops = ["s%i" % i for i in range(point % 5 + 1)]
+            self.expected[point] = stops
+            pairs += [(str(point), stop) for stop in stops]
+        random.Random(0).shuffle(pairs)
+        # The chunks are smaller than the pairs of some runs of points
+        self.store = BBB_PointsAndStopsStore.PointsAndStopsStore(point_key=int, chunk_size=4)
+        self.store.add_pairs(pairs + [(None, "s0")])
+
+    def tearDown(self):
+        path = self.store.path
+        self.store.close()
+        self.assertFalse(os.path.exists(path))
+
+    def check(self, get, points):
+        for point in points:
+            self.assertEqual(sorted(get(point)), self.expected.get(point, []))
+
+    def test_get_in_sorted_order(self):
+        self.check(self.store.get, range(60))
+
+    def test_get_out_of_order(self):
+        points = list(range(60))
+        random.Random(1).shuffle(points)
+        self.check(self.store.get, points)
+
+    def test_lookup(self):
+        points = list(range(60))
+        random.Random(2).shuffle(points)
+        self.check(self.store.lookup, points)
+
+    def test_point_key_applied(self):
+        self.assertEqual(self.store.get("12"), self.store.get(12))
+        self.assertEqual(self.store.lookup("12"), self.store.get(12))
+
+    def test_no_point(self):
+        self.assertEqual(self.store.get(None), [])
+        self.assertEqual(self.store.lookup(None), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for BBB_QueryPlans, run against its synthetic GTFS SQL database.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_QueryPlans
+import BBB_SharedFunctions
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = BBB_QueryPlans.BuildTestDatabase()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_queries_use_indices(self):
+        failures = [(name, problems) for name, plan, problems in BBB_QueryPlans.CheckQueryPlans(self.conn)
+                    if problems]
+        self.assertEqual(failures, [])
+
+    def test_every_statement_registered(self):
+        # Module-level *Fetch constants are the queries the tools run for
+        # every date, service_id, or trip.
+        names = set(name.split(" (")[0] for name, sql, params in BBB_QueryPlans.HotQueries())
+        fetches = set(name for name in dir(BBB_SharedFunctions) if name.endswith("Fetch"))
+        self.assertTrue(fetches)
+        self.assertEqual(sorted(fetches - names), [])
+
+    def test_stop_visits_optional(self):
+        self.conn.execute("DROP TABLE stop_visits;")
+        names = [name for name, plan, problems in BBB_QueryPlans.CheckQueryPlans(self.conn)]
+        self.assertTrue(names)
+        self.assertFalse([name for name in names if name.startswith("StopVisits") or "ByStop" in name])
+
+    def test_scan_is_a_problem(self):
+        plan = BBB_QueryPlans.GetQueryPlan(self.conn, "SELECT * FROM stops WHERE stop_name=?", ("Stop 1",))
+        self.assertTrue(BBB_QueryPlans.FindPlanProblems(plan))
+
+    def test_sort_is_a_problem(self):
+        plan = BBB_QueryPlans.GetQueryPlan(self.conn, "SELECT * FROM stop_times WHERE trip_id=? ORDER BY stop_id",
+                                           ("t0",))
+        self.assertTrue([problem for problem in BBB_QueryPlans.FindPlanProblems(plan) if "B-tree" in problem])
+
+    def test_missing_index_fails(self):
+        index = [row[0] for row in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='stop_times';")]
+        self.assertTrue(index)
+        for name in index:
+            self.conn.execute("DROP INDEX %s;" % name)
+        failures = [name for name, plan, problems in BBB_QueryPlans.CheckQueryPlans(self.conn) if problems]
+        self.assertTrue([name for name in failures if name.startswith("StopTimesFetch")])
+
+
+if __name__ == "__main__":
+    unittest.main()
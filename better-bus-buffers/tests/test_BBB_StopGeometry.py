@@ -0,0 +1,54 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for the stop-to-stop segment helpers in BBB_StopGeometry.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_StopGeometry
+
+# The default XY tolerance of WGS84, in degrees
+WGS84_XY_TOLERANCE = 8.983152841195215e-09
+
+
+class TestValidSegments(unittest.TestCase):
+
+    def setUp(self):
+        stop_xy_dict = {"a": (-117.0, 34.0),
+                        "near": (-117.0 + WGS84_XY_TOLERANCE / 2, 34.0),
+                        "far": (-117.001, 34.001)}
+        segments = [("a", "far"), ("a", "near"), ("a", "a"), ("a", "missing")]
+        self.from_xy, self.to_xy, self.missing = BBB_StopGeometry.SegmentCoordinates(segments, stop_xy_dict)
+
+    def test_missing_stops(self):
+        self.assertEqual(self.missing, set(["missing"]))
+
+    def test_exact_zero_length(self):
+        valid = BBB_StopGeometry.ValidSegments(self.from_xy, self.to_xy)
+        self.assertEqual(valid.tolist(), [True, True, False, False])
+
+    def test_shorter_than_tolerance(self):
+        valid = BBB_StopGeometry.ValidSegments(self.from_xy, self.to_xy, WGS84_XY_TOLERANCE)
+        self.assertEqual(valid.tolist(), [True, False, False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for BBB_Tiling, run with a fake solver on a grid of unit cells.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import math
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_Tiling
+
+
+class FakeTileSolver(BBB_Tiling.TileSolver):
+    '''The analysis area is a grid of unit cells, and each cell is a polygon. A
+    stop's service area is the square of cells whose centers are within radius of
+    the stop in x and y. A tile keeps the cells whose centers are inside its
+    bounds. Module-level so it can be sent to worker processes.'''
+
+    def __init__(self, stops, radius, fail_tile=None):
+        self.stops = stops # {stop_id: (x, y)}
+        self.radius = radius
+        self.fail_tile = fail_tile
+
+    def covered_cells(self, stop_ids):
+        '''Return {cell: set of stop_ids covering it}.'''
+        cells = {}
+        for stop_id in stop_ids:
+            x, y = self.stops[stop_id]
+            for cx in range(int(math.floor(x - self.radius)) - 1, int(math.ceil(x + self.radius)) + 1):
+                for cy in range(int(math.floor(y - self.radius)) - 1, int(math.ceil(y + self.radius)) + 1):
+                    if abs(cx + 0.5 - x) <= self.radius and abs(cy + 0.5 - y) <= self.radius:
+                        cells.setdefault((cx, cy), set()).add(stop_id)
+        return cells
+
+    def solve(self, tile):
+        if tile.index == self.fail_tile:
+            raise RuntimeError("Tile %i failed" % tile.index)
+        cells = self.covered_cells(tile.stop_ids)
+        if tile.bounds:
+            xmin, ymin, xmax, ymax = tile.bounds
+            cells = dict((cell, stop_ids) for cell, stop_ids in cells.items()
+                         if xmin <= cell[0] + 0.5 < xmax and ymin <= cell[1] + 0.5 < ymax)
+        polygons = sorted(cells)
+        poly_stops = [(local_id, stop_id) for local_id, cell in enumerate(polygons)
+                      for stop_id in sorted(cells[cell])]
+        return BBB_Tiling.TileResult(tile.index, polygons, poly_stops)
+
+    def merge(self, results):
+        self.merged = []
+        polyids = {}
+        for result in results:
+            for local_id, cell in enumerate(result.polygons):
+                polyids[(result.tile_index, local_id)] = len(self.merged)
+                self.merged.append(cell)
+        return polyids
+
+
+class TestMakeTiles(unittest.TestCase):
+
+    def test_single_tile(self):
+        tiles = BBB_Tiling.make_tiles([1, 2], [0, 100], [0, 100], None, 10)
+        self.assertEqual(len(tiles), 1)
+        self.assertIsNone(tiles[0].bounds)
+        self.assertEqual(tiles[0].stop_ids, [1, 2])
+
+    def test_no_stops(self):
+        self.assertEqual(BBB_Tiling.make_tiles([], [], [], 10, 1), [])
+
+    def test_stops_in_overlap_margin(self):
+        # Tiles are 10 wide starting at x = -2. The stop at x = 7 is within 2 of the
+        # tile edge at x = 8, so it's in both tiles.
+        tiles = BBB_Tiling.make_tiles(["a", "b"], [0, 7], [0, 0], 10, 2)
+        self.assertEqual([tile.bounds for tile in tiles], [(-2, -2, 8, 8), (8, -2, 18, 8)])
+        self.assertEqual([tile.stop_ids for tile in tiles], [["a", "b"], ["b"]])
+        self.assertEqual([tile.index for tile in tiles], [0, 1])
+
+    def test_x_scales_widen_margin(self):
+        # With an x scale of 2, the margin of stop b in x is 4, so it reaches back into the tile at x < 8.
+        stop_ids = ["a", "b"]
+        xs = [0, 11]
+        tiles = BBB_Tiling.make_tiles(stop_ids, xs, [0, 0], 10, 2)
+        self.assertEqual([tile.stop_ids for tile in tiles], [["a"], ["b"]])
+        tiles = BBB_Tiling.make_tiles(stop_ids, xs, [0, 0], 10, 2, [1.0, 2.0])
+        self.assertEqual([tile.stop_ids for tile in tiles], [["a", "b"], ["b"]])
+
+
+class TestSolveAndStitch(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.stops = dict(("s%i" % i, (rand.uniform(0, 40), rand.uniform(0, 30))) for i in range(40))
+        self.radius = 3
+
+    def expected(self):
+        '''The pairs of (cell, stop_id) solved without tiles.'''
+        cells = FakeTileSolver(self.stops, self.radius).covered_cells(self.stops)
+        return sorted((cell, stop_id) for cell, stop_ids in cells.items() for stop_id in stop_ids)
+
+    def solve(self, tile_size, num_workers=1):
+        stop_ids = sorted(self.stops)
+        tiles = BBB_Tiling.make_tiles(stop_ids, [self.stops[s][0] for s in stop_ids],
+                                      [self.stops[s][1] for s in stop_ids], tile_size, self.radius + 1)
+        solver = FakeTileSolver(self.stops, self.radius)
+        finished = []
+        results = BBB_Tiling.solve_tiles(solver, tiles, num_workers, finished.append)
+        self.assertEqual(sorted(result.tile_index for result in finished), list(range(len(tiles))))
+        self.assertEqual([result.tile_index for result in results], list(range(len(tiles))))
+        pairs, uncovered = BBB_Tiling.stitch(solver, results)
+        # Every merged polygon is output once.
+        self.assertEqual(len(solver.merged), len(set(solver.merged)))
+        self.assertEqual(uncovered, [])
+        return tiles, sorted((solver.merged[poly_id], stop_id) for poly_id, stop_id in pairs)
+
+    def test_single_tile(self):
+        tiles, pairs = self.solve(None)
+        self.assertEqual(len(tiles), 1)
+        self.assertEqual(pairs, self.expected())
+
+    def test_tiles_match_single_tile(self):
+        for tile_size in [5, 7.5, 13, 100]:
+            tiles, pairs = self.solve(tile_size)
+            self.assertEqual(pairs, self.expected())
+        self.assertGreater(len(self.solve(5)[0]), 1)
+
+    def test_parallel(self):
+        tiles, pairs = self.solve(10, num_workers=2)
+        self.assertGreater(len(tiles), 1)
+        self.assertEqual(pairs, self.expected())
+
+    def test_uncovered_polygons(self):
+        solver = FakeTileSolver(self.stops, self.radius)
+        results = [BBB_Tiling.TileResult(0, ["p0", "p1", "p2"], [(0, "s0"), (2, "s1"), (2, None)])]
+        pairs, uncovered = BBB_Tiling.stitch(solver, results)
+        self.assertEqual(pairs, [(0, "s0"), (2, "s1")])
+        self.assertEqual(uncovered, [1])
+
+    def test_error_propagates(self):
+        stop_ids = sorted(self.stops)
+        tiles = BBB_Tiling.make_tiles(stop_ids, [self.stops[s][0] for s in stop_ids],
+                                      [self.stops[s][1] for s in stop_ids], 10, self.radius + 1)
+        for num_workers in [1, 2]:
+            with self.assertRaises(RuntimeError):
+                BBB_Tiling.solve_tiles(FakeTileSolver(self.stops, self.radius, fail_tile=1), tiles, num_workers)
+
+
+if __name__ == "__main__":
+    unittest.main()
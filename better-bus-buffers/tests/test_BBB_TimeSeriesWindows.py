@@ -0,0 +1,73 @@
+############################################################################
+## Tool name: BetterBusBuffers
+############################################################################
+''' Tests for the time series windows in BBB_SharedFunctions.
+
+Run with python -m unittest discover (or pytest) from the tests folder.
+'''
+################################################################################
+'''Copyright 2017 Esri
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+       http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.'''
+################################################################################
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import BBB_SharedFunctions
+
+
+class TestMakeTimeSeriesWindows(unittest.TestCase):
+
+    def test_windows(self):
+        self.assertEqual(BBB_SharedFunctions.MakeTimeSeriesWindows("07:00", "08:30", 60),
+                         [("07:00", "08:00"), ("08:00", "08:30")])
+
+    def test_past_midnight(self):
+        self.assertEqual(BBB_SharedFunctions.MakeTimeSeriesWindows("23:00", "25:00", 60),
+                         [("23:00", "24:00"), ("24:00", "25:00")])
+
+    def test_end_before_start(self):
+        with self.assertRaises(BBB_SharedFunctions.CustomError):
+            BBB_SharedFunctions.MakeTimeSeriesWindows("23:00", "01:00", 60)
+
+
+class TestWindowBoundaries(unittest.TestCase):
+
+    def setUp(self):
+        # Visits at each window boundary and in the middle of each window
+        self.stoptimedict = {"s1": [["t%i" % i, stop_time] for i, stop_time in
+                                    enumerate([25200, 27000, 28800, 30600, 32400])]}
+        self.windows = [(25200, 28800), (28800, 32400)]
+
+    def test_split_counts_boundary_once(self):
+        windowdicts = BBB_SharedFunctions.SplitStopTimesByTimeWindow(self.stoptimedict, self.windows)
+        self.assertEqual([[st[1] for st in windowdict["s1"]] for windowdict in windowdicts],
+                         [[25200, 27000], [28800, 30600, 32400]])
+
+    def test_stop_visit_arrays_match_split(self):
+        arrays = BBB_SharedFunctions.StopVisitArrays(
+            (stop_id, list(stoptimes)) for stop_id, stoptimes in self.stoptimedict.items())
+        windowdicts = BBB_SharedFunctions.SplitStopTimesByTimeWindow(self.stoptimedict, self.windows)
+        for idx, (windowdict, (start_sec, end_sec)) in enumerate(zip(windowdicts, self.windows)):
+            include_end = BBB_SharedFunctions.TimeWindowIncludesEnd(idx, self.windows)
+            self.assertEqual(
+                BBB_SharedFunctions.RetrieveStatsForSetOfStops(["s1"], arrays, False, start_sec, end_sec, include_end),
+                BBB_SharedFunctions.RetrieveStatsForSetOfStops(["s1"], windowdict, False, start_sec, end_sec))
+
+    def test_whole_window_counts_every_visit(self):
+        stats = BBB_SharedFunctions.RetrieveStatsForSetOfStops(["s1"], self.stoptimedict, False, 25200, 32400)
+        self.assertEqual(stats[0], 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
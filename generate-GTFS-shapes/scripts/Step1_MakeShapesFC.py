@@ -671,7 +671,7 @@ field will remain blank for all other shapes.")
         f.close ()
 
     #  Generate indices
-    c.execute("CREATE INDEX stoptimes_index_tripIDs ON stop_times (trip_id);")
+    c.execute("CREATE INDEX stoptimes_index_tripIDs ON stop_times (trip_id, stop_sequence);")
     c.execute("CREATE INDEX trips_index_tripIDs ON trips (trip_id);")
     if "shapes" in files_to_sqlize:
         c.execute("CREATE INDEX trips_index_shapeIDs ON trips (shape_id);")
@@ -1349,27 +1349,28 @@ def get_unique_stop_sequences():
     '''Find the unique sequences of stops from stop_times.txt. Each unique sequence is a new shape.'''
     
     arcpy.AddMessage("Calculating unique sequences of stops...")
-    # Find all trip_ids.
+    # Read all the stop_times in a single pass, ordered by trip and stop_sequence, rather
+    # than querying stop_times separately for every trip.
     ct = conn.cursor()
-    tripsfetch = '''
-        SELECT DISTINCT trip_id FROM stop_times
+    stopfetch = '''
+        SELECT trip_id, stop_id FROM stop_times
+        ORDER BY trip_id, stop_sequence
         ;'''
-    ct.execute(tripsfetch)
-    # Select stops in that trip
+    ct.execute(stopfetch)
     global sequence_shape_dict, shape_trip_dict
     sequence_shape_dict = {}
     shape_trip_dict = {}
     shape_id = 1
-    for trip in ct:
-        stop_sequence = get_trip_stop_sequence(trip[0])
-        route_id = trip_route_dict[trip[0]]
+    for trip_id, stops in itertools.groupby(ct, key=operator.itemgetter(0)):
+        stop_sequence = tuple(stop[1] for stop in stops)
+        route_id = trip_route_dict[trip_id]
         sequence_shape_dict_key = (route_id, stop_sequence)
         try:
             sh = sequence_shape_dict[sequence_shape_dict_key]
-            shape_trip_dict.setdefault(sh, []).append(trip[0])
+            shape_trip_dict.setdefault(sh, []).append(trip_id)
         except KeyError:
             sequence_shape_dict[sequence_shape_dict_key] = str(shape_id)
-            shape_trip_dict.setdefault(str(shape_id), []).append(trip[0])
+            shape_trip_dict.setdefault(str(shape_id), []).append(trip_id)
             shape_id += 1
     
     numshapes = shape_id - 1